@@ -0,0 +1,268 @@
+# account_store.py
+import json
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+
+# auth_id & access_token per (user, nomor, provider) disimpan di tabel sendiri, bukan di JSON users.accounts,
+# sehingga login/refresh token cukup menulis satu baris. users.accounts tetap menyimpan daftar nomor
+# dan state alur pembelian per nomor.
+PROVIDER = ("kmsp", "hesda")
+# Perkiraan masa berlaku token jika respons login tidak menyertakan expires_in (detik).
+MASA_BERLAKU_TOKEN = {"kmsp": 7 * 24 * 3600, "hesda": 7 * 24 * 3600}
+FORMAT_WAKTU = '%Y-%m-%d %H:%M:%S'
+SAMPEL_PERKIRAAN = 50     # jumlah penolakan token terakhir yang dipakai memperkirakan umur token
+MIN_SAMPEL_PERKIRAAN = 5
+
+_db_file = None
+
+
+def _sekarang():
+    return datetime.now().strftime(FORMAT_WAKTU)
+
+def _connect():
+    return sqlite3.connect(_db_file)
+
+def inisialisasi(db_file):
+    """Siapkan tabel accounts dan pindahkan token lama dari users.accounts (sekali saja)."""
+    global _db_file
+    _db_file = db_file
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'accounts'")
+        sudah_ada = cursor.fetchone() is not None
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS accounts (
+            user_id INTEGER NOT NULL, phone TEXT NOT NULL, provider TEXT NOT NULL,
+            auth_id TEXT, access_token TEXT, login_timestamp TEXT, expires_at TEXT,
+            PRIMARY KEY (user_id, phone, provider)
+        )''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_accounts_phone ON accounts (phone, provider)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_accounts_expires ON accounts (expires_at)')
+        cursor.execute("PRAGMA table_info(accounts)")
+        kolom = [row[1] for row in cursor.fetchall()]
+        for nama in ("terakhir_sukses", "ditolak_pada"):
+            if nama not in kolom:
+                cursor.execute(f"ALTER TABLE accounts ADD COLUMN {nama} TEXT")
+        # Umur token (detik sejak login) saat ditolak upstream, untuk memperkirakan masa berlaku token.
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS token_ditolak (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, provider TEXT NOT NULL, umur_detik INTEGER NOT NULL, waktu TEXT NOT NULL
+        )''')
+        if not sudah_ada:
+            _migrasi(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+def _migrasi(cursor):
+    cursor.execute("SELECT id, accounts FROM users WHERE accounts IS NOT NULL AND accounts != '{}'")
+    jumlah = 0
+    for user_id, accounts_json in cursor.fetchall():
+        try:
+            accounts = json.loads(accounts_json)
+        except (TypeError, ValueError):
+            continue
+        for phone, data_nomor in accounts.items():
+            for provider in PROVIDER:
+                data = data_nomor.pop(provider, None) if isinstance(data_nomor, dict) else None
+                if not data:
+                    continue
+                login = expires_at = None
+                try:
+                    waktu_login = datetime.fromisoformat(data['login_timestamp'])
+                    login = waktu_login.strftime(FORMAT_WAKTU)
+                    expires_at = (waktu_login + timedelta(seconds=MASA_BERLAKU_TOKEN[provider])).strftime(FORMAT_WAKTU)
+                except (KeyError, TypeError, ValueError):
+                    pass
+                cursor.execute(
+                    "INSERT OR REPLACE INTO accounts (user_id, phone, provider, auth_id, access_token, login_timestamp, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (user_id, phone, provider, data.get('auth_id'), data.get('access_token'), login, expires_at)
+                )
+                jumlah += 1
+        cursor.execute("UPDATE users SET accounts = ? WHERE id = ?", (json.dumps(accounts), user_id))
+    if jumlah:
+        logging.info(f"{jumlah} token akun dipindahkan dari users.accounts ke tabel accounts.")
+
+def simpan_auth_id(user_id, phone, provider, auth_id):
+    """Simpan auth_id hasil request OTP (token lama untuk nomor ini tetap berlaku sampai login berhasil)."""
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO accounts (user_id, phone, provider, auth_id) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id, phone, provider) DO UPDATE SET auth_id = excluded.auth_id",
+            (int(user_id), phone, provider, auth_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def simpan_token(user_id, phone, provider, access_token, masa_berlaku=None):
+    """Simpan access_token hasil login OTP beserta waktu login dan perkiraan kedaluwarsanya."""
+    try:
+        masa_berlaku = int(masa_berlaku)
+    except (TypeError, ValueError):
+        masa_berlaku = 0
+    sekarang = datetime.now()
+    expires_at = sekarang + timedelta(seconds=masa_berlaku if masa_berlaku > 0 else MASA_BERLAKU_TOKEN[provider])
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO accounts (user_id, phone, provider, access_token, login_timestamp, expires_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id, phone, provider) DO UPDATE SET access_token = excluded.access_token, "
+            "login_timestamp = excluded.login_timestamp, expires_at = excluded.expires_at, "
+            "terakhir_sukses = NULL, ditolak_pada = NULL",
+            (int(user_id), phone, provider, access_token, sekarang.strftime(FORMAT_WAKTU), expires_at.strftime(FORMAT_WAKTU))
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def auth_id(user_id, phone, provider):
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT auth_id FROM accounts WHERE user_id = ? AND phone = ? AND provider = ?", (int(user_id), phone, provider)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+def token(user_id, phone, provider):
+    """access_token milik user untuk nomor & provider ini, atau None jika belum login / sudah kedaluwarsa."""
+    if not phone:
+        return None
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT access_token FROM accounts WHERE user_id = ? AND phone = ? AND provider = ? "
+            "AND access_token IS NOT NULL AND (expires_at IS NULL OR expires_at > ?)",
+            (int(user_id), phone, provider, _sekarang())
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+def token_nomor(phone, provider):
+    """(user_id, access_token) dari user mana pun yang login terakhir dengan nomor ini (dipakai admin), atau (None, None)."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT user_id, access_token FROM accounts WHERE phone = ? AND provider = ? "
+            "AND access_token IS NOT NULL AND (expires_at IS NULL OR expires_at > ?) "
+            "ORDER BY login_timestamp DESC LIMIT 1",
+            (phone, provider, _sekarang())
+        ).fetchone()
+    finally:
+        conn.close()
+    return (str(row[0]), row[1]) if row else (None, None)
+
+def status_nomor(user_id, phone):
+    """{provider: (punya token berlaku, login_timestamp)} untuk tampilan Akun Saya."""
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT provider, access_token IS NOT NULL AND (expires_at IS NULL OR expires_at > ?), login_timestamp "
+            "FROM accounts WHERE user_id = ? AND phone = ?",
+            (_sekarang(), int(user_id), phone)
+        ).fetchall()
+    finally:
+        conn.close()
+    return {provider: (bool(aktif), login) for provider, aktif, login in rows}
+
+def info_token(phone, provider, access_token):
+    """(login_timestamp, terakhir_sukses) sebagai datetime (atau None) untuk token ini, atau None jika tidak tersimpan."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT login_timestamp, terakhir_sukses FROM accounts WHERE phone = ? AND provider = ? AND access_token = ? "
+            "ORDER BY login_timestamp DESC LIMIT 1",
+            (phone, provider, access_token)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return tuple(_parse_waktu(nilai) for nilai in row)
+
+def _parse_waktu(nilai):
+    try:
+        return datetime.fromisoformat(nilai)
+    except (TypeError, ValueError):
+        return None
+
+def tandai_sukses(phone, provider, access_token):
+    """Catat bahwa token baru saja diterima upstream."""
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE accounts SET terakhir_sukses = ? WHERE phone = ? AND provider = ? AND access_token = ?",
+            (_sekarang(), phone, provider, access_token)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def tandai_ditolak(phone, provider, access_token):
+    """Token ditolak upstream: anggap kedaluwarsa sekarang (token() tidak lagi mengembalikannya) dan catat umurnya."""
+    sekarang = _sekarang()
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT login_timestamp FROM accounts WHERE phone = ? AND provider = ? AND access_token = ? AND ditolak_pada IS NULL",
+            (phone, provider, access_token)
+        ).fetchall()
+        if not rows:
+            return
+        conn.execute(
+            "UPDATE accounts SET ditolak_pada = ?, expires_at = ? WHERE phone = ? AND provider = ? AND access_token = ?",
+            (sekarang, sekarang, phone, provider, access_token)
+        )
+        login = _parse_waktu(rows[0][0])
+        if login is not None:
+            conn.execute(
+                "INSERT INTO token_ditolak (provider, umur_detik, waktu) VALUES (?, ?, ?)",
+                (provider, int((datetime.now() - login).total_seconds()), sekarang)
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    logging.info(f"Token {provider} untuk nomor {phone} ditolak upstream, ditandai kedaluwarsa.")
+
+def perkiraan_umur(provider):
+    """Median umur token (detik) saat ditolak dari penolakan terakhir, atau None jika sampel belum cukup."""
+    conn = _connect()
+    try:
+        umur = sorted(row[0] for row in conn.execute(
+            "SELECT umur_detik FROM token_ditolak WHERE provider = ? ORDER BY id DESC LIMIT ?", (provider, SAMPEL_PERKIRAAN)
+        ))
+    finally:
+        conn.close()
+    if len(umur) < MIN_SAMPEL_PERKIRAAN:
+        return None
+    return umur[len(umur) // 2]
+
+def kedaluwarsa(sampai=None):
+    """Baris (user_id, phone, provider, expires_at) yang tokennya sudah kedaluwarsa pada `sampai` (default sekarang)."""
+    conn = _connect()
+    try:
+        return conn.execute(
+            "SELECT user_id, phone, provider, expires_at FROM accounts WHERE expires_at <= ? AND access_token IS NOT NULL",
+            ((sampai or datetime.now()).strftime(FORMAT_WAKTU),)
+        ).fetchall()
+    finally:
+        conn.close()
+
+def hapus(user_id, phone=None):
+    """Hapus token satu nomor milik user, atau semua nomornya jika phone None."""
+    conn = _connect()
+    try:
+        if phone is None:
+            conn.execute("DELETE FROM accounts WHERE user_id = ?", (int(user_id),))
+        else:
+            conn.execute("DELETE FROM accounts WHERE user_id = ? AND phone = ?", (int(user_id), phone))
+        conn.commit()
+    finally:
+        conn.close()
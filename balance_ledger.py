@@ -0,0 +1,70 @@
+# balance_ledger.py
+import logging
+import sqlite3
+from datetime import datetime
+
+# Semua perubahan saldo lewat sini: satu transaksi SQLite berisi UPDATE bersyarat pada users.balance
+# dan satu baris append-only di balance_ledger. Kunci idempotensi (opsional) membuat aksi yang sama
+# (mis. tombol konfirmasi top up ditekan dua kali) hanya diterapkan sekali.
+_db_file = None
+
+
+class SaldoTidakCukup(ValueError):
+    """Debit ditolak karena saldo user di database lebih kecil dari jumlah yang dipotong."""
+
+
+def inisialisasi(db_file):
+    """Siapkan tabel balance_ledger."""
+    global _db_file
+    _db_file = db_file
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, delta INTEGER NOT NULL,
+            saldo_setelah INTEGER NOT NULL, jenis TEXT NOT NULL, kunci TEXT UNIQUE, waktu TEXT NOT NULL
+        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger (user_id, id)')
+        conn.commit()
+    finally:
+        conn.close()
+
+def ubah(user_id, delta, jenis, kunci=None):
+    """Terapkan delta ke saldo user secara atomik; kembalikan (saldo_setelah, diterapkan_sekarang).
+
+    Debit (delta < 0) hanya berhasil jika saldo mencukupi, selain itu SaldoTidakCukup dilempar.
+    Jika kunci sudah pernah dipakai, tidak ada yang diubah dan saldo_setelah dari baris lama dikembalikan.
+    KeyError jika user belum ada di tabel users.
+    """
+    conn = sqlite3.connect(_db_file, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if kunci is not None:
+            row = conn.execute("SELECT saldo_setelah FROM balance_ledger WHERE kunci = ?", (kunci,)).fetchone()
+            if row is not None:
+                conn.execute("ROLLBACK")
+                logging.info(f"Perubahan saldo {jenis} user {user_id} dengan kunci {kunci} sudah pernah diterapkan, dilewati.")
+                return row[0], False
+        if delta < 0:
+            cursor = conn.execute("UPDATE users SET balance = balance + ? WHERE id = ? AND balance >= ?", (delta, int(user_id), -delta))
+        else:
+            cursor = conn.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (delta, int(user_id)))
+        if cursor.rowcount == 0:
+            ada = conn.execute("SELECT 1 FROM users WHERE id = ?", (int(user_id),)).fetchone()
+            conn.execute("ROLLBACK")
+            if ada is None:
+                raise KeyError(user_id)
+            raise SaldoTidakCukup(f"Saldo user {user_id} tidak cukup untuk dipotong Rp{-delta:,}.")
+        saldo = conn.execute("SELECT balance FROM users WHERE id = ?", (int(user_id),)).fetchone()[0]
+        conn.execute(
+            "INSERT INTO balance_ledger (user_id, delta, saldo_setelah, jenis, kunci, waktu) VALUES (?, ?, ?, ?, ?, ?)",
+            (int(user_id), delta, saldo, jenis, kunci, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        conn.execute("COMMIT")
+        return saldo, True
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
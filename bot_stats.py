@@ -0,0 +1,79 @@
+# bot_stats.py
+import logging
+import sqlite3
+from datetime import datetime
+
+# Counter statistik penjualan yang diperbarui tiap kali transaksi dicatat, sehingga menu user/admin
+# cukup membaca angka tanpa memindai tabel transactions. Nilai awal dihitung sekali saat startup.
+_total = {"berhasil": 0, "gagal": 0}
+# package (kode atau nama) -> {"berhasil", "gagal", "pendapatan"}
+_per_paket = {}
+# "YYYY-MM-DD" -> {"berhasil", "gagal", "pendapatan"}
+_per_hari = {}
+
+
+def _hasil_pembelian(tx_type, status):
+    """'berhasil' / 'gagal' untuk transaksi pembelian, None untuk transaksi lain (top up, refund, info)."""
+    if not (tx_type or "").startswith("Pembelian"):
+        return None
+    status = status or ""
+    if status.startswith(("Berhasil", "Sukses")):
+        return "berhasil"
+    if status.startswith(("Gagal", "Pending")):
+        return "gagal"
+    return None
+
+def _tambah(hasil, paket, tanggal, jumlah, pendapatan):
+    _total[hasil] += jumlah
+    for wadah, kunci in ((_per_paket, paket), (_per_hari, tanggal)):
+        counter = wadah.setdefault(kunci, {"berhasil": 0, "gagal": 0, "pendapatan": 0})
+        counter[hasil] += jumlah
+        if hasil == "berhasil":
+            counter["pendapatan"] += pendapatan
+
+def muat(db_file):
+    """Hitung nilai awal counter dari tabel transactions (sekali, dengan GROUP BY)."""
+    _total.update(berhasil=0, gagal=0)
+    _per_paket.clear()
+    _per_hari.clear()
+    conn = sqlite3.connect(db_file)
+    try:
+        rows = conn.execute('''
+        SELECT type, status, COALESCE(package_code, package_name, 'lainnya'), substr(timestamp, 1, 10), COUNT(*), SUM(ABS(amount))
+        FROM transactions WHERE type LIKE 'Pembelian%'
+        GROUP BY type, status, 3, 4
+        ''').fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Gagal memuat statistik transaksi: {e}")
+        return
+    finally:
+        conn.close()
+    for tx_type, status, paket, tanggal, jumlah, pendapatan in rows:
+        hasil = _hasil_pembelian(tx_type, status)
+        if hasil:
+            _tambah(hasil, paket, tanggal, jumlah, pendapatan or 0)
+    logging.info(f"Statistik transaksi dimuat: {_total['berhasil']} berhasil, {_total['gagal']} gagal.")
+
+def catat(tx):
+    """Perbarui counter dari satu transaksi yang baru dicatat."""
+    hasil = _hasil_pembelian(tx.get("type"), tx.get("status"))
+    if not hasil:
+        return
+    paket = tx.get("package_code") or tx.get("package_id") or tx.get("package_name") or "lainnya"
+    tanggal = (tx.get("timestamp") or datetime.now().strftime('%Y-%m-%d'))[:10]
+    _tambah(hasil, paket, tanggal, 1, abs(tx.get("amount") or 0))
+
+def total_berhasil():
+    return _total["berhasil"]
+
+def total_gagal():
+    return _total["gagal"]
+
+def harian(tanggal=None):
+    """Counter satu hari (default hari ini): {"berhasil", "gagal", "pendapatan"}."""
+    tanggal = tanggal or datetime.now().strftime('%Y-%m-%d')
+    return dict(_per_hari.get(tanggal, {"berhasil": 0, "gagal": 0, "pendapatan": 0}))
+
+def per_paket(batas=10):
+    """Paket dengan pembelian berhasil terbanyak: [(paket, counter), ...]."""
+    return sorted(_per_paket.items(), key=lambda item: item[1]["berhasil"], reverse=True)[:batas]
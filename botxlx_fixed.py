@@ -2,13 +2,31 @@ import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
 from telegram.helpers import escape_markdown
-import requests
+import httpx
+import http_client
+import broadcast_engine
+import bot_stats
+import panel_balance
+import provider_client
+import endpoint_health
+import package_catalog
+import purchase_jobs
+import purchase_queue
+import retry_engine
+import callback_router
+import flow_scheduler
+import status_message
+import step_router
+import user_index
+import user_repository
+import account_store
+import balance_ledger
+import token_validity
 from datetime import datetime, timedelta, timezone
 import json
 from datetime import datetime, timedelta
 import os
 import re
-import signal
 import sys
 import asyncio
 import math
@@ -41,50 +59,41 @@ def inisialisasi_database():
     )''')
     cursor.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
     cursor.execute('CREATE TABLE IF NOT EXISTS blocked_users (user_id INTEGER PRIMARY KEY)')
-    conn.commit()
-    conn.close()
-    logging.info("Database SQLite berhasil diinisialisasi.")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance, id)')
+    user_repository.siapkan_tabel(cursor)
+
+    # Versi lama menulis ID Telegram ke kolom tambahan `user_id` sehingga setiap simpan menambah baris duplikat.
+    # Ambil baris terbaru per user, jadikan `id` = ID Telegram, dan buang sisanya.
+    cursor.execute("PRAGMA table_info(users)")
+    if 'user_id' in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("SELECT MAX(id), user_id FROM users WHERE user_id IS NOT NULL GROUP BY user_id")
+        for row_id, telegram_id in cursor.fetchall():
+            cursor.execute("DELETE FROM users WHERE user_id = ? AND id != ?", (telegram_id, row_id))
+            cursor.execute("UPDATE users SET id = ?, user_id = NULL WHERE id = ?", (telegram_id, row_id))
 
-def simpan_data_ke_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    for user_id_str, details in user_data["registered_users"].items():
-        cursor.execute('''
-        INSERT OR REPLACE INTO users (id, first_name, username, balance, accounts, transactions, selected_hesdapkg_ids, selected_30h_pkg_ids)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            int(user_id_str), details.get('first_name'), details.get('username'),
-            details.get('balance', 0), json.dumps(details.get('accounts', {})),
-            json.dumps(details.get('transactions', [])), json.dumps(details.get('selected_hesdapkg_ids', [])),
-            json.dumps(details.get('selected_30h_pkg_ids', []))
-        ))
-    cursor.execute("DELETE FROM blocked_users")
-    if user_data.get("blocked_users"):
-        cursor.executemany("INSERT INTO blocked_users (user_id) VALUES (?)", [(uid,) for uid in user_data["blocked_users"]])
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, timestamp TEXT NOT NULL,
+        type TEXT, status TEXT, package_code TEXT, package_name TEXT, phone TEXT,
+        amount INTEGER DEFAULT 0, balance_after_tx INTEGER, admin_id INTEGER
+    )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user_time ON transactions (user_id, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_status ON transactions (status)')
+
+    # Pindahkan riwayat lama dari kolom JSON users.transactions ke tabel transactions (sekali saja).
+    cursor.execute("SELECT id, transactions FROM users WHERE transactions IS NOT NULL AND transactions != '[]'")
+    for telegram_id, transactions_json in cursor.fetchall():
+        try:
+            riwayat_lama = json.loads(transactions_json)
+        except json.JSONDecodeError:
+            logging.warning(f"Riwayat transaksi lama user {telegram_id} tidak valid, dilewati.")
+            riwayat_lama = []
+        cursor.executemany(SQL_INSERT_TRANSAKSI, [_baris_transaksi(telegram_id, tx) for tx in riwayat_lama])
+        cursor.execute("UPDATE users SET transactions = '[]' WHERE id = ?", (telegram_id,))
     conn.commit()
     conn.close()
-    logging.info("Data berhasil disimpan ke SQLite.")
+    logging.info("Database SQLite berhasil diinisialisasi.")
 
-def muat_data_dari_db():
-    global user_data
-    user_data = {"registered_users": {}, "blocked_users": [], "custom_packages": {}}
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    # PERBAIKAN: Menggunakan nama kolom yang benar ('id')
-    cursor.execute("SELECT id, first_name, username, balance, accounts, transactions, selected_hesdapkg_ids, selected_30h_pkg_ids FROM users")
-    for row in cursor.fetchall():
-        user_id_str = str(row[0])
-        user_data["registered_users"][user_id_str] = {
-            "first_name": row[1], "username": row[2], "balance": row[3],
-            "accounts": json.loads(row[4] or '{}'),
-            "transactions": json.loads(row[5] or '[]'),
-            "selected_hesdapkg_ids": json.loads(row[6] or '[]'),
-            "selected_30h_pkg_ids": json.loads(row[7] or '[]')
-        }
-    cursor.execute("SELECT user_id FROM blocked_users")
-    user_data["blocked_users"] = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    logging.info(f"Data dari SQLite berhasil dimuat. Total {len(user_data['registered_users'])} user.")
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO,
@@ -208,6 +217,26 @@ THIRTY_H_PACKAGES = [
     {"id": "XLUNLITURBOHSTANDARD7H_P", "name": "STANDARD 7H", "price_bot": 200},
 ]
 
+def _bangun_registry_paket(daftar_paket, kunci, provider, payment_method):
+    """Bangun dict kode -> metadata paket sekali di awal, supaya flow tidak perlu scan list per paket."""
+    registry = {}
+    for pkg in daftar_paket:
+        code = pkg[kunci]
+        harga_info = CUSTOM_PACKAGE_PRICES.get(code, {})
+        registry[code] = {
+            **pkg,
+            "code": code,
+            "display_name": harga_info.get("display_name", pkg["name"]),
+            "price_bot": pkg.get("price_bot", harga_info.get("price_bot", 0)),
+            "provider": provider,
+            "payment_method": payment_method,
+        }
+    return registry
+
+ADD_ON_REGISTRY = _bangun_registry_paket(ADD_ON_SEQUENCE, "code", "kmsp", "BALANCE")
+HESDA_REGISTRY = _bangun_registry_paket(HESDA_PACKAGES, "id", "hesda", "PULSA")
+THIRTY_H_REGISTRY = _bangun_registry_paket(THIRTY_H_PACKAGES, "id", "kmsp", "BALANCE")
+
 MIN_BALANCE_FOR_PURCHASE = 5000
 MIN_TOP_UP_AMOUNT = 5000
 
@@ -249,51 +278,85 @@ async def qris_expiration_job(context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logging.warning(f"Gagal mengedit atau menghapus pesan teks QRIS {qris_message_id} untuk user {user_id}: {e}")
 
-def simpan_data_ke_db():
+user_kotor = set()
+_blocked_users_tersimpan = set()
+_custom_packages_tersimpan = {}
+
+def tandai_user_berubah(*user_ids):
+    """Catat user yang datanya berubah agar ikut ditulis pada simpan_data_ke_db() berikutnya."""
+    for uid in user_ids:
+        if uid is not None:
+            user_kotor.add(str(uid))
+
+def _serialisasi_custom_package(details):
+    return json.dumps(details, sort_keys=True)
+
+def simpan_data_ke_db(*user_ids):
+    """Tulis ke SQLite hanya user, daftar blokir, dan paket kustom yang berubah sejak simpan terakhir."""
+    global _blocked_users_tersimpan, _custom_packages_tersimpan
+    tandai_user_berubah(*user_ids)
+
+    blocked_sekarang = set(user_data.get("blocked_users", []))
+    blok_baru = blocked_sekarang - _blocked_users_tersimpan
+    blok_dilepas = _blocked_users_tersimpan - blocked_sekarang
+
+    custom_packages_sekarang = {
+        code: _serialisasi_custom_package(details) for code, details in user_data.get("custom_packages", {}).items()
+    }
+    paket_berubah = [code for code, serial in custom_packages_sekarang.items() if _custom_packages_tersimpan.get(code) != serial]
+    paket_dihapus = [code for code in _custom_packages_tersimpan if code not in custom_packages_sekarang]
+    if paket_berubah or paket_dihapus:
+        bangun_indeks_harga()
+
+    users_to_flush = list(user_kotor)
+    if not (users_to_flush or blok_baru or blok_dilepas or paket_berubah or paket_dihapus):
+        return
+
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
+    try:
+        user_data["registered_users"].tulis(cursor, users_to_flush)
+
+        if blok_baru:
+            cursor.executemany("INSERT OR IGNORE INTO blocked_users (user_id) VALUES (?)", [(uid,) for uid in blok_baru])
+        if blok_dilepas:
+            cursor.executemany("DELETE FROM blocked_users WHERE user_id = ?", [(uid,) for uid in blok_dilepas])
+
+        for code in paket_berubah:
+            details = user_data["custom_packages"][code]
+            cursor.execute('''
+            INSERT OR REPLACE INTO custom_packages (code, name, price, description, payment_methods, ewallet_fee)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (
+                code,
+                details['name'],
+                details['price'],
+                details.get('description', ''),
+                json.dumps(details.get('payment_methods', [])),
+                details.get('ewallet_fee', 0)
+            ))
+        if paket_dihapus:
+            cursor.executemany("DELETE FROM custom_packages WHERE code = ?", [(code,) for code in paket_dihapus])
+
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"Gagal menyimpan data ke SQLite, perubahan akan dicoba lagi pada simpan berikutnya: {e}")
+        return
+    finally:
+        conn.close()
 
-    for user_id_str, details in user_data["registered_users"].items():
-        cursor.execute('''
-        INSERT OR REPLACE INTO users (user_id, first_name, username, balance, accounts, transactions, selected_hesdapkg_ids, selected_30h_pkg_ids)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            int(user_id_str),
-            details.get('first_name', 'N/A'),
-            details.get('username', 'N/A'),
-            details.get('balance', 0),
-            json.dumps(details.get('accounts', {})),
-            json.dumps(details.get('transactions', [])),
-            json.dumps(details.get('selected_hesdapkg_ids', [])),
-            json.dumps(details.get('selected_30h_pkg_ids', []))
-        ))
-    
-    cursor.execute("DELETE FROM blocked_users")
-    if user_data["blocked_users"]:
-        cursor.executemany("INSERT INTO blocked_users (user_id) VALUES (?)", [(uid,) for uid in user_data["blocked_users"]])
-
-    cursor.execute("DELETE FROM custom_packages")
-    if user_data["custom_packages"]:
-        package_list = [
-            (
-                code, 
-                details['name'], 
-                details['price'], 
-                details.get('description', ''), 
-                json.dumps(details.get('payment_methods', []))
-            ) 
-            for code, details in user_data["custom_packages"].items()
-        ]
-        cursor.executemany("INSERT INTO custom_packages (code, name, price, description, payment_methods) VALUES (?, ?, ?, ?, ?)", package_list)
-
-    conn.commit()
-    conn.close()
-    logging.info("Data berhasil disimpan ke SQLite.")
+    user_kotor.difference_update(users_to_flush)
+    user_data["registered_users"].selesai_tulis(users_to_flush)
+    _blocked_users_tersimpan = blocked_sekarang
+    _custom_packages_tersimpan = custom_packages_sekarang
+    logging.info(f"Data berhasil disimpan ke SQLite ({len(users_to_flush)} user, {len(blok_baru) + len(blok_dilepas)} blokir, {len(paket_berubah) + len(paket_dihapus)} paket kustom).")
 
 def muat_data_dari_db():
-    global user_data
+    global user_data, _blocked_users_tersimpan, _custom_packages_tersimpan
+    # User tidak dimuat semua di sini: UserRepository mengambil tiap user dari SQLite saat pertama diakses.
     user_data = {
-        "registered_users": {},
+        "registered_users": user_repository.UserRepository(DB_FILE, user_kotor),
         "blocked_users": [],
         "custom_packages": {}
     }
@@ -301,33 +364,261 @@ def muat_data_dari_db():
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM users")
-    for row in cursor.fetchall():
-        user_id_str = str(row[0])
-        user_data["registered_users"][user_id_str] = {
-            "first_name": row[1],
-            "username": row[2],
-            "balance": row[3],
-            "accounts": json.loads(row[4] or '{}'),
-            "transactions": json.loads(row[5] or '[]'),
-            "selected_hesdapkg_ids": json.loads(row[6] or '[]'),
-            "selected_30h_pkg_ids": json.loads(row[7] or '[]')
-        }
-
     cursor.execute("SELECT user_id FROM blocked_users")
     user_data["blocked_users"] = [row[0] for row in cursor.fetchall()]
 
-    cursor.execute("SELECT code, name, price, description, payment_methods FROM custom_packages")
+    cursor.execute("SELECT code, name, price, description, payment_methods, ewallet_fee FROM custom_packages")
     for row in cursor.fetchall():
         user_data["custom_packages"][row[0]] = {
             "name": row[1],
             "price": row[2],
             "description": row[3],
-            "payment_methods": json.loads(row[4] or '[]')
+            "payment_methods": json.loads(row[4] or '[]'),
+            "ewallet_fee": row[5] or 0
         }
     
     conn.close()
-    logging.info(f"📂 Data dari SQLite berhasil dimuat. Total {len(user_data['registered_users'])} user.")
+
+    user_kotor.clear()
+    user_index.atur_sumber(_baris_indeks_user)
+    _blocked_users_tersimpan = set(user_data["blocked_users"])
+    _custom_packages_tersimpan = {
+        code: _serialisasi_custom_package(details) for code, details in user_data["custom_packages"].items()
+    }
+    logging.info(f"📂 Data dari SQLite berhasil dimuat ({len(user_data['blocked_users'])} user diblokir, {len(user_data['custom_packages'])} paket kustom). User dimuat saat dibutuhkan.")
+
+def _baris_indeks_user():
+    """Sumber indeks pencarian user: (id, username, first_name) dari SQLite setelah perubahan tertunda ditulis."""
+    simpan_data_ke_db()
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        return conn.execute("SELECT id, username, first_name FROM users").fetchall()
+    finally:
+        conn.close()
+
+SQL_INSERT_TRANSAKSI = '''
+INSERT INTO transactions (user_id, timestamp, type, status, package_code, package_name, phone, amount, balance_after_tx, admin_id)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+KOLOM_TRANSAKSI = ["timestamp", "type", "status", "package_code", "package_name", "phone", "amount", "balance_after_tx", "admin_id"]
+
+def _baris_transaksi(user_id, tx):
+    return (
+        int(user_id),
+        tx.get("timestamp") or datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        tx.get("type"),
+        tx.get("status"),
+        tx.get("package_code") or tx.get("package_id"),
+        tx.get("package_name"),
+        tx.get("phone"),
+        tx.get("amount", 0),
+        tx.get("balance_after_tx"),
+        tx.get("admin_id")
+    )
+
+def catat_transaksi(user_id, tx):
+    """Tambahkan satu baris transaksi ke tabel transactions (append-only)."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        conn.execute(SQL_INSERT_TRANSAKSI, _baris_transaksi(user_id, tx))
+        conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Gagal mencatat transaksi user {user_id}: {e}. Data: {tx}")
+    else:
+        bot_stats.catat(tx)
+    finally:
+        conn.close()
+
+def _ubah_saldo(user_id, delta, jenis, kunci):
+    if str(user_id) in user_kotor:
+        # Baris user harus sudah ada di SQLite sebelum saldo diubah lewat ledger.
+        simpan_data_ke_db()
+    saldo, diterapkan = balance_ledger.ubah(user_id, delta, jenis, kunci)
+    user_entry = user_data["registered_users"].get(str(user_id))
+    if user_entry is not None:
+        user_entry["balance"] = saldo
+    return diterapkan
+
+def debit_saldo(user_id, jumlah, jenis, kunci=None):
+    """Potong saldo lewat ledger (UPDATE bersyarat); False jika saldo tidak cukup atau kunci sudah pernah dipakai."""
+    try:
+        return _ubah_saldo(user_id, -jumlah, jenis, kunci)
+    except balance_ledger.SaldoTidakCukup as e:
+        logging.warning(str(e))
+        return False
+
+def kredit_saldo(user_id, jumlah, jenis, kunci=None):
+    """Tambah saldo lewat ledger; False jika jumlah tidak positif atau kunci sudah pernah dipakai."""
+    if jumlah <= 0:
+        return False
+    return _ubah_saldo(user_id, jumlah, jenis, kunci)
+
+def kunci_update(update, jenis):
+    """Kunci idempotensi dari update Telegram, agar update yang sama tidak mengubah saldo dua kali."""
+    return f"{jenis}:{update.update_id}"
+
+def pesan_debit_gagal(user_id, jumlah):
+    """Pesan untuk user saat debit_saldo ditolak: saldo tidak cukup, atau kunci sudah dipakai (permintaan sudah diproses)."""
+    saldo = user_data["registered_users"].get(str(user_id), {}).get("balance", 0)
+    if saldo < jumlah:
+        return f"❌ Saldo Anda tidak cukup (dibutuhkan Rp{jumlah:,}). Saldo Anda saat ini: Rp{saldo:,}."
+    return "ℹ️ Permintaan ini sudah diproses sebelumnya."
+
+# Filter riwayat transaksi admin: kunci -> (label tombol, potongan SQL / jumlah hari ke belakang).
+FILTER_STATUS_TRANSAKSI = {
+    "semua": ("Semua", ""),
+    "berhasil": ("Berhasil", " AND (status LIKE 'Berhasil%' OR status LIKE 'Sukses%')"),
+    "gagal": ("Gagal", " AND (status LIKE 'Gagal%' OR status LIKE 'Pending%')"),
+}
+FILTER_PERIODE_TRANSAKSI = {
+    "semua": ("Semua", None),
+    "hari_ini": ("Hari Ini", 0),
+    "7_hari": ("7 Hari", 7),
+    "30_hari": ("30 Hari", 30),
+}
+
+def ambil_transaksi_user(user_id, limit, arah=None, kursor_id=None, status="semua", periode="semua"):
+    """Satu halaman transaksi user, terbaru lebih dulu, dengan keyset (timestamp, id) di atas indeks (user_id, timestamp).
+
+    arah "n" mengambil transaksi setelah (lebih lama dari) transaksi kursor_id, "p" sebelum (lebih baru).
+    Mengembalikan (daftar transaksi dengan key "id", ada_lagi_searah).
+    """
+    sql = f"SELECT id, {', '.join(KOLOM_TRANSAKSI)} FROM transactions WHERE user_id = ?" + FILTER_STATUS_TRANSAKSI[status][1]
+    params = [int(user_id)]
+    hari = FILTER_PERIODE_TRANSAKSI[periode][1]
+    if hari is not None:
+        sql += " AND timestamp >= ?"
+        params.append((datetime.now() - timedelta(days=hari)).strftime('%Y-%m-%d'))
+    if arah == "n":
+        sql += " AND (timestamp, id) < (SELECT timestamp, id FROM transactions WHERE id = ?)"
+        params.append(kursor_id)
+    elif arah == "p":
+        sql += " AND (timestamp, id) > (SELECT timestamp, id FROM transactions WHERE id = ?)"
+        params.append(kursor_id)
+    sql += " ORDER BY timestamp ASC, id ASC LIMIT ?" if arah == "p" else " ORDER BY timestamp DESC, id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+    ada_lagi = len(rows) > limit
+    rows = rows[:limit]
+    if arah == "p":
+        rows.reverse()
+    return [{kolom: nilai for kolom, nilai in zip(["id"] + KOLOM_TRANSAKSI, row) if nilai is not None} for row in rows], ada_lagi
+
+def hitung_transaksi_user(user_id):
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM transactions WHERE user_id = ?", (int(user_id),))
+    total = cursor.fetchone()[0]
+    conn.close()
+    return total
+
+# Keyset pagination daftar user admin: kursor = kunci urut baris batas halaman, "n" = halaman setelahnya, "p" = sebelumnya.
+SQL_HALAMAN_USER = {
+    ("saldo", None): "ORDER BY balance DESC, id DESC",
+    ("saldo", "n"): "WHERE (balance, id) < (?, ?) ORDER BY balance DESC, id DESC",
+    ("saldo", "p"): "WHERE (balance, id) > (?, ?) ORDER BY balance ASC, id ASC",
+    ("id", None): "ORDER BY id ASC",
+    ("id", "n"): "WHERE id > ? ORDER BY id ASC",
+    ("id", "p"): "WHERE id < ? ORDER BY id DESC",
+}
+
+def ambil_halaman_user(urutan, limit, arah=None, kursor=()):
+    """Satu halaman baris (id, first_name, username, balance) urut saldo atau id; kembalikan (baris, ada_lagi_searah)."""
+    simpan_data_ke_db()
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        rows = conn.execute(
+            f"SELECT id, first_name, username, balance FROM users {SQL_HALAMAN_USER[(urutan, arah)]} LIMIT ?",
+            (*kursor, limit + 1)
+        ).fetchall()
+    finally:
+        conn.close()
+    ada_lagi = len(rows) > limit
+    rows = rows[:limit]
+    if arah == "p":
+        rows.reverse()
+    return rows, ada_lagi
+
+def parse_kursor_halaman(data, prefix):
+    """Pecah callback '<prefix><halaman>_<arah>_<kunci...>' menjadi (halaman, arah, kursor int)."""
+    bagian = data[len(prefix):].split('_')
+    return int(bagian[0]), bagian[1], tuple(int(nilai) for nilai in bagian[2:])
+
+# Key context.user_data yang membentuk state tiap flow pembelian multi-langkah. Key pesan status
+# sengaja tidak ikut: setelah restart flow membuat pesan status baru.
+JOB_STATE_KEYS = {
+    purchase_jobs.JENIS_XCS: ('automatic_xcs_flow_state', 'total_automatic_xcs_price'),
+    purchase_jobs.JENIS_XUTP: ('xutp_purchase_phone', 'xutp_purchase_token', 'xutp_purchase_payment_method'),
+    purchase_jobs.JENIS_HESDA_BATCH: ('phone_for_hesda_batch', 'packages_to_process_hesda_batch', 'current_batch_index_hesda',
+                                      'current_hesda_batch_results', 'total_hesdapkg_batch_price'),
+    purchase_jobs.JENIS_30H_BATCH: ('phone_for_30h_batch', 'token_for_30h_batch', 'packages_to_process_30h_batch',
+                                    'current_batch_index_30h', 'current_30h_batch_results', 'total_30h_batch_price'),
+}
+JOB_NAMA = {
+    purchase_jobs.JENIS_XCS: "XCS ADD ON Otomatis",
+    purchase_jobs.JENIS_XUTP: "XUTP Otomatis",
+    purchase_jobs.JENIS_HESDA_BATCH: "Batch BYPAS",
+    purchase_jobs.JENIS_30H_BATCH: "Batch 30H",
+}
+JOB_RESUME_MAX_AGE = timedelta(hours=6)   # job lebih tua dari ini saat startup langsung direfund
+
+def checkpoint_job(context, user_id, jenis, dana_tertahan=0):
+    """Simpan state flow pembelian ke SQLite agar bisa dilanjutkan/direfund setelah restart."""
+    state = {key: context.user_data[key] for key in JOB_STATE_KEYS[jenis] if key in context.user_data}
+    purchase_jobs.simpan(user_id, jenis, state, dana_tertahan)
+
+def refund_job_pembelian(user_id, jenis, job, user_data_context=None):
+    """Kembalikan saldo yang tertahan di job, hapus job & state flow-nya; kembalikan nominal refund."""
+    dana = job.get("dana_tertahan", 0)
+    user_entry = user_data["registered_users"].get(str(user_id))
+    if dana > 0 and user_entry is not None and kredit_saldo(user_id, dana, "refund_job", f"refund_job:{user_id}:{jenis}:{job.get('dibuat_pada')}"):
+        catat_transaksi(user_id, {
+            "type": f"Refund {JOB_NAMA.get(jenis, jenis)} (Terputus)", "amount": dana, "status": "Sukses",
+            "phone": job["state"].get('xutp_purchase_phone') or job["state"].get(f"phone_for_{jenis}")
+                     or job["state"].get('automatic_xcs_flow_state', {}).get('phone'),
+            "balance_after_tx": user_entry["balance"]
+        })
+    if jenis == purchase_jobs.JENIS_XUTP and user_entry is not None:
+        phone = job["state"].get('xutp_purchase_phone')
+        user_entry.get('accounts', {}).get(phone, {}).pop('xutp_flow_state', None)
+    simpan_data_ke_db(user_id)
+    purchase_jobs.hapus(user_id, jenis)
+    if user_data_context is not None:
+        for key in JOB_STATE_KEYS[jenis]:
+            user_data_context.pop(key, None)
+    return dana
+
+async def pulihkan_job_pembelian(application):
+    """Startup: pulihkan state job yang terputus restart dan tawarkan lanjut/refund; job basi langsung direfund."""
+    jobs = purchase_jobs.semua()
+    for job in jobs:
+        user_id, jenis = job["user_id"], job["jenis"]
+        nama = JOB_NAMA.get(jenis, jenis)
+        umur = datetime.now() - datetime.strptime(job["diperbarui_pada"], '%Y-%m-%d %H:%M:%S')
+        try:
+            if umur > JOB_RESUME_MAX_AGE or jenis not in JOB_STATE_KEYS:
+                dana = refund_job_pembelian(user_id, jenis, job)
+                await application.bot.send_message(
+                    user_id, f"⚠️ Pembelian *{nama}* Anda terhenti karena bot dimulai ulang dan sudah terlalu lama untuk dilanjutkan.\n"
+                             f"💰 Saldo Rp{dana:,} telah dikembalikan.", parse_mode="Markdown")
+                continue
+            application.user_data[user_id].update(job["state"])
+            keyboard = [
+                [InlineKeyboardButton("▶️ Lanjutkan", callback_data=f"lanjut_job_{jenis}")],
+                [InlineKeyboardButton(f"↩️ Batalkan & Refund Rp{job['dana_tertahan']:,}", callback_data=f"refund_job_{jenis}")],
+            ]
+            await application.bot.send_message(
+                user_id, f"⚠️ Pembelian *{nama}* Anda terhenti karena bot dimulai ulang.\nLanjutkan dari langkah terakhir atau batalkan dan kembalikan saldo?",
+                parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
+        except Exception as e:
+            logging.error(f"Gagal memulihkan job pembelian {jenis} user {user_id}: {e}", exc_info=True)
+    if jobs:
+        logging.info(f"{len(jobs)} job pembelian tertunda dipulihkan dari SQLite.")
 
 user_data = {}
 package_info = {}
@@ -337,7 +628,12 @@ bot_messages = {}
 login_counter = {}
 
 inisialisasi_database()
+purchase_jobs.inisialisasi(DB_FILE)
+broadcast_engine.inisialisasi(DB_FILE)
+account_store.inisialisasi(DB_FILE)
+balance_ledger.inisialisasi(DB_FILE)
 muat_data_dari_db()
+bot_stats.muat(DB_FILE)
 
 XUTS_PACKAGE_CODE = "XLUNLITURBOSUPERXC_PULSA" 
 XC1PLUS1GB_PULSA_CODE = "XL_XC1PLUS1DISC_PULSA"
@@ -349,15 +645,41 @@ XCP_8GB_DANA_CODE_FOR_XUTP = "c03be70fb3523ac2ac440966d3a5920e"
 XCP_8GB_PULSA_CODE_FOR_XUTP = "bdb392a7aa12b21851960b7e7d54af2c" 
 XCP_8GB_QRIS_CODE_FOR_XUTP = "c03be70fb3523ac2ac440966d3a5920e_QRIS" 
 
+# price_or_fee tetap untuk kode yang tidak mengikuti harga katalog API.
+API_FEE_OVERRIDES = {
+    XC1PLUS1GB_DANA_CODE: 2500,
+    XC1PLUS1GB_PULSA_CODE: 2500,
+    "XLUNLITURBOVIDIO_DANA": 1500,
+    XUTS_PACKAGE_CODE: 0,
+}
+
+indeks_harga = {}
+
+def bangun_indeks_harga():
+    """Bangun ulang index harga per kode paket dari katalog API, CUSTOM_PACKAGE_PRICES, paket kustom dan override fee."""
+    global indeks_harga
+    indeks = {}
+    for code, harga in package_catalog.harga_api().items():
+        indeks[code] = {"price_bot": None, "api_price_or_fee": harga}
+    for code, info in CUSTOM_PACKAGE_PRICES.items():
+        indeks.setdefault(code, {"price_bot": None, "api_price_or_fee": 0})["price_bot"] = info.get("price_bot", 0)
+    for code, details in user_data.get("custom_packages", {}).items():
+        entry = indeks.setdefault(code, {"price_bot": None, "api_price_or_fee": 0})
+        entry["price_bot"] = details.get("price", 0)
+        entry["api_price_or_fee"] = details.get("ewallet_fee", 0) or 0
+    for code, fee in API_FEE_OVERRIDES.items():
+        indeks.setdefault(code, {"price_bot": None, "api_price_or_fee": 0})["api_price_or_fee"] = fee
+    indeks_harga = indeks
+
+def get_api_price_or_fee(package_code):
+    """price_or_fee yang dikirim ke API untuk package_code (0 jika tidak dikenal)."""
+    return indeks_harga.get(package_code, {}).get("api_price_or_fee", 0)
+
+bangun_indeks_harga()
+package_catalog.tambah_listener(bangun_indeks_harga)
+
 def calculate_total_successful_transactions():
-    count = 0
-    all_users = user_data.get("registered_users", {})
-    for user_id, details in all_users.items():
-        transactions = details.get("transactions", [])
-        for tx in transactions:
-            if tx.get("status") == "Berhasil":
-                count += 1
-    return count
+    return bot_stats.total_berhasil()
 
 async def run_automatic_xcs_addon_flow(update, context):
     user_id = update.effective_user.id
@@ -412,12 +734,19 @@ async def run_automatic_xcs_addon_flow(update, context):
                                                               
     reprocessing_queue = automatic_xcs_flow_state['reprocessing_queue']
 
+    if automatic_xcs_flow_state['xcp_8gb_completed']:
+        dana_tertahan = 0
+    else:
+        harga_addon_terproses = sum(ADD_ON_REGISTRY.get(code, {}).get('price_bot', 0) for code in addons_to_process[:current_addon_index])
+        dana_tertahan = max(0, context.user_data.get('total_automatic_xcs_price', 0) - harga_addon_terproses)
+    checkpoint_job(context, user_id, purchase_jobs.JENIS_XCS, dana_tertahan)
+
                                     
     current_status_text = ""
     
     if current_addon_index < len(addons_to_process):
                                       
-        addon_info_current = next((pkg for pkg in ADD_ON_SEQUENCE if pkg['code'] == addons_to_process[current_addon_index]), None)
+        addon_info_current = ADD_ON_REGISTRY.get(addons_to_process[current_addon_index])
         current_addon_name_for_display = addon_info_current['name'] if addon_info_current else "Paket Tidak Dikenal"
         current_status_text = (
             f"Melanjutkan alur XCS ADD ON otomatis untuk *{phone}*...\n"
@@ -459,17 +788,16 @@ async def run_automatic_xcs_addon_flow(update, context):
         status_message_id = msg.message_id
     else:
         try:
-            await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=current_status_text, parse_mode="Markdown")
+            await status_message.perbarui(context, user_id, status_message_id, text=current_status_text, parse_mode="Markdown")
         except Exception as e:
-            if "message is not modified" not in str(e):
-                logging.warning(f"Gagal mengedit pesan status XCS {status_message_id}: {e}.")
+            logging.warning(f"Gagal mengedit pesan status XCS {status_message_id}: {e}.")
 
                                                                          
                                                                             
                                                                          
     if current_addon_index < len(addons_to_process):
         addon_code = addons_to_process[current_addon_index]
-        addon_info = next((pkg for pkg in ADD_ON_SEQUENCE if pkg['code'] == addon_code), None)
+        addon_info = ADD_ON_REGISTRY.get(addon_code)
         
         if not addon_info:
             logging.error(f"Paket ADD ON tidak dikenal ({addon_code}). Melewatkan.")
@@ -479,13 +807,21 @@ async def run_automatic_xcs_addon_flow(update, context):
             return
 
         addon_name = addon_info['name']
-        addon_price = CUSTOM_PACKAGE_PRICES.get(addon_code, {}).get('price_bot', 0)
+        addon_price = addon_info['price_bot']
 
         addon_purchase_result = await execute_single_purchase_30h(
             update, context, user_id, addon_code, addon_name, phone, access_token, "BALANCE", addon_price,
             "automatic_xcs_addon_flow",
-            automatic_xcs_flow_state['addon_pending_retry_count'] + 1
+            automatic_xcs_flow_state.get('addon_attempt', automatic_xcs_flow_state['addon_pending_retry_count'] + 1),
+            prioritas=purchase_queue.PRIORITAS_OTOMATIS
         )
+        if addon_purchase_result.get('ulang_dalam'):
+            # Addon sudah termasuk saldo yang dipotong di awal alur: cukup jadwalkan ulang langkah ini.
+            automatic_xcs_flow_state['addon_attempt'] = addon_purchase_result['attempt']
+            await status_message.perbarui(context, user_id, status_message_id, text=f"⏳ Server sibuk, *{addon_name}* dicoba lagi dalam {int(addon_purchase_result['ulang_dalam'])} detik...", parse_mode="Markdown")
+            flow_scheduler.jadwalkan(context, addon_purchase_result['ulang_dalam'], run_automatic_xcs_addon_flow, update)
+            return
+        automatic_xcs_flow_state.pop('addon_attempt', None)
         addon_results[addon_code] = addon_purchase_result
 
                                                                            
@@ -503,8 +839,8 @@ async def run_automatic_xcs_addon_flow(update, context):
 
                                    
             if remaining_refund > 0:
-                user_data["registered_users"][str(user_id)]["balance"] += remaining_refund
-                simpan_data_ke_db()
+                kredit_saldo(user_id, remaining_refund, "refund")
+                simpan_data_ke_db(user_id)
 
                                               
             user_facing_error = (
@@ -517,7 +853,7 @@ async def run_automatic_xcs_addon_flow(update, context):
             status_message_id = automatic_xcs_flow_state.get('overall_status_message_id')
             if status_message_id:
                 try:
-                    await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=user_facing_error, parse_mode="Markdown")
+                    await status_message.perbarui(context, user_id, status_message_id, text=user_facing_error, parse_mode="Markdown")
                 except Exception:
                     await context.bot.send_message(user_id, user_facing_error, parse_mode="Markdown")
             else:
@@ -525,16 +861,16 @@ async def run_automatic_xcs_addon_flow(update, context):
 
                                              
             del context.user_data['automatic_xcs_flow_state']
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XCS)
             await send_main_menu(update, context)
             return
                                  
 
         if addon_purchase_result['success']:
-            await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=f"✅ Pembelian *{addon_name}* berhasil! Melanjutkan...", parse_mode="Markdown")
+            await status_message.perbarui(context, user_id, status_message_id, text=f"✅ Pembelian *{addon_name}* berhasil! Melanjutkan...", parse_mode="Markdown")
             automatic_xcs_flow_state['addon_pending_retry_count'] = 0
             automatic_xcs_flow_state['current_addon_index'] += 1
-            await asyncio.sleep(10)
-            asyncio.create_task(run_automatic_xcs_addon_flow(update, context))
+            flow_scheduler.jadwalkan(context, 10, run_automatic_xcs_addon_flow, update)
 
         elif addon_purchase_result.get('specific_action') == 'countdown_retry':
             if automatic_xcs_flow_state['flow_has_waited']:
@@ -543,17 +879,15 @@ async def run_automatic_xcs_addon_flow(update, context):
                 failed_attempts_for_reprocess[unique_failure_id] = {
                     "package_code": addon_code, "package_name": addon_name, "price_bot": addon_price, "error_message": "Pending kedua kali, dianggap gagal."
                 }
-                await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=f"⚠️ Pembelian *{addon_name}* pending lagi. Ini dianggap kegagalan dan akan dicoba ulang nanti. Melanjutkan...", parse_mode="Markdown")
+                await status_message.perbarui(context, user_id, status_message_id, text=f"⚠️ Pembelian *{addon_name}* pending lagi. Ini dianggap kegagalan dan akan dicoba ulang nanti. Melanjutkan...", parse_mode="Markdown")
                 automatic_xcs_flow_state['addon_pending_retry_count'] = 0
                 automatic_xcs_flow_state['current_addon_index'] += 1
-                await asyncio.sleep(10)
+                flow_scheduler.jadwalkan(context, 10, run_automatic_xcs_addon_flow, update)
             else:
                 automatic_xcs_flow_state['flow_has_waited'] = True
                 logging.info(f"User {user_id} - {phone}: ADD ON {addon_name} pending. Memulai countdown 10 menit.")
                 countdown_msg = await context.bot.send_message(user_id, f"⏳ Pembelian *{addon_name}* pending. Menunggu 10 menit sebelum mencoba lagi...", parse_mode="Markdown")
-                await asyncio.sleep(600)
-                await countdown_msg.delete()
-            asyncio.create_task(run_automatic_xcs_addon_flow(update, context))
+                flow_scheduler.jadwalkan(context, 600, run_automatic_xcs_addon_flow, update, hapus_pesan_id=countdown_msg.message_id)
         else:
             automatic_xcs_flow_state['addon_pending_retry_count'] += 1
             if automatic_xcs_flow_state['addon_pending_retry_count'] >= MAX_ADDON_PURCHASE_RETRIES:
@@ -562,15 +896,13 @@ async def run_automatic_xcs_addon_flow(update, context):
                 failed_attempts_for_reprocess[unique_failure_id] = {
                     "package_code": addon_code, "package_name": addon_name, "price_bot": addon_price, "error_message": addon_purchase_result.get('error_message', 'Gagal')
                 }
-                await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=f"❌ Pembelian *{addon_name}* gagal total dan dicatat untuk dicoba ulang nanti. Melanjutkan...", parse_mode="Markdown")
+                await status_message.perbarui(context, user_id, status_message_id, text=f"❌ Pembelian *{addon_name}* gagal total dan dicatat untuk dicoba ulang nanti. Melanjutkan...", parse_mode="Markdown")
                 automatic_xcs_flow_state['addon_pending_retry_count'] = 0
                 automatic_xcs_flow_state['current_addon_index'] += 1
-                await asyncio.sleep(10)
             else:
                 logging.info(f"User {user_id} - {phone}: ADD ON {addon_name} gagal. Mencoba lagi.")
-                await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=f"❌ Pembelian *{addon_name}* gagal. Mencoba lagi...", parse_mode="Markdown")
-                await asyncio.sleep(10)
-            asyncio.create_task(run_automatic_xcs_addon_flow(update, context))
+                await status_message.perbarui(context, user_id, status_message_id, text=f"❌ Pembelian *{addon_name}* gagal. Mencoba lagi...", parse_mode="Markdown")
+            flow_scheduler.jadwalkan(context, 10, run_automatic_xcs_addon_flow, update)
         return
 
                                                                          
@@ -583,28 +915,22 @@ async def run_automatic_xcs_addon_flow(update, context):
         automatic_xcs_flow_state['reprocessing_queue'] = list(failed_attempts_for_reprocess.keys())
         
         logging.info(f"User {user_id} - {phone}: Fase 1 selesai, ditemukan {len(failed_attempts_for_reprocess)} kegagalan. Memulai jeda 4 menit.")
-        await context.bot.edit_message_text(
-            chat_id=user_id, message_id=status_message_id, 
+        await status_message.perbarui(
+            context, user_id, status_message_id,
             text="✅ Pemrosesan awal selesai. Ditemukan beberapa paket yang gagal. Akan dicoba lagi setelah jeda.",
             parse_mode="Markdown"
         )
         countdown_seconds = 240
         countdown_msg = await context.bot.send_message(user_id, f"⏳ Jeda 4 menit 0 detik sebelum mencoba ulang...", parse_mode="Markdown")
-        for i in range(countdown_seconds, 0, -1):
-            if i % 15 == 0 or i <= 10:
-                minutes = i // 60
-                seconds = i % 60
-                try:
-                    await context.bot.edit_message_text(
-                        chat_id=user_id, message_id=countdown_msg.message_id,
-                        text=f"⏳ Jeda sebelum mencoba ulang: *{minutes} menit {seconds} detik*"
-                    )
-                except Exception as e:
-                    if "message is not modified" not in str(e): logging.warning(f"Gagal update countdown: {e}")
-            await asyncio.sleep(1)
-        try: await countdown_msg.delete()
-        except Exception: pass
-        asyncio.create_task(run_automatic_xcs_addon_flow(update, context))
+
+        async def tampilkan_countdown(ctx, sisa):
+            await status_message.perbarui(
+                ctx, user_id, countdown_msg.message_id,
+                text=f"⏳ Jeda sebelum mencoba ulang: *{sisa // 60} menit {sisa % 60} detik*"
+            )
+
+        flow_scheduler.jadwalkan_countdown(context, countdown_seconds, 15, tampilkan_countdown, run_automatic_xcs_addon_flow, update,
+                                           hapus_pesan_id=countdown_msg.message_id)
         return
 
                                                                          
@@ -626,28 +952,32 @@ async def run_automatic_xcs_addon_flow(update, context):
             asyncio.create_task(run_automatic_xcs_addon_flow(update, context))
             return
 
-        user_data["registered_users"][str(user_id)]["balance"] -= addon_price_to_retry
-        simpan_data_ke_db()
+        if not debit_saldo(user_id, addon_price_to_retry, "pembelian"):
+            logging.info(f"User {user_id} - {phone}: Saldo tidak cukup untuk percobaan ulang {addon_name_to_retry}, dilewati.")
+            automatic_xcs_flow_state['current_reprocess_id_index'] += 1
+            asyncio.create_task(run_automatic_xcs_addon_flow(update, context))
+            return
+        simpan_data_ke_db(user_id)
         logging.info(f"User {user_id} saldo dipotong Rp{addon_price_to_retry} untuk percobaan ulang ADD ON {addon_name_to_retry}.")
         
         reprocess_result = await execute_single_purchase_30h(
             update, context, user_id, addon_code_to_retry, addon_name_to_retry, phone, access_token, "BALANCE", addon_price_to_retry,
-            "automatic_xcs_addon_flow", current_reprocess_attempt + 1
+            "automatic_xcs_addon_flow", current_reprocess_attempt + 1, prioritas=purchase_queue.PRIORITAS_OTOMATIS,
+            kebijakan=retry_engine.SEKALI
         )
         reprocess_attempts_counter[unique_failure_id_to_retry] += 1
 
         if reprocess_result['success']:
             logging.info(f"User {user_id} - {phone}: Percobaan ulang ADD ON {addon_name_to_retry} berhasil.")
-            await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=f"✅ Percobaan ulang *{addon_name_to_retry}* berhasil!", parse_mode="Markdown")
+            await status_message.perbarui(context, user_id, status_message_id, text=f"✅ Percobaan ulang *{addon_name_to_retry}* berhasil!", parse_mode="Markdown")
                                                                                                    
             del failed_attempts_for_reprocess[unique_failure_id_to_retry]
         else:
             logging.warning(f"User {user_id} - {phone}: Percobaan ulang ADD ON {addon_name_to_retry} masih gagal.")
-            await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=f"❌ Percobaan ulang *{addon_name_to_retry}* masih gagal. Melanjutkan...", parse_mode="Markdown")
+            await status_message.perbarui(context, user_id, status_message_id, text=f"❌ Percobaan ulang *{addon_name_to_retry}* masih gagal. Melanjutkan...", parse_mode="Markdown")
 
         automatic_xcs_flow_state['current_reprocess_id_index'] += 1
-        await asyncio.sleep(10)
-        asyncio.create_task(run_automatic_xcs_addon_flow(update, context))
+        flow_scheduler.jadwalkan(context, 10, run_automatic_xcs_addon_flow, update)
         return
 
                                                                          
@@ -664,15 +994,12 @@ async def run_automatic_xcs_addon_flow(update, context):
         
         logging.info(f"User {user_id}: Memulai putaran proses ulang ke-{automatic_xcs_flow_state['reprocessing_pass_count']}.")
         
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=status_message_id,
+        await status_message.perbarui(
+            context, user_id, status_message_id,
             text=f"⚠️ Beberapa paket masih gagal. Menunggu 1 menit sebelum melakukan upaya terakhir...",
             parse_mode="Markdown"
         )
-        await asyncio.sleep(60)
-        
-        asyncio.create_task(run_automatic_xcs_addon_flow(update, context))
+        flow_scheduler.jadwalkan(context, 60, run_automatic_xcs_addon_flow, update)
         return
 
                                                                          
@@ -685,10 +1012,11 @@ async def run_automatic_xcs_addon_flow(update, context):
                 final_error_text += f"- *{fail_details['package_name']}*: `{fail_details['error_message']}`\n"
             
             final_error_text += f"\nSaldo Anda saat ini: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*."
-            await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=final_error_text, parse_mode="Markdown")
+            await status_message.perbarui(context, user_id, status_message_id, text=final_error_text, parse_mode="Markdown")
             
             del context.user_data['automatic_xcs_flow_state']
-            simpan_data_ke_db()
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XCS)
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
 
@@ -703,7 +1031,7 @@ async def run_automatic_xcs_addon_flow(update, context):
         xcp_8gb_name = CUSTOM_PACKAGE_PRICES.get(xcp_8gb_price_key, {}).get('display_name', 'XCP 8GB')
         xcp_8gb_price = CUSTOM_PACKAGE_PRICES.get(xcp_8gb_price_key, {}).get('price_bot', 0)
         
-        await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=f"Mencoba membeli paket utama *{xcp_8gb_name}* untuk *{phone}*...", parse_mode="Markdown")
+        await status_message.perbarui(context, user_id, status_message_id, text=f"Mencoba membeli paket utama *{xcp_8gb_name}* untuk *{phone}*...", parse_mode="Markdown")
         
         xcp_8gb_purchase_result = await execute_automatic_xc_purchase(
             update, context, user_id, xcp_8gb_code, xcp_8gb_name, phone, access_token, payment_method_xcp_8gb, xcp_8gb_price
@@ -714,13 +1042,14 @@ async def run_automatic_xcs_addon_flow(update, context):
                 f"🎉 *Alur pembelian XCS ADD ON otomatis untuk *{phone}* telah selesai!*\n\n"
                 f"Semua paket Add-On dan paket utama *{xcp_8gb_name}* berhasil dibeli."
             )
-            await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=final_summary_text, parse_mode="Markdown")
+            await status_message.perbarui(context, user_id, status_message_id, text=final_summary_text, parse_mode="Markdown")
             automatic_xcs_flow_state['xcp_8gb_completed'] = True
         else:
-            await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=f"❌ Pembelian paket utama *{xcp_8gb_name}* gagal: {xcp_8gb_purchase_result['error_message']}. Alur dihentikan.", parse_mode="Markdown")
+            await status_message.perbarui(context, user_id, status_message_id, text=f"❌ Pembelian paket utama *{xcp_8gb_name}* gagal: {xcp_8gb_purchase_result['error_message']}. Alur dihentikan.", parse_mode="Markdown")
 
         del context.user_data['automatic_xcs_flow_state']
-        simpan_data_ke_db()
+        purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XCS)
+        simpan_data_ke_db(user_id)
         await send_main_menu(update, context)
 
 async def run_automatic_purchase_flow(update, context):
@@ -755,9 +1084,8 @@ async def run_automatic_purchase_flow(update, context):
         status_message_id = msg.message_id
     else:
         try:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"Melanjutkan alur pembelian otomatis untuk *{current_phone}*...",
                 parse_mode="Markdown"
             )
@@ -766,82 +1094,76 @@ async def run_automatic_purchase_flow(update, context):
             msg = await context.bot.send_message(user_id, f"Melanjutkan alur pembelian otomatis untuk *{current_phone}*...", parse_mode="Markdown")
             automatic_flow_state['status_message_id'] = msg.message_id
             status_message_id = msg.message_id
-    simpan_data_ke_db()
+    simpan_data_ke_db(user_id)
 
     if automatic_flow_state['current_step'] == 'xuts' and not automatic_flow_state['xuts_completed']:
         if automatic_flow_state['xuts_retry_count'] >= 5:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Gagal membeli XUTS untuk *{current_phone}* setelah {automatic_flow_state['xuts_retry_count']} percobaan. Melanjutkan ke pembelian XC 1+1GB.",
                 parse_mode="Markdown"
             )
             logging.info(f"User {user_id} - {current_phone}: XUTS gagal setelah {automatic_flow_state['xuts_retry_count']} percobaan. Lanjut ke XC.")
             automatic_flow_state['xuts_completed'] = True
             automatic_flow_state['current_step'] = 'xc'
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             asyncio.create_task(run_automatic_purchase_flow(update, context))
             return
 
         xuts_price = CUSTOM_PACKAGE_PRICES.get(XUTS_PACKAGE_CODE, {}).get('price_bot', 0)
         if xuts_price <= 0:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Harga paket XUTS tidak ditemukan atau tidak valid. Menghentikan alur otomatis untuk *{current_phone}*.",
                 parse_mode="Markdown"
             )
             logging.error(f"User {user_id} - {current_phone}: Harga XUTS tidak valid ({xuts_price}). Menghentikan alur.")
             if 'automatic_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['automatic_flow_state']
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
 
         user_current_balance = user_data_entry.get("balance", 0)
         if user_current_balance < xuts_price:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Saldo Anda tidak cukup untuk membeli paket XUTS (harga bot: Rp{xuts_price:,}). Saldo Anda saat ini: Rp{user_current_balance:,}. Menghentikan alur otomatis untuk *{current_phone}*.",
                 parse_mode="Markdown"
             )
             logging.info(f"User {user_id} - {current_phone}: Saldo tidak cukup untuk XUTS. Menghentikan alur.")
             if 'automatic_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['automatic_flow_state']
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
 
         automatic_flow_state['xuts_retry_count'] += 1
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=status_message_id,
+        await status_message.perbarui(
+            context, user_id, status_message_id,
             text=f"Mencoba membeli XUTS untuk *{current_phone}*... (Percobaan ke-{automatic_flow_state['xuts_retry_count']})",
             parse_mode="Markdown"
         )
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
 
         xuts_purchase_result = await execute_automatic_xuts_purchase(
             update, context, user_id, XUTS_PACKAGE_CODE, current_phone, access_token, "PULSA", xuts_price, automatic_flow_state['xuts_retry_count']
         )
 
         if xuts_purchase_result['success']:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"✅ Pembelian XUTS berhasil untuk *{current_phone}*! Melanjutkan ke pembelian XC 1+1GB.",
                 parse_mode="Markdown"
             )
             logging.info(f"User {user_id} - {current_phone}: XUTS berhasil. Lanjut ke XC.")
             automatic_flow_state['xuts_completed'] = True
             automatic_flow_state['current_step'] = 'xc'
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             asyncio.create_task(run_automatic_purchase_flow(update, context))
         elif xuts_purchase_result.get('specific_action') == 'countdown_retry':
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"⚠️ XUTS pending untuk *{current_phone}*. Bot akan mencoba kembali dalam 10 menit. Mohon tunggu...",
                 parse_mode="Markdown"
             )
@@ -849,47 +1171,19 @@ async def run_automatic_purchase_flow(update, context):
 
             countdown_message_text = f"⏳ Menunggu 10 menit sebelum mencoba XUTS lagi untuk *{current_phone}* (percobaan ke-{automatic_flow_state['xuts_retry_count']}).\nSisa waktu: *10 menit*."
             countdown_msg = await context.bot.send_message(user_id, countdown_message_text, parse_mode="Markdown")
-            automatic_flow_state['qris_countdown_message_id'] = countdown_msg.message_id
-            simpan_data_ke_db()
 
-            for i in range(9, -1, -1):
-                await asyncio.sleep(60)
-                if i > 0:
-                    try:
-                        await context.bot.edit_message_text(
-                            chat_id=user_id,
-                            message_id=automatic_flow_state['qris_countdown_message_id'],
-                            text=f"⏳ Menunggu 10 menit sebelum mencoba XUTS lagi untuk *{current_phone}* (percobaan ke-{automatic_flow_state['xuts_retry_count']}).\nSisa waktu: *{i} menit*.",
-                            parse_mode="Markdown"
-                        )
-                    except Exception as e:
-                        if "message is not modified" not in str(e) and "message to edit not found" not in str(e):
-                            logging.warning(f"Gagal mengupdate countdown XUTS untuk user {user_id} - {current_phone}: {e}")
-                        break
-                else:
-                    try:
-                        await context.bot.edit_message_text(
-                            chat_id=user_id,
-                            message_id=automatic_flow_state['qris_countdown_message_id'],
-                            text="✅ Waktu jeda XUTS selesai. Mencoba kembali...",
-                            parse_mode="Markdown"
-                        )
-                    except Exception as e:
-                        logging.warning(f"Gagal mengedit pesan countdown XUTS selesai untuk {current_phone}: {e}")
-
-            if 'qris_countdown_message_id' in automatic_flow_state:
-                try:
-                    await context.bot.delete_message(chat_id=user_id, message_id=automatic_flow_state['qris_countdown_message_id'])
-                    del automatic_flow_state['qris_countdown_message_id']
-                    simpan_data_ke_db()
-                except Exception as e:
-                    logging.warning(f"Gagal menghapus pesan countdown XUTS untuk user {user_id} - {current_phone}: {e}")
+            async def tampilkan_countdown(ctx, sisa):
+                await status_message.perbarui(
+                    ctx, user_id, countdown_msg.message_id,
+                    text=f"⏳ Menunggu 10 menit sebelum mencoba XUTS lagi untuk *{current_phone}* (percobaan ke-{automatic_flow_state['xuts_retry_count']}).\nSisa waktu: *{sisa // 60} menit*.",
+                    parse_mode="Markdown"
+                )
 
-            asyncio.create_task(run_automatic_purchase_flow(update, context))
+            flow_scheduler.jadwalkan_countdown(context, 600, 60, tampilkan_countdown, run_automatic_purchase_flow, update,
+                                               hapus_pesan_id=countdown_msg.message_id)
         else:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Pembelian XUTS untuk *{current_phone}* gagal: {xuts_purchase_result['error_message']}. Mencoba lagi...",
                 parse_mode="Markdown"
             )
@@ -916,71 +1210,77 @@ async def run_automatic_purchase_flow(update, context):
             xc_price_key = XC1PLUS1GB_QRIS_CODE                                     
             xc_package_name_display = CUSTOM_PACKAGE_PRICES.get(xc_price_key, {}).get('display_name', 'XC 1+1GB QRIS')
         else:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Metode pembayaran tidak valid untuk XC 1+1GB. Menghentikan alur otomatis untuk *{current_phone}*.",
                 parse_mode="Markdown"
             )
             logging.error(f"User {user_id} - {current_phone}: Metode pembayaran XC 1+1GB tidak valid ({payment_method_for_xc}). Menghentikan alur.")
             if 'automatic_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['automatic_flow_state']
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
         
         xc_price = CUSTOM_PACKAGE_PRICES.get(xc_price_key, {}).get('price_bot', 0)
         
         if xc_price <= 0:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Harga paket {xc_package_name_display} tidak ditemukan atau tidak valid. Menghentikan alur otomatis untuk *{current_phone}*.",
                 parse_mode="Markdown"
             )
             logging.error(f"User {user_id} - {current_phone}: Harga XC 1+1GB tidak valid ({xc_price}). Menghentikan alur.")
             if 'automatic_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['automatic_flow_state']
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
 
         user_current_balance = user_data_entry.get("balance", 0)
         if user_current_balance < xc_price:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Saldo Anda tidak cukup untuk membeli paket {xc_package_name_display} (harga bot: Rp{xc_price:,}). Saldo Anda saat ini: Rp{user_current_balance:,}. Menghentikan alur otomatis untuk *{current_phone}*.",
                 parse_mode="Markdown"
             )
             logging.info(f"User {user_id} - {current_phone}: Saldo tidak cukup untuk XC 1+1GB. Menghentikan alur.")
             if 'automatic_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['automatic_flow_state']
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
 
-        user_data["registered_users"][str(user_id)]["balance"] -= xc_price
-        simpan_data_ke_db()
+        if not debit_saldo(user_id, xc_price, "pembelian"):
+            await status_message.perbarui(
+                context, user_id, status_message_id,
+                text=f"{pesan_debit_gagal(user_id, xc_price)} Menghentikan alur otomatis untuk *{current_phone}*.",
+                parse_mode="Markdown"
+            )
+            logging.info(f"User {user_id} - {current_phone}: Saldo gagal dipotong untuk XC 1+1GB. Menghentikan alur.")
+            if 'automatic_flow_state' in user_data_entry['accounts'][current_phone]:
+                del user_data_entry['accounts'][current_phone]['automatic_flow_state']
+            simpan_data_ke_db(user_id)
+            await send_main_menu(update, context)
+            return
+        simpan_data_ke_db(user_id)
         await context.bot.send_message(user_id, f"Saldo Anda terpotong: *Rp{xc_price:,}* untuk pembelian {xc_package_name_display}. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
         logging.info(f"User {user_id} - {current_phone}: saldo dipotong Rp{xc_price} untuk XC 1+1GB.")
 
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=status_message_id,
+        await status_message.perbarui(
+            context, user_id, status_message_id,
             text=f"Mencoba membeli {xc_package_name_display} untuk *{current_phone}*...",
             parse_mode="Markdown"
         )
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
 
         xc_purchase_result = await execute_automatic_xc_purchase(
             update, context, user_id, xc_package_code, xc_package_name_display, current_phone, access_token, payment_method_for_xc, xc_price                                  
         )
 
         if xc_purchase_result['success']:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"✅ Pembelian {xc_package_name_display} untuk *{current_phone}* berhasil! Alur otomatis selesai.",
                 parse_mode="Markdown"
             )
@@ -989,19 +1289,18 @@ async def run_automatic_purchase_flow(update, context):
             automatic_flow_state['current_step'] = 'finished'
             if 'automatic_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['automatic_flow_state']
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
         else:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Pembelian {xc_package_name_display} untuk *{current_phone}* gagal: {xc_purchase_result['error_message']}. Alur otomatis dihentikan.",
                 parse_mode="Markdown"
             )
             logging.info(f"User {user_id} - {current_phone}: XC 1+1GB gagal. Alur dihentikan.")
             if 'automatic_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['automatic_flow_state']
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
         return
 
@@ -1009,7 +1308,7 @@ async def run_automatic_purchase_flow(update, context):
         logging.info(f"User {user_id} - {current_phone}: Automatic flow completed (final cleanup).")
         if 'automatic_flow_state' in user_data_entry['accounts'][current_phone]:
             del user_data_entry['accounts'][current_phone]['automatic_flow_state']
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
         await send_main_menu(update, context)
         return
 
@@ -1047,9 +1346,8 @@ async def run_automatic_xutp_flow(update, context):
         status_message_id = msg.message_id
     else:
         try:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"Melanjutkan alur pembelian XUTP otomatis untuk *{current_phone}*...",
                 parse_mode="Markdown"
             )
@@ -1058,7 +1356,9 @@ async def run_automatic_xutp_flow(update, context):
             msg = await context.bot.send_message(user_id, f"Melanjutkan alur pembelian XUTP otomatis untuk *{current_phone}*...", parse_mode="Markdown")
             xutp_flow_state['status_message_id'] = msg.message_id
             status_message_id = msg.message_id
-    simpan_data_ke_db()
+    simpan_data_ke_db(user_id)
+    # Saldo XUTP dipotong per langkah, jadi tidak ada dana yang tertahan di antara langkah.
+    checkpoint_job(context, user_id, purchase_jobs.JENIS_XUTP)
 
                                                                       
     if xutp_flow_state['current_step'] == 'initial_package' and not xutp_flow_state['initial_package_completed']:
@@ -1067,83 +1367,92 @@ async def run_automatic_xutp_flow(update, context):
         initial_package_price = CUSTOM_PACKAGE_PRICES.get(initial_package_code, {}).get('price_bot', 0)
 
         if xutp_flow_state['initial_package_retry_count'] >= 5:                                   
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Gagal membeli {initial_package_name_display} untuk *{current_phone}* setelah {xutp_flow_state['initial_package_retry_count']} percobaan. Melanjutkan ke pembelian XCP 8GB.",
                 parse_mode="Markdown"
             )
             logging.info(f"User {user_id} - {current_phone}: {initial_package_name_display} gagal setelah {xutp_flow_state['initial_package_retry_count']} percobaan. Lanjut ke XCP 8GB.")
             xutp_flow_state['initial_package_completed'] = True
             xutp_flow_state['current_step'] = 'xcp_8gb'
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             asyncio.create_task(run_automatic_xutp_flow(update, context))
             return
 
         if initial_package_price <= 0:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Harga paket {initial_package_name_display} tidak ditemukan atau tidak valid. Menghentikan alur XUTP otomatis untuk *{current_phone}*.",
                 parse_mode="Markdown"
             )
             logging.error(f"User {user_id} - {current_phone}: Harga {initial_package_name_display} tidak valid ({initial_package_price}). Menghentikan alur.")
             if 'xutp_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['xutp_flow_state']
-            simpan_data_ke_db()
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XUTP)
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
 
         user_current_balance = user_data_entry.get("balance", 0)
         if user_current_balance < initial_package_price:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Saldo Anda tidak cukup untuk membeli paket {initial_package_name_display} (harga bot: Rp{initial_package_price:,}). Saldo Anda saat ini: Rp{user_current_balance:,}. Menghentikan alur XUTP otomatis untuk *{current_phone}*.",
                 parse_mode="Markdown"
             )
             logging.info(f"User {user_id} - {current_phone}: Saldo tidak cukup untuk {initial_package_name_display}. Menghentikan alur.")
             if 'xutp_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['xutp_flow_state']
-            simpan_data_ke_db()
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XUTP)
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
 
-        user_data["registered_users"][str(user_id)]["balance"] -= initial_package_price
-        simpan_data_ke_db()
+        if not debit_saldo(user_id, initial_package_price, "pembelian"):
+            await status_message.perbarui(
+                context, user_id, status_message_id,
+                text=f"{pesan_debit_gagal(user_id, initial_package_price)} Menghentikan alur untuk *{current_phone}*.",
+                parse_mode="Markdown"
+            )
+            logging.info(f"User {user_id} - {current_phone}: Saldo gagal dipotong untuk {initial_package_name_display}. Menghentikan alur.")
+            if 'xutp_flow_state' in user_data_entry['accounts'][current_phone]:
+                del user_data_entry['accounts'][current_phone]['xutp_flow_state']
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XUTP)
+            simpan_data_ke_db(user_id)
+            await send_main_menu(update, context)
+            return
+        simpan_data_ke_db(user_id)
         await context.bot.send_message(user_id, f"Saldo Anda terpotong: *Rp{initial_package_price:,}* untuk percobaan pembelian {initial_package_name_display}. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
         logging.info(f"User {user_id} - {current_phone}: saldo dipotong Rp{initial_package_price} untuk {initial_package_name_display}.")
 
         xutp_flow_state['initial_package_retry_count'] += 1
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=status_message_id,
+        await status_message.perbarui(
+            context, user_id, status_message_id,
             text=f"Mencoba membeli {initial_package_name_display} untuk *{current_phone}*... (Percobaan ke-{xutp_flow_state['initial_package_retry_count']})",
             parse_mode="Markdown"
         )
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
 
                                                                                             
         initial_purchase_result = await execute_single_purchase_30h(
-            update, context, user_id, initial_package_code, initial_package_name_display, current_phone, access_token, "BALANCE", initial_package_price, "xutp_method_selection_menu", xutp_flow_state['initial_package_retry_count']
+            update, context, user_id, initial_package_code, initial_package_name_display, current_phone, access_token, "BALANCE", initial_package_price, "xutp_method_selection_menu", xutp_flow_state['initial_package_retry_count'],
+            prioritas=purchase_queue.PRIORITAS_OTOMATIS, kebijakan=retry_engine.SEKALI
         )
 
         if initial_purchase_result['success']:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"✅ Pembelian {initial_package_name_display} berhasil untuk *{current_phone}*! Melanjutkan ke pembelian XCP 8GB.",
                 parse_mode="Markdown"
             )
             logging.info(f"User {user_id} - {current_phone}: {initial_package_name_display} berhasil. Lanjut ke XCP 8GB.")
             xutp_flow_state['initial_package_completed'] = True
             xutp_flow_state['current_step'] = 'xcp_8gb'
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             asyncio.create_task(run_automatic_xutp_flow(update, context))
         elif initial_purchase_result.get('specific_action') == 'countdown_retry':
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"⚠️ {initial_package_name_display} pending untuk *{current_phone}*. Bot akan mencoba kembali dalam 10 menit. Mohon tunggu...",
                 parse_mode="Markdown"
             )
@@ -1151,47 +1460,19 @@ async def run_automatic_xutp_flow(update, context):
 
             countdown_message_text = f"⏳ Menunggu 10 menit sebelum mencoba {initial_package_name_display} lagi untuk *{current_phone}* (percobaan ke-{xutp_flow_state['initial_package_retry_count']}).\nSisa waktu: *10 menit*."
             countdown_msg = await context.bot.send_message(user_id, countdown_message_text, parse_mode="Markdown")
-            xutp_flow_state['qris_countdown_message_id'] = countdown_msg.message_id
-            simpan_data_ke_db()
 
-            for i in range(9, -1, -1):
-                await asyncio.sleep(60)
-                if i > 0:
-                    try:
-                        await context.bot.edit_message_text(
-                            chat_id=user_id,
-                            message_id=xutp_flow_state['qris_countdown_message_id'],
-                            text=f"⏳ Menunggu 10 menit sebelum mencoba {initial_package_name_display} lagi untuk *{current_phone}* (percobaan ke-{xutp_flow_state['initial_package_retry_count']}).\nSisa waktu: *{i} menit*.",
-                            parse_mode="Markdown"
-                        )
-                    except Exception as e:
-                        if "message is not modified" not in str(e) and "message to edit not found" not in str(e):
-                            logging.warning(f"Gagal mengupdate countdown XUTP initial package untuk user {user_id} - {current_phone}: {e}")
-                        break
-                else:
-                    try:
-                        await context.bot.edit_message_text(
-                            chat_id=user_id,
-                            message_id=xutp_flow_state['qris_countdown_message_id'],
-                            text="✅ Waktu jeda XUTP initial package selesai. Mencoba kembali...",
-                            parse_mode="Markdown"
-                        )
-                    except Exception as e:
-                        logging.warning(f"Gagal mengedit pesan countdown XUTP initial package selesai untuk {current_phone}: {e}")
-
-            if 'qris_countdown_message_id' in xutp_flow_state:
-                try:
-                    await context.bot.delete_message(chat_id=user_id, message_id=xutp_flow_state['qris_countdown_message_id'])
-                    del xutp_flow_state['qris_countdown_message_id']
-                    simpan_data_ke_db()
-                except Exception as e:
-                    logging.warning(f"Gagal menghapus pesan countdown XUTP initial package untuk user {user_id} - {current_phone}: {e}")
+            async def tampilkan_countdown(ctx, sisa):
+                await status_message.perbarui(
+                    ctx, user_id, countdown_msg.message_id,
+                    text=f"⏳ Menunggu 10 menit sebelum mencoba {initial_package_name_display} lagi untuk *{current_phone}* (percobaan ke-{xutp_flow_state['initial_package_retry_count']}).\nSisa waktu: *{sisa // 60} menit*.",
+                    parse_mode="Markdown"
+                )
 
-            asyncio.create_task(run_automatic_xutp_flow(update, context))
+            flow_scheduler.jadwalkan_countdown(context, 600, 60, tampilkan_countdown, run_automatic_xutp_flow, update,
+                                               hapus_pesan_id=countdown_msg.message_id)
         else:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Pembelian {initial_package_name_display} untuk *{current_phone}* gagal: {initial_purchase_result['error_message']}. Mencoba lagi...",
                 parse_mode="Markdown"
             )
@@ -1217,71 +1498,81 @@ async def run_automatic_xutp_flow(update, context):
         xcp_8gb_name = CUSTOM_PACKAGE_PRICES.get(xcp_8gb_price_key, {}).get('display_name', 'XCP 8GB')
 
         if xcp_8gb_price_key is None or xcp_8gb_package_code is None:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Konfigurasi paket XCP 8GB untuk XUTP tidak valid. Menghentikan alur otomatis untuk *{current_phone}*.",
                 parse_mode="Markdown"
             )
             logging.error(f"User {user_id} - {current_phone}: Konfigurasi XCP 8GB untuk XUTP tidak valid.")
             if 'xutp_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['xutp_flow_state']
-            simpan_data_ke_db()
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XUTP)
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
 
         xcp_8gb_price = CUSTOM_PACKAGE_PRICES.get(xcp_8gb_price_key, {}).get('price_bot', 0)
         
         if xcp_8gb_price <= 0:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Harga paket {xcp_8gb_name} tidak ditemukan atau tidak valid. Menghentikan alur XUTP otomatis untuk *{current_phone}*.",
                 parse_mode="Markdown"
             )
             logging.error(f"User {user_id} - {current_phone}: Harga XCP 8GB tidak valid ({xcp_8gb_price}). Menghentikan alur.")
             if 'xutp_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['xutp_flow_state']
-            simpan_data_ke_db()
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XUTP)
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
 
         user_current_balance = user_data_entry.get("balance", 0)
         if user_current_balance < xcp_8gb_price:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Saldo Anda tidak cukup untuk membeli paket {xcp_8gb_name} (harga bot: Rp{xcp_8gb_price:,}). Saldo Anda saat ini: Rp{user_current_balance:,}. Menghentikan alur XUTP otomatis untuk *{current_phone}*.",
                 parse_mode="Markdown"
             )
             logging.info(f"User {user_id} - {current_phone}: Saldo tidak cukup untuk XCP 8GB. Menghentikan alur.")
             if 'xutp_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['xutp_flow_state']
-            simpan_data_ke_db()
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XUTP)
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
             return
-        
-        user_data["registered_users"][str(user_id)]["balance"] -= xcp_8gb_price
-        simpan_data_ke_db()
+
+        if not debit_saldo(user_id, xcp_8gb_price, "pembelian"):
+            await status_message.perbarui(
+                context, user_id, status_message_id,
+                text=f"{pesan_debit_gagal(user_id, xcp_8gb_price)} Menghentikan alur untuk *{current_phone}*.",
+                parse_mode="Markdown"
+            )
+            logging.info(f"User {user_id} - {current_phone}: Saldo gagal dipotong untuk XCP 8GB. Menghentikan alur.")
+            if 'xutp_flow_state' in user_data_entry['accounts'][current_phone]:
+                del user_data_entry['accounts'][current_phone]['xutp_flow_state']
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XUTP)
+            simpan_data_ke_db(user_id)
+            await send_main_menu(update, context)
+            return
+        simpan_data_ke_db(user_id)
         await context.bot.send_message(user_id, f"Saldo Anda terpotong: *Rp{xcp_8gb_price:,}* untuk pembelian {xcp_8gb_name}. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
         logging.info(f"User {user_id} - {current_phone}: saldo dipotong Rp{xcp_8gb_price} untuk XCP 8GB.")
 
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=status_message_id,
+        await status_message.perbarui(
+            context, user_id, status_message_id,
             text=f"Mencoba membeli {xcp_8gb_name} untuk *{current_phone}*...",
             parse_mode="Markdown"
         )
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
 
         xcp_8gb_purchase_result = await execute_automatic_xc_purchase(
             update, context, user_id, xcp_8gb_package_code, xcp_8gb_name, current_phone, access_token, payment_method_for_xcp_8gb, xcp_8gb_price
         )
 
         if xcp_8gb_purchase_result['success']:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"✅ Pembelian {xcp_8gb_name} untuk *{current_phone}* berhasil! Alur XUTP otomatis selesai.",
                 parse_mode="Markdown"
             )
@@ -1289,19 +1580,20 @@ async def run_automatic_xutp_flow(update, context):
             xutp_flow_state['xcp_8gb_completed'] = True
             if 'xutp_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['xutp_flow_state']
-            simpan_data_ke_db()
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XUTP)
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
         else:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"❌ Pembelian {xcp_8gb_name} untuk *{current_phone}* gagal: {xcp_8gb_purchase_result['error_message']}. Alur XUTP otomatis dihentikan.",
                 parse_mode="Markdown"
             )
             logging.info(f"User {user_id} - {current_phone}: XCP 8GB gagal. Alur XUTP dihentikan.")
             if 'xutp_flow_state' in user_data_entry['accounts'][current_phone]:
                 del user_data_entry['accounts'][current_phone]['xutp_flow_state']
-            simpan_data_ke_db()
+            purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XUTP)
+            simpan_data_ke_db(user_id)
             await send_main_menu(update, context)
         return
 
@@ -1310,12 +1602,12 @@ async def run_automatic_xutp_flow(update, context):
         logging.info(f"User {user_id} - {current_phone}: XUTP Automatic flow completed (final cleanup).")
         if 'xutp_flow_state' in user_data_entry['accounts'][current_phone]:
             del user_data_entry['accounts'][current_phone]['xutp_flow_state']
-        simpan_data_ke_db()
+        purchase_jobs.hapus(user_id, purchase_jobs.JENIS_XUTP)
+        simpan_data_ke_db(user_id)
         await send_main_menu(update, context)
         return
 
 async def execute_automatic_xuts_purchase(update, context, user_id, package_code, phone, access_token, payment_method, deducted_balance, attempt):
-    url = f"https://golang-openapi-packagepurchase-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}&package_code={package_code}&phone={phone}&access_token={access_token}&payment_method={payment_method}&price_or_fee=0"
 
     transaction_time = datetime.now()
     transaction_time_str = transaction_time.strftime('%Y-%m-%d %H:%M:%S')
@@ -1333,20 +1625,17 @@ async def execute_automatic_xuts_purchase(update, context, user_id, package_code
         await context.bot.send_message(user_id, "❌ Saldo Anda tidak cukup untuk melanjutkan pembelian ini.")
         return {"success": False, "package_name": "XUTS", "error_message": "Saldo tidak cukup.", "refunded_amount": 0, "status_message": "Gagal"}
 
-    user_data["registered_users"][str(user_id)]["balance"] -= deducted_balance
-    simpan_data_ke_db()
+    if not debit_saldo(user_id, deducted_balance, "pembelian"):
+        await context.bot.send_message(user_id, pesan_debit_gagal(user_id, deducted_balance))
+        return {"success": False, "package_name": "XUTS", "error_message": "Saldo tidak cukup.", "refunded_amount": 0, "status_message": "Gagal"}
+    simpan_data_ke_db(user_id)
     await context.bot.send_message(user_id, f"Saldo Anda terpotong: *Rp{deducted_balance:,}* untuk percobaan pembelian XUTS. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
     logging.info(f"User {user_id} saldo dipotong Rp{deducted_balance} untuk XUTS. Percobaan {attempt}.")
                                     
 
     try:
-        def blocking_api_call():
-            return requests.get(url, timeout=58)
-
-        response = await asyncio.wait_for(
-            asyncio.get_running_loop().run_in_executor(None, blocking_api_call),
-            timeout=60.0
-        )
+        response = await retry_engine.jalankan("kmsp", lambda attempt: provider_client.kmsp_purchase(KMSP_API_KEY, package_code, phone, access_token, payment_method, price_or_fee=0,
+                                                                                                     prioritas=purchase_queue.PRIORITAS_OTOMATIS))
 
         raw_api_response_content = response.text
 
@@ -1355,11 +1644,7 @@ async def execute_automatic_xuts_purchase(update, context, user_id, package_code
         api_status = False
 
         try:
-            parsed_json = response.json()
-            if isinstance(parsed_json, list):
-                result = parsed_json[0] if parsed_json else {}
-            else:
-                result = parsed_json
+            result = provider_client.normalisasi_respons(response.json())
 
             api_message = result.get('message', '').strip().replace('\r', '').replace('\n', '')
             api_status = result.get('status', False)
@@ -1368,17 +1653,14 @@ async def execute_automatic_xuts_purchase(update, context, user_id, package_code
             api_message = f"Invalid JSON response or non-JSON content: {raw_api_response_content[:100]}...".strip().replace('\r', '').replace('\n', '')
             api_status = False
 
-        EXPECTED_SUCCESS_MESSAGE_CONTAINING_422 = "Error Message: 422 -> Failed call ipaas purchase, with status code:422 : null,".strip().replace('\r', '').replace('\n', '')
-        EXPECTED_SUCCESS_MESSAGE_MYXL = "Paket berhasil dibeli. Silakan cek kuotanya via aplikasi MyXL (disarankan) dan/atau via SMS kamu".strip().replace('\r', '').replace('\n', '')
-
-        if response.status_code == 200 and EXPECTED_SUCCESS_MESSAGE_CONTAINING_422 in api_message:
+        if response.status_code == 200 and provider_client.is_sukses_422(api_message):
             logging.info(f"Pembelian XUTS (KMSP) untuk {phone} dianggap SUKSES (respon 200 dgn pesan 422). (Percobaan {attempt})")
-            user_data["registered_users"][str(user_id)]["transactions"].append({
+            catat_transaksi(user_id, {
                 "type": f"Pembelian Paket (LOGIN - XUTS Sukses)", "package_code": package_code, "package_name": "XUTS", "phone": phone,
                 "amount": -deducted_balance, "timestamp": transaction_time_str, "status": "Berhasil (Skenario 1)",
                 "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
             })
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
 
             user_info = user_data["registered_users"][str(user_id)]
             admin_message = (
@@ -1394,17 +1676,17 @@ async def execute_automatic_xuts_purchase(update, context, user_id, package_code
             await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown")
             return {"success": True, "package_name": "XUTS", "error_message": None, "refunded_amount": 0, "status_message": "Berhasil"}
 
-        elif response.status_code == 200 and EXPECTED_SUCCESS_MESSAGE_MYXL in api_message:
+        elif response.status_code == 200 and provider_client.is_sukses_myxl(api_message):
             logging.info(f"Pembelian XUTS (KMSP) untuk {phone} dianggap SUKSES (respon 200 dgn pesan MyXL), perlu jeda & retry. (Percobaan {attempt})")
 
                                                                   
-            user_data["registered_users"][str(user_id)]["balance"] += deducted_balance
-            user_data["registered_users"][str(user_id)]["transactions"].append({
+            kredit_saldo(user_id, deducted_balance, "refund")
+            catat_transaksi(user_id, {
                 "type": f"Pembelian Paket (LOGIN - XUTS Pending Retry) (Refund)", "package_code": package_code, "package_name": "XUTS", "phone": phone,
                 "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Pending (Refund)",                            
                 "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
             })
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             logging.info(f"Saldo user {user_id} dikembalikan Rp{deducted_balance} karena XUTS pending (MyXL message).")
 
             user_info = user_data["registered_users"][str(user_id)]
@@ -1434,13 +1716,13 @@ async def execute_automatic_xuts_purchase(update, context, user_id, package_code
         user_facing_error = "Terjadi kesalahan yang tidak terduga."
         admin_facing_error = str(e)
 
-        if isinstance(e, asyncio.TimeoutError) or isinstance(e, requests.exceptions.ReadTimeout):
+        if isinstance(e, asyncio.TimeoutError) or isinstance(e, httpx.ReadTimeout):
             user_facing_error = "Waktu tunggu habis. Server tidak merespon dalam 60 detik (Timeout). Silakan coba lagi."
             admin_facing_error = "Request timed out after 60 seconds (KMSP API - XUTS)"
-        elif isinstance(e, requests.exceptions.ConnectTimeout):
+        elif isinstance(e, httpx.ConnectTimeout):
             user_facing_error = "Gagal terhubung. Tidak dapat terhubung ke server (Connection Timeout)."
             admin_facing_error = "Connection timed out (KMSP API - XUTS)"
-        elif isinstance(e, requests.exceptions.HTTPError):
+        elif isinstance(e, httpx.HTTPStatusError):
             try:
                 if e.response and e.response.content:
                     response_json_content = {}
@@ -1465,13 +1747,13 @@ async def execute_automatic_xuts_purchase(update, context, user_id, package_code
         logging.error(traceback.format_exc())
 
                                                                                           
-        user_data["registered_users"][str(user_id)]["balance"] += deducted_balance
-        user_data["registered_users"][str(user_id)]["transactions"].append({
+        kredit_saldo(user_id, deducted_balance, "refund")
+        catat_transaksi(user_id, {
             "type": "Pembelian Gagal (LOGIN - XUTS) (Refund)", "package_code": package_code, "package_name": "XUTS", "phone": phone,
             "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Gagal (Refund)",
             "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
         })
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
         logging.info(f"Saldo user {user_id} dikembalikan {deducted_balance} karena kegagalan pembelian XUTS (percobaan {attempt}).")
 
         admin_message = (f"❌ *PEMBELIAN XUTS GAGAL (LOGIN)!* ❌\n"
@@ -1492,7 +1774,6 @@ async def execute_automatic_xc_purchase(update, context, user_id, package_code,
 
     actual_package_code_for_api = package_code
     
-    url = f"https://golang-openapi-packagepurchase-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}&package_code={actual_package_code_for_api}&phone={phone}&access_token={access_token}&payment_method={payment_method}&price_or_fee={api_price_or_fee}"
 
     transaction_time = datetime.now()
     transaction_time_str = transaction_time.strftime('%Y-%m-%d %H:%M:%S')
@@ -1509,9 +1790,8 @@ async def execute_automatic_xc_purchase(update, context, user_id, package_code,
         status_message_id = msg.message_id
     else:
         try:
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=status_message_id,
+            await status_message.perbarui(
+                context, user_id, status_message_id,
                 text=f"Memproses pembelian *{package_name_display}* dari LOGIN...\nProses ini dapat memakan waktu hingga 60 detik. Harap tunggu.",
                 parse_mode="Markdown"
             )
@@ -1524,18 +1804,13 @@ async def execute_automatic_xc_purchase(update, context, user_id, package_code,
                 context.user_data['automatic_xcs_flow_state']['overall_status_message_id'] = msg.message_id
             status_message_id = msg.message_id
 
-    loop = asyncio.get_running_loop()
 
     try:
-        def blocking_api_call():
-            return requests.get(url, timeout=58)
-
-        response = await asyncio.wait_for(
-            loop.run_in_executor(None, blocking_api_call),
-            timeout=60.0
-        )
+        response = await retry_engine.jalankan("kmsp", lambda attempt: provider_client.kmsp_purchase(KMSP_API_KEY, actual_package_code_for_api, phone, access_token, payment_method,
+                                                                                                     price_or_fee=api_price_or_fee, prioritas=purchase_queue.PRIORITAS_OTOMATIS))
 
         try:
+            status_message.lupakan(user_id, status_message_id)
             await context.bot.delete_message(chat_id=user_id, message_id=status_message_id)
         except Exception:
             logging.warning(f"Gagal menghapus pesan status setelah panggilan API XC: {e}")
@@ -1543,7 +1818,7 @@ async def execute_automatic_xc_purchase(update, context, user_id, package_code,
         response.raise_for_status()
         result = response.json()
 
-        if isinstance(result, list): result = result[0] if result else {}
+        result = provider_client.normalisasi_respons(result)
 
         api_message = result.get('message', '')
         api_status = result.get('status', False)
@@ -1613,12 +1888,12 @@ async def execute_automatic_xc_purchase(update, context, user_id, package_code,
             user_keyboard.append([InlineKeyboardButton("🏠 Kembali ke Menu Utama", callback_data="back_to_menu")])
             await context.bot.send_message(user_id, user_message_to_send, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(user_keyboard))
 
-        user_data["registered_users"][str(user_id)]["transactions"].append({
+        catat_transaksi(user_id, {
             "type": f"Pembelian Paket Otomatis (LOGIN - {payment_method})", "package_code": package_code, "package_name": package_name_display, "phone": phone,
             "amount": -deducted_balance, "timestamp": transaction_time_str, "status": "Berhasil",
             "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
         })
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
 
         user_info = user_data["registered_users"][str(user_id)]
         user_first_name = user_info.get("first_name", "N/A")
@@ -1651,6 +1926,7 @@ async def execute_automatic_xc_purchase(update, context, user_id, package_code,
 
     except Exception as e:
         try:
+            status_message.lupakan(user_id, status_message_id)
             await context.bot.delete_message(chat_id=user_id, message_id=status_message_id)
         except Exception:
             pass
@@ -1659,13 +1935,13 @@ async def execute_automatic_xc_purchase(update, context, user_id, package_code,
         user_facing_error = "Terjadi kesalahan yang tidak terduga."
         admin_facing_error = str(e)
 
-        if isinstance(e, asyncio.TimeoutError) or isinstance(e, requests.exceptions.ReadTimeout):
+        if isinstance(e, asyncio.TimeoutError) or isinstance(e, httpx.ReadTimeout):
             user_facing_error = "Server tidak merespon dalam 60 detik (Timeout). Silakan coba lagi."
             admin_facing_error = "Request timed out after 60 seconds"
-        elif isinstance(e, requests.exceptions.ConnectTimeout):
+        elif isinstance(e, httpx.ConnectTimeout):
             user_facing_error = "Tidak dapat terhubung ke server (Connection Timeout)."
             admin_facing_error = "Connection timed out"
-        elif isinstance(e, requests.exceptions.HTTPError):
+        elif isinstance(e, httpx.HTTPStatusError):
             try:
                 error_msg_from_api = e.response.json().get("message", "Terjadi kesalahan HTTP.")
                 user_facing_error = f"Pesan dari API: {error_msg_from_api}"
@@ -1684,13 +1960,13 @@ async def execute_automatic_xc_purchase(update, context, user_id, package_code,
         final_user_error_message = f"❌ Gagal melakukan pembelian *{escaped_package_name_display}* dari LOGIN.\n*Pesan Error:*\n`{escaped_user_facing_error}`"
 
         if deducted_balance > 0:
-            user_data["registered_users"][str(user_id)]["balance"] += deducted_balance
-            user_data["registered_users"][str(user_id)]["transactions"].append({
+            kredit_saldo(user_id, deducted_balance, "refund")
+            catat_transaksi(user_id, {
                 "type": f"Pembelian Otomatis Gagal (LOGIN) (Refund)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
                 "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Gagal",
                 "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
             })
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             final_user_error_message += f"\n💰 Saldo Anda sebesar *Rp{deducted_balance:,}* telah dikembalikan."
 
         await context.bot.send_message(user_id, final_user_error_message, parse_mode="Markdown")
@@ -1717,7 +1993,7 @@ async def delete_last_message(user_id, context):
 
 async def send_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_first_name = update.effective_user.first_name
+    user_first_name = update.effective_user.first_name or user_data.get("registered_users", {}).get(str(user_id), {}).get("first_name", "")
     
     user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
     total_users = len(user_data.get("registered_users", {}))
@@ -1738,6 +2014,7 @@ async def send_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "║ 📊 *S T A T I S T I K  B O T*\n"
         "╠══════════════════════════════╣\n"
         f"║ 👥 *Total Pengguna* : {total_users} user\n"
+        f"║ ✅ *Transaksi Sukses* : {bot_stats.total_berhasil():,}\n"
         f"║ ⏱️ *Uptime Bot* : {uptime_str}\n"
         "╚══════════════════════════════╝\n\n"
         "🌸 *~ Selamat Berbelanja Di Hokage Legend ~* 🌸\n"
@@ -1819,12 +2096,19 @@ async def send_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode="Markdown",
                 reply_markup=reply_markup
             )
-    else:
+    elif update.message:
         await update.message.reply_text(
             text,
             parse_mode="Markdown",
             reply_markup=reply_markup
         )
+    else:
+        await context.bot.send_message(
+            user_id,
+            text,
+            parse_mode="Markdown",
+            reply_markup=reply_markup
+        )
 
 async def show_login_options_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -1859,12 +2143,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     is_new_user = user_id_str not in user_data["registered_users"]
 
     user_details = user_data["registered_users"].setdefault(user_id_str, {
-        "accounts": {}, "balance": 0, "transactions": [], "selected_hesdapkg_ids": [],
+        "accounts": {}, "balance": 0, "selected_hesdapkg_ids": [],
         "selected_30h_pkg_ids": [] 
     })
     
     user_details['first_name'] = user_first_name
     user_details['username'] = user_username
+    user_index.perbarui(user_id_str, user_username, user_first_name)
 
     if is_new_user:
         logging.info(f"User baru terdaftar: ID={user_id_str}, Nama={user_first_name}, Username=@{user_username}")
@@ -1887,16 +2172,39 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logging.error(f"Gagal mengirim notifikasi user baru ke admin: {e}")
 
-    simpan_data_ke_db()
+    simpan_data_ke_db(user_id_str)
     await delete_last_message(user_id_str, context)
     await send_main_menu(update, context)
 
+def sinkronkan_profil_user(user):
+    """Perbarui nama & username user terdaftar (dan indeks pencarian) jika berubah di profil Telegram."""
+    details = user_data["registered_users"].get(str(user.id))
+    if details is None:
+        return
+    first_name = user.first_name or "N/A"
+    username = user.username or "N/A"
+    if details.get('first_name') == first_name and details.get('username') == username:
+        return
+    details['first_name'] = first_name
+    details['username'] = username
+    user_index.perbarui(user.id, username, first_name)
+    simpan_data_ke_db(user.id)
+
+def resolusi_target_user(teks):
+    """ID user dari input admin berupa ID angka atau @username, atau None jika username tidak dikenal."""
+    if teks.isdigit():
+        return int(teks)
+    user_id = user_index.cari_username(teks)
+    return int(user_id) if user_id else None
+
 async def check_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     if user_id == ADMIN_ID:
         return True
 
+    sinkronkan_profil_user(update.effective_user)
+
     if user_id in user_data.get("blocked_users", []):
         message_text = "ANDA TELAH DIBLOKIR DAN TIDAK DAPAT MENGAKSES BOT INI. Silakan hubungi admin."
         if update.callback_query:
@@ -1914,9 +2222,9 @@ async def check_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return True
 
 async def get_kmsp_balance():
+    """Ambil saldo akun panel KMSP: (saldo int, None) jika berhasil, (None, pesan error) jika gagal."""
     try:
-        url = f"https://golang-openapi-panelaccountbalance-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}"
-        response = requests.get(url, timeout=10)
+        response = await provider_client.kmsp_get("panelaccountbalance", KMSP_API_KEY)
         response.raise_for_status()
         api_response = response.json()
         logging.info(f"KMSP balance API response: {api_response}")
@@ -1925,28 +2233,42 @@ async def get_kmsp_balance():
             balance_value = api_response['data'].get('balance')
             if balance_value is not None:
                 try:
-                    formatted_balance = f"Rp{int(float(balance_value)):,}"
-                    return formatted_balance
+                    return int(float(balance_value)), None
                 except (ValueError, TypeError):
                     logging.error(f"Gagal mengonversi nilai saldo '{balance_value}' menjadi angka.")
-                    return "Format saldo tidak valid"
+                    return None, "Format saldo tidak valid"
 
         message = api_response.get('message', 'Respons API tidak dikenali.')
         logging.warning(f"Struktur respons API KMSP tidak seperti yang diharapkan. Pesan: {message}")
-        return f"Info dari API: {message}"
+        return None, f"Info dari API: {message}"
 
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         logging.error(f"HTTP Error saat mengambil saldo KMSP: {e}")
-        return "API tidak dapat diakses (HTTP Error)"
-    except requests.exceptions.RequestException as e:
+        return None, "API tidak dapat diakses (HTTP Error)"
+    except httpx.HTTPError as e:
         logging.error(f"Error jaringan saat mengambil saldo KMSP: {e}")
-        return "Gagal terhubung ke server API"
+        return None, "Gagal terhubung ke server API"
     except json.JSONDecodeError:
         logging.error(f"Gagal memecah JSON dari API saldo KMSP. Respon: {response.text}")
-        return "Respons API tidak valid (Bukan JSON)"
+        return None, "Respons API tidak valid (Bukan JSON)"
     except Exception as e:
         logging.error(f"Kesalahan tak terduga saat mengambil saldo KMSP: {e}", exc_info=True)
-        return "Kesalahan tak terduga terjadi"
+        return None, "Kesalahan tak terduga terjadi"
+
+async def poll_saldo_kmsp_job(context: ContextTypes.DEFAULT_TYPE):
+    saldo, pesan = await get_kmsp_balance()
+    panel_balance.perbarui(saldo, pesan)
+    if panel_balance.perlu_peringatan():
+        try:
+            await context.bot.send_message(
+                ADMIN_ID,
+                f"⚠️ *Saldo akun LOGIN menipis!*\nSaldo saat ini: *Rp{panel_balance.saldo():,}* "
+                f"(batas peringatan Rp{panel_balance.BATAS_PERINGATAN:,}).\n"
+                f"Pembelian akan ditolak otomatis jika saldo di bawah Rp{panel_balance.BATAS_BLOKIR:,}.",
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            logging.warning(f"Gagal mengirim peringatan saldo panel ke admin: {e}")
 
 async def jalankan_cek_kuota_baru(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -1957,7 +2279,7 @@ async def jalankan_cek_kuota_baru(update: Update, context: ContextTypes.DEFAULT_
             '❌ Format nomor tidak valid. Masukkan nomor dalam format `08xxxx` atau `62xxxx`.',
             parse_mode="Markdown"
         )
-        context.user_data['next'] = 'handle_cek_kuota_baru_input'
+        step_router.set_next(context, 'handle_cek_kuota_baru_input')
         return
 
     if nomor_input.startswith('08'):
@@ -1975,7 +2297,7 @@ async def jalankan_cek_kuota_baru(update: Update, context: ContextTypes.DEFAULT_
             "X-App-Version": "4.0.0"
         }
         
-        response = requests.get(url, headers=headers, timeout=20)
+        response = await http_client.get(url, headers=headers, timeout=20)
         response.raise_for_status() 
         
         response_json = response.json()
@@ -1997,17 +2319,17 @@ async def jalankan_cek_kuota_baru(update: Update, context: ContextTypes.DEFAULT_
             await context.bot.send_message(user_id, f"❌ Terjadi kesalahan: `{error_text}`", parse_mode="Markdown")
             await send_main_menu(update, context)
 
-    except requests.exceptions.ConnectionError as e:                                   
+    except httpx.ConnectError as e:                                   
         logging.error(f"Connection Error Cek Kuota Baru untuk nomor {nomor}: {e}", exc_info=True)
         await status_msg.delete()
         await context.bot.send_message(user_id, "❌ Gagal terhubung ke server pengecekan kuota. Mohon coba lagi nanti.")
         await send_main_menu(update, context)
-    except requests.exceptions.Timeout as e:                       
+    except httpx.TimeoutException as e:                       
         logging.error(f"Timeout Error Cek Kuota Baru untuk nomor {nomor}: {e}", exc_info=True)
         await status_msg.delete()
         await context.bot.send_message(user_id, "❌ Waktu tunggu habis saat mengecek kuota. Mohon coba lagi nanti.")
         await send_main_menu(update, context)
-    except requests.exceptions.RequestException as e:                                 
+    except httpx.HTTPError as e:                                 
         logging.error(f"General Request Error Cek Kuota Baru untuk nomor {nomor}: {e}", exc_info=True)
         await status_msg.delete()
         await context.bot.send_message(user_id, "❌ Terjadi kesalahan saat request pengecekan kuota. Mohon coba lagi nanti.")
@@ -2018,23 +2340,11 @@ async def jalankan_cek_kuota_baru(update: Update, context: ContextTypes.DEFAULT_
         await context.bot.send_message(user_id, "❌ Terjadi kesalahan tak terduga. Silakan hubungi admin.")
         await send_main_menu(update, context)
 
-async def get_api_package_details(package_code: str):
-    try:
-        url = f"https://golang-openapi-packagelist-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}"
-        response = requests.get(url, timeout=20)
-        response.raise_for_status()
-        all_packages = response.json().get("data", [])
-        
-        for package in all_packages:
-            if package.get("package_code") == package_code:
-                return package                                           
-        return None                                       
-    except requests.RequestException as e:
-        logging.error(f"Gagal mengambil list paket dari API: {e}")
-        return None
-    except json.JSONDecodeError:
-        logging.error("Gagal memecah JSON dari API list paket.")
-        return None
+async def refresh_katalog_paket_job(context: ContextTypes.DEFAULT_TYPE):
+    await package_catalog.refresh(KMSP_API_KEY)
+
+async def probe_endpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    await provider_client.probe_endpoint_terbuka(KMSP_API_KEY)
 
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -2042,24 +2352,16 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Anda tidak memiliki izin untuk menggunakan perintah ini.")
         return
 
-    msg_info = None
-    if update.callback_query:
-        try:
-            await update.callback_query.edit_message_text("Memuat data statistik, harap tunggu...")
-            msg_info = update.callback_query.message
-        except Exception:
-             msg_info = await context.bot.send_message(user_id, "Memuat data statistik, harap tunggu...")
-    else:
-        msg_info = await context.bot.send_message(user_id, "Memuat data statistik, harap tunggu...")
-
-
     total_users = len(user_data.get("registered_users", {}))
-    kmsp_balance = await get_kmsp_balance()
+    kmsp_balance = panel_balance.teks()
+    hari_ini = bot_stats.harian()
 
     header_text = (
         f"📊 *Statistik Bot*\n"
         f"👥 Total Pengguna: *{total_users}*\n"
-        f"💰 Saldo Akun LOGIN: *{kmsp_balance}*\n\n"                        
+        f"💰 Saldo Akun LOGIN: *{kmsp_balance}*\n"
+        f"🛒 Hari Ini: *{hari_ini['berhasil']}* sukses / *{hari_ini['gagal']}* gagal, omzet *Rp{hari_ini['pendapatan']:,}*\n"
+        f"📦 Total Transaksi: *{bot_stats.total_berhasil():,}* sukses / *{bot_stats.total_gagal():,}* gagal\n\n"
         "👑 *Panel Admin Bot XL Tembak*\n"
         "Pilih tindakan yang ingin Anda lakukan:"
     )
@@ -2088,67 +2390,52 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardButton("➕ Paket Kustom", callback_data='admin_add_custom_package'),
             InlineKeyboardButton("✏️ Edit Paket Kustom", callback_data='admin_edit_custom_package_menu')
         ],
-        [InlineKeyboardButton("📢 Broadcast Pesan", callback_data='admin_broadcast')],
+        [
+            InlineKeyboardButton("📢 Broadcast Pesan", callback_data='admin_broadcast'),
+            InlineKeyboardButton("📈 Statistik Paket", callback_data='admin_sales_stats')
+        ],
         [InlineKeyboardButton("🏠 Kembali ke Menu User", callback_data='back_to_menu')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    try:
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=msg_info.message_id,
-            text=header_text,
-            parse_mode="Markdown",
-            reply_markup=reply_markup
-        )
-    except Exception as e:
-        logging.warning(f"Gagal mengedit pesan admin menu: {e}. Mengirim pesan baru.")
-        await context.bot.delete_message(chat_id=user_id, message_id=msg_info.message_id)
-        await context.bot.send_message(user_id, header_text, parse_mode="Markdown", reply_markup=reply_markup)
+    if update.callback_query:
+        try:
+            await update.callback_query.edit_message_text(header_text, parse_mode="Markdown", reply_markup=reply_markup)
+            return
+        except Exception as e:
+            logging.warning(f"Gagal mengedit pesan admin menu: {e}. Mengirim pesan baru.")
+    await context.bot.send_message(user_id, header_text, parse_mode="Markdown", reply_markup=reply_markup)
 
-async def admin_check_user_balances(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
+async def admin_check_user_balances(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0, arah=None, kursor=()):
     try:
         query = update.callback_query
-        all_users = user_data.get("registered_users", {})
-
-        user_balances = [
-            {
-                "id": uid,
-                "name": details.get("first_name", "N/A"),
-                "username": details.get("username", "N/A"),
-                "balance": details.get("balance", 0)
-            } for uid, details in all_users.items()
-        ]
-
-        sorted_users = sorted(user_balances, key=lambda x: x['balance'], reverse=True)
-        
-        start_index = page * USERS_PER_PAGE_ADMIN
-        end_index = start_index + USERS_PER_PAGE_ADMIN
-        paginated_users = sorted_users[start_index:end_index]
+        rows, ada_lagi = ambil_halaman_user("saldo", USERS_PER_PAGE_ADMIN, arah, kursor)
 
-        if not paginated_users and page == 0:
+        if not rows and page == 0:
             text = "Tidak ada user terdaftar untuk ditampilkan."
             keyboard = [[InlineKeyboardButton("🔙 Kembali ke Menu Admin", callback_data="admin_back_to_menu")]]
             await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
             return
-        elif not paginated_users:
+        elif not rows:
             await query.answer("Anda sudah di halaman terakhir.", show_alert=True)
             return
 
+        start_index = page * USERS_PER_PAGE_ADMIN
         response_text = f"💰 *Daftar Saldo User (Hal. {page + 1})*\n(Terbesar ke Terkecil)\n\n"
-        for i, user in enumerate(paginated_users, start=start_index + 1):
+        for i, (uid, name, username, balance) in enumerate(rows, start=start_index + 1):
             response_text += (
-                f"*{i}.* Nama: `{user['name']}` (@`{user['username']}`)\n"
-                f"   ID: `{user['id']}`\n"
-                f"   Saldo: *Rp{user['balance']:,}*\n\n"
+                f"*{i}.* Nama: `{name or 'N/A'}` (@`{username or 'N/A'}`)\n"
+                f"   ID: `{uid}`\n"
+                f"   Saldo: *Rp{balance or 0:,}*\n\n"
             )
         
         keyboard = []
         nav_buttons = []
+        pertama, terakhir = rows[0], rows[-1]
         if page > 0:
-            nav_buttons.append(InlineKeyboardButton("⏪ Sebelumnya", callback_data=f"admin_user_balance_page_{page-1}"))
-        if end_index < len(sorted_users):
-            nav_buttons.append(InlineKeyboardButton("Berikutnya ⏩", callback_data=f"admin_user_balance_page_{page+1}"))
+            nav_buttons.append(InlineKeyboardButton("⏪ Sebelumnya", callback_data=f"admin_user_balance_page_{page-1}_p_{pertama[3] or 0}_{pertama[0]}"))
+        if ada_lagi or arah == "p":
+            nav_buttons.append(InlineKeyboardButton("Berikutnya ⏩", callback_data=f"admin_user_balance_page_{page+1}_n_{terakhir[3] or 0}_{terakhir[0]}"))
         
         if nav_buttons:
             keyboard.append(nav_buttons)
@@ -2174,7 +2461,7 @@ async def admin_check_user_balances(update: Update, context: ContextTypes.DEFAUL
             logging.error(f"Gagal mengedit pesan error, mengirim pesan baru: {edit_e}")
             await context.bot.send_message(chat_id=update.effective_chat.id, text=error_text, parse_mode="Markdown", reply_markup=reply_markup)
 
-async def admin_display_user_transactions(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int):
+async def admin_display_user_transactions(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int, arah=None, kursor_id=None):
     user_id_admin = update.effective_user.id
     query = update.callback_query                                        
     
@@ -2192,14 +2479,10 @@ async def admin_display_user_transactions(update: Update, context: ContextTypes.
         return
 
     user_info = user_data["registered_users"][target_user_id_str]
-    transactions = user_info.get('transactions', [])
-    
-                                                                            
-    sorted_transactions = sorted(transactions, key=lambda x: datetime.strptime(x['timestamp'], '%Y-%m-%d %H:%M:%S'), reverse=True)
-
-    start_index = page * TRANSACTIONS_PER_PAGE_ADMIN
-    end_index = start_index + TRANSACTIONS_PER_PAGE_ADMIN
-    paginated_transactions = sorted_transactions[start_index:end_index]
+    filter_tx = context.user_data.setdefault('admin_tx_filter', {"status": "semua", "periode": "semua"})
+    paginated_transactions, ada_lagi = ambil_transaksi_user(
+        target_user_id_str, TRANSACTIONS_PER_PAGE_ADMIN, arah, kursor_id, filter_tx["status"], filter_tx["periode"]
+    )
 
     response_text_parts = []
     response_text_parts.append(f"*Riwayat Transaksi untuk User:*\n")
@@ -2207,7 +2490,10 @@ async def admin_display_user_transactions(update: Update, context: ContextTypes.
     response_text_parts.append(f"Nama: `{user_info.get('first_name', 'N/A')}`")
     response_text_parts.append(f"Username: `@{user_info.get('username', 'N/A')}`")
     response_text_parts.append(f"Saldo Saat Ini: `Rp{user_info.get('balance', 0):,}`\n")
-    response_text_parts.append(f"--- Riwayat Transaksi (Hal. {page + 1}/{math.ceil(len(sorted_transactions) / TRANSACTIONS_PER_PAGE_ADMIN)}) ---\n")
+    response_text_parts.append(
+        f"--- Riwayat Transaksi (Hal. {page + 1}, Status: {FILTER_STATUS_TRANSAKSI[filter_tx['status']][0]}, "
+        f"Periode: {FILTER_PERIODE_TRANSAKSI[filter_tx['periode']][0]}) ---\n"
+    )
 
     if paginated_transactions:
         for tx in paginated_transactions:
@@ -2232,14 +2518,18 @@ async def admin_display_user_transactions(update: Update, context: ContextTypes.
     
     keyboard = []
     nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⏪ Sebelumnya", callback_data=f"admin_tx_page_{page-1}"))
-    if end_index < len(sorted_transactions):
-        nav_buttons.append(InlineKeyboardButton("Berikutnya ⏩", callback_data=f"admin_tx_page_{page+1}"))
+    if page > 0 and paginated_transactions:
+        nav_buttons.append(InlineKeyboardButton("⏪ Sebelumnya", callback_data=f"admin_tx_page_{page-1}_p_{paginated_transactions[0]['id']}"))
+    if paginated_transactions and (ada_lagi or arah == "p"):
+        nav_buttons.append(InlineKeyboardButton("Berikutnya ⏩", callback_data=f"admin_tx_page_{page+1}_n_{paginated_transactions[-1]['id']}"))
     
     if nav_buttons:
         keyboard.append(nav_buttons)
     
+    keyboard.append([
+        InlineKeyboardButton(f"Status: {FILTER_STATUS_TRANSAKSI[filter_tx['status']][0]}", callback_data="admin_tx_filter_status"),
+        InlineKeyboardButton(f"Periode: {FILTER_PERIODE_TRANSAKSI[filter_tx['periode']][0]}", callback_data="admin_tx_filter_periode")
+    ])
     keyboard.append([InlineKeyboardButton("🔙 Kembali ke Menu Admin", callback_data="admin_back_to_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -2258,6 +2548,190 @@ async def admin_display_user_transactions(update: Update, context: ContextTypes.
         else:
             await context.bot.send_message(user_id_admin, error_message)
 
+
+@callback_router.route("admin_add_balance", grup="admin")
+async def cb_admin_add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    msg = await context.bot.send_message(user_id, "Masukkan ID User (atau @username) dan jumlah saldo yang ingin ditambahkan (contoh: `123456789 10000`):", parse_mode="Markdown")
+    bot_messages.setdefault(user_id, []).append(msg.message_id)
+    step_router.set_next(context, 'admin_handle_add_balance_input')
+
+
+@callback_router.route("admin_deduct_balance", grup="admin")
+async def cb_admin_deduct_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    msg = await context.bot.send_message(user_id, "Masukkan ID User (atau @username) dan jumlah saldo yang ingin dikurangi (contoh: `123456789 5000`):", parse_mode="Markdown")
+    bot_messages.setdefault(user_id, []).append(msg.message_id)
+    step_router.set_next(context, 'admin_handle_deduct_balance_input')
+
+
+@callback_router.route("admin_block_user_menu", grup="admin")
+async def cb_admin_block_user_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    msg = await context.bot.send_message(user_id, "Masukkan ID User yang ingin diblokir:", parse_mode="Markdown")
+    bot_messages.setdefault(user_id, []).append(msg.message_id)
+    step_router.set_next(context, 'admin_handle_block_user_input')
+
+
+@callback_router.route("admin_unblock_user_menu", grup="admin")
+async def cb_admin_unblock_user_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    msg = await context.bot.send_message(user_id, "Masukkan ID User yang ingin dibatalkan blokirnya:", parse_mode="Markdown")
+    bot_messages.setdefault(user_id, []).append(msg.message_id)
+    step_router.set_next(context, 'admin_handle_unblock_user_input')
+
+
+@callback_router.route("admin_broadcast", grup="admin")
+async def cb_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    msg = await context.bot.send_message(user_id, "Kirim pesan, foto, atau media lain yang ingin Anda broadcast ke semua user. Pesan ini akan dikirim persis seperti yang Anda kirimkan:")
+    bot_messages.setdefault(user_id, []).append(msg.message_id)
+    step_router.set_next(context, 'admin_handle_broadcast_message_content')
+
+
+@callback_router.route(prefix="admin_toggle_method_", grup="admin")
+async def cb_admin_toggle_method(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_toggle_payment_method(update, context)
+
+
+@callback_router.route("admin_save_custom_package", grup="admin")
+async def cb_admin_save_custom_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_save_custom_package(update, context)
+
+
+@callback_router.route("admin_search_user_menu", grup="admin")
+async def cb_admin_search_user_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    msg = await context.bot.send_message(user_id, "Masukkan nama depan atau username user yang ingin dicari:", parse_mode="Markdown")
+    bot_messages.setdefault(user_id, []).append(msg.message_id)
+    step_router.set_next(context, 'admin_handle_search_user_input')
+
+
+@callback_router.route("admin_check_user_transactions_menu", grup="admin")
+async def cb_admin_check_user_transactions_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    msg = await context.bot.send_message(user_id, "Masukkan nama depan atau username user yang riwayat transaksinya ingin dicek:", parse_mode="Markdown")
+    bot_messages.setdefault(user_id, []).append(msg.message_id)
+    step_router.set_next(context, 'admin_handle_check_user_transactions_input')
+
+
+@callback_router.route("admin_check_api_packages", grup="admin")
+async def cb_admin_check_api_packages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_check_api_packages(update, context)
+
+
+@callback_router.route("admin_search_api_package_menu", grup="admin")
+async def cb_admin_search_api_package_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    msg = await context.bot.send_message(user_id, "Masukkan kata kunci (nama paket atau kode paket) untuk mencari paket:", parse_mode="Markdown")
+    bot_messages.setdefault(user_id, []).append(msg.message_id)
+    step_router.set_next(context, 'admin_handle_search_api_package_input')
+
+
+@callback_router.route("admin_add_custom_package", grup="admin")
+async def cb_admin_add_custom_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_add_custom_package_code(update, context)
+
+
+@callback_router.route("admin_edit_custom_package_menu", grup="admin")
+async def cb_admin_edit_custom_package_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_edit_custom_package_menu(update, context)
+
+
+@callback_router.route("admin_check_user_balances", grup="admin")
+async def cb_admin_check_user_balances(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_check_user_balances(update, context, page=0)
+
+
+@callback_router.route("admin_sales_stats", grup="admin")
+async def cb_admin_sales_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    lines = ["📈 *Statistik Paket (Top 10)*\n"]
+    for paket, counter in bot_stats.per_paket(10):
+        lines.append(f"• `{paket}`: {counter['berhasil']} sukses / {counter['gagal']} gagal, omzet Rp{counter['pendapatan']:,}")
+    if len(lines) == 1:
+        lines.append("Belum ada transaksi pembelian.")
+    keyboard = [[InlineKeyboardButton("🔙 Kembali ke Menu Admin", callback_data="admin_back_to_menu")]]
+    await query.edit_message_text("\n".join(lines), parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+@callback_router.route("admin_list_users", grup="admin")
+async def cb_admin_list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_list_users(update, context, page=0)
+
+
+@callback_router.route(prefix="admin_list_users_page_", grup="admin")
+async def cb_admin_list_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    page, arah, kursor = parse_kursor_halaman(query.data, "admin_list_users_page_")
+    await admin_list_users(update, context, page=page, arah=arah, kursor=kursor)
+
+
+@callback_router.route(prefix="admin_user_balance_page_", grup="admin")
+async def cb_admin_user_balance_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    page, arah, kursor = parse_kursor_halaman(query.data, "admin_user_balance_page_")
+    await admin_check_user_balances(update, context, page=page, arah=arah, kursor=kursor)
+
+
+@callback_router.route(prefix="admin_edit_package_", grup="admin")
+async def cb_admin_edit_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    package_code = data.replace('admin_edit_package_', '')
+    await admin_prompt_edit_custom_package(update, context, package_code)
+
+
+@callback_router.route(prefix="admin_delete_package_", grup="admin")
+async def cb_admin_delete_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    package_code = data.replace('admin_delete_package_', '')
+    await admin_confirm_delete_custom_package(update, context, package_code)
+
+
+@callback_router.route("admin_back_to_menu", grup="admin")
+async def cb_admin_back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_menu(update, context)
+
+
+@callback_router.route(prefix="admin_top_up_confirm_", grup="admin")
+async def cb_admin_top_up_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_confirm_user_top_up(update, context)
+
+
+@callback_router.route(prefix="admin_top_up_reject_", grup="admin")
+async def cb_admin_top_up_reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_reject_user_top_up(update, context)
+
+
+@callback_router.route(prefix="admin_tx_page_", grup="admin")
+async def cb_admin_tx_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    page, arah, kursor = parse_kursor_halaman(query.data, "admin_tx_page_")
+    await admin_display_user_transactions(update, context, page=page, arah=arah, kursor_id=kursor[0])
+
+
+@callback_router.route(prefix="admin_tx_filter_", grup="admin")
+async def cb_admin_tx_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Putar filter status/periode riwayat transaksi ke pilihan berikutnya, lalu tampilkan ulang dari halaman pertama."""
+    query = update.callback_query
+    jenis = query.data.replace("admin_tx_filter_", "")
+    pilihan = list(FILTER_STATUS_TRANSAKSI if jenis == "status" else FILTER_PERIODE_TRANSAKSI)
+    filter_tx = context.user_data.setdefault('admin_tx_filter', {"status": "semua", "periode": "semua"})
+    filter_tx[jenis] = pilihan[(pilihan.index(filter_tx[jenis]) + 1) % len(pilihan)]
+    await admin_display_user_transactions(update, context, page=0)
+
+
+@callback_router.route("admin_next_api_package_page", grup="admin")
+async def cb_admin_next_api_package_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_next_api_package_page(update, context)
+
+
+@callback_router.route("admin_prev_api_package_page", grup="admin")
+async def cb_admin_prev_api_package_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await admin_prev_api_package_page(update, context)
+
 async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
@@ -2348,14 +2822,16 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
 
                                                                                 
             if deducted_balance > 0:
-                user_data["registered_users"][str(user_id)]["balance"] -= deducted_balance
-                simpan_data_ke_db()
+                if not debit_saldo(user_id, deducted_balance, "pembelian", kunci_update(update, "pembelian")):
+                    await context.bot.send_message(user_id, f"❌ Gagal mencoba lagi: {pesan_debit_gagal(user_id, deducted_balance)}")
+                    return
+                simpan_data_ke_db(user_id)
                 await context.bot.send_message(user_id, f"Mencoba lagi pembelian... Saldo Anda terpotong: *Rp{deducted_balance:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
 
             if provider == "kmsp":
                                                                                  
                 current_phone_in_user_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("current_phone")
-                access_token = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(current_phone_in_user_data, {}).get("kmsp", {}).get("access_token")
+                access_token = account_store.token(user_id, current_phone_in_user_data, "kmsp")
                 if not access_token:
                     await context.bot.send_message(user_id, "Gagal mencoba lagi: Token LOGIN tidak ditemukan. Silakan login ulang LOGIN.")
                     return
@@ -2364,7 +2840,7 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
             elif provider == "hesda":
                                                                                                                             
                 phone_for_hesda_retry = phone                                                  
-                access_token_hesda = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone_for_hesda_retry, {}).get("hesda", {}).get("access_token")
+                access_token_hesda = account_store.token(user_id, phone_for_hesda_retry, "hesda")
                 
                 if not access_token_hesda:
                     await context.bot.send_message(user_id, f"Gagal mencoba lagi: Token BYPAS tidak ditemukan untuk nomor `{phone_for_hesda_retry}`. Silakan login ulang BYPAS untuk nomor ini.")
@@ -2376,12 +2852,12 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
                     }
                     context.user_data['temp_phone_for_login'] = phone_for_hesda_retry
                     context.user_data['current_login_provider'] = 'hesda'
-                    context.user_data['next'] = 'handle_login_otp_input'
+                    step_router.set_next(context, 'handle_login_otp_input')
                     context.user_data['resume_hesda_purchase_after_otp'] = True
                     await request_otp_and_prompt_hesda(update, context, phone_for_hesda_retry)
                     return                              
 
-                asyncio.create_task(execute_single_purchase_hesda(update, context, user_id, package_id_or_code, package_name, phone, access_token_hesda, payment_method, deducted_balance, return_menu_callback_data))
+                asyncio.create_task(pembelian_hesda_tunggal(update, context, user_id, package_id_or_code, package_name, phone, access_token_hesda, payment_method, deducted_balance, return_menu_callback_data))
         except (json.JSONDecodeError, KeyError, ValueError) as e:
             logging.error(f"Error decoding retry payload for user {user_id}, data: {data}. Error: {e}", exc_info=True)
             await context.bot.send_message(user_id, "❌ Terjadi kesalahan saat memproses permintaan coba lagi. Data tidak valid. Silakan coba beli dari awal.")
@@ -2413,85 +2889,8 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
     else:
         await query.answer()
 
+    await callback_router.dispatch(update, context, data, grup="admin")
 
-    if data == 'admin_add_balance':
-        msg = await context.bot.send_message(user_id, "Masukkan ID User dan jumlah saldo yang ingin ditambahkan (contoh: `123456789 10000`):", parse_mode="Markdown")
-        bot_messages.setdefault(user_id, []).append(msg.message_id)
-        context.user_data['next'] = 'admin_handle_add_balance_input'
-    elif data == 'admin_deduct_balance':
-        msg = await context.bot.send_message(user_id, "Masukkan ID User dan jumlah saldo yang ingin dikurangi (contoh: `123456789 5000`):", parse_mode="Markdown")
-        bot_messages.setdefault(user_id, []).append(msg.message_id)
-        context.user_data['next'] = 'admin_handle_deduct_balance_input'
-    elif data == 'admin_block_user_menu':
-        msg = await context.bot.send_message(user_id, "Masukkan ID User yang ingin diblokir:", parse_mode="Markdown")
-        bot_messages.setdefault(user_id, []).append(msg.message_id)
-        context.user_data['next'] = 'admin_handle_block_user_input'
-    elif data == 'admin_unblock_user_menu':
-        msg = await context.bot.send_message(user_id, "Masukkan ID User yang ingin dibatalkan blokirnya:", parse_mode="Markdown")
-        bot_messages.setdefault(user_id, []).append(msg.message_id)
-        context.user_data['next'] = 'admin_handle_unblock_user_input'
-    
-    elif data == 'admin_broadcast':
-        msg = await context.bot.send_message(user_id, "Kirim pesan, foto, atau media lain yang ingin Anda broadcast ke semua user. Pesan ini akan dikirim persis seperti yang Anda kirimkan:")
-        bot_messages.setdefault(user_id, []).append(msg.message_id)
-        context.user_data['next'] = 'admin_handle_broadcast_message_content'
-    
-    elif data.startswith('admin_toggle_method_'):
-        await admin_toggle_payment_method(update, context)
-    elif data == 'admin_save_custom_package':
-        await admin_save_custom_package(update, context)
-    
-    elif data == 'admin_search_user_menu':
-        msg = await context.bot.send_message(user_id, "Masukkan nama depan atau username user yang ingin dicari:", parse_mode="Markdown")
-        bot_messages.setdefault(user_id, []).append(msg.message_id)
-        context.user_data['next'] = 'admin_handle_search_user_input'
-    elif data == 'admin_check_user_transactions_menu':
-        msg = await context.bot.send_message(user_id, "Masukkan nama depan atau username user yang riwayat transaksinya ingin dicek:", parse_mode="Markdown")
-        bot_messages.setdefault(user_id, []).append(msg.message_id)
-        context.user_data['next'] = 'admin_handle_check_user_transactions_input'
-    elif data == 'admin_check_api_packages':
-        await admin_check_api_packages(update, context)
-    elif data == 'admin_search_api_package_menu':
-        msg = await context.bot.send_message(user_id, "Masukkan kata kunci (nama paket atau kode paket) untuk mencari paket:", parse_mode="Markdown")
-        bot_messages.setdefault(user_id, []).append(msg.message_id)
-        context.user_data['next'] = 'admin_handle_search_api_package_input'
-    elif data == 'admin_add_custom_package':
-        await admin_add_custom_package_code(update, context)
-    elif data == 'admin_edit_custom_package_menu':
-        await admin_edit_custom_package_menu(update, context)
-    elif data == 'admin_check_user_balances':
-        await admin_check_user_balances(update, context, page=0)
-    elif data == 'admin_list_users':
-        await admin_list_users(update, context, page=0)
-    elif data.startswith('admin_list_users_page_'):
-        page = int(data.split('_')[-1])
-        await admin_list_users(update, context, page=page)
-    elif data.startswith('admin_user_balance_page_'):
-        page = int(data.split('_')[-1])
-        await admin_check_user_balances(update, context, page=page)
-    elif data.startswith('admin_edit_package_'):
-        package_code = data.replace('admin_edit_package_', '')
-        await admin_prompt_edit_custom_package(update, context, package_code)
-    elif data.startswith('admin_delete_package_'):
-        package_code = data.replace('admin_delete_package_', '')
-        await admin_confirm_delete_custom_package(update, context, package_code)
-    elif data == 'admin_back_to_menu':
-        await admin_menu(update, context)
-    elif data.startswith('admin_top_up_confirm_'):
-        await admin_confirm_user_top_up(update, context)
-    elif data.startswith('admin_top_up_reject_'):
-        await admin_reject_user_top_up(update, context)
-    elif data.startswith('admin_tx_page_'):
-        page = int(data.split('_')[-1])
-        await admin_display_user_transactions(update, context, page=page)
-        return
-    elif data == 'admin_next_api_package_page':
-        await admin_next_api_package_page(update, context)
-        return
-    elif data == 'admin_prev_api_package_page':
-        await admin_prev_api_package_page(update, context)
-        return
-                        
 async def admin_edit_custom_package_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id_admin = update.effective_user.id
     custom_packages = user_data.get("custom_packages", {})
@@ -2535,8 +2934,7 @@ async def admin_prompt_edit_custom_package(update: Update, context: ContextTypes
             "Ketik nama baru untuk paket ini atau ketik `SKIP` untuk tidak mengubah nama:")
     
     await context.bot.send_message(user_id_admin, text, parse_mode="Markdown")
-    context.user_data['next'] = 'admin_edit_custom_package_name_input'
-
+    step_router.set_next(context, 'admin_edit_custom_package_name_input')
 async def admin_confirm_delete_custom_package(update: Update, context: ContextTypes.DEFAULT_TYPE, package_code: str):
     user_id_admin = update.effective_user.id
     package_details = user_data["custom_packages"].get(package_code)
@@ -2554,8 +2952,7 @@ async def admin_confirm_delete_custom_package(update: Update, context: ContextTy
     
     context.user_data['confirm_delete_package_code'] = package_code
     await context.bot.send_message(user_id_admin, text, parse_mode="Markdown")
-    context.user_data['next'] = 'admin_handle_delete_custom_package_confirmation'
-
+    step_router.set_next(context, 'admin_handle_delete_custom_package_confirmation')
 def extract_package_display_name(package_full_name: str) -> str:
     match1 = re.search(r'\]\s*(.*?)(?:\s*\(|$)', package_full_name)
     if match1:
@@ -2584,69 +2981,59 @@ def extract_package_display_name(package_full_name: str) -> str:
 async def admin_check_api_packages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id_admin = update.effective_user.id
     logging.info(f"Admin {user_id_admin} meminta daftar paket API.")
-    try:
-        response = requests.get(f"https://golang-openapi-packagelist-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}")
-        response.raise_for_status()
-        paket_data = response.json().get("data", [])
-        
-        context.user_data['all_api_packages'] = paket_data
-        
-        page = 0
-        context.user_data['api_package_current_page'] = page
-        
-        per_page = PACKAGES_PER_PAGE_ADMIN
-        start = page * per_page
-        end = start + per_page
-        sliced = paket_data[start:end]
+    paket_data = await package_catalog.get_packages(KMSP_API_KEY)
+    if paket_data is None:
+        await context.bot.send_message(user_id_admin, "Terjadi kesalahan saat mengambil daftar paket dari API. Mohon coba lagi nanti.")
+        await admin_menu(update, context)
+        return
+
+    page = 0
+    context.user_data['api_package_current_page'] = page
+    
+    per_page = PACKAGES_PER_PAGE_ADMIN
+    start = page * per_page
+    end = start + per_page
+    sliced = paket_data[start:end]
 
-        logging.debug(f"Initial load: total packages: {len(paket_data)}, page: {page}, slice: {start}-{end}")
+    logging.debug(f"Initial load: total packages: {len(paket_data)}, page: {page}, slice: {start}-{end}")
 
-        if not sliced:
-            response_text = "Tidak ada data paket dari API tersedia."
-        else:
-            response_text = "*Daftar Paket dari API:*\n\n"
-            for i, paket in enumerate(sliced):
-                full_name = paket.get("package_name", "Tanpa Nama")
-                display_name = extract_package_display_name(full_name)
-                code = paket.get("package_code", "-")
-                price = paket.get("package_harga", "N/A")
-                response_text += f"{i+1+start}. *{display_name}*\n"
-                response_text += f"   Kode: `{code}`\n"
-                response_text += f"   Harga: `Rp{price}`\n\n"
-            
-        buttons = []
-        nav_buttons = []
-        if end < len(paket_data):
-            nav_buttons.append(InlineKeyboardButton("⏩ Next", callback_data="admin_next_api_package_page"))
+    if not sliced:
+        response_text = "Tidak ada data paket dari API tersedia."
+    else:
+        response_text = "*Daftar Paket dari API:*\n\n"
+        for i, paket in enumerate(sliced):
+            full_name = paket.get("package_name", "Tanpa Nama")
+            display_name = extract_package_display_name(full_name)
+            code = paket.get("package_code", "-")
+            price = paket.get("package_harga", "N/A")
+            response_text += f"{i+1+start}. *{display_name}*\n"
+            response_text += f"   Kode: `{code}`\n"
+            response_text += f"   Harga: `Rp{price}`\n\n"
         
-        nav_buttons.append(InlineKeyboardButton("🔙 Kembali ke Menu Admin", callback_data="admin_back_to_menu"))
-        buttons.append(nav_buttons)
+    buttons = []
+    nav_buttons = []
+    if end < len(paket_data):
+        nav_buttons.append(InlineKeyboardButton("⏩ Next", callback_data="admin_next_api_package_page"))
+    
+    nav_buttons.append(InlineKeyboardButton("🔙 Kembali ke Menu Admin", callback_data="admin_back_to_menu"))
+    buttons.append(nav_buttons)
 
-        reply_markup = InlineKeyboardMarkup(buttons)
-        if update.callback_query:
-            try:
-                await update.callback_query.edit_message_text(response_text, parse_mode="Markdown", reply_markup=reply_markup)
-            except Exception as e:
-                logging.warning(f"Gagal mengedit pesan admin_check_api_packages: {e}. Mengirim pesan baru.")
-                await context.bot.send_message(user_id_admin, response_text, parse_mode="Markdown", reply_markup=reply_markup)
-        else:
+    reply_markup = InlineKeyboardMarkup(buttons)
+    if update.callback_query:
+        try:
+            await update.callback_query.edit_message_text(response_text, parse_mode="Markdown", reply_markup=reply_markup)
+        except Exception as e:
+            logging.warning(f"Gagal mengedit pesan admin_check_api_packages: {e}. Mengirim pesan baru.")
             await context.bot.send_message(user_id_admin, response_text, parse_mode="Markdown", reply_markup=reply_markup)
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error saat mengambil daftar paket API untuk admin: {e}")
-        await context.bot.send_message(user_id_admin, "Terjadi kesalahan saat mengambil daftar paket dari API. Mohon coba lagi nanti.")
-        await admin_menu(update, context)
-    except json.JSONDecodeError:
-        logging.error(f"Gagal mengurai JSON dari daftar paket API untuk admin. Respon: {response.text}")
-        await context.bot.send_message(user_id_admin, "Terjadi kesalahan saat memproses data paket dari API.")
-        await admin_menu(update, context)
+    else:
+        await context.bot.send_message(user_id_admin, response_text, parse_mode="Markdown", reply_markup=reply_markup)
 
 async def admin_next_api_package_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id_admin = update.effective_user.id
     query = update.callback_query
     await query.answer()
 
-    paket_data = context.user_data.get("all_api_packages", [])
+    paket_data = await package_catalog.get_packages(KMSP_API_KEY) or []
     if not paket_data:
         await context.bot.send_message(user_id_admin, "Tidak ada data paket yang dimuat. Silakan coba 'Cek & Kelola Paket API' lagi.")
         return
@@ -2697,7 +3084,7 @@ async def admin_prev_api_package_page(update: Update, context: ContextTypes.DEFA
     query = update.callback_query
     await query.answer()
 
-    paket_data = context.user_data.get("all_api_packages", [])
+    paket_data = await package_catalog.get_packages(KMSP_API_KEY) or []
     if not paket_data:
         await context.bot.send_message(user_id_admin, "Tidak ada data paket yang dimuat. Silakan coba 'Cek & Kelola Paket API' lagi.")
         return
@@ -2754,12 +3141,9 @@ async def admin_handle_search_user_input(update: Update, context: ContextTypes.D
         found_users.append(f"• ID: `{search_query}`\n  Nama: `{details.get('first_name', 'N/A')}`\n  Username: `@{details.get('username', 'N/A')}`\n  Saldo: `Rp{details.get('balance', 0):,}`")
     
     else:
-        search_query_lower = search_query.lower()
-        for uid_str, details in user_data["registered_users"].items():
-            first_name = details.get('first_name', '').lower()
-            username = details.get('username', '').lower()
-            
-            if search_query_lower in first_name or search_query_lower in username:
+        for uid_str in user_index.cari(search_query):
+            details = user_data["registered_users"].get(uid_str)
+            if details:
                 found_users.append(f"• ID: `{uid_str}`\n  Nama: `{details.get('first_name', 'N/A')}`\n  Username: `@{details.get('username', 'N/A')}`\n  Saldo: `Rp{details.get('balance', 0):,}`")
 
     response_text_parts = []
@@ -2778,7 +3162,7 @@ async def admin_handle_search_api_package_input(update: Update, context: Context
     if user_id_admin != ADMIN_ID: return
 
     search_query = update.message.text.strip().lower()
-    all_packages = context.user_data.get('all_api_packages', [])
+    all_packages = await package_catalog.get_packages(KMSP_API_KEY) or []
 
     if not all_packages:
         await update.message.reply_text("Data paket API belum dimuat. Silakan gunakan menu 'Cek & Kelola Paket API' terlebih dahulu.")
@@ -2828,21 +3212,14 @@ async def admin_handle_check_user_transactions_input(update: Update, context: Co
         found_user_id = search_query
         user_info = user_data["registered_users"][search_query]
     else:
-                                                             
-        search_query_lower = search_query.lower()
-        if isinstance(user_data.get("registered_users"), dict):
-            for uid_str, details in user_data["registered_users"].items():
-                first_name = details.get('first_name', '').lower()
-                username = details.get('username', '').lower()
-                
-                if search_query_lower in first_name or search_query_lower in username:
-                    found_user_id = uid_str
-                    user_info = details
-                    break
+        for uid_str in user_index.cari(search_query, batas=1):
+            found_user_id = uid_str
+            user_info = user_data["registered_users"].get(uid_str)
     
     if found_user_id and user_info:
                                               
         context.user_data['current_viewed_transactions_user_id'] = found_user_id
+        context.user_data.pop('admin_tx_filter', None)
         await admin_display_user_transactions(update, context, page=0)                    
     else:
         response_text = "❌ User tidak ditemukan. Pastikan ID, nama depan, atau username benar."
@@ -2856,8 +3233,11 @@ async def admin_handle_add_balance_input(update: Update, context: ContextTypes.D
 
     try:
         parts = update.message.text.split()
-        target_user_id = int(parts[0])
+        target_user_id = resolusi_target_user(parts[0])
         amount = int(parts[1])
+        if target_user_id is None:
+            await update.message.reply_text(f"❌ Username `{parts[0]}` tidak ditemukan.", parse_mode="Markdown")
+            return
         
         if str(target_user_id) not in user_data["registered_users"]:
             user_data["registered_users"][str(target_user_id)] = {
@@ -2865,20 +3245,19 @@ async def admin_handle_add_balance_input(update: Update, context: ContextTypes.D
                 "balance": 0,
                 "first_name": "N/A",
                 "username": "N/A",
-                "transactions": [],
                 "selected_hesdapkg_ids": []                                   
             }
             await update.message.reply_text(f"User ID `{target_user_id}` belum terdaftar, telah didaftarkan dengan saldo 0.")
 
-        user_data["registered_users"][str(target_user_id)]["balance"] += amount
-        user_data["registered_users"][str(target_user_id)]["transactions"].append({
+        kredit_saldo(target_user_id, amount, "admin_tambah", kunci_update(update, "admin_tambah"))
+        catat_transaksi(target_user_id, {
             "type": "Top Up Manual Admin",
             "amount": amount,
             "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             "admin_id": user_id_admin,
             "status": "Berhasil"
         })
-        simpan_data_ke_db()
+        simpan_data_ke_db(target_user_id)
         await update.message.reply_text(f"✅ Saldo user `{target_user_id}` berhasil ditambahkan sebesar `Rp{amount:,}`. Saldo baru: `Rp{user_data['registered_users'][str(target_user_id)]['balance']:,}`.", parse_mode="Markdown")
         try:
             await context.bot.send_message(target_user_id, f"💰 Saldo Anda telah ditambahkan sebesar *Rp{amount:,}* oleh admin. Saldo Anda sekarang: *Rp{user_data['registered_users'][str(target_user_id)]['balance']:,}*.", parse_mode="Markdown")
@@ -2896,22 +3275,27 @@ async def admin_handle_deduct_balance_input(update: Update, context: ContextType
 
     try:
         parts = update.message.text.split()
-        target_user_id = int(parts[0])
+        target_user_id = resolusi_target_user(parts[0])
         amount = int(parts[1])
+        if target_user_id is None:
+            await update.message.reply_text(f"❌ Username `{parts[0]}` tidak ditemukan.", parse_mode="Markdown")
+            return
 
         if str(target_user_id) not in user_data["registered_users"]:
             await update.message.reply_text(f"❌ User ID `{target_user_id}` tidak terdaftar.", parse_mode="Markdown")
             return
 
-        user_data["registered_users"][str(target_user_id)]["balance"] -= amount
-        user_data["registered_users"][str(target_user_id)]["transactions"].append({
+        if not debit_saldo(target_user_id, amount, "admin_kurangi", kunci_update(update, "admin_kurangi")):
+            await update.message.reply_text(f"❌ Saldo user `{target_user_id}` (Rp{user_data['registered_users'][str(target_user_id)]['balance']:,}) tidak cukup untuk dikurangi `Rp{amount:,}`.", parse_mode="Markdown")
+            return
+        catat_transaksi(target_user_id, {
             "type": "Kurangi Saldo Manual Admin",
             "amount": -amount,
             "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             "admin_id": user_id_admin,
             "status": "Info"
         })
-        simpan_data_ke_db()
+        simpan_data_ke_db(target_user_id)
         await update.message.reply_text(f"✅ Saldo user `{target_user_id}` berhasil dikurangi sebesar `Rp{amount:,}`. Saldo baru: `Rp{user_data['registered_users'][str(target_user_id)]['balance']:,}`.", parse_mode="Markdown")
         try:
             await context.bot.send_message(target_user_id, f"💸 Saldo Anda telah dikurangi sebesar *Rp{amount:,}* oleh admin. Saldo Anda sekarang: *Rp{user_data['registered_users'][str(target_user_id)]['balance']:,}*.", parse_mode="Markdown")
@@ -2937,7 +3321,9 @@ async def admin_handle_block_user_input(update: Update, context: ContextTypes.DE
             user_data["blocked_users"].append(user_to_block)
             if str(user_to_block) in user_data["registered_users"]:
                 del user_data["registered_users"][str(user_to_block)]
-            simpan_data_ke_db()
+                user_index.hapus(user_to_block)
+                account_store.hapus(user_to_block)
+            simpan_data_ke_db(user_to_block)
             await update.message.reply_text(f"❌ User ID `{user_to_block}` berhasil diblokir dan datanya dihapus.", parse_mode="Markdown")
             try:
                 await context.bot.send_message(user_to_block, "⛔ Anda telah diblokir dan tidak dapat lagi menggunakan bot ini. Silakan hubungi admin jika Anda merasa ini adalah kesalahan.")
@@ -2964,10 +3350,9 @@ async def admin_handle_unblock_user_input(update: Update, context: ContextTypes.
                     "balance": 0,
                     "first_name": "N/A",
                     "username": "N/A",
-                    "transactions": [],
-                    "selected_hesdapkg_ids": []                                 
+                    "selected_hesdapkg_ids": []
                 }
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_to_unblock)
             await update.message.reply_text(f"✅ User ID `{user_to_unblock}` berhasil dibatalkan blokirnya.", parse_mode="Markdown")
             try:
                 await context.bot.send_message(user_to_unblock, "🔓 Blokir Anda telah dicabut. Anda sekarang dapat menggunakan bot ini kembali. Silakan ketik `/start`.")
@@ -2983,24 +3368,25 @@ async def admin_handle_unblock_user_input(update: Update, context: ContextTypes.
 async def admin_add_custom_package_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id_admin = update.effective_user.id
     await context.bot.send_message(user_id_admin, "Masukkan Kode Paket dari API KMSP:")
-    context.user_data['next'] = 'admin_handle_smart_package_code_input'
-
+    step_router.set_next(context, 'admin_handle_smart_package_code_input')
 async def admin_handle_smart_package_code_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id_admin = update.effective_user.id
     code = update.message.text.strip()
 
     if code in user_data["custom_packages"]:
         await update.message.reply_text(f"❌ Kode `{code}` sudah ada di database paket kustom. Gunakan kode lain atau edit yang sudah ada.")
-        context.user_data['next'] = 'admin_handle_smart_package_code_input'
+        step_router.set_next(context, 'admin_handle_smart_package_code_input')
         return
     
     status_msg = await update.message.reply_text(f"🔍 Mencari detail untuk `{code}` dari API...")
     
-    api_details = await get_api_package_details(code)
+    api_details = await package_catalog.get_package(KMSP_API_KEY, code)
+    if not api_details and await package_catalog.refresh(KMSP_API_KEY):
+        api_details = await package_catalog.get_package(KMSP_API_KEY, code)
     
     if not api_details:
         await status_msg.edit_text(f"❌ Kode paket `{code}` tidak ditemukan di API KMSP. Pastikan kode sudah benar.")
-        context.user_data['next'] = 'admin_handle_smart_package_code_input'
+        step_router.set_next(context, 'admin_handle_smart_package_code_input')
         return
 
     api_name = api_details.get("package_name", "Nama Tidak Ditemukan")
@@ -3025,8 +3411,7 @@ async def admin_handle_smart_package_code_input(update: Update, context: Context
         f"Sekarang, masukkan *Nama Tampilan* singkat untuk paket ini (contoh: `iFlix Tanpa Gandengan`):",
         parse_mode="Markdown"
     )
-    context.user_data['next'] = 'admin_handle_smart_package_display_name_input' 
-
+    step_router.set_next(context, 'admin_handle_smart_package_display_name_input')
 async def admin_handle_smart_package_display_name_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     display_name = update.message.text.strip()
     context.user_data['temp_custom_pkg']['name'] = display_name
@@ -3036,8 +3421,7 @@ async def admin_handle_smart_package_display_name_input(update: Update, context:
         f"Sekarang, masukkan *harga jual* di bot Anda (contoh: `1500`):",
         parse_mode="Markdown"
     )
-    context.user_data['next'] = 'admin_handle_smart_package_price_input'
-
+    step_router.set_next(context, 'admin_handle_smart_package_price_input')
 async def admin_handle_smart_package_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         price = int(update.message.text.strip())
@@ -3047,11 +3431,10 @@ async def admin_handle_smart_package_price_input(update: Update, context: Contex
             f"Selanjutnya, masukkan *Price or fee* pastikan price nya sama dengan harga dari KMSP (Contoh: `1500` untuk iFlix). Masukkan `0` jika tidak ada.",
             parse_mode="Markdown"
         )
-        context.user_data['next'] = 'admin_handle_smart_package_ewallet_fee_input'
+        step_router.set_next(context, 'admin_handle_smart_package_ewallet_fee_input')
     except ValueError:
         await update.message.reply_text("❌ Harga tidak valid. Masukkan angka saja.")
-        context.user_data['next'] = 'admin_handle_smart_package_price_input'
-
+        step_router.set_next(context, 'admin_handle_smart_package_price_input')
 async def admin_handle_smart_package_ewallet_fee_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         ewallet_fee = int(update.message.text.strip())
@@ -3061,32 +3444,22 @@ async def admin_handle_smart_package_ewallet_fee_input(update: Update, context:
             f"Terakhir, masukkan deskripsi singkat untuk paket ini:",
             parse_mode="Markdown"
         )
-        context.user_data['next'] = 'admin_handle_smart_package_desc_and_save'
+        step_router.set_next(context, 'admin_handle_smart_package_desc_and_save')
     except ValueError:
         await update.message.reply_text("❌ Biaya E-Wallet tidak valid. Masukkan angka saja.")
-        context.user_data['next'] = 'admin_handle_smart_package_ewallet_fee_input'
-        
+        step_router.set_next(context, 'admin_handle_smart_package_ewallet_fee_input')
 async def admin_handle_smart_package_desc_and_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pkg_data = context.user_data.pop('temp_custom_pkg', None)
     pkg_data['description'] = update.message.text.strip()
     
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-    INSERT OR REPLACE INTO custom_packages (code, name, price, description, payment_methods, ewallet_fee)
-    VALUES (?, ?, ?, ?, ?, ?)
-    ''', (
-        pkg_data['code'],
-        pkg_data['name'],
-        pkg_data['price'],
-        pkg_data['description'],
-        json.dumps(pkg_data['payment_methods']),
-        pkg_data.get('ewallet_fee', 0)
-    ))
-    conn.commit()
-    conn.close()
-    
-    muat_data_dari_db()
+    user_data["custom_packages"][pkg_data['code']] = {
+        "name": pkg_data['name'],
+        "price": pkg_data['price'],
+        "description": pkg_data['description'],
+        "payment_methods": pkg_data['payment_methods'],
+        "ewallet_fee": pkg_data.get('ewallet_fee', 0)
+    }
+    simpan_data_ke_db()
 
     await update.message.reply_text(f"🎉 Paket kustom *{pkg_data['name']}* berhasil disimpan!", parse_mode="Markdown")
     await admin_menu(update, context)
@@ -3167,12 +3540,8 @@ async def handle_custom_package_payment_selection(update: Update, context: Conte
         parse_mode="Markdown",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data=f"view_custom_package_{package_code}")]]))
         
-    context.user_data['next'] = 'handle_buy_custom_package_phone_input'
-
+    step_router.set_next(context, 'handle_buy_custom_package_phone_input')
 async def do_broadcast(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int, message_to_copy: Message, add_admin_button: bool, add_reply_button: bool, excluded_users: list):
-    success_count = 0
-    fail_count = 0
-    
     buttons = []
     if add_reply_button:
         buttons.append(InlineKeyboardButton("✍️ Jawab", callback_data="user_reply_to_broadcast"))
@@ -3183,40 +3552,15 @@ async def do_broadcast(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int, m
 
     excluded_ids = set()
     for user_identifier in excluded_users:
-        if user_identifier.isdigit():
-            excluded_ids.add(int(user_identifier))
-        else:
-            username_to_find = user_identifier.lower().replace('@', '')
-            for uid, details in user_data["registered_users"].items():
-                if details.get('username', 'N/A').lower() == username_to_find:
-                    excluded_ids.add(int(uid))
-                    break
+        uid = resolusi_target_user(user_identifier)
+        if uid is not None:
+            excluded_ids.add(uid)
     
     logging.info(f"Broadcast akan dijalankan. Tombol Admin: {add_admin_button}, Tombol Jawab: {add_reply_button}. Pengecualian ID: {excluded_ids}")
-    all_user_ids = list(user_data["registered_users"].keys())
-    
-    for uid_str in all_user_ids:
-        try:
-            target_user_id = int(uid_str)
-            if target_user_id == admin_chat_id or target_user_id in excluded_ids:
-                continue
-
-            await context.bot.copy_message(
-                chat_id=target_user_id,
-                from_chat_id=message_to_copy.chat_id,
-                message_id=message_to_copy.message_id,
-                reply_markup=reply_markup
-            )
-            success_count += 1
-            logging.info(f"Broadcast berhasil dikirim ke {target_user_id}")
-        except Exception as e:
-            logging.warning(f"Gagal mengirim broadcast ke user {uid_str}: {e}")
-            fail_count += 1
-        
-        await asyncio.sleep(0.1) 
-    
-    final_message = f"✅ Selesai mengirim broadcast.\nBerhasil: *{success_count}* user\nGagal: *{fail_count}* user"
-    await context.bot.send_message(admin_chat_id, final_message, parse_mode="Markdown")
+    target_ids = [int(uid) for uid in user_data["registered_users"]
+                  if int(uid) != admin_chat_id and int(uid) not in excluded_ids]
+    broadcast_engine.mulai(context.application, admin_chat_id, message_to_copy.chat_id, message_to_copy.message_id,
+                           target_ids, reply_markup)
 
 async def admin_handle_broadcast_message_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id_admin = update.effective_user.id
@@ -3272,9 +3616,7 @@ async def admin_handle_broadcast_reply_choice(update: Update, context: ContextTy
         parse_mode="Markdown"
     )
     bot_messages.setdefault(query.from_user.id, []).append(msg.message_id)
-    context.user_data['next'] = 'admin_handle_broadcast_exclusions'
-
-
+    step_router.set_next(context, 'admin_handle_broadcast_exclusions')
 async def admin_handle_broadcast_exclusions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id_admin = update.effective_user.id
     if user_id_admin != ADMIN_ID: return
@@ -3299,7 +3641,7 @@ async def admin_handle_broadcast_exclusions(update: Update, context: ContextType
         parse_mode="Markdown"
     )
     
-    asyncio.create_task(do_broadcast(context, user_id_admin, message_to_copy, add_admin_button, add_reply_button, excluded_users))
+    await do_broadcast(context, user_id_admin, message_to_copy, add_admin_button, add_reply_button, excluded_users)
     await admin_menu(update, context)
 
 async def send_xcp_addon_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3759,386 +4101,437 @@ async def send_30h_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg = await context.bot.send_message(user_id, text, parse_mode="Markdown", reply_markup=reply_markup)
         bot_messages.setdefault(user_id, []).append(msg.message_id)
 
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+@callback_router.route("stop_automatic_xcs_flow")
+async def cb_stop_automatic_xcs_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data
     user_id = query.from_user.id
-    
-    if user_id == ADMIN_ID:
-        if data.startswith("broadcast_add_button_"):
-            await admin_handle_broadcast_button_choice(update, context)
-            return
-        if data.startswith("broadcast_add_reply_"):
-            await admin_handle_broadcast_reply_choice(update, context)
-            return
-        if data.startswith("admin_"):
-            await admin_callback_handler(update, context)
-            return    
-                                                                   
-        if data.startswith('hesda_api_res_'):
-            await admin_callback_handler(update, context)
-            return
-                                                                                         
-        if data.startswith('retry_single_'):
-            await admin_callback_handler(update, context)                                                                  
-            return
-        
-    if not await check_access(update, context):
-        return
-        
-                                
-    elif data == 'stop_automatic_xcs_flow':
-        user_id = query.from_user.id
-        await query.answer("🛑 Mengirim sinyal berhenti darurat...", show_alert=False)
+    await query.answer("🛑 Mengirim sinyal berhenti darurat...", show_alert=False)
 
-        if 'automatic_xcs_flow_state' in context.user_data:
-                                                      
-            context.user_data['automatic_xcs_flow_state']['stop_requested'] = True
+    if 'automatic_xcs_flow_state' in context.user_data:
 
-                                                          
-            current_task = context.user_data['automatic_xcs_flow_state'].get('current_task')
-            if current_task and not current_task.done():
-                current_task.cancel()
-                logging.info(f"Sinyal pembatalan dikirim ke tugas yang sedang berjalan untuk user {user_id}.")
-            else:
-                logging.info(f"Tombol stop ditekan user {user_id}, tapi tidak ada tugas aktif untuk dibatalkan.")
-            
-            try:
-                await query.edit_message_text(text=" Sinyal berhenti diterima. Proses akan dihentikan secara paksa...", parse_mode="Markdown")
-            except Exception:
-                pass
-        else:
-            await query.answer("Sesi pembelian otomatis sudah tidak aktif.", show_alert=True)
-        return
-         
-    elif data == 'skip_pending_addon':
-        await query.answer("Permintaan untuk melewati paket diterima...", show_alert=False)
-                                                                               
-        if 'automatic_xcs_flow_state' in context.user_data:
-            context.user_data['automatic_xcs_flow_state']['skip_current_wait'] = True
-            simpan_data_ke_db()
+        context.user_data['automatic_xcs_flow_state']['stop_requested'] = True
+
+        current_task = context.user_data['automatic_xcs_flow_state'].get('current_task')
+        if current_task and not current_task.done():
+            current_task.cancel()
+            logging.info(f"Sinyal pembatalan dikirim ke tugas yang sedang berjalan untuk user {user_id}.")
         else:
-            logging.warning(f"User {user_id} menekan skip_pending_addon tetapi state tidak ditemukan.")
-            try:
-                await query.edit_message_text("Sesi pembelian otomatis sudah tidak aktif.")
-            except Exception: pass
-        return
-        
-    elif data == 'show_login_options':                                                
-        await query.answer()                        
-        await show_login_options_menu(update, context)
-        return
+            logging.info(f"Tombol stop ditekan user {user_id}, tapi tidak ada tugas aktif untuk dibatalkan.")
 
-    elif data == 'qris_paid_manual_confirm':
-        await query.answer("Konfirmasi diterima!", show_alert=False)
-        
-        active_qris_messages = context.user_data.pop('active_qris_messages', {})
-        
-        if active_qris_messages:
-            for msg_id in active_qris_messages.values():
-                if msg_id:
-                    try:
-                        await context.bot.delete_message(chat_id=user_id, message_id=msg_id)
-                    except Exception:
-                        pass
+        try:
+            await query.edit_message_text(text=" Sinyal berhenti diterima. Proses akan dihentikan secara paksa...", parse_mode="Markdown")
+        except Exception:
+            pass
+    else:
+        await query.answer("Sesi pembelian otomatis sudah tidak aktif.", show_alert=True)
 
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="✅ Terima kasih telah melakukan pembayaran.\nJika sudah membayar, tinggal menunggu paket masuk, harap bersabar..."
-            )
-        else:
-            try:
-                                                                                           
-                await query.edit_message_text("Sesi pembayaran ini sudah tidak aktif atau sudah selesai.")
-            except Exception:
-                pass
-        return                           
+
+@callback_router.route(prefix="lanjut_job_")
+async def cb_lanjut_job(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    jenis = query.data[len("lanjut_job_"):]
+    flows = {
+        purchase_jobs.JENIS_XCS: run_automatic_xcs_addon_flow,
+        purchase_jobs.JENIS_XUTP: run_automatic_xutp_flow,
+        purchase_jobs.JENIS_HESDA_BATCH: process_hesda_package_queue,
+        purchase_jobs.JENIS_30H_BATCH: process_30h_package_queue,
+    }
+    job = purchase_jobs.ambil(user_id, jenis)
+    if job is None or jenis not in flows:
+        await query.answer("Tidak ada pembelian tertunda untuk dilanjutkan.", show_alert=True)
         return
-    
-    elif data == 'login_kmsp':                                  
-        await query.edit_message_text(text="Masukkan nomor HP Anda untuk login LOGIN (contoh: `0812xxxxxxxx` atau `62812xxxxxxxx`):", parse_mode="Markdown")
-        context.user_data['current_login_provider'] = 'kmsp'
-        context.user_data['next'] = 'handle_phone_for_login'
+    await query.answer("Melanjutkan pembelian...")
+    for key, value in job["state"].items():
+        context.user_data.setdefault(key, value)
+    try:
+        await query.edit_message_text(f"▶️ Melanjutkan pembelian *{JOB_NAMA[jenis]}*...", parse_mode="Markdown")
+    except Exception:
+        pass
+    logging.info(f"User {user_id} melanjutkan job pembelian {jenis} setelah restart.")
+    asyncio.create_task(flows[jenis](update, context))
 
-    elif data == 'login_hesda':                                   
-        await query.edit_message_text(text="Masukkan nomor HP Anda untuk login BYPAS (contoh: `0812xxxxxxxx` atau `62812xxxxxxxx`):", parse_mode="Markdown")
-        context.user_data['current_login_provider'] = 'hesda'
-        context.user_data['next'] = 'handle_phone_for_login'
-    
-    elif data == 'vidio_xl_menu':
-        await send_vidio_xl_menu(update, context)
-        return                                                                   
 
-    elif data == 'iflix_xl_menu':
-        await send_iflix_xl_menu(update, context)
+@callback_router.route(prefix="refund_job_")
+async def cb_refund_job(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    jenis = query.data[len("refund_job_"):]
+    job = purchase_jobs.ambil(user_id, jenis)
+    if job is None:
+        await query.answer("Tidak ada pembelian tertunda untuk direfund.", show_alert=True)
         return
+    await query.answer()
+    dana = refund_job_pembelian(user_id, jenis, job, context.user_data)
+    logging.info(f"User {user_id} membatalkan job pembelian {jenis} setelah restart, refund Rp{dana}.")
+    await query.edit_message_text(
+        f"↩️ Pembelian *{JOB_NAMA.get(jenis, jenis)}* dibatalkan. Saldo Rp{dana:,} telah dikembalikan.\n"
+        f"Saldo Anda sekarang: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.",
+        parse_mode="Markdown"
+    )
 
-    elif data.startswith('buy_vidio_xl_package_'):
-        payment_method_selected = data.replace('buy_vidio_xl_package_', '')
 
-                                                                    
-                                                                                                
-        package_name_display = "XTRA UNLIMITED VIDIO XL"
-        payment_method_for_api = ""                                           
-        price_lookup_key = ""                                                    
+@callback_router.route("skip_pending_addon")
+async def cb_skip_pending_addon(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer("Permintaan untuk melewati paket diterima...", show_alert=False)
 
-        if payment_method_selected == "PULSA":
-            payment_method_for_api = "BALANCE"
-            package_code_for_api = "XLUNLITURBOVIDIO_PULSA"            
-            price_lookup_key = "XLUNLITURBOVIDIO_PULSA"            
-            package_name_display += " (PULSA)"
-        elif payment_method_selected == "DANA":
-            payment_method_for_api = "DANA"
-            package_code_for_api = "XLUNLITURBOVIDIO_DANA"            
-            price_lookup_key = "XLUNLITURBOVIDIO_DANA"            
-            package_name_display += " (DANA)"
-        elif payment_method_selected == "QRIS":
-            payment_method_for_api = "QRIS"
-            package_code_for_api = "XLUNLITURBOVIDIO_DANA"                                            
-            price_lookup_key = "XLUNLITURBOVIDIO_QRIS"            
-            package_name_display += " (QRIS)"
-        else:
-            await query.answer("Pilihan metode pembayaran tidak valid.", show_alert=True)
-            return
-            
-        required_balance = CUSTOM_PACKAGE_PRICES.get(price_lookup_key, {}).get('price_bot', 0)
-        user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
+    if 'automatic_xcs_flow_state' in context.user_data:
+        context.user_data['automatic_xcs_flow_state']['skip_current_wait'] = True
+        simpan_data_ke_db()
+    else:
+        logging.warning(f"User {user_id} menekan skip_pending_addon tetapi state tidak ditemukan.")
+        try:
+            await query.edit_message_text("Sesi pembelian otomatis sudah tidak aktif.")
+        except Exception: pass
 
-        if user_balance < required_balance:
-            await query.answer(f"Saldo Anda tidak cukup untuk membeli paket ini (butuh Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_balance:,}", show_alert=True)
-            return
 
-        await query.edit_message_text(
-            text=f"Anda memilih: *{package_name_display}*.\nMasukkan nomor HP untuk pembelian:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="vidio_xl_menu")]]),
-            parse_mode="Markdown"
-        )
+@callback_router.route("show_login_options")
+async def cb_show_login_options(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await show_login_options_menu(update, context)
 
-        context.user_data['selected_package_code'] = package_code_for_api                                                     
-        context.user_data['selected_package_name_display'] = package_name_display
-        context.user_data['selected_payment_method'] = payment_method_for_api
-        context.user_data['selected_price_lookup_key'] = price_lookup_key
-        context.user_data['selected_api_provider'] = "kmsp"
-        context.user_data['next'] = 'handle_beli_single_vidio_package'
-        return
-       
-    elif data.startswith('buy_iflix_xl_package_'):                     
-        payment_method_selected = data.replace('buy_iflix_xl_package_', '')
 
-        package_name_display = "XTRA UNLIMITED IFLIX XL"
-        payment_method_for_api = "" 
-        price_lookup_key = "" 
+@callback_router.route("qris_paid_manual_confirm")
+async def cb_qris_paid_manual_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer("Konfirmasi diterima!", show_alert=False)
 
-        if payment_method_selected == "PULSA":
-            payment_method_for_api = "BALANCE"
-            package_code_for_api = "XLUNLITURBOIFLIXXC_PULSA" 
-            price_lookup_key = "XLUNLITURBOIFLIXXC_PULSA" 
-            package_name_display += " (PULSA)"
-        elif payment_method_selected == "DANA":
-            payment_method_for_api = "DANA"
-            package_code_for_api = "XLUNLITURBOIFLIXXC_EWALLET" 
-            price_lookup_key = "XLUNLITURBOIFLIXXC_DANA" 
-            package_name_display += " (DANA)"
-        elif payment_method_selected == "QRIS":
-            payment_method_for_api = "QRIS"
-            package_code_for_api = "XLUNLITURBOIFLIXXC_EWALLET"                                              
-            price_lookup_key = "XLUNLITURBOIFLIXXC_QRIS" 
-            package_name_display += " (QRIS)"
-        else:
-            await query.answer("Pilihan metode pembayaran tidak valid.", show_alert=True)
-            return
-            
-        required_balance = CUSTOM_PACKAGE_PRICES.get(price_lookup_key, {}).get('price_bot', 0)
-        user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
+    active_qris_messages = context.user_data.pop('active_qris_messages', {})
 
-        if user_balance < required_balance:
-            await query.answer(f"Saldo Anda tidak cukup untuk membeli paket ini (butuh Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_balance:,}", show_alert=True)
-            return
+    if active_qris_messages:
+        for msg_id in active_qris_messages.values():
+            if msg_id:
+                try:
+                    await context.bot.delete_message(chat_id=user_id, message_id=msg_id)
+                except Exception:
+                    pass
 
-        await query.edit_message_text(
-            text=f"Anda memilih: *{package_name_display}*.\nMasukkan nomor HP untuk pembelian:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="iflix_xl_menu")]]),                        
-            parse_mode="Markdown"
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="✅ Terima kasih telah melakukan pembayaran.\nJika sudah membayar, tinggal menunggu paket masuk, harap bersabar..."
         )
+    else:
+        try:
 
-        context.user_data['selected_package_code'] = package_code_for_api 
-        context.user_data['selected_package_name_display'] = package_name_display
-        context.user_data['selected_payment_method'] = payment_method_for_api
-        context.user_data['selected_price_lookup_key'] = price_lookup_key
-        context.user_data['selected_api_provider'] = "kmsp"
-        context.user_data['next'] = 'handle_beli_single_iflix_package'                                               
-        return
-   
-    if data == 'show_login_options':                                                
-        await query.answer()                        
-        await show_login_options_menu(update, context)
-        return
+            await query.edit_message_text("Sesi pembayaran ini sudah tidak aktif atau sudah selesai.")
+        except Exception:
+            pass
 
-    elif data == 'login_kmsp':                                  
-        await query.edit_message_text(text="Masukkan nomor HP Anda untuk login LOGIN (contoh: `0812xxxxxxxx` atau `62812xxxxxxxx`):", parse_mode="Markdown")
-        context.user_data['current_login_provider'] = 'kmsp'
-        context.user_data['next'] = 'handle_phone_for_login'
 
-    elif data == 'login_hesda':                                   
-        await query.edit_message_text(text="Masukkan nomor HP Anda untuk login BYPAS (contoh: `0812xxxxxxxx` atau `62812xxxxxxxx`):", parse_mode="Markdown")
-        context.user_data['current_login_provider'] = 'hesda'
-        context.user_data['next'] = 'handle_phone_for_login'
-    
-                                
-                        
-    if data == 'user_reply_to_broadcast':
-        await query.answer()
-        msg = await context.bot.send_message(user_id, "Silakan ketik jawaban Anda dan kirim. Jawaban akan diteruskan ke Admin.")
-        bot_messages.setdefault(user_id, []).append(msg.message_id)
-        context.user_data['next'] = 'handle_user_broadcast_reply'
-        return
+@callback_router.route("login_kmsp")
+async def cb_login_kmsp(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(text="Masukkan nomor HP Anda untuk login LOGIN (contoh: `0812xxxxxxxx` atau `62812xxxxxxxx`):", parse_mode="Markdown")
+    context.user_data['current_login_provider'] = 'kmsp'
+    step_router.set_next(context, 'handle_phone_for_login')
 
-                                                                                                   
-                                                                                                                      
-        await query.answer()
 
-    logging.info(f"User {user_id} menekan tombol: {data}")
+@callback_router.route("login_hesda")
+async def cb_login_hesda(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(text="Masukkan nomor HP Anda untuk login BYPAS (contoh: `0812xxxxxxxx` atau `62812xxxxxxxx`):", parse_mode="Markdown")
+    context.user_data['current_login_provider'] = 'hesda'
+    step_router.set_next(context, 'handle_phone_for_login')
 
-    if data == 'login':                         
-        await query.edit_message_text(text="Masukkan nomor HP Anda (contoh: `0812xxxxxxxx` atau `62812xxxxxxxx`):", parse_mode="Markdown")
-        context.user_data['current_login_provider'] = 'kmsp'
-        context.user_data['next'] = 'handle_phone_for_login'
-    
-    elif data == 'login_hesda':                                    
-        await query.edit_message_text(text="Masukkan nomor HP Anda untuk login BYPAS (contoh: `0812xxxxxxxx` atau `62812xxxxxxxx`):", parse_mode="Markdown")
-        context.user_data['current_login_provider'] = 'hesda'
-        context.user_data['next'] = 'handle_phone_for_login'
 
-    elif data == 'akun_saya':                          
-        await akun_saya_command_handler(update, context)
-        return
+@callback_router.route("vidio_xl_menu")
+async def cb_vidio_xl_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_vidio_xl_menu(update, context)
 
-    elif data == 'tembak_paket':
-       
-        harga_text = (
-            "> " + escape_markdown("✨ HARGA DOR XC 1+1GB & XUTS: 5.200", version=2) + "\n" +
-            "> " + escape_markdown("💳 SIAPIN SALDO BUAT BAYAR XC 1+1GB Rp.12.500 ️", version=2) + "\n" +
-            "> " + escape_markdown("💵 TOTAL BAYAR XUTS Rp.17.700 ✅", version=2) + "\n\n" + 
-            "> " + escape_markdown("🌟 HARGA DOR XUTP: 5.200", version=2) + "\n" +
-            "> " + escape_markdown("💳 SIAPIN SALDO BUAT BAYAR XCP 8GB Rp.25.000", version=2) + "\n" +
-            "> " + escape_markdown("💵  TOTAL BAYAR XUTP Rp.30.200 ✅", version=2) + "\n\n" +
-            "> " + escape_markdown("⚡ HARGA DOR XCS ADD ON: 7.400 ( HARGA FULL ADD ON )", version=2) + "\n" +
-            "> " + escape_markdown("💳 SIAPIN SALDO BUAT BAYAR XCP 8GB Rp.25.000", version=2) + "\n" +
-            "> " + escape_markdown("💵  TOTAL XCS ADD ON Rp32.400 ✅", version=2) + "\n\n" +
-            
-            "> " + escape_markdown("NOTE. harga XCS di atas adalah harga  FULL ADD ON harga nya bisa kurang jika tidak membeli semua ADD ON harga per ADD ON 200", version=2)
-        )
-        
-        message_text = "🔥 *DAFTAR HARGA PAKET* 🔥\n\n" + harga_text
-        tembak_buttons = [
-            [InlineKeyboardButton("✨ XUTS", callback_data="menu_uts_nested")],
-            [InlineKeyboardButton("🌟 XUTP", callback_data="xutp_menu")],
-            [InlineKeyboardButton("⚡ XCS ADD ON", callback_data="xcp_addon")],
-            [InlineKeyboardButton("🏠 Kembali ke Menu Utama", callback_data="back_to_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(tembak_buttons)
-        await query.edit_message_text(text=message_text, reply_markup=reply_markup, parse_mode="MarkdownV2")
 
-    elif data == 'xutp_menu':
-        await send_xutp_method_selection_menu(update, context)
-        return
+@callback_router.route("iflix_xl_menu")
+async def cb_iflix_xl_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_iflix_xl_menu(update, context)
 
-    elif data.startswith('xutp_method_'):
-        await query.answer()
-        payment_method_for_xutp = data.replace('xutp_method_', '').upper()
-        
-        if payment_method_for_xutp == "PULSA":
-            context.user_data['xutp_purchase_payment_method'] = "BALANCE" 
-            display_method_name = "PULSA" 
-        else:
-            context.user_data['xutp_purchase_payment_method'] = payment_method_for_xutp
-            display_method_name = payment_method_for_xutp 
 
-        await query.edit_message_text(
-            text=f"Anda memilih mode XUTP dengan pembayaran *{display_method_name}*.\nMasukkan nomor HP untuk memproses pembelian:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="xutp_menu")]]),
-            parse_mode="Markdown"
-        )
-        context.user_data['next'] = 'handle_automatic_xutp_phone_input'
+@callback_router.route(prefix="buy_vidio_xl_package_")
+async def cb_buy_vidio_xl_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    payment_method_selected = data.replace('buy_vidio_xl_package_', '')
+
+    package_name_display = "XTRA UNLIMITED VIDIO XL"
+    payment_method_for_api = ""
+    price_lookup_key = ""
+
+    if payment_method_selected == "PULSA":
+        payment_method_for_api = "BALANCE"
+        package_code_for_api = "XLUNLITURBOVIDIO_PULSA"
+        price_lookup_key = "XLUNLITURBOVIDIO_PULSA"
+        package_name_display += " (PULSA)"
+    elif payment_method_selected == "DANA":
+        payment_method_for_api = "DANA"
+        package_code_for_api = "XLUNLITURBOVIDIO_DANA"
+        price_lookup_key = "XLUNLITURBOVIDIO_DANA"
+        package_name_display += " (DANA)"
+    elif payment_method_selected == "QRIS":
+        payment_method_for_api = "QRIS"
+        package_code_for_api = "XLUNLITURBOVIDIO_DANA"
+        price_lookup_key = "XLUNLITURBOVIDIO_QRIS"
+        package_name_display += " (QRIS)"
+    else:
+        await query.answer("Pilihan metode pembayaran tidak valid.", show_alert=True)
         return
 
-    elif data == 'menu_uts_nested':
-        await send_uts_menu(update, context)
-    
-    elif data == 'menu_bypass_nested':                                                     
-        await send_bypass_menu(update, context)
+    required_balance = CUSTOM_PACKAGE_PRICES.get(price_lookup_key, {}).get('price_bot', 0)
+    user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
 
-    elif data == 'xcp_addon_dana':                                              
-        await send_xcp_addon_dana_menu(update, context)
-   
-    elif data == 'automatic_purchase_flow':                    
-        await query.answer()
-        message_text = "Silakan pilih metode pembayaran untuk pembelian paket otomatis:"
-        keyboard = [
-            [InlineKeyboardButton("DANA", callback_data="automatic_method_dana")],
-            [InlineKeyboardButton("PULSA", callback_data="automatic_method_pulsa")],
-            [InlineKeyboardButton("QRIS", callback_data="automatic_method_qris")],
-            [InlineKeyboardButton("🔙 Kembali ke Menu XC 1+1GB & XUTS", callback_data="menu_uts_nested")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message_text, parse_mode="Markdown", reply_markup=reply_markup)
+    if user_balance < required_balance:
+        await query.answer(f"Saldo Anda tidak cukup untuk membeli paket ini (butuh Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_balance:,}", show_alert=True)
         return
 
-    elif data.startswith('automatic_method_'):
-        await query.answer()
-        payment_method_for_auto = data.replace('automatic_method_', '').upper()
-        
-        if payment_method_for_auto == "PULSA":
-            context.user_data['automatic_purchase_payment_method'] = "BALANCE"
-            display_method_name = "PULSA"
-        else:
-            context.user_data['automatic_purchase_payment_method'] = payment_method_for_auto
-            display_method_name = payment_method_for_auto
+    await query.edit_message_text(
+        text=f"Anda memilih: *{package_name_display}*.\nMasukkan nomor HP untuk pembelian:",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="vidio_xl_menu")]]),
+        parse_mode="Markdown"
+    )
 
-        await query.edit_message_text(
-            text=f"Anda memilih mode Otomatis dengan pembayaran *{display_method_name}*.\nMasukkan nomor HP untuk memproses pembelian:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="automatic_purchase_flow")]]),
-            parse_mode="Markdown"
-        )
-        context.user_data['next'] = 'handle_automatic_purchase_phone_input'
-        return
+    context.user_data['selected_package_code'] = package_code_for_api
+    context.user_data['selected_package_name_display'] = package_name_display
+    context.user_data['selected_payment_method'] = payment_method_for_api
+    context.user_data['selected_price_lookup_key'] = price_lookup_key
+    context.user_data['selected_api_provider'] = "kmsp"
+    step_router.set_next(context, 'handle_beli_single_vidio_package')
 
-    elif data == 'manual_uts_selection_menu': 
-        await query.answer()
-        await send_manual_uts_selection_menu(update, context)
-        return
 
-    elif data == 'cek_saldo':
-        balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
-        await query.answer(f"💰 Saldo Anda saat ini: Rp{balance:,}", show_alert=True)
+@callback_router.route(prefix="buy_iflix_xl_package_")
+async def cb_buy_iflix_xl_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    payment_method_selected = data.replace('buy_iflix_xl_package_', '')
+
+    package_name_display = "XTRA UNLIMITED IFLIX XL"
+    payment_method_for_api = ""
+    price_lookup_key = ""
+
+    if payment_method_selected == "PULSA":
+        payment_method_for_api = "BALANCE"
+        package_code_for_api = "XLUNLITURBOIFLIXXC_PULSA"
+        price_lookup_key = "XLUNLITURBOIFLIXXC_PULSA"
+        package_name_display += " (PULSA)"
+    elif payment_method_selected == "DANA":
+        payment_method_for_api = "DANA"
+        package_code_for_api = "XLUNLITURBOIFLIXXC_EWALLET"
+        price_lookup_key = "XLUNLITURBOIFLIXXC_DANA"
+        package_name_display += " (DANA)"
+    elif payment_method_selected == "QRIS":
+        payment_method_for_api = "QRIS"
+        package_code_for_api = "XLUNLITURBOIFLIXXC_EWALLET"
+        price_lookup_key = "XLUNLITURBOIFLIXXC_QRIS"
+        package_name_display += " (QRIS)"
+    else:
+        await query.answer("Pilihan metode pembayaran tidak valid.", show_alert=True)
         return
 
-    elif data == 'top_up_saldo':
-        await query.edit_message_text(text=f"Masukkan nominal top up yang diinginkan (minimal Rp{MIN_TOP_UP_AMOUNT:,}, contoh: `10000`):", 
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Kembali", callback_data="back_to_menu")]]),
-                                      parse_mode="Markdown")
-        context.user_data['next'] = 'handle_top_up_amount'
-        return
+    required_balance = CUSTOM_PACKAGE_PRICES.get(price_lookup_key, {}).get('price_bot', 0)
+    user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
 
-    elif data == 'cek_kuota':
-        await query.edit_message_text(text="Masukkan nomor HP XL/Axis yang ingin dicek kuotanya (contoh: `0878...`):", 
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Kembali", callback_data="back_to_menu")]]), 
-                                      parse_mode="Markdown")
-        context.user_data['next'] = 'handle_cek_kuota_baru_input'
+    if user_balance < required_balance:
+        await query.answer(f"Saldo Anda tidak cukup untuk membeli paket ini (butuh Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_balance:,}", show_alert=True)
         return
 
-    elif data == 'tutorial_beli':
-        keyboard = [
-            [InlineKeyboardButton("❗Syarat Pembelian❗", callback_data='syarat_pembelian')],
-            [InlineKeyboardButton("📖 Tutorial Pembelian XCS ADD-ONS", callback_data='tutorial_xcs_addons')],
-            [InlineKeyboardButton("📖 Tutorial Pembelian XUTS", callback_data='tutorial_uts')],
-            [InlineKeyboardButton("🏠 Kembali ke Menu Utama", callback_data='back_to_menu')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text="Pilih tutorial yang ingin Anda lihat:", parse_mode="Markdown", reply_markup=reply_markup)
+    await query.edit_message_text(
+        text=f"Anda memilih: *{package_name_display}*.\nMasukkan nomor HP untuk pembelian:",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="iflix_xl_menu")]]),
+        parse_mode="Markdown"
+    )
+
+    context.user_data['selected_package_code'] = package_code_for_api
+    context.user_data['selected_package_name_display'] = package_name_display
+    context.user_data['selected_payment_method'] = payment_method_for_api
+    context.user_data['selected_price_lookup_key'] = price_lookup_key
+    context.user_data['selected_api_provider'] = "kmsp"
+    step_router.set_next(context, 'handle_beli_single_iflix_package')
+
+
+@callback_router.route("user_reply_to_broadcast")
+async def cb_user_reply_to_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer()
+    msg = await context.bot.send_message(user_id, "Silakan ketik jawaban Anda dan kirim. Jawaban akan diteruskan ke Admin.")
+    bot_messages.setdefault(user_id, []).append(msg.message_id)
+    step_router.set_next(context, 'handle_user_broadcast_reply')
+
+
+@callback_router.route("login")
+async def cb_login(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(text="Masukkan nomor HP Anda (contoh: `0812xxxxxxxx` atau `62812xxxxxxxx`):", parse_mode="Markdown")
+    context.user_data['current_login_provider'] = 'kmsp'
+    step_router.set_next(context, 'handle_phone_for_login')
 
-    elif data == 'syarat_pembelian':
-        syarat_pembelian_text = """
+
+@callback_router.route("akun_saya")
+async def cb_akun_saya(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await akun_saya_command_handler(update, context)
+
+
+@callback_router.route("tembak_paket")
+async def cb_tembak_paket(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+
+    harga_text = (
+        "> " + escape_markdown("✨ HARGA DOR XC 1+1GB & XUTS: 5.200", version=2) + "\n" +
+        "> " + escape_markdown("💳 SIAPIN SALDO BUAT BAYAR XC 1+1GB Rp.12.500 ️", version=2) + "\n" +
+        "> " + escape_markdown("💵 TOTAL BAYAR XUTS Rp.17.700 ✅", version=2) + "\n\n" +
+        "> " + escape_markdown("🌟 HARGA DOR XUTP: 5.200", version=2) + "\n" +
+        "> " + escape_markdown("💳 SIAPIN SALDO BUAT BAYAR XCP 8GB Rp.25.000", version=2) + "\n" +
+        "> " + escape_markdown("💵  TOTAL BAYAR XUTP Rp.30.200 ✅", version=2) + "\n\n" +
+        "> " + escape_markdown("⚡ HARGA DOR XCS ADD ON: 7.400 ( HARGA FULL ADD ON )", version=2) + "\n" +
+        "> " + escape_markdown("💳 SIAPIN SALDO BUAT BAYAR XCP 8GB Rp.25.000", version=2) + "\n" +
+        "> " + escape_markdown("💵  TOTAL XCS ADD ON Rp32.400 ✅", version=2) + "\n\n" +
+
+        "> " + escape_markdown("NOTE. harga XCS di atas adalah harga  FULL ADD ON harga nya bisa kurang jika tidak membeli semua ADD ON harga per ADD ON 200", version=2)
+    )
+
+    message_text = "🔥 *DAFTAR HARGA PAKET* 🔥\n\n" + harga_text
+    tembak_buttons = [
+        [InlineKeyboardButton("✨ XUTS", callback_data="menu_uts_nested")],
+        [InlineKeyboardButton("🌟 XUTP", callback_data="xutp_menu")],
+        [InlineKeyboardButton("⚡ XCS ADD ON", callback_data="xcp_addon")],
+        [InlineKeyboardButton("🏠 Kembali ke Menu Utama", callback_data="back_to_menu")]
+    ]
+    reply_markup = InlineKeyboardMarkup(tembak_buttons)
+    await query.edit_message_text(text=message_text, reply_markup=reply_markup, parse_mode="MarkdownV2")
+
+
+@callback_router.route("xutp_menu")
+async def cb_xutp_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_xutp_method_selection_menu(update, context)
+
+
+@callback_router.route(prefix="xutp_method_")
+async def cb_xutp_method(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    await query.answer()
+    payment_method_for_xutp = data.replace('xutp_method_', '').upper()
+
+    if payment_method_for_xutp == "PULSA":
+        context.user_data['xutp_purchase_payment_method'] = "BALANCE"
+        display_method_name = "PULSA"
+    else:
+        context.user_data['xutp_purchase_payment_method'] = payment_method_for_xutp
+        display_method_name = payment_method_for_xutp
+
+    await query.edit_message_text(
+        text=f"Anda memilih mode XUTP dengan pembayaran *{display_method_name}*.\nMasukkan nomor HP untuk memproses pembelian:",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="xutp_menu")]]),
+        parse_mode="Markdown"
+    )
+    step_router.set_next(context, 'handle_automatic_xutp_phone_input')
+
+
+@callback_router.route("menu_uts_nested")
+async def cb_menu_uts_nested(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_uts_menu(update, context)
+
+
+@callback_router.route("menu_bypass_nested")
+async def cb_menu_bypass_nested(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_bypass_menu(update, context)
+
+
+@callback_router.route("xcp_addon_dana")
+async def cb_xcp_addon_dana(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_xcp_addon_dana_menu(update, context)
+
+
+@callback_router.route("automatic_purchase_flow")
+async def cb_automatic_purchase_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    message_text = "Silakan pilih metode pembayaran untuk pembelian paket otomatis:"
+    keyboard = [
+        [InlineKeyboardButton("DANA", callback_data="automatic_method_dana")],
+        [InlineKeyboardButton("PULSA", callback_data="automatic_method_pulsa")],
+        [InlineKeyboardButton("QRIS", callback_data="automatic_method_qris")],
+        [InlineKeyboardButton("🔙 Kembali ke Menu XC 1+1GB & XUTS", callback_data="menu_uts_nested")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(message_text, parse_mode="Markdown", reply_markup=reply_markup)
+
+
+@callback_router.route(prefix="automatic_method_")
+async def cb_automatic_method(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    await query.answer()
+    payment_method_for_auto = data.replace('automatic_method_', '').upper()
+
+    if payment_method_for_auto == "PULSA":
+        context.user_data['automatic_purchase_payment_method'] = "BALANCE"
+        display_method_name = "PULSA"
+    else:
+        context.user_data['automatic_purchase_payment_method'] = payment_method_for_auto
+        display_method_name = payment_method_for_auto
+
+    await query.edit_message_text(
+        text=f"Anda memilih mode Otomatis dengan pembayaran *{display_method_name}*.\nMasukkan nomor HP untuk memproses pembelian:",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="automatic_purchase_flow")]]),
+        parse_mode="Markdown"
+    )
+    step_router.set_next(context, 'handle_automatic_purchase_phone_input')
+
+
+@callback_router.route("manual_uts_selection_menu")
+async def cb_manual_uts_selection_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await send_manual_uts_selection_menu(update, context)
+
+
+@callback_router.route("cek_saldo")
+async def cb_cek_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
+    await query.answer(f"💰 Saldo Anda saat ini: Rp{balance:,}", show_alert=True)
+
+
+@callback_router.route("top_up_saldo")
+async def cb_top_up_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(text=f"Masukkan nominal top up yang diinginkan (minimal Rp{MIN_TOP_UP_AMOUNT:,}, contoh: `10000`):",
+                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Kembali", callback_data="back_to_menu")]]),
+                                  parse_mode="Markdown")
+    step_router.set_next(context, 'handle_top_up_amount')
+
+
+@callback_router.route("cek_kuota")
+async def cb_cek_kuota(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.edit_message_text(text="Masukkan nomor HP XL/Axis yang ingin dicek kuotanya (contoh: `0878...`):",
+                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Kembali", callback_data="back_to_menu")]]),
+                                  parse_mode="Markdown")
+    step_router.set_next(context, 'handle_cek_kuota_baru_input')
+
+
+@callback_router.route("tutorial_beli")
+async def cb_tutorial_beli(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    keyboard = [
+        [InlineKeyboardButton("❗Syarat Pembelian❗", callback_data='syarat_pembelian')],
+        [InlineKeyboardButton("📖 Tutorial Pembelian XCS ADD-ONS", callback_data='tutorial_xcs_addons')],
+        [InlineKeyboardButton("📖 Tutorial Pembelian XUTS", callback_data='tutorial_uts')],
+        [InlineKeyboardButton("🏠 Kembali ke Menu Utama", callback_data='back_to_menu')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(text="Pilih tutorial yang ingin Anda lihat:", parse_mode="Markdown", reply_markup=reply_markup)
+
+
+@callback_router.route("syarat_pembelian")
+async def cb_syarat_pembelian(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    syarat_pembelian_text = """
 ❗ *Syarat Pembelian* ❗
 
 1. Sudah Login OTP
@@ -4149,12 +4542,15 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     - Rp12.500 Untuk XUTS 
 5. Pastikan saldo bot cukup
 """
-        keyboard = [[InlineKeyboardButton("🔙 Kembali ke Tutorial Beli", callback_data='tutorial_beli')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(syarat_pembelian_text, parse_mode="Markdown", reply_markup=reply_markup)
+    keyboard = [[InlineKeyboardButton("🔙 Kembali ke Tutorial Beli", callback_data='tutorial_beli')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(syarat_pembelian_text, parse_mode="Markdown", reply_markup=reply_markup)
+
 
-    elif data == 'tutorial_xcs_addons':
-        tutorial_xcs_addons_text = """
+@callback_router.route("tutorial_xcs_addons")
+async def cb_tutorial_xcs_addons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    tutorial_xcs_addons_text = """
 📖 *Tutorial Pembelian XCS ADD-ONS* 📖
 
 1. Pilih MENU TEMBAK PAKET
@@ -4173,12 +4569,15 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 4. Paket Unofficial, tidak ada garansi.!
 5. Segala Konsekwensinya Di tanggung User
 """
-        keyboard = [[InlineKeyboardButton("🔙 Kembali ke Tutorial Beli", callback_data='tutorial_beli')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(tutorial_xcs_addons_text, parse_mode="Markdown", reply_markup=reply_markup)
+    keyboard = [[InlineKeyboardButton("🔙 Kembali ke Tutorial Beli", callback_data='tutorial_beli')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(tutorial_xcs_addons_text, parse_mode="Markdown", reply_markup=reply_markup)
+
 
-    elif data == 'tutorial_uts':
-        tutorial_uts_text = """
+@callback_router.route("tutorial_uts")
+async def cb_tutorial_uts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    tutorial_uts_text = """
 📖 *Tutorial Pembelian XUTS*📖 
 
 1. Pilih menu tembak paket pilih menu XUTS 
@@ -4197,501 +4596,636 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 4. Paket Unofficial, tidak ada garansi.!
 5. Segala Konsekwensinya Di tanggung User
 """
-        keyboard = [[InlineKeyboardButton("🔙 Kembali ke Tutorial Beli", callback_data='tutorial_beli')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(tutorial_uts_text, parse_mode="Markdown", reply_markup=reply_markup)
-        
-    elif data == 'back_to_menu':
-        await send_main_menu(update, context)
-        simpan_data_ke_db()
-        return
-    
-    elif data == 'xcp_addon':                                                      
-        await send_xcp_addon_menu(update, context)
+    keyboard = [[InlineKeyboardButton("🔙 Kembali ke Tutorial Beli", callback_data='tutorial_beli')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(tutorial_uts_text, parse_mode="Markdown", reply_markup=reply_markup)
 
-    elif data == 'manual_xcs_addon_selection_menu':                                 
-        await send_manual_xcs_addon_selection_menu(update, context)
 
-    elif data == 'automatic_xcs_addon_flow':                                                       
-        await send_automatic_xcs_addon_method_selection_menu(update, context)
+@callback_router.route("back_to_menu")
+async def cb_back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_main_menu(update, context)
+    simpan_data_ke_db()
 
-    elif data.startswith('auto_xcs_method_'):                                                          
-        payment_method_for_xcp_8gb = data.replace('auto_xcs_method_', '').upper()
-        context.user_data['automatic_xcs_payment_method'] = payment_method_for_xcp_8gb
-        context.user_data['selected_automatic_addons'] = []                                           
-        await send_automatic_xcs_addon_package_selection_menu(update, context)
 
-    elif data.startswith('select_auto_addon_'):                                                                        
-        addon_code = data.replace('select_auto_addon_', '')
-        user_selected_addons = user_data["registered_users"][str(user_id)].setdefault("selected_automatic_addons", [])
-        
-        if addon_code in user_selected_addons:
-            user_selected_addons.remove(addon_code)
-            await query.answer(f"Paket dihapus dari pilihan.")
-        else:
-            user_selected_addons.append(addon_code)
-            await query.answer(f"Paket ditambahkan ke pilihan.")
-        
-        simpan_data_ke_db()
-        await send_automatic_xcs_addon_package_selection_menu(update, context)                  
-    
-    elif data == 'select_all_auto_addons':                      
-        all_addon_codes = [pkg['code'] for pkg in ADD_ON_SEQUENCE]
-        user_data["registered_users"][str(user_id)]["selected_automatic_addons"] = all_addon_codes
-        simpan_data_ke_db()
-        await query.answer("Semua paket ADD ON telah dipilih.")
-        await send_automatic_xcs_addon_package_selection_menu(update, context)
+@callback_router.route("xcp_addon")
+async def cb_xcp_addon(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_xcp_addon_menu(update, context)
 
-    elif data == 'clear_auto_addons_selection':                        
-        user_data["registered_users"][str(user_id)]["selected_automatic_addons"] = []
-        simpan_data_ke_db()
-        await query.answer("Pilihan paket ADD ON telah dihapus.")
-        await send_automatic_xcs_addon_package_selection_menu(update, context)
 
-    elif data == 'initiate_automatic_xcs_purchase':                                      
-        selected_addons = user_data["registered_users"][str(user_id)].get("selected_automatic_addons", [])
-        if not selected_addons:
-            await query.answer("Anda belum memilih paket ADD ON apapun.", show_alert=True)
-            return
+@callback_router.route("manual_xcs_addon_selection_menu")
+async def cb_manual_xcs_addon_selection_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_manual_xcs_addon_selection_menu(update, context)
 
-        payment_method_for_xcp_8gb = context.user_data.get('automatic_xcs_payment_method')
 
-        total_price_addons = 0
-        for addon_code in selected_addons:
-                                                                      
-            price_info = CUSTOM_PACKAGE_PRICES.get(addon_code)
-            if isinstance(price_info, dict):
-                total_price_addons += price_info.get('price_bot', 0)
-            else:                                                                                                    
-                total_price_addons += price_info if isinstance(price_info, (int, float)) else 0
-        
-                                          
-        xcp_8gb_price_key = f"c03be70fb3523ac2ac440966d3a5920e_{payment_method_for_xcp_8gb}" if payment_method_for_xcp_8gb == "QRIS" else XCP_8GB_PACKAGE['code']
-        if payment_method_for_xcp_8gb == "PULSA":
-            xcp_8gb_price_key = XCP_8GB_PULSA_PACKAGE['code']                                                       
+@callback_router.route("automatic_xcs_addon_flow")
+async def cb_automatic_xcs_addon_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_automatic_xcs_addon_method_selection_menu(update, context)
 
-        xcp_8gb_price = CUSTOM_PACKAGE_PRICES.get(xcp_8gb_price_key, {}).get('price_bot', 0)
-        
-        total_required_balance = total_price_addons + xcp_8gb_price
 
-        user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
-        if user_current_balance < total_required_balance:
-            await query.answer(f"Saldo Anda tidak cukup. Saldo Anda Rp{user_current_balance:,}, dibutuhkan Rp{total_required_balance:,}", show_alert=True)
-            return
-        
-                                                       
-        if total_required_balance > 0:
-            user_data["registered_users"][str(user_id)]["balance"] -= total_required_balance
-            simpan_data_ke_db()
-            await query.answer(f"Saldo Anda terpotong: Rp{total_required_balance:,}. Silakan masukkan nomor HP.", show_alert=False) 
-            logging.info(f"Saldo user {user_id} dipotong sebesar {total_required_balance} untuk batch XCS ADD ON otomatis.")
-        else:
-            if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
-                await query.answer(f"Saldo minimal Rp{MIN_BALANCE_FOR_PURCHASE:,} dibutuhkan untuk transaksi.", show_alert=True)
-                return
+@callback_router.route(prefix="auto_xcs_method_")
+async def cb_auto_xcs_method(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    payment_method_for_xcp_8gb = data.replace('auto_xcs_method_', '').upper()
+    context.user_data['automatic_xcs_payment_method'] = payment_method_for_xcp_8gb
+    context.user_data['selected_automatic_addons'] = []
+    await send_automatic_xcs_addon_package_selection_menu(update, context)
 
-        context.user_data['total_automatic_xcs_price'] = total_required_balance
-        context.user_data['automatic_xcs_flow_state'] = {                                         
-            'phone': None,
-            'access_token': None,
-            'payment_method_xcp_8gb': payment_method_for_xcp_8gb,
-            'addons_to_process': selected_addons,
-            'current_addon_index': 0,
-            'xcp_8gb_completed': False,
-            'overall_status_message_id': None,
-            'addon_retry_count': 0,
-            'has_waited_for_pending_once': False,  
-            'addon_long_delay_done': False, 
-            'addon_results': {},            
-            'addon_pass_retry_count': {},   
-        }
-        user_data["registered_users"][str(user_id)]["selected_automatic_addons"] = []                        
-        simpan_data_ke_db() 
-        
-        await query.edit_message_text(
-            text="Masukkan nomor HP untuk memproses pembelian XCS ADD ON Otomatis:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="automatic_xcs_addon_flow")]])
-        )
-        context.user_data['next'] = 'handle_automatic_xcs_addon_phone_input'
-        
-    elif data == 'menu_30h_nested':   
-        await send_30h_menu(update, context)  
 
-    elif data.startswith("select_30h_pkg_"): 
-        selected_package_id = data.replace("select_30h_pkg_", "")
-        user_selected_packages = user_data["registered_users"][str(user_id)].setdefault("selected_30h_pkg_ids", [])                   
-        
-        if selected_package_id in user_selected_packages:
-            user_selected_packages.remove(selected_package_id)
-            await query.answer(f"Paket dihapus dari pilihan.")
-        else:
-            user_selected_packages.append(selected_package_id)
-            await query.answer(f"Paket ditambahkan ke pilihan.")
-        
-        simpan_data_ke_db()
-        await send_30h_menu(update, context)
-    
-    elif data == "initiate_30h_batch_purchase": 
-        selected_30h_pkg_ids = user_data["registered_users"][str(user_id)].get("selected_30h_pkg_ids", [])
-        if not selected_30h_pkg_ids:
-            await query.answer("Anda belum memilih paket 30H apapun.", show_alert=True)
-            return
+@callback_router.route(prefix="select_auto_addon_")
+async def cb_select_auto_addon(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    addon_code = data.replace('select_auto_addon_', '')
+    user_selected_addons = user_data["registered_users"][str(user_id)].setdefault("selected_automatic_addons", [])
 
-        total_required_balance = 0
-        for pkg_id in selected_30h_pkg_ids:
-            pkg_info = next((p for p in THIRTY_H_PACKAGES if p["id"] == pkg_id), None)
-            if pkg_info:
-                total_required_balance += pkg_info['price_bot']
+    if addon_code in user_selected_addons:
+        user_selected_addons.remove(addon_code)
+        await query.answer(f"Paket dihapus dari pilihan.")
+    else:
+        user_selected_addons.append(addon_code)
+        await query.answer(f"Paket ditambahkan ke pilihan.")
 
-        user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
-        if user_current_balance < total_required_balance:
-            await query.answer(f"Saldo tidak cukup. Saldo Anda Rp{user_current_balance:,}, dibutuhkan Rp{total_required_balance:,}", show_alert=True)
-            return
-        
-        if total_required_balance > 0:
-            user_data["registered_users"][str(user_id)]["balance"] -= total_required_balance
-            simpan_data_ke_db()
-            await query.answer(f"Saldo Anda terpotong: Rp{total_required_balance:,}. Silakan masukkan nomor HP.", show_alert=False) 
-            logging.info(f"Saldo user {user_id} dipotong sebesar {total_required_balance} untuk batch 30H.")
-        else:
-            if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
-                await query.answer(f"Saldo minimal Rp{MIN_BALANCE_FOR_PURCHASE:,} dibutuhkan untuk transaksi.", show_alert=True)
-                return
+    simpan_data_ke_db(user_id)
+    await send_automatic_xcs_addon_package_selection_menu(update, context)
 
-        context.user_data['total_30h_batch_price'] = total_required_balance
-        
-        await query.edit_message_text(
-            text="Masukkan nomor HP untuk memproses paket 30H yang dipilih:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="menu_30h_nested")]])
-        )
-        context.user_data['next'] = 'handle_phone_for_30h_batch_purchase'
-        context.user_data['current_30h_batch_results'] = []                                
 
-    elif data == "clear_30h_pkg_selection": 
-        user_data["registered_users"][str(user_id)]["selected_30h_pkg_ids"] = []
-        simpan_data_ke_db()
-        await query.answer("Pilihan paket 30H telah dihapus.")
-        await send_30h_menu(update, context)
-        
-    elif data == "select_all_30h_pkg": 
-        all_package_ids = [pkg['id'] for pkg in THIRTY_H_PACKAGES]
-        user_data["registered_users"][str(user_id)]["selected_30h_pkg_ids"] = all_package_ids
-        
-        simpan_data_ke_db()
-        await query.answer("Semua paket 30H telah dipilih.")
-        await send_30h_menu(update, context)     
-   
-   
-    elif data.startswith("xcp_"):
-        selected_package_raw = data.replace("xcp_", "")                                                                                               
+@callback_router.route("select_all_auto_addons")
+async def cb_select_all_auto_addons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    all_addon_codes = list(ADD_ON_REGISTRY)
+    user_data["registered_users"][str(user_id)]["selected_automatic_addons"] = all_addon_codes
+    simpan_data_ke_db(user_id)
+    await query.answer("Semua paket ADD ON telah dipilih.")
+    await send_automatic_xcs_addon_package_selection_menu(update, context)
 
-                                                              
-        if selected_package_raw.endswith("_QRIS"):
-            selected_package_code = selected_package_raw.replace("_QRIS", "")
-            payment_method_for_api = "QRIS"
-                                              
-            package_name_display = XCP_8GB_PACKAGE['name'] + " QRIS"
+
+@callback_router.route("clear_auto_addons_selection")
+async def cb_clear_auto_addons_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    user_data["registered_users"][str(user_id)]["selected_automatic_addons"] = []
+    simpan_data_ke_db(user_id)
+    await query.answer("Pilihan paket ADD ON telah dihapus.")
+    await send_automatic_xcs_addon_package_selection_menu(update, context)
+
+
+@callback_router.route("initiate_automatic_xcs_purchase")
+async def cb_initiate_automatic_xcs_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    selected_addons = user_data["registered_users"][str(user_id)].get("selected_automatic_addons", [])
+    if not selected_addons:
+        await query.answer("Anda belum memilih paket ADD ON apapun.", show_alert=True)
+        return
+
+    payment_method_for_xcp_8gb = context.user_data.get('automatic_xcs_payment_method')
+
+    total_price_addons = 0
+    for addon_code in selected_addons:
+
+        price_info = CUSTOM_PACKAGE_PRICES.get(addon_code)
+        if isinstance(price_info, dict):
+            total_price_addons += price_info.get('price_bot', 0)
         else:
-            selected_package_code = selected_package_raw
-                                                                     
-            if selected_package_code == XCP_8GB_PULSA_PACKAGE['code']:
-                payment_method_for_api = "BALANCE"
-                package_name_display = XCP_8GB_PULSA_PACKAGE['name']
-            else:                                                                    
-                payment_method_for_api = "DANA"
-                package_info = next((p for p in ADD_ON_SEQUENCE if p["code"] == selected_package_code), None)
-                if package_info:
-                    package_name_display = package_info["name"]
-                elif selected_package_code == XCP_8GB_PACKAGE['code']:
-                    package_name_display = XCP_8GB_PACKAGE['name']
-                else:
-                    package_name_display = selected_package_code           
+            total_price_addons += price_info if isinstance(price_info, (int, float)) else 0
 
+    xcp_8gb_price_key = f"c03be70fb3523ac2ac440966d3a5920e_{payment_method_for_xcp_8gb}" if payment_method_for_xcp_8gb == "QRIS" else XCP_8GB_PACKAGE['code']
+    if payment_method_for_xcp_8gb == "PULSA":
+        xcp_8gb_price_key = XCP_8GB_PULSA_PACKAGE['code']
 
-        required_balance = CUSTOM_PACKAGE_PRICES.get(selected_package_raw, {}).get('price_bot', 0)
-        user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
+    xcp_8gb_price = CUSTOM_PACKAGE_PRICES.get(xcp_8gb_price_key, {}).get('price_bot', 0)
 
-        if user_balance < required_balance:
-            await query.answer(f"Saldo Anda tidak cukup (butuh Rp{required_balance:,})", show_alert=True)
+    total_required_balance = total_price_addons + xcp_8gb_price
+
+    user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
+    if user_current_balance < total_required_balance:
+        await query.answer(f"Saldo Anda tidak cukup. Saldo Anda Rp{user_current_balance:,}, dibutuhkan Rp{total_required_balance:,}", show_alert=True)
+        return
+
+    if total_required_balance > 0:
+        if not debit_saldo(user_id, total_required_balance, "pembelian", kunci_update(update, "pembelian")):
+            await query.answer(pesan_debit_gagal(user_id, total_required_balance), show_alert=True)
             return
-        
-                                              
-        if selected_package_code == XCP_8GB_PACKAGE['code']:                             
-            back_callback = "xcp_addon"
-        else:                                   
-            back_callback = "xcp_addon_dana"
-            
-        await query.edit_message_text(
-            text=f"Anda memilih: *{package_name_display}*.\nMasukkan nomor HP untuk pembelian:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data=back_callback)]]),
-            parse_mode="Markdown"
-        )
-        
-        context.user_data['selected_package_code'] = selected_package_code
-        context.user_data['selected_payment_method'] = payment_method_for_api
-        context.user_data['selected_api_provider'] = "kmsp"
-        context.user_data['next'] = 'handle_beli_xcp'
-
-    elif data.startswith("select_hesdapkg_"):
-        selected_package_id = data.replace("select_hesdapkg_", "")
-        user_selected_packages = user_data["registered_users"][str(user_id)]["selected_hesdapkg_ids"]
-        
-        if selected_package_id in user_selected_packages:
-            user_selected_packages.remove(selected_package_id)
-            await query.answer(f"Paket dihapus dari pilihan.")
-        else:
-            user_selected_packages.append(selected_package_id)
-            await query.answer(f"Paket ditambahkan ke pilihan.")
-        
-        simpan_data_ke_db()
-        await send_bypass_menu(update, context)
-    
-    elif data == "initiate_hesda_batch_purchase":
-        selected_hesdapkg_ids = user_data["registered_users"][str(user_id)].get("selected_hesdapkg_ids", [])
-        if not selected_hesdapkg_ids:
-            await query.answer("Anda belum memilih paket apapun.", show_alert=True)
+        simpan_data_ke_db(user_id)
+        await query.answer(f"Saldo Anda terpotong: Rp{total_required_balance:,}. Silakan masukkan nomor HP.", show_alert=False)
+        logging.info(f"Saldo user {user_id} dipotong sebesar {total_required_balance} untuk batch XCS ADD ON otomatis.")
+    else:
+        if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
+            await query.answer(f"Saldo minimal Rp{MIN_BALANCE_FOR_PURCHASE:,} dibutuhkan untuk transaksi.", show_alert=True)
             return
 
-        total_required_balance = 0
-        for pkg_id in selected_hesdapkg_ids:
-            pkg_info = next((p for p in HESDA_PACKAGES if p["id"] == pkg_id), None)
-            if pkg_info:
-                total_required_balance += pkg_info['price_bot']
+    context.user_data['total_automatic_xcs_price'] = total_required_balance
+    context.user_data['automatic_xcs_flow_state'] = {
+        'phone': None,
+        'access_token': None,
+        'payment_method_xcp_8gb': payment_method_for_xcp_8gb,
+        'addons_to_process': selected_addons,
+        'current_addon_index': 0,
+        'xcp_8gb_completed': False,
+        'overall_status_message_id': None,
+        'addon_retry_count': 0,
+        'has_waited_for_pending_once': False,
+        'addon_long_delay_done': False,
+        'addon_results': {},
+        'addon_pass_retry_count': {},
+    }
+    user_data["registered_users"][str(user_id)]["selected_automatic_addons"] = []
+    simpan_data_ke_db(user_id)
+
+    await query.edit_message_text(
+        text="Masukkan nomor HP untuk memproses pembelian XCS ADD ON Otomatis:",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="automatic_xcs_addon_flow")]])
+    )
+    step_router.set_next(context, 'handle_automatic_xcs_addon_phone_input')
+
+
+@callback_router.route("menu_30h_nested")
+async def cb_menu_30h_nested(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_30h_menu(update, context)
+
+
+@callback_router.route(prefix="select_30h_pkg_")
+async def cb_select_30h_pkg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    selected_package_id = data.replace("select_30h_pkg_", "")
+    user_selected_packages = user_data["registered_users"][str(user_id)].setdefault("selected_30h_pkg_ids", [])
+
+    if selected_package_id in user_selected_packages:
+        user_selected_packages.remove(selected_package_id)
+        await query.answer(f"Paket dihapus dari pilihan.")
+    else:
+        user_selected_packages.append(selected_package_id)
+        await query.answer(f"Paket ditambahkan ke pilihan.")
+
+    simpan_data_ke_db(user_id)
+    await send_30h_menu(update, context)
+
+
+@callback_router.route("initiate_30h_batch_purchase")
+async def cb_initiate_30h_batch_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    selected_30h_pkg_ids = user_data["registered_users"][str(user_id)].get("selected_30h_pkg_ids", [])
+    if not selected_30h_pkg_ids:
+        await query.answer("Anda belum memilih paket 30H apapun.", show_alert=True)
+        return
+
+    total_required_balance = 0
+    for pkg_id in selected_30h_pkg_ids:
+        pkg_info = THIRTY_H_REGISTRY.get(pkg_id)
+        if pkg_info:
+            total_required_balance += pkg_info['price_bot']
 
-        user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
-        if user_current_balance < total_required_balance:
-            await query.answer(f"Saldo tidak cukup. Saldo Anda Rp{user_current_balance:,}, dibutuhkan Rp{total_required_balance:,}", show_alert=True)
+    user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
+    if user_current_balance < total_required_balance:
+        await query.answer(f"Saldo tidak cukup. Saldo Anda Rp{user_current_balance:,}, dibutuhkan Rp{total_required_balance:,}", show_alert=True)
+        return
+
+    if total_required_balance > 0:
+        if not debit_saldo(user_id, total_required_balance, "pembelian", kunci_update(update, "pembelian")):
+            await query.answer(pesan_debit_gagal(user_id, total_required_balance), show_alert=True)
+            return
+        simpan_data_ke_db(user_id)
+        await query.answer(f"Saldo Anda terpotong: Rp{total_required_balance:,}. Silakan masukkan nomor HP.", show_alert=False)
+        logging.info(f"Saldo user {user_id} dipotong sebesar {total_required_balance} untuk batch 30H.")
+    else:
+        if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
+            await query.answer(f"Saldo minimal Rp{MIN_BALANCE_FOR_PURCHASE:,} dibutuhkan untuk transaksi.", show_alert=True)
             return
-        
-                                                               
-        if total_required_balance > 0:
-            user_data["registered_users"][str(user_id)]["balance"] -= total_required_balance
-            simpan_data_ke_db()
-            await query.answer(f"Saldo Anda terpotong: Rp{total_required_balance:,}. Silakan masukkan nomor HP.", show_alert=False)                    
-            logging.info(f"Saldo user {user_id} dipotong sebesar {total_required_balance} untuk batch Hesda.")
-        else:
-                                                                     
-            if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
-                await query.answer(f"Saldo minimal Rp{MIN_BALANCE_FOR_PURCHASE:,} dibutuhkan untuk transaksi.", show_alert=True)
-                return
 
-                                                                                      
-        context.user_data['total_hesdapkg_batch_price'] = total_required_balance
-        
-                                                        
-        await query.edit_message_text(
-            text="Masukkan nomor HP untuk memproses paket BYPAS yang dipilih:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="menu_bypass_nested")]])
-        )
-        context.user_data['next'] = 'handle_phone_for_hesda_batch_purchase'
-        context.user_data['current_hesda_batch_results'] = []                                
+    context.user_data['total_30h_batch_price'] = total_required_balance
 
-    elif data == "clear_hesdapkg_selection":
-        user_data["registered_users"][str(user_id)]["selected_hesdapkg_ids"] = []
-        simpan_data_ke_db()
-        await query.answer("Pilihan paket BYPAS telah dihapus.")
-        await send_bypass_menu(update, context)
-        
-    elif data == "select_all_hesdapkg":
-                                                            
-        all_package_ids = [pkg['id'] for pkg in HESDA_PACKAGES]
-        
-                                                                      
-        user_data["registered_users"][str(user_id)]["selected_hesdapkg_ids"] = all_package_ids
-        
-        simpan_data_ke_db()
-        await query.answer("Semua paket bypass telah dipilih.")
-        
-                                                               
-        await send_bypass_menu(update, context)     
+    await query.edit_message_text(
+        text="Masukkan nomor HP untuk memproses paket 30H yang dipilih:",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="menu_30h_nested")]])
+    )
+    step_router.set_next(context, 'handle_phone_for_30h_batch_purchase')
+    context.user_data['current_30h_batch_results'] = []
 
-    elif data.startswith("ganti_"):
-        nomor_baru = data.replace("ganti_", "")
-        if nomor_baru in user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}):
-            user_data["registered_users"][str(user_id)]["current_phone"] = nomor_baru
-            simpan_data_ke_db()
-            logging.info(f"User {user_id} mengganti akun aktif ke {nomor_baru}")
-            try:
-                await query.edit_message_text(f"✅ Nomor aktif diubah ke `{nomor_baru}`", parse_mode="Markdown")
-            except Exception as e:
-                logging.warning(f"Gagal mengedit pesan setelah ganti akun: {e}. Mengirim pesan baru.")
-                msg = await context.bot.send_message(user_id, f"✅ Nomor aktif diubah ke `{nomor_baru}`", parse_mode="Markdown")
-                bot_messages.setdefault(user_id, []).append(msg.message_id)
-            
-            await akun_saya_command_handler(update, context)
+
+@callback_router.route("clear_30h_pkg_selection")
+async def cb_clear_30h_pkg_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    user_data["registered_users"][str(user_id)]["selected_30h_pkg_ids"] = []
+    simpan_data_ke_db(user_id)
+    await query.answer("Pilihan paket 30H telah dihapus.")
+    await send_30h_menu(update, context)
+
+
+@callback_router.route("select_all_30h_pkg")
+async def cb_select_all_30h_pkg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    all_package_ids = list(THIRTY_H_REGISTRY)
+    user_data["registered_users"][str(user_id)]["selected_30h_pkg_ids"] = all_package_ids
+
+    simpan_data_ke_db(user_id)
+    await query.answer("Semua paket 30H telah dipilih.")
+    await send_30h_menu(update, context)
+
+
+@callback_router.route(prefix="xcp_")
+async def cb_xcp(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    selected_package_raw = data.replace("xcp_", "")
+
+    if selected_package_raw.endswith("_QRIS"):
+        selected_package_code = selected_package_raw.replace("_QRIS", "")
+        payment_method_for_api = "QRIS"
+
+        package_name_display = XCP_8GB_PACKAGE['name'] + " QRIS"
+    else:
+        selected_package_code = selected_package_raw
+
+        if selected_package_code == XCP_8GB_PULSA_PACKAGE['code']:
+            payment_method_for_api = "BALANCE"
+            package_name_display = XCP_8GB_PULSA_PACKAGE['name']
         else:
-            msg = await context.bot.send_message(user_id, "❌ Nomor tidak ditemukan di akunmu.")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
+            payment_method_for_api = "DANA"
+            package_info = ADD_ON_REGISTRY.get(selected_package_code)
+            if package_info:
+                package_name_display = package_info["name"]
+            elif selected_package_code == XCP_8GB_PACKAGE['code']:
+                package_name_display = XCP_8GB_PACKAGE['name']
+            else:
+                package_name_display = selected_package_code
+
+    required_balance = CUSTOM_PACKAGE_PRICES.get(selected_package_raw, {}).get('price_bot', 0)
+    user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
+
+    if user_balance < required_balance:
+        await query.answer(f"Saldo Anda tidak cukup (butuh Rp{required_balance:,})", show_alert=True)
         return
 
-    elif data == 'resend_otp':
-        phone = user_data.get("registered_users", {}).get(str(user_id), {}).get("current_phone")
-        current_provider = context.user_data.get('current_login_provider')
+    if selected_package_code == XCP_8GB_PACKAGE['code']:
+        back_callback = "xcp_addon"
+    else:
+        back_callback = "xcp_addon_dana"
 
-        if not phone:
-            msg = await context.bot.send_message(user_id, "Nomor HP tidak ditemukan. Silakan coba Login ulang.")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
+    await query.edit_message_text(
+        text=f"Anda memilih: *{package_name_display}*.\nMasukkan nomor HP untuk pembelian:",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data=back_callback)]]),
+        parse_mode="Markdown"
+    )
+
+    context.user_data['selected_package_code'] = selected_package_code
+    context.user_data['selected_payment_method'] = payment_method_for_api
+    context.user_data['selected_api_provider'] = "kmsp"
+    step_router.set_next(context, 'handle_beli_xcp')
+
+
+@callback_router.route(prefix="select_hesdapkg_")
+async def cb_select_hesdapkg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    selected_package_id = data.replace("select_hesdapkg_", "")
+    user_selected_packages = user_data["registered_users"][str(user_id)]["selected_hesdapkg_ids"]
+
+    if selected_package_id in user_selected_packages:
+        user_selected_packages.remove(selected_package_id)
+        await query.answer(f"Paket dihapus dari pilihan.")
+    else:
+        user_selected_packages.append(selected_package_id)
+        await query.answer(f"Paket ditambahkan ke pilihan.")
+
+    simpan_data_ke_db(user_id)
+    await send_bypass_menu(update, context)
+
+
+@callback_router.route("initiate_hesda_batch_purchase")
+async def cb_initiate_hesda_batch_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    selected_hesdapkg_ids = user_data["registered_users"][str(user_id)].get("selected_hesdapkg_ids", [])
+    if not selected_hesdapkg_ids:
+        await query.answer("Anda belum memilih paket apapun.", show_alert=True)
+        return
+
+    total_required_balance = 0
+    for pkg_id in selected_hesdapkg_ids:
+        pkg_info = HESDA_REGISTRY.get(pkg_id)
+        if pkg_info:
+            total_required_balance += pkg_info['price_bot']
+
+    user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
+    if user_current_balance < total_required_balance:
+        await query.answer(f"Saldo tidak cukup. Saldo Anda Rp{user_current_balance:,}, dibutuhkan Rp{total_required_balance:,}", show_alert=True)
+        return
+
+    if total_required_balance > 0:
+        if not debit_saldo(user_id, total_required_balance, "pembelian", kunci_update(update, "pembelian")):
+            await query.answer(pesan_debit_gagal(user_id, total_required_balance), show_alert=True)
             return
-        
-        login_counter[user_id] = 0
-        if current_provider == 'kmsp':
-            await request_otp_and_prompt_kmsp(update, context, phone)
-        elif current_provider == 'hesda':
-            await request_otp_and_prompt_hesda(update, context, phone)
-    
-    elif data.startswith("buy_uts_"):
-        package_type = data.replace("buy_uts_", "")
-        
-        selected_package_code = ""
-        package_name_display = ""
-        payment_method_for_api = ""
-
-        if package_type == "pulsa_gandengan":
-            selected_package_code = "XLUNLITURBOSUPERXC_PULSA"
-            package_name_display = "XUTS"
-            payment_method_for_api = "BALANCE"                           
-        elif package_type == "1gb":
-            selected_package_code = "XL_XC1PLUS1DISC_EWALLET"
-            package_name_display = "XC 1+1GB DANA"
-            payment_method_for_api = "DANA"                           
-        elif package_type == "1gb_pulsa": 
-            selected_package_code = "XL_XC1PLUS1DISC_PULSA" 
-            package_name_display = "XC 1+1GB PULSA" 
-            payment_method_for_api = "BALANCE"                           
-        elif package_type == "1gb_qris":                                
-            selected_package_code = "XL_XC1PLUS1DISC_EWALLET"                            
-            package_name_display = "XC 1+1GB QRIS"
-            payment_method_for_api = "QRIS"                             
-        else:
-            await query.answer("Pilihan tidak valid.", show_alert=True)
+        simpan_data_ke_db(user_id)
+        await query.answer(f"Saldo Anda terpotong: Rp{total_required_balance:,}. Silakan masukkan nomor HP.", show_alert=False)
+        logging.info(f"Saldo user {user_id} dipotong sebesar {total_required_balance} untuk batch Hesda.")
+    else:
+
+        if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
+            await query.answer(f"Saldo minimal Rp{MIN_BALANCE_FOR_PURCHASE:,} dibutuhkan untuk transaksi.", show_alert=True)
             return
 
-                                                              
-        price_lookup_key = selected_package_code
-        if package_type == "1gb_qris":
-             price_lookup_key = "XL_XC1PLUS1DISC_QRIS"                            
+    context.user_data['total_hesdapkg_batch_price'] = total_required_balance
 
-        required_balance = CUSTOM_PACKAGE_PRICES.get(price_lookup_key, {}).get('price_bot', 0)
-        user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
+    await query.edit_message_text(
+        text="Masukkan nomor HP untuk memproses paket BYPAS yang dipilih:",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="menu_bypass_nested")]])
+    )
+    step_router.set_next(context, 'handle_phone_for_hesda_batch_purchase')
+    context.user_data['current_hesda_batch_results'] = []
 
-        if user_balance < required_balance:
-            await query.answer(f"Saldo Anda tidak cukup (butuh Rp{required_balance:,})", show_alert=True)
-            return
-        
-                                           
-        await query.edit_message_text(
-            text=f"Anda memilih: *{package_name_display}*.\nMasukkan nomor HP untuk pembelian:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="menu_uts_nested")]]),
-            parse_mode="Markdown"
-        )
 
-        context.user_data['selected_package_code'] = selected_package_code
-        context.user_data['selected_payment_method'] = payment_method_for_api
-        context.user_data['selected_api_provider'] = "kmsp"
-        context.user_data['next'] = 'handle_beli_uts_package'
-
-    elif data == 'buy_all_addons':
-        user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
-        if user_balance < MIN_BALANCE_FOR_PURCHASE:
-            await query.answer("Saldo tidak cukup", show_alert=True)
-            text = (f"❌ Saldo Anda tidak cukup untuk memulai pembelian batch.\n"
-                    f"Saldo Anda: *Rp{user_balance:,}*\n"
-                    f"Saldo Minimal: *Rp{MIN_TOP_UP_AMOUNT:,}*\n"
-                    f"Silakan isi saldo terlebih dahulu.")
-            
-            keyboard = [[InlineKeyboardButton("🏠 Kembali ke Menu Paket XCS", callback_data="xcp_addon_dana")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            msg = await context.bot.send_message(user_id, text, parse_mode="Markdown", reply_markup=reply_markup)
+@callback_router.route("clear_hesdapkg_selection")
+async def cb_clear_hesdapkg_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    user_data["registered_users"][str(user_id)]["selected_hesdapkg_ids"] = []
+    simpan_data_ke_db(user_id)
+    await query.answer("Pilihan paket BYPAS telah dihapus.")
+    await send_bypass_menu(update, context)
+
+
+@callback_router.route("select_all_hesdapkg")
+async def cb_select_all_hesdapkg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+
+    all_package_ids = list(HESDA_REGISTRY)
+
+    user_data["registered_users"][str(user_id)]["selected_hesdapkg_ids"] = all_package_ids
+
+    simpan_data_ke_db(user_id)
+    await query.answer("Semua paket bypass telah dipilih.")
+
+    await send_bypass_menu(update, context)
+
+
+@callback_router.route(prefix="ganti_")
+async def cb_ganti(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    nomor_baru = data.replace("ganti_", "")
+    if nomor_baru in user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}):
+        user_data["registered_users"][str(user_id)]["current_phone"] = nomor_baru
+        simpan_data_ke_db(user_id)
+        logging.info(f"User {user_id} mengganti akun aktif ke {nomor_baru}")
+        try:
+            await query.edit_message_text(f"✅ Nomor aktif diubah ke `{nomor_baru}`", parse_mode="Markdown")
+        except Exception as e:
+            logging.warning(f"Gagal mengedit pesan setelah ganti akun: {e}. Mengirim pesan baru.")
+            msg = await context.bot.send_message(user_id, f"✅ Nomor aktif diubah ke `{nomor_baru}`", parse_mode="Markdown")
             bot_messages.setdefault(user_id, []).append(msg.message_id)
-            return
 
-        context.user_data['addon_batch_current'] = 1
-        context.user_data['selected_api_provider'] = "kmsp"
-        msg = await context.bot.send_message(user_id, "Anda memilih untuk membeli *SEMUA ADD ON* secara bertahap.\nMasukkan nomor HP yang akan diisi paket:", parse_mode="Markdown")
+        await akun_saya_command_handler(update, context)
+    else:
+        msg = await context.bot.send_message(user_id, "❌ Nomor tidak ditemukan di akunmu.")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+
+
+@callback_router.route("resend_otp")
+async def cb_resend_otp(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    phone = user_data.get("registered_users", {}).get(str(user_id), {}).get("current_phone")
+    current_provider = context.user_data.get('current_login_provider')
+
+    if not phone:
+        msg = await context.bot.send_message(user_id, "Nomor HP tidak ditemukan. Silakan coba Login ulang.")
         bot_messages.setdefault(user_id, []).append(msg.message_id)
-        context.user_data['next'] = 'handle_all_addons_phone_input'
         return
-    
-    elif data == 'stop_batch_purchase':
-        await query.answer("Mengirim sinyal berhenti...")
-        context.user_data['stop_batch_purchase'] = True
-        logging.info(f"User {user_id} meminta untuk menghentikan batch purchase.")
-        await context.bot.edit_message_text(chat_id=user_id, message_id=query.message.message_id, text="⏳ Proses penghentian diminta, harap tunggu...", reply_markup=None)
+
+    login_counter[user_id] = 0
+    if current_provider == 'kmsp':
+        await request_otp_and_prompt_kmsp(update, context, phone)
+    elif current_provider == 'hesda':
+        await request_otp_and_prompt_hesda(update, context, phone)
+
+
+@callback_router.route(prefix="buy_uts_")
+async def cb_buy_uts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    package_type = data.replace("buy_uts_", "")
+
+    selected_package_code = ""
+    package_name_display = ""
+    payment_method_for_api = ""
+
+    if package_type == "pulsa_gandengan":
+        selected_package_code = "XLUNLITURBOSUPERXC_PULSA"
+        package_name_display = "XUTS"
+        payment_method_for_api = "BALANCE"
+    elif package_type == "1gb":
+        selected_package_code = "XL_XC1PLUS1DISC_EWALLET"
+        package_name_display = "XC 1+1GB DANA"
+        payment_method_for_api = "DANA"
+    elif package_type == "1gb_pulsa":
+        selected_package_code = "XL_XC1PLUS1DISC_PULSA"
+        package_name_display = "XC 1+1GB PULSA"
+        payment_method_for_api = "BALANCE"
+    elif package_type == "1gb_qris":
+        selected_package_code = "XL_XC1PLUS1DISC_EWALLET"
+        package_name_display = "XC 1+1GB QRIS"
+        payment_method_for_api = "QRIS"
+    else:
+        await query.answer("Pilihan tidak valid.", show_alert=True)
+        return
+
+    price_lookup_key = selected_package_code
+    if package_type == "1gb_qris":
+         price_lookup_key = "XL_XC1PLUS1DISC_QRIS"
+
+    required_balance = CUSTOM_PACKAGE_PRICES.get(price_lookup_key, {}).get('price_bot', 0)
+    user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
+
+    if user_balance < required_balance:
+        await query.answer(f"Saldo Anda tidak cukup (butuh Rp{required_balance:,})", show_alert=True)
         return
 
-    elif data.startswith('continue_addon_batch_'):
-        next_batch_num = int(data.split('_')[-1])
-        context.user_data['addon_batch_current'] = next_batch_num
-        asyncio.create_task(process_addon_batch(update, context))
+    await query.edit_message_text(
+        text=f"Anda memilih: *{package_name_display}*.\nMasukkan nomor HP untuk pembelian:",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="menu_uts_nested")]]),
+        parse_mode="Markdown"
+    )
+
+    context.user_data['selected_package_code'] = selected_package_code
+    context.user_data['selected_payment_method'] = payment_method_for_api
+    context.user_data['selected_api_provider'] = "kmsp"
+    step_router.set_next(context, 'handle_beli_uts_package')
+
+
+@callback_router.route("buy_all_addons")
+async def cb_buy_all_addons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
+    if user_balance < MIN_BALANCE_FOR_PURCHASE:
+        await query.answer("Saldo tidak cukup", show_alert=True)
+        text = (f"❌ Saldo Anda tidak cukup untuk memulai pembelian batch.\n"
+                f"Saldo Anda: *Rp{user_balance:,}*\n"
+                f"Saldo Minimal: *Rp{MIN_TOP_UP_AMOUNT:,}*\n"
+                f"Silakan isi saldo terlebih dahulu.")
+
+        keyboard = [[InlineKeyboardButton("🏠 Kembali ke Menu Paket XCS", callback_data="xcp_addon_dana")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        msg = await context.bot.send_message(user_id, text, parse_mode="Markdown", reply_markup=reply_markup)
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
         return
 
-    elif data == 'show_custom_packages':
-        await show_custom_packages_for_user(update, context)
+    context.user_data['addon_batch_current'] = 1
+    context.user_data['selected_api_provider'] = "kmsp"
+    msg = await context.bot.send_message(user_id, "Anda memilih untuk membeli *SEMUA ADD ON* secara bertahap.\nMasukkan nomor HP yang akan diisi paket:", parse_mode="Markdown")
+    bot_messages.setdefault(user_id, []).append(msg.message_id)
+    step_router.set_next(context, 'handle_all_addons_phone_input')
+
+
+@callback_router.route("stop_batch_purchase")
+async def cb_stop_batch_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer("Mengirim sinyal berhenti...")
+    context.user_data['stop_batch_purchase'] = True
+    logging.info(f"User {user_id} meminta untuk menghentikan batch purchase.")
+    await context.bot.edit_message_text(chat_id=user_id, message_id=query.message.message_id, text="⏳ Proses penghentian diminta, harap tunggu...", reply_markup=None)
+
+
+@callback_router.route(prefix="continue_addon_batch_")
+async def cb_continue_addon_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    next_batch_num = int(data.split('_')[-1])
+    context.user_data['addon_batch_current'] = next_batch_num
+    asyncio.create_task(process_addon_batch(update, context))
+
+
+@callback_router.route("show_custom_packages")
+async def cb_show_custom_packages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_custom_packages_for_user(update, context)
+
+
+@callback_router.route(prefix="buy_custom_package_")
+async def cb_buy_custom_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    package_code = data.replace("buy_custom_package_", "")
+    package_details = user_data["custom_packages"].get(package_code)
+
+    if not package_details:
+        await query.answer("Paket kustom tidak dikenali.", show_alert=True)
+        return
+
+    package_name = package_details['name']
+    package_price = package_details['price']
+
+    user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
+
+    if user_balance < package_price:
+        await query.answer(f"Saldo Anda tidak cukup (butuh Rp{package_price:,})", show_alert=True)
+        return
+
+    await query.edit_message_text(
+        text=f"Anda memilih: *{package_name}*.\nMasukkan nomor HP untuk pembelian:",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="show_custom_packages")]]),
+        parse_mode="Markdown"
+    )
+
+    context.user_data['selected_custom_package_code'] = package_code
+    context.user_data['selected_custom_package_name'] = package_name
+    context.user_data['selected_custom_package_price'] = package_price
+    context.user_data['selected_api_provider'] = "kmsp"
+    step_router.set_next(context, 'handle_buy_custom_package_phone_input')
+
+
+@callback_router.route(prefix="view_custom_package_")
+async def cb_view_custom_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_custom_package_details(update, context)
+
+
+@callback_router.route(prefix="buy_custom_")
+async def cb_buy_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await handle_custom_package_payment_selection(update, context)
+
+
+@callback_router.route(prefix="retry_single_")
+async def cb_retry_single(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    pass
 
-    elif data.startswith("buy_custom_package_"):
-        package_code = data.replace("buy_custom_package_", "")
-        package_details = user_data["custom_packages"].get(package_code)
-        
-        if not package_details:
-            await query.answer("Paket kustom tidak dikenali.", show_alert=True)
-            return
-        
-        package_name = package_details['name']
-        package_price = package_details['price']
 
-        user_balance = user_data.get("registered_users", {}).get(str(user_id), {}).get("balance", 0)
+@callback_router.route("hapus_akun_menu")
+async def cb_hapus_akun_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await hapus_akun_menu(update, context)
 
-        if user_balance < package_price:
-            await query.answer(f"Saldo Anda tidak cukup (butuh Rp{package_price:,})", show_alert=True)
+
+@callback_router.route(prefix="pilih_hapus_")
+async def cb_pilih_hapus(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    phone_to_delete = data.replace('pilih_hapus_', '')
+    await konfirmasi_hapus_akun(update, context, phone_to_delete)
+
+
+@callback_router.route(prefix="konfirmasi_hapus_")
+async def cb_konfirmasi_hapus(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    phone_to_delete = data.replace('konfirmasi_hapus_', '')
+    await eksekusi_hapus_akun(update, context, phone_to_delete)
+
+
+@callback_router.route("batal_hapus_akun")
+async def cb_batal_hapus_akun(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer("Penghapusan dibatalkan.")
+    await akun_saya_command_handler(update, context)
+
+async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    
+    if user_id == ADMIN_ID:
+        if data.startswith("broadcast_add_button_"):
+            await admin_handle_broadcast_button_choice(update, context)
+            return
+        if data.startswith("broadcast_add_reply_"):
+            await admin_handle_broadcast_reply_choice(update, context)
+            return
+        if data.startswith("admin_"):
+            await admin_callback_handler(update, context)
+            return    
+                                                                   
+        if data.startswith('hesda_api_res_'):
+            await admin_callback_handler(update, context)
+            return
+                                                                                         
+        if data.startswith('retry_single_'):
+            await admin_callback_handler(update, context)                                                                  
             return
         
-                                           
-        await query.edit_message_text(
-            text=f"Anda memilih: *{package_name}*.\nMasukkan nomor HP untuk pembelian:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali", callback_data="show_custom_packages")]]),
-            parse_mode="Markdown"
-        )
-        
-        context.user_data['selected_custom_package_code'] = package_code
-        context.user_data['selected_custom_package_name'] = package_name
-        context.user_data['selected_custom_package_price'] = package_price
-        context.user_data['selected_api_provider'] = "kmsp"
-        context.user_data['next'] = 'handle_buy_custom_package_phone_input'
-    
-
-    elif data.startswith("view_custom_package_"):
-        await show_custom_package_details(update, context)
-        return
-    elif data.startswith("buy_custom_"):
-        await handle_custom_package_payment_selection(update, context)
+    if not await check_access(update, context):
         return
 
-    
-    elif data.startswith("retry_single_"):
-        pass
-
-    elif data == 'hapus_akun_menu':
-        await hapus_akun_menu(update, context)
-        return
-    elif data.startswith('pilih_hapus_'):
-        phone_to_delete = data.replace('pilih_hapus_', '')
-        await konfirmasi_hapus_akun(update, context, phone_to_delete)
-        return
-    elif data.startswith('konfirmasi_hapus_'):
-        phone_to_delete = data.replace('konfirmasi_hapus_', '')
-        await eksekusi_hapus_akun(update, context, phone_to_delete)
-        return
-    elif data == 'batal_hapus_akun':
-        await query.answer("Penghapusan dibatalkan.")
-        await akun_saya_command_handler(update, context)                            
-        return
+    logging.info(f"User {user_id} menekan tombol: {data}")
+    if not await callback_router.dispatch(update, context, data):
+        logging.warning(f"Callback tanpa route dari user {user_id}: {data}")
 
 async def request_otp_and_prompt_kmsp(update: Update, context: ContextTypes.DEFAULT_TYPE, phone: str):
     user_id = update.effective_user.id
     try:
-        url = f"https://golang-openapi-reqotp-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}&phone={phone}&method=OTP"
-        response = requests.get(url, timeout=20)
+        response = await provider_client.kmsp_get("reqotp", KMSP_API_KEY, phone=phone, method="OTP")
         response.raise_for_status()
         result = response.json()
         auth_id = result.get('data', {}).get('auth_id')
@@ -4703,11 +5237,10 @@ async def request_otp_and_prompt_kmsp(update: Update, context: ContextTypes.DEFA
             raise ValueError(api_error_message)
         
         user_data["registered_users"].setdefault(str(user_id), {})
-        user_data["registered_users"][str(user_id)].setdefault('accounts', {})
-                                                           
-        user_data["registered_users"][str(user_id)]['accounts'].setdefault(phone, {}).setdefault('kmsp', {})['auth_id'] = auth_id
+        user_data["registered_users"][str(user_id)].setdefault('accounts', {}).setdefault(phone, {})
+        account_store.simpan_auth_id(user_id, phone, 'kmsp', auth_id)
         user_data["registered_users"][str(user_id)]['current_phone'] = phone
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
         
         msg = await context.bot.send_message(user_id, f"📲 Kode OTP LOGIN telah dikirim ke *{phone}*\nSilakan masukkan kode OTP-nya.", parse_mode="Markdown")
         bot_messages.setdefault(user_id, []).append(msg.message_id)
@@ -4718,17 +5251,17 @@ async def request_otp_and_prompt_kmsp(update: Update, context: ContextTypes.DEFA
         msg2 = await context.bot.send_message(user_id, "Jika belum menerima OTP, tekan tombol di bawah atau masukkan kode OTP Anda:", parse_mode="Markdown", reply_markup=reply_markup)
         bot_messages.setdefault(user_id, []).append(msg2.message_id)
 
-        context.user_data['next'] = 'handle_login_otp_input'
+        step_router.set_next(context, 'handle_login_otp_input')
         login_counter[user_id] = 0
         context.user_data['current_login_provider'] = 'kmsp'
         
-    except requests.exceptions.HTTPError as http_err:
+    except httpx.HTTPStatusError as http_err:
         error_detail = http_err.response.json().get("message", "unknown error") if http_err.response.content else "no response content"
         logging.error(f"HTTP error saat request OTP KMSP untuk {phone}: {http_err}. Respon: {http_err.response.text}. Detail: {error_detail}")
         msg = await context.bot.send_message(user_id, f"Terjadi kesalahan saat request OTP: {error_detail}. Mohon coba lagi nanti.")                        
         bot_messages.setdefault(user_id, []).append(msg.message_id)
         await send_main_menu(update, context)
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Network error saat request OTP KMSP untuk {phone}: {e}")
         msg = await context.bot.send_message(user_id, f"Terjadi kesalahan jaringan saat request OTP. Mohon coba lagi nanti.")                        
         bot_messages.setdefault(user_id, []).append(msg.message_id)
@@ -4752,7 +5285,6 @@ async def request_otp_and_prompt_kmsp(update: Update, context: ContextTypes.DEFA
 async def request_otp_and_prompt_hesda(update: Update, context: ContextTypes.DEFAULT_TYPE, phone: str):
     user_id = update.effective_user.id
     try:
-        url = "https://api.hesda-store.com/v2/get_otp"
         headers = get_hesda_auth_headers()
         if not headers:
             msg = await context.bot.send_message(user_id, "Informasi otentikasi tidak lengkap. Mohon hubungi admin.", parse_mode="Markdown")
@@ -4766,7 +5298,7 @@ async def request_otp_and_prompt_hesda(update: Update, context: ContextTypes.DEF
             "metode": "OTP"
         }
         
-        response = requests.post(url, headers=headers, data=payload, timeout=20)
+        response = await provider_client.hesda_post("get_otp", headers, **payload)
         response.raise_for_status()
         result = response.json()
 
@@ -4794,10 +5326,10 @@ async def request_otp_and_prompt_hesda(update: Update, context: ContextTypes.DEF
             raise ValueError(api_error_message)
         
         user_data["registered_users"].setdefault(str(user_id), {})
-        user_data["registered_users"][str(user_id)].setdefault('accounts', {})
-        user_data["registered_users"][str(user_id)]['accounts'].setdefault(phone, {}).setdefault('hesda', {})['auth_id'] = auth_id
+        user_data["registered_users"][str(user_id)].setdefault('accounts', {}).setdefault(phone, {})
+        account_store.simpan_auth_id(user_id, phone, 'hesda', auth_id)
         user_data["registered_users"][str(user_id)]['current_phone'] = phone
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
         
         msg = await context.bot.send_message(user_id, f"📲 Kode OTP BYPAS telah dikirim ke *{phone}*\nSilakan masukkan kode OTP-nya.", parse_mode="Markdown")
         bot_messages.setdefault(user_id, []).append(msg.message_id)
@@ -4808,11 +5340,11 @@ async def request_otp_and_prompt_hesda(update: Update, context: ContextTypes.DEF
         msg2 = await context.bot.send_message(user_id, "Jika belum menerima OTP, tekan tombol di bawah atau masukkan kode OTP Anda:", parse_mode="Markdown", reply_markup=reply_markup)
         bot_messages.setdefault(user_id, []).append(msg2.message_id)
 
-        context.user_data['next'] = 'handle_login_otp_input'
+        step_router.set_next(context, 'handle_login_otp_input')
         login_counter[user_id] = 0
         context.user_data['current_login_provider'] = 'hesda'
         
-    except requests.exceptions.HTTPError as http_err:
+    except httpx.HTTPStatusError as http_err:
         error_detail = "unknown error"
         try:
             if http_err.response and http_err.response.content:
@@ -4824,7 +5356,7 @@ async def request_otp_and_prompt_hesda(update: Update, context: ContextTypes.DEF
         msg = await context.bot.send_message(user_id, f"Terjadi kesalahan saat request OTP: {error_detail}. Mohon coba lagi nanti.", parse_mode="Markdown")
         bot_messages.setdefault(user_id, []).append(msg.message_id)
         await send_main_menu(update, context)
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Network error saat request OTP Hesda untuk {phone}: {e}")
         msg = await context.bot.send_message(user_id, f"Terjadi kesalahan jaringan saat request OTP. Mohon coba lagi nanti.", parse_mode="Markdown")
         bot_messages.setdefault(user_id, []).append(msg.message_id)
@@ -4845,6 +5377,12 @@ async def request_otp_and_prompt_hesda(update: Update, context: ContextTypes.DEF
         bot_messages.setdefault(user_id, []).append(msg.message_id)
         await send_main_menu(update, context)
 
+async def token_siap_pakai(phone, provider, access_token):
+    """access_token jika masih diterima upstream (probe ter-cache), None jika ditolak sehingga user diminta login ulang."""
+    if access_token and not await token_validity.periksa(KMSP_API_KEY, phone, provider, access_token):
+        return None
+    return access_token
+
 def get_hesda_auth_headers():
     if not HESDA_USERNAME or not HESDA_PASSWORD:
         logging.error("HESDA_USERNAME atau HESDA_PASSWORD tidak diatur. Tidak dapat membuat header otentikasi Hesda.")
@@ -4906,7 +5444,7 @@ async def schedule_top_up_expiration(context: ContextTypes.DEFAULT_TYPE, user_id
             
                                                                                              
                                                                             
-            simpan_data_ke_db()                                                  
+            simpan_data_ke_db(user_id)                                                  
 
     except Exception as e:
         logging.error(f"Error pada schedule_top_up_expiration untuk user {user_id}: {e}", exc_info=True)
@@ -4928,7 +5466,7 @@ async def handle_top_up_amount(update: Update, context: ContextTypes.DEFAULT_TYP
         
         if top_up_amount < MIN_TOP_UP_AMOUNT:
             await update.message.reply_text(f"Nominal top up minimal Rp{MIN_TOP_UP_AMOUNT:,}. Silakan masukkan lagi.", parse_mode="Markdown")
-            context.user_data['next'] = 'handle_top_up_amount' 
+            step_router.set_next(context, 'handle_top_up_amount')
             return
 
                                                
@@ -4941,7 +5479,7 @@ async def handle_top_up_amount(update: Update, context: ContextTypes.DEFAULT_TYP
             if not QRIS_STATIS:
                 raise ValueError("QRIS_STATIS belum diatur dengan benar di dalam kode bot.")
 
-            response = requests.post("https://qrisku.my.id/api", json={"amount": str(unique_top_up_amount), "qris_statis": QRIS_STATIS}, timeout=20)
+            response = await http_client.post("https://qrisku.my.id/api", json={"amount": str(unique_top_up_amount), "qris_statis": QRIS_STATIS}, timeout=20)
             response.raise_for_status()
             response_data = response.json()
             
@@ -4970,7 +5508,7 @@ async def handle_top_up_amount(update: Update, context: ContextTypes.DEFAULT_TYP
                     "admin_message_id": admin_msg.message_id
                 }
                 user_data["registered_users"][str(user_id)]["pending_top_up"] = pending_info
-                simpan_data_ke_db()
+                simpan_data_ke_db(user_id)
 
                 asyncio.create_task(schedule_top_up_expiration(context, user_id, unique_top_up_amount))
             else:
@@ -4983,1059 +5521,1052 @@ async def handle_top_up_amount(update: Update, context: ContextTypes.DEFAULT_TYP
 
     except ValueError:
         await update.message.reply_text("Nominal tidak valid. Masukkan angka saja.", parse_mode="Markdown")
-        context.user_data['next'] = 'handle_top_up_amount'
+        step_router.set_next(context, 'handle_top_up_amount')
     return        
 
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+@step_router.step("admin_edit_custom_package_name_input", grup="admin", cleanup=("editing_package_code", "temp_edited_name"))
+async def step_admin_edit_custom_package_name_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    package_code = context.user_data.get('editing_package_code')
+    if not package_code:
+        await update.message.reply_text("Terjadi kesalahan (kode paket tidak ditemukan). Silakan mulai ulang.")
+        await admin_menu(update, context)
+        return
 
-    if user_id == ADMIN_ID and 'next' in context.user_data and context.user_data['next'].startswith('admin_'):
-        next_admin_step = context.user_data.pop('next')
+    new_name = update.message.text.strip()
+    if new_name.upper() == 'SKIP':
+        new_name = user_data["custom_packages"][package_code]['name']
 
-                                                                                                        
-        if next_admin_step not in ['admin_handle_broadcast_exclusions', 'admin_handle_search_user_input', 'admin_handle_check_user_transactions_input', 'admin_handle_search_api_package_input']:
-             await delete_last_message(user_id, context)
+    context.user_data['temp_edited_name'] = new_name
+    await context.bot.send_message(user_id, f"Masukkan harga baru untuk paket ini (angka saja, cth: `5000`) atau ketik `SKIP` untuk tidak mengubah harga:")
+    step_router.set_next(context, 'admin_edit_custom_package_price_input')
 
-        if next_admin_step == 'admin_handle_add_balance_input':
-            await admin_handle_add_balance_input(update, context)
-        elif next_admin_step == 'admin_handle_deduct_balance_input':
-            await admin_handle_deduct_balance_input(update, context)
-        elif next_admin_step == 'admin_handle_block_user_input':
-            await admin_handle_block_user_input(update, context)
-        elif next_admin_step == 'admin_handle_unblock_user_input':
-            await admin_handle_unblock_user_input(update, context)
-        elif next_admin_step == 'admin_handle_broadcast_message_content':
-            await admin_handle_broadcast_message_content(update, context)
-            return                                                     
-        elif next_admin_step == 'admin_handle_broadcast_exclusions':
-            await admin_handle_broadcast_exclusions(update, context)
-            return                                                   
-        elif next_admin_step == 'admin_handle_search_user_input':
-            await admin_handle_search_user_input(update, context)
-        elif next_admin_step == 'admin_handle_check_user_transactions_input':
-            await admin_handle_check_user_transactions_input(update, context)
-        elif next_admin_step == 'admin_handle_search_api_package_input':
-            await admin_handle_search_api_package_input(update, context)     
-        elif next_admin_step == 'admin_handle_smart_package_code_input':
-            await admin_handle_smart_package_code_input(update, context)
-        elif next_admin_step == 'admin_handle_smart_package_display_name_input':
-            await admin_handle_smart_package_display_name_input(update, context)
-        elif next_admin_step == 'admin_handle_smart_package_price_input':
-            await admin_handle_smart_package_price_input(update, context)
-        elif next_admin_step == 'admin_handle_smart_package_ewallet_fee_input':
-            await admin_handle_smart_package_ewallet_fee_input(update, context)
-        elif next_admin_step == 'admin_handle_smart_package_desc_and_save':
-            await admin_handle_smart_package_desc_and_save(update, context)
-        elif next_admin_step == 'admin_edit_custom_package_name_input':
-            package_code = context.user_data.get('editing_package_code')
-            if not package_code:
-                await update.message.reply_text("Terjadi kesalahan (kode paket tidak ditemukan). Silakan mulai ulang.")
-                await admin_menu(update, context)
-                return
 
-            new_name = update.message.text.strip()
-            if new_name.upper() == 'SKIP':
-                new_name = user_data["custom_packages"][package_code]['name']
+@step_router.step("admin_edit_custom_package_price_input", grup="admin", cleanup=("editing_package_code", "temp_edited_name"))
+async def step_admin_edit_custom_package_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    package_code = context.user_data.pop('editing_package_code', None)
+    new_name = context.user_data.pop('temp_edited_name', None)
+    new_price_str = update.message.text.strip()
 
-            context.user_data['temp_edited_name'] = new_name
-            await context.bot.send_message(user_id, f"Masukkan harga baru untuk paket ini (angka saja, cth: `5000`) atau ketik `SKIP` untuk tidak mengubah harga:")
-            context.user_data['next'] = 'admin_edit_custom_package_price_input'
+    if package_code is None or new_name is None:
+        await update.message.reply_text("Terjadi kesalahan. Silakan mulai ulang pengeditan paket kustom.")
+        await admin_menu(update, context)
+        return
 
-        elif next_admin_step == 'admin_edit_custom_package_price_input':
-            package_code = context.user_data.pop('editing_package_code', None)
-            new_name = context.user_data.pop('temp_edited_name', None)
-            new_price_str = update.message.text.strip()
+    original_price = user_data["custom_packages"][package_code]['price']
+    new_price = original_price
 
-            if package_code is None or new_name is None:
-                await update.message.reply_text("Terjadi kesalahan. Silakan mulai ulang pengeditan paket kustom.")
-                await admin_menu(update, context)
+    if new_price_str.upper() != 'SKIP':
+        try:
+            new_price = int(new_price_str)
+            if new_price <= 0:
+                await update.message.reply_text("Harga harus lebih besar dari 0. Masukkan harga baru (angka saja) atau `SKIP`:")
+                context.user_data['editing_package_code'] = package_code
+                context.user_data['temp_edited_name'] = new_name
+                step_router.set_next(context, 'admin_edit_custom_package_price_input')
                 return
+        except ValueError:
+            await update.message.reply_text("Harga tidak valid. Masukkan angka saja atau `SKIP`.")
+            context.user_data['editing_package_code'] = package_code
+            context.user_data['temp_edited_name'] = new_name
+            step_router.set_next(context, 'admin_edit_custom_package_price_input')
+            return
+
+    user_data["custom_packages"][package_code]['name'] = new_name
+    user_data["custom_packages"][package_code]['price'] = new_price
+    simpan_data_ke_db()
+    await update.message.reply_text(f"✅ Paket `{package_code}` berhasil diperbarui:\nNama: *{new_name}*\nHarga: Rp{new_price:,}", parse_mode="Markdown")
+    await admin_menu(update, context)
 
-            original_price = user_data["custom_packages"][package_code]['price']
-            new_price = original_price
 
-            if new_price_str.upper() != 'SKIP':
-                try:
-                    new_price = int(new_price_str)
-                    if new_price <= 0:
-                        await update.message.reply_text("Harga harus lebih besar dari 0. Masukkan harga baru (angka saja) atau `SKIP`:")
-                        context.user_data['editing_package_code'] = package_code                          
-                        context.user_data['temp_edited_name'] = new_name                          
-                        context.user_data['next'] = 'admin_edit_custom_package_price_input'
-                        return
-                except ValueError:
-                    await update.message.reply_text("Harga tidak valid. Masukkan angka saja atau `SKIP`.")
-                    context.user_data['editing_package_code'] = package_code                          
-                    context.user_data['temp_edited_name'] = new_name                          
-                    context.user_data['next'] = 'admin_edit_custom_package_price_input'
-                    return
+@step_router.step("admin_handle_delete_custom_package_confirmation", grup="admin", cleanup=("confirm_delete_package_code",))
+async def step_admin_handle_delete_custom_package_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    package_code_to_delete = context.user_data.pop('confirm_delete_package_code', None)
+    confirmation = update.message.text.strip().upper()
 
-            user_data["custom_packages"][package_code]['name'] = new_name
-            user_data["custom_packages"][package_code]['price'] = new_price
+    if package_code_to_delete is None:
+        await update.message.reply_text("Kesalahan konfirmasi penghapusan. Silakan coba lagi dari menu edit paket kustom.")
+        await admin_menu(update, context)
+        return
+
+    if confirmation == 'YA':
+        if package_code_to_delete in user_data["custom_packages"]:
+            del user_data["custom_packages"][package_code_to_delete]
             simpan_data_ke_db()
-            await update.message.reply_text(f"✅ Paket `{package_code}` berhasil diperbarui:\nNama: *{new_name}*\nHarga: Rp{new_price:,}", parse_mode="Markdown")
-            await admin_menu(update, context)
-        elif next_admin_step == 'admin_handle_delete_custom_package_confirmation':
-            package_code_to_delete = context.user_data.pop('confirm_delete_package_code', None)
-            confirmation = update.message.text.strip().upper()
+            await update.message.reply_text(f"✅ Paket kustom `{package_code_to_delete}` berhasil dihapus.")
+        else:
+            await update.message.reply_text(f"❌ Paket kustom `{package_code_to_delete}` tidak ditemukan.")
+    else:
+        await update.message.reply_text("Penghapusan paket kustom dibatalkan.")
+    await admin_menu(update, context)
 
-            if package_code_to_delete is None:
-                await update.message.reply_text("Kesalahan konfirmasi penghapusan. Silakan coba lagi dari menu edit paket kustom.")
-                await admin_menu(update, context)
-                return
 
-            if confirmation == 'YA':
-                if package_code_to_delete in user_data["custom_packages"]:
-                    del user_data["custom_packages"][package_code_to_delete]
-                    simpan_data_ke_db()
-                    await update.message.reply_text(f"✅ Paket kustom `{package_code_to_delete}` berhasil dihapus.")
-                else:
-                    await update.message.reply_text(f"❌ Paket kustom `{package_code_to_delete}` tidak ditemukan.")
-            else:
-                await update.message.reply_text("Penghapusan paket kustom dibatalkan.")
-            await admin_menu(update, context)
+@step_router.step("handle_user_broadcast_reply")
+async def step_handle_user_broadcast_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    await delete_last_message(user_id, context)
+
+    reply_text = update.message.text
+    user_details = user_data["registered_users"].get(str(user_id), {})
+
+    user_first_name = user_details.get("first_name", "N/A")
+    user_username = user_details.get("username", "N/A")
+    user_balance = user_details.get("balance", 0)
+
+    admin_notification = (
+        f"📩 *Jawaban Broadcast Diterima* 📩\n"
+        f"👤 *Nama User:* `{user_first_name}`\n"
+        f"🆔 *ID User:* `{user_id}`\n"
+        f"🔗 *Username:* `@{user_username}`\n"
+        f"💰 *Sisa Saldo User:* `Rp{user_balance:,}`\n"
+        f"💬 *Isi Pesan Jawaban:*\n"
+        f"{reply_text}"
+    )
+
+    try:
+        await context.bot.send_message(ADMIN_ID, admin_notification, parse_mode="Markdown")
+        await update.message.reply_text("✅ Jawaban Anda telah berhasil dikirim ke admin. Terima kasih!")
+    except Exception as e:
+        logging.error(f"Gagal mengirim jawaban broadcast ke admin dari user {user_id}: {e}")
+        await update.message.reply_text("❌ Maaf, terjadi kesalahan saat mengirim jawaban Anda. Coba lagi nanti.")
+
+    await send_main_menu(update, context)
+
+
+@step_router.step("handle_cek_kuota_baru_input")
+async def step_handle_cek_kuota_baru_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await jalankan_cek_kuota_baru(update, context)
+
+
+@step_router.step("handle_phone_for_login", cleanup=("current_login_provider",))
+async def step_handle_phone_for_login(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone = update.message.text.strip()
+    if phone.startswith('08'):
+        phone = '62' + phone[1:]
+
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_phone_for_login')
         return
 
-    if not await check_access(update, context):
+    context.user_data['temp_phone_for_login'] = phone
+    logging.info(f"User {user_id} mengirim nomor untuk login: {phone}")
+
+    login_provider = context.user_data.get('current_login_provider', 'kmsp')
+    if login_provider == 'kmsp':
+        await request_otp_and_prompt_kmsp(update, context, phone)
+    elif login_provider == 'hesda':
+        await request_otp_and_prompt_hesda(update, context, phone)
+
+
+@step_router.step("handle_phone_for_hesda_batch_purchase", cleanup=("packages_to_process_hesda_batch", "total_hesdapkg_batch_price"))
+async def step_handle_phone_for_hesda_batch_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
+
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_phone_for_hesda_batch_purchase')
         return
 
-    if 'next' in context.user_data and context.user_data['next'] == 'handle_user_broadcast_reply':
-        next_step = context.user_data.pop('next')
-        await delete_last_message(user_id, context)
+    access_token_hesda = None
+    if user_id == ADMIN_ID:
+        logging.info(f"Admin ({user_id}) memulai alur Batch BYPAS untuk {phone}. Mencari token BYPAS di seluruh database...")
+        uid, token = account_store.token_nomor(phone, "hesda")
+        if token:
+            access_token_hesda = token
+            logging.info(f"Token BYPAS untuk {phone} ditemukan di akun user {uid}.")
 
-        reply_text = update.message.text
-        user_details = user_data["registered_users"].get(str(user_id), {})
-
-        user_first_name = user_details.get("first_name", "N/A")
-        user_username = user_details.get("username", "N/A")
-        user_balance = user_details.get("balance", 0)
-
-        admin_notification = (
-            f"📩 *Jawaban Broadcast Diterima* 📩\n"
-            f"👤 *Nama User:* `{user_first_name}`\n"
-            f"🆔 *ID User:* `{user_id}`\n"
-            f"🔗 *Username:* `@{user_username}`\n"
-            f"💰 *Sisa Saldo User:* `Rp{user_balance:,}`\n"
-            f"💬 *Isi Pesan Jawaban:*\n"
-            f"{reply_text}"
-        )
+    if not access_token_hesda:
+        access_token_hesda = account_store.token(user_id, phone, "hesda")
+    access_token_hesda = await token_siap_pakai(phone, "hesda", access_token_hesda)
 
-        try:
-            await context.bot.send_message(ADMIN_ID, admin_notification, parse_mode="Markdown")
-            await update.message.reply_text("✅ Jawaban Anda telah berhasil dikirim ke admin. Terima kasih!")
-        except Exception as e:
-            logging.error(f"Gagal mengirim jawaban broadcast ke admin dari user {user_id}: {e}")
-            await update.message.reply_text("❌ Maaf, terjadi kesalahan saat mengirim jawaban Anda. Coba lagi nanti.")
+    if not access_token_hesda:
+        total_price_to_refund = context.user_data.pop('total_hesdapkg_batch_price', 0)
+        if user_id == ADMIN_ID:
+            await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken BYPAS tidak ditemukan untuk nomor `{phone}` di seluruh database.", parse_mode="Markdown")
+            if total_price_to_refund > 0:
+                kredit_saldo(user_id, total_price_to_refund, "refund")
+                simpan_data_ke_db(user_id)
+                await context.bot.send_message(user_id, f"💰 Saldo Anda sebesar Rp{total_price_to_refund:,} telah dikembalikan.", parse_mode="Markdown")
+            await send_main_menu(update, context)
+        else:
+            await update.message.reply_text(f"Token BYPAS tidak ditemukan untuk nomor `{phone}`. Silakan login terlebih dahulu.")
+            if total_price_to_refund > 0:
+                kredit_saldo(user_id, total_price_to_refund, "refund")
+                simpan_data_ke_db(user_id)
+                await context.bot.send_message(user_id, f"💰 Saldo Anda sebesar Rp{total_price_to_refund:,} telah dikembalikan.", parse_mode="Markdown")
+
+            context.user_data['temp_phone_for_login'] = phone
+            context.user_data['current_login_provider'] = 'hesda'
+            step_router.set_next(context, 'handle_login_otp_input')
+            context.user_data['resume_hesda_purchase_after_otp'] = True
+            await request_otp_and_prompt_hesda(update, context, phone)
+        return
+
+    context.user_data['phone_for_hesda_batch'] = phone
+    selected_package_ids = user_data["registered_users"][str(user_id)].get("selected_hesdapkg_ids", [])
+    user_data["registered_users"][str(user_id)]["selected_hesdapkg_ids"] = []
+
+    context.user_data['packages_to_process_hesda_batch'] = selected_package_ids
+    context.user_data['current_batch_index_hesda'] = 0
+    context.user_data['current_hesda_batch_results'] = []
+
+    asyncio.create_task(process_hesda_package_queue(update, context))
+
+
+@step_router.step("handle_automatic_xcs_addon_phone_input", cleanup=("total_automatic_xcs_price",))
+async def step_handle_automatic_xcs_addon_phone_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
+
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_automatic_xcs_addon_phone_input')
+        return
 
+    automatic_xcs_flow_state = context.user_data.get('automatic_xcs_flow_state')
+    if not automatic_xcs_flow_state:
+        await update.message.reply_text("Sesi pembelian otomatis XCS ADD ON tidak valid atau kedaluwarsa. Silakan mulai ulang.")
         await send_main_menu(update, context)
         return
 
-    if 'next' not in context.user_data:
-        try:
-            await update.message.delete()
-        except Exception:
-            pass
+    automatic_xcs_flow_state['phone'] = phone
+    access_token_kmsp = None
+
+    if user_id == ADMIN_ID:
+        logging.info(f"Admin ({user_id}) memulai alur XCS otomatis untuk nomor {phone}. Mencari token di seluruh database...")
+
+        uid, token = account_store.token_nomor(phone, "kmsp")
+        if token:
+            access_token_kmsp = token
+            logging.info(f"Token untuk nomor {phone} ditemukan di akun user {uid}. Admin akan menggunakan token ini.")
+
+    if not access_token_kmsp:
+        access_token_kmsp = account_store.token(user_id, phone, "kmsp")
+    access_token_kmsp = await token_siap_pakai(phone, "kmsp", access_token_kmsp)
+
+    if not access_token_kmsp:
+
+        if user_id == ADMIN_ID:
+            await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken LOGIN tidak ditemukan untuk nomor `{phone}` di seluruh database bot. Nomor ini belum pernah login oleh siapapun.", parse_mode="Markdown")
+
+            total_price = context.user_data.pop('total_automatic_xcs_price', 0)
+            if total_price > 0:
+                kredit_saldo(user_id, total_price, "refund")
+                simpan_data_ke_db(user_id)
+                await context.bot.send_message(user_id, f"💰 Saldo Anda sebesar Rp{total_price:,} telah dikembalikan.", parse_mode="Markdown")
+            await send_main_menu(update, context)
+        else:
+
+            await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor `{phone}`. Silakan login terlebih dahulu untuk nomor ini.")
+            context.user_data['temp_phone_for_login'] = phone
+            context.user_data['current_login_provider'] = 'kmsp'
+            step_router.set_next(context, 'handle_login_otp_input')
+            context.user_data['resume_automatic_xcs_purchase_after_otp'] = True
+            await request_otp_and_prompt_kmsp(update, context, phone)
         return
 
-    next_step = context.user_data.pop('next')
+    automatic_xcs_flow_state['access_token'] = access_token_kmsp
+    simpan_data_ke_db(user_id)
+
+    await context.bot.send_message(user_id, f"Memulai proses pembelian XCS ADD ON Otomatis untuk nomor *{phone}*.\n\nMemproses paket ADD ON pertama...", parse_mode="Markdown")
+    asyncio.create_task(run_automatic_xcs_addon_flow(update, context))
+
 
-    if next_step == 'handle_cek_kuota_baru_input':
-        await jalankan_cek_kuota_baru(update, context)
+@step_router.step("handle_automatic_xutp_phone_input")
+async def step_handle_automatic_xutp_phone_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
+
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_automatic_xutp_phone_input')
         return
 
-    if next_step == 'handle_phone_for_login':
-        phone = update.message.text.strip()
-        if phone.startswith('08'):
-            phone = '62' + phone[1:]
+    payment_method_selected = context.user_data.get('xutp_purchase_payment_method', 'DANA')
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_phone_for_login'
-            return
+    access_token_kmsp = None
+    if user_id == ADMIN_ID:
+        logging.info(f"Admin ({user_id}) memulai alur XUTP untuk {phone}. Mencari token KMSP di seluruh database...")
+        uid, token = account_store.token_nomor(phone, "kmsp")
+        if token:
+            access_token_kmsp = token
+            logging.info(f"Token KMSP untuk {phone} ditemukan di akun user {uid}.")
 
-        context.user_data['temp_phone_for_login'] = phone
-        logging.info(f"User {user_id} mengirim nomor untuk login: {phone}")
+    if not access_token_kmsp:
+        access_token_kmsp = account_store.token(user_id, phone, "kmsp")
+    access_token_kmsp = await token_siap_pakai(phone, "kmsp", access_token_kmsp)
 
-        login_provider = context.user_data.get('current_login_provider', 'kmsp')
-        if login_provider == 'kmsp':
+    if not access_token_kmsp:
+        if user_id == ADMIN_ID:
+            await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken LOGIN tidak ditemukan untuk nomor `{phone}` di seluruh database bot.", parse_mode="Markdown")
+            await send_main_menu(update, context)
+        else:
+            await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor `{phone}`. Silakan login terlebih dahulu untuk nomor ini.")
+            context.user_data['temp_phone_for_login'] = phone
+            context.user_data['current_login_provider'] = 'kmsp'
+            step_router.set_next(context, 'handle_login_otp_input')
+            context.user_data['resume_automatic_xutp_purchase_after_otp'] = True
             await request_otp_and_prompt_kmsp(update, context, phone)
-        elif login_provider == 'hesda':
-            await request_otp_and_prompt_hesda(update, context, phone)
+        return
 
-                                                        
-    elif next_step == 'handle_phone_for_hesda_batch_purchase':
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
-        else:
-            phone = phone_raw
+    context.user_data['xutp_purchase_phone'] = phone
+    context.user_data['xutp_purchase_token'] = access_token_kmsp
+    context.user_data['xutp_purchase_payment_method'] = payment_method_selected
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_phone_for_hesda_batch_purchase'
-            return
-            
-                                            
-                                                               
-        access_token_hesda = None
-        if user_id == ADMIN_ID:
-            logging.info(f"Admin ({user_id}) memulai alur Batch BYPAS untuk {phone}. Mencari token BYPAS di seluruh database...")
-            for uid, details in user_data["registered_users"].items():
-                token = details.get("accounts", {}).get(phone, {}).get("hesda", {}).get("access_token")
-                if token:
-                    access_token_hesda = token
-                    logging.info(f"Token BYPAS untuk {phone} ditemukan di akun user {uid}.")
-                    break
-        
-        if not access_token_hesda:
-            token_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {})
-            access_token_hesda = token_data.get("hesda", {}).get("access_token")
-
-        if not access_token_hesda:
-            total_price_to_refund = context.user_data.pop('total_hesdapkg_batch_price', 0)
-            if user_id == ADMIN_ID:
-                await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken BYPAS tidak ditemukan untuk nomor `{phone}` di seluruh database.", parse_mode="Markdown")
-                if total_price_to_refund > 0:
-                    user_data["registered_users"][str(user_id)]["balance"] += total_price_to_refund
-                    simpan_data_ke_db()
-                    await context.bot.send_message(user_id, f"💰 Saldo Anda sebesar Rp{total_price_to_refund:,} telah dikembalikan.", parse_mode="Markdown")
-                await send_main_menu(update, context)
-            else:
-                await update.message.reply_text(f"Token BYPAS tidak ditemukan untuk nomor `{phone}`. Silakan login terlebih dahulu.")
-                if total_price_to_refund > 0:
-                    user_data["registered_users"][str(user_id)]["balance"] += total_price_to_refund
-                    simpan_data_ke_db()
-                    await context.bot.send_message(user_id, f"💰 Saldo Anda sebesar Rp{total_price_to_refund:,} telah dikembalikan.", parse_mode="Markdown")
-                          
-                context.user_data['temp_phone_for_login'] = phone
-                context.user_data['current_login_provider'] = 'hesda'
-                context.user_data['next'] = 'handle_login_otp_input'
-                context.user_data['resume_hesda_purchase_after_otp'] = True
-                await request_otp_and_prompt_hesda(update, context, phone)
-            return
-                                            
+    if 'xutp_flow_state' in user_data["registered_users"].get(str(user_id), {}).get('accounts', {}).get(phone, {}):
+         del user_data["registered_users"][str(user_id)]['accounts'][phone]['xutp_flow_state']
+    simpan_data_ke_db(user_id)
 
-        context.user_data['phone_for_hesda_batch'] = phone
-        selected_package_ids = user_data["registered_users"][str(user_id)].get("selected_hesdapkg_ids", [])
-        user_data["registered_users"][str(user_id)]["selected_hesdapkg_ids"] = []
+    await context.bot.send_message(user_id, f"Memulai proses pembelian XUTP otomatis untuk nomor *{phone}* dengan metode *{payment_method_selected}*.\n\nMemproses paket awal (ADD ON PREMIUM)...", parse_mode="Markdown")
+    asyncio.create_task(run_automatic_xutp_flow(update, context))
 
-        context.user_data['packages_to_process_hesda_batch'] = selected_package_ids
-        context.user_data['current_batch_index_hesda'] = 0
-        context.user_data['current_hesda_batch_results'] = []
 
-        asyncio.create_task(process_hesda_package_queue(update, context))
+@step_router.step("handle_phone_for_30h_batch_purchase", cleanup=("packages_to_process_30h_batch", "total_30h_batch_price"))
+async def step_handle_phone_for_30h_batch_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
+
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_phone_for_30h_batch_purchase')
         return
 
-    elif next_step == 'handle_automatic_xcs_addon_phone_input':
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
-        else:
-            phone = phone_raw
+    access_token_kmsp = None
+    if user_id == ADMIN_ID:
+        logging.info(f"Admin ({user_id}) memulai alur Batch 30H untuk {phone}. Mencari token KMSP di seluruh database...")
+        uid, token = account_store.token_nomor(phone, "kmsp")
+        if token:
+            access_token_kmsp = token
+            logging.info(f"Token KMSP untuk {phone} ditemukan di akun user {uid}.")
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_automatic_xcs_addon_phone_input'
-            return
+    if not access_token_kmsp:
+        access_token_kmsp = account_store.token(user_id, phone, "kmsp")
+    access_token_kmsp = await token_siap_pakai(phone, "kmsp", access_token_kmsp)
 
-        automatic_xcs_flow_state = context.user_data.get('automatic_xcs_flow_state')
-        if not automatic_xcs_flow_state:
-            await update.message.reply_text("Sesi pembelian otomatis XCS ADD ON tidak valid atau kedaluwarsa. Silakan mulai ulang.")
+    if not access_token_kmsp:
+        total_price_to_refund = context.user_data.pop('total_30h_batch_price', 0)
+        if user_id == ADMIN_ID:
+            await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken LOGIN tidak ditemukan untuk nomor `{phone}` di seluruh database.", parse_mode="Markdown")
+            if total_price_to_refund > 0:
+                kredit_saldo(user_id, total_price_to_refund, "refund")
+                simpan_data_ke_db(user_id)
+                await context.bot.send_message(user_id, f"💰 Saldo Anda sebesar Rp{total_price_to_refund:,} telah dikembalikan.", parse_mode="Markdown")
             await send_main_menu(update, context)
-            return
+        else:
+            await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor `{phone}`. Silakan login terlebih dahulu.")
+            if total_price_to_refund > 0:
+                kredit_saldo(user_id, total_price_to_refund, "refund")
+                simpan_data_ke_db(user_id)
+                await context.bot.send_message(user_id, f"💰 Saldo Anda sebesar Rp{total_price_to_refund:,} telah dikembalikan.", parse_mode="Markdown")
+            context.user_data['temp_phone_for_login'] = phone
+            context.user_data['current_login_provider'] = 'kmsp'
+            step_router.set_next(context, 'handle_login_otp_input')
+            context.user_data['resume_30h_purchase_after_otp'] = True
+            await request_otp_and_prompt_kmsp(update, context, phone)
+        return
 
-        automatic_xcs_flow_state['phone'] = phone
-        access_token_kmsp = None
+    context.user_data['token_for_30h_batch'] = access_token_kmsp
 
-                                            
+    context.user_data['phone_for_30h_batch'] = phone
+    selected_package_ids = user_data["registered_users"][str(user_id)].get("selected_30h_pkg_ids", [])
+    user_data["registered_users"][str(user_id)]["selected_30h_pkg_ids"] = []
 
-                                             
-        if user_id == ADMIN_ID:
-            logging.info(f"Admin ({user_id}) memulai alur XCS otomatis untuk nomor {phone}. Mencari token di seluruh database...")
-            
-                                                  
-            for uid, details in user_data["registered_users"].items():
-                token = details.get("accounts", {}).get(phone, {}).get("kmsp", {}).get("access_token")
-                if token:
-                    access_token_kmsp = token
-                    logging.info(f"Token untuk nomor {phone} ditemukan di akun user {uid}. Admin akan menggunakan token ini.")
-                    break                                                
-        
-                                                                                                              
-        if not access_token_kmsp:
-            token_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {})
-            access_token_kmsp = token_data.get("kmsp", {}).get("access_token")
+    context.user_data['packages_to_process_30h_batch'] = selected_package_ids
+    context.user_data['current_batch_index_30h'] = 0
+    context.user_data['current_30h_batch_results'] = []
 
-                                            
+    logging.info(f"Starting 30H batch purchase for user {user_id} with phone {phone}. Packages: {selected_package_ids}")
+    asyncio.create_task(process_30h_package_queue(update, context))
 
-        if not access_token_kmsp:
-                                                                                                              
-                                                                    
-            if user_id == ADMIN_ID:
-                await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken LOGIN tidak ditemukan untuk nomor `{phone}` di seluruh database bot. Nomor ini belum pernah login oleh siapapun.", parse_mode="Markdown")
-                                                                                    
-                total_price = context.user_data.pop('total_automatic_xcs_price', 0)
-                if total_price > 0:
-                    user_data["registered_users"][str(user_id)]["balance"] += total_price
-                    simpan_data_ke_db()
-                    await context.bot.send_message(user_id, f"💰 Saldo Anda sebesar Rp{total_price:,} telah dikembalikan.", parse_mode="Markdown")
-                await send_main_menu(update, context)                        
-            else:
-                                                  
-                await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor `{phone}`. Silakan login terlebih dahulu untuk nomor ini.")
-                context.user_data['temp_phone_for_login'] = phone
-                context.user_data['current_login_provider'] = 'kmsp'
-                context.user_data['next'] = 'handle_login_otp_input'
-                context.user_data['resume_automatic_xcs_purchase_after_otp'] = True
-                await request_otp_and_prompt_kmsp(update, context, phone)
-            return
 
-                                                                                                            
-        automatic_xcs_flow_state['access_token'] = access_token_kmsp
-        simpan_data_ke_db()
+@step_router.step("handle_akun_saya_nomor_input")
+async def step_handle_akun_saya_nomor_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
 
-        await context.bot.send_message(user_id, f"Memulai proses pembelian XCS ADD ON Otomatis untuk nomor *{phone}*.\n\nMemproses paket ADD ON pertama...", parse_mode="Markdown")
-        asyncio.create_task(run_automatic_xcs_addon_flow(update, context))
+    if not re.match(r'^628\d{9,12}$', phone):
+        await update.message.reply_text("Format nomor HP salah. Masukkan lagi atau kembali ke menu utama.")
+        step_router.set_next(context, 'handle_akun_saya_nomor_input')
         return
 
-    elif next_step == 'handle_automatic_xutp_phone_input':                                                      
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
-        else:
-            phone = phone_raw
+    keyboard = [[InlineKeyboardButton("🔙 Kembali", callback_data="back_to_menu")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_automatic_xutp_phone_input'
-            return
+    if phone in user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}):
+        status_token = account_store.status_nomor(user_id, phone)
+        kmsp_status = "✅" if status_token.get("kmsp", (False, None))[0] else "❌"
+        hesda_status = "✅" if status_token.get("hesda", (False, None))[0] else "❌"
 
-        payment_method_selected = context.user_data.get('xutp_purchase_payment_method', 'DANA')
+        timestamp_str = "N/A"
+        ts_iso = status_token.get("kmsp", (False, None))[1] or status_token.get("hesda", (False, None))[1]
+        if ts_iso:
+            try:
+                dt_object = datetime.fromisoformat(ts_iso)
+                timestamp_str = dt_object.strftime('%H.%M  %d.%m.%Y')
+            except ValueError:
+                timestamp_str = "Format waktu tidak valid"
+
+        response_text = (
+            f"Nomor kamu terdeteksi\n"
+            f"`{phone}`   `{timestamp_str}`\n\n"
+            f"*Status Nomor*\n"
+            f"LOGIN OTP {kmsp_status}\n"
+            f"OTP BYPAS {hesda_status}\n\n"
+            f"_Meskipun nomor kamu sudah pernah login, jika XL merefresh token login, besar kemungkinan kamu mesti login otp ulang._"
+        )
 
-                                            
-        access_token_kmsp = None
-        if user_id == ADMIN_ID:
-            logging.info(f"Admin ({user_id}) memulai alur XUTP untuk {phone}. Mencari token KMSP di seluruh database...")
-            for uid, details in user_data["registered_users"].items():
-                token = details.get("accounts", {}).get(phone, {}).get("kmsp", {}).get("access_token")
-                if token:
-                    access_token_kmsp = token
-                    logging.info(f"Token KMSP untuk {phone} ditemukan di akun user {uid}.")
-                    break
-        
-        if not access_token_kmsp:
-            token_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {})
-            access_token_kmsp = token_data.get("kmsp", {}).get("access_token")
-                                            
-
-        if not access_token_kmsp:
-            if user_id == ADMIN_ID:
-                await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken LOGIN tidak ditemukan untuk nomor `{phone}` di seluruh database bot.", parse_mode="Markdown")
-                await send_main_menu(update, context)
-            else:
-                await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor `{phone}`. Silakan login terlebih dahulu untuk nomor ini.")
-                context.user_data['temp_phone_for_login'] = phone
-                context.user_data['current_login_provider'] = 'kmsp'
-                context.user_data['next'] = 'handle_login_otp_input'
-                context.user_data['resume_automatic_xutp_purchase_after_otp'] = True           
-                await request_otp_and_prompt_kmsp(update, context, phone)
-            return
+        await update.message.reply_text(response_text, parse_mode="Markdown", reply_markup=reply_markup)
+    else:
+        response_text = f"❌ Nomor `{phone}` tidak ditemukan di riwayat login Anda. Silakan login terlebih dahulu untuk nomor ini."
 
-        context.user_data['xutp_purchase_phone'] = phone
-        context.user_data['xutp_purchase_token'] = access_token_kmsp
-        context.user_data['xutp_purchase_payment_method'] = payment_method_selected
-        
-        if 'xutp_flow_state' in user_data["registered_users"].get(str(user_id), {}).get('accounts', {}).get(phone, {}):
-             del user_data["registered_users"][str(user_id)]['accounts'][phone]['xutp_flow_state']
-        simpan_data_ke_db()
+        await update.message.reply_text(response_text, parse_mode="Markdown", reply_markup=reply_markup)
+
+
+@step_router.step("handle_beli_single_vidio_package", cleanup=("selected_package_code", "selected_package_name_display", "selected_payment_method", "selected_price_lookup_key", "selected_api_provider"))
+async def step_handle_beli_single_vidio_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
+
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_beli_single_vidio_package')
+        return
+
+    kode = context.user_data.pop('selected_package_code')
+    package_name_display = context.user_data.pop('selected_package_name_display')
+    metode = context.user_data.pop('selected_payment_method')
+    price_lookup_key = context.user_data.pop('selected_price_lookup_key')
+    api_provider = context.user_data.get('selected_api_provider', 'kmsp')
 
-        await context.bot.send_message(user_id, f"Memulai proses pembelian XUTP otomatis untuk nomor *{phone}* dengan metode *{payment_method_selected}*.\n\nMemproses paket awal (ADD ON PREMIUM)...", parse_mode="Markdown")
-        asyncio.create_task(run_automatic_xutp_flow(update, context))
+    if not kode or not package_name_display or not metode or price_lookup_key is None:
+        await update.message.reply_text("Informasi paket tidak lengkap. Silakan pilih ulang paket.")
+        await send_main_menu(update, context)
         return
 
-    elif next_step == 'handle_phone_for_30h_batch_purchase':
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
+    access_token = None
+    if user_id == ADMIN_ID:
+        logging.info(f"Admin ({user_id}) memulai alur Vidio XL untuk {phone}. Mencari token KMSP di database...")
+        uid, token = account_store.token_nomor(phone, api_provider)
+        if token:
+            access_token = token
+            logging.info(f"Token KMSP untuk {phone} ditemukan di akun user {uid}.")
+
+    if not access_token:
+        access_token = account_store.token(user_id, phone, api_provider)
+    access_token = await token_siap_pakai(phone, api_provider, access_token)
+
+    required_balance = CUSTOM_PACKAGE_PRICES.get(price_lookup_key, {}).get('price_bot', 0)
+
+    if not access_token:
+        if user_id == ADMIN_ID:
+             await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken LOGIN tidak ditemukan untuk `{phone}` di database.", parse_mode="Markdown")
         else:
-            phone = phone_raw
+            await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor ini. Silakan login terlebih dahulu.")
+            await context.bot.send_message(user_id, "Silakan login untuk LOGIN.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("LOGIN OTP", callback_data="login_kmsp")]]))
+        return
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_phone_for_30h_batch_purchase'
+    user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
+    if user_current_balance < required_balance:
+        await context.bot.send_message(user_id, f"❌ Saldo Anda tidak cukup untuk membeli paket: *{package_name_display}* (harga: Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_current_balance:,}.", parse_mode="Markdown")
+        await send_vidio_xl_menu(update, context)
+        return
+
+    if required_balance > 0:
+        if not debit_saldo(user_id, required_balance, "pembelian", kunci_update(update, "pembelian")):
+            await context.bot.send_message(user_id, pesan_debit_gagal(user_id, required_balance))
+            await send_vidio_xl_menu(update, context)
+            return
+        simpan_data_ke_db(user_id)
+        await update.message.reply_text(f"Memproses pembelian... Saldo Anda terpotong: *Rp{required_balance:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
+        logging.info(f"Saldo user {user_id} dipotong sebesar {required_balance} untuk paket {package_name_display}.")
+    else:
+        if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
+            await context.bot.send_message(user_id, f"❌ MESKIPUN PAKET GRATIS, ANDA HARUS MEMILIKI MINIMAL SALDO BOT Rp{MIN_BALANCE_FOR_PURCHASE:,} (Saldo Anda saat ini: Rp{user_current_balance:,}).", parse_mode="Markdown")
+            await send_vidio_xl_menu(update, context)
             return
 
-                                            
-        access_token_kmsp = None
-        if user_id == ADMIN_ID:
-            logging.info(f"Admin ({user_id}) memulai alur Batch 30H untuk {phone}. Mencari token KMSP di seluruh database...")
-            for uid, details in user_data["registered_users"].items():
-                token = details.get("accounts", {}).get(phone, {}).get("kmsp", {}).get("access_token")
-                if token:
-                    access_token_kmsp = token
-                    logging.info(f"Token KMSP untuk {phone} ditemukan di akun user {uid}.")
-                    break
-        
-        if not access_token_kmsp:
-            token_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {})
-            access_token_kmsp = token_data.get("kmsp", {}).get("access_token")
-
-        if not access_token_kmsp:
-            total_price_to_refund = context.user_data.pop('total_30h_batch_price', 0)
-            if user_id == ADMIN_ID:
-                await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken LOGIN tidak ditemukan untuk nomor `{phone}` di seluruh database.", parse_mode="Markdown")
-                if total_price_to_refund > 0:
-                    user_data["registered_users"][str(user_id)]["balance"] += total_price_to_refund
-                    simpan_data_ke_db()
-                    await context.bot.send_message(user_id, f"💰 Saldo Anda sebesar Rp{total_price_to_refund:,} telah dikembalikan.", parse_mode="Markdown")
-                await send_main_menu(update, context)
-            else:
-                await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor `{phone}`. Silakan login terlebih dahulu.")
-                if total_price_to_refund > 0:
-                    user_data["registered_users"][str(user_id)]["balance"] += total_price_to_refund
-                    simpan_data_ke_db()
-                    await context.bot.send_message(user_id, f"💰 Saldo Anda sebesar Rp{total_price_to_refund:,} telah dikembalikan.", parse_mode="Markdown")
-                context.user_data['temp_phone_for_login'] = phone
-                context.user_data['current_login_provider'] = 'kmsp'
-                context.user_data['next'] = 'handle_login_otp_input'
-                context.user_data['resume_30h_purchase_after_otp'] = True
-                await request_otp_and_prompt_kmsp(update, context, phone)
+    await asyncio.create_task(execute_single_purchase(
+        update, context, user_id, kode, phone, access_token, metode,
+        deducted_balance=required_balance,
+        return_menu_callback_data="vidio_xl_menu",
+        provider=api_provider,
+        package_name_for_display=package_name_display
+    ))
+
+
+@step_router.step("handle_beli_single_iflix_package", cleanup=("selected_package_code", "selected_package_name_display", "selected_payment_method", "selected_price_lookup_key", "selected_api_provider"))
+async def step_handle_beli_single_iflix_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
+
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_beli_single_iflix_package')
+        return
+
+    kode = context.user_data.pop('selected_package_code')
+    package_name_display = context.user_data.pop('selected_package_name_display')
+    metode = context.user_data.pop('selected_payment_method')
+    price_lookup_key = context.user_data.pop('selected_price_lookup_key')
+    api_provider = context.user_data.get('selected_api_provider', 'kmsp')
+
+    if not kode or not package_name_display or not metode or price_lookup_key is None:
+        await update.message.reply_text("Informasi paket tidak lengkap. Silakan pilih ulang paket.")
+        await send_main_menu(update, context)
+        return
+
+    access_token = account_store.token(user_id, phone, api_provider)
+    access_token = await token_siap_pakai(phone, api_provider, access_token)
+
+    if not access_token:
+        await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor ini. Silakan login terlebih dahulu.")
+        await context.bot.send_message(user_id, "Silakan login untuk LOGIN.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("LOGIN OTP", callback_data="login_kmsp")]]))
+        return
+
+    user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
+    required_balance = CUSTOM_PACKAGE_PRICES.get(price_lookup_key, {}).get('price_bot', 0)
+
+    if user_current_balance < required_balance:
+        await context.bot.send_message(user_id, f"❌ Saldo Anda tidak cukup untuk membeli paket: *{package_name_display}* (harga: Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_current_balance:,}.", parse_mode="Markdown")
+        await send_iflix_xl_menu(update, context)
+        return
+
+    if required_balance > 0:
+        if not debit_saldo(user_id, required_balance, "pembelian", kunci_update(update, "pembelian")):
+            await context.bot.send_message(user_id, pesan_debit_gagal(user_id, required_balance))
+            await send_iflix_xl_menu(update, context)
             return
-        
-                                     
-                                                                                         
-        context.user_data['token_for_30h_batch'] = access_token_kmsp
-                                  
+        simpan_data_ke_db(user_id)
+        await update.message.reply_text(f"Memproses pembelian... Saldo Anda terpotong: *Rp{required_balance:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
+        logging.info(f"Saldo user {user_id} dipotong sebesar {required_balance} untuk paket {package_name_display}.")
+    else:
+        if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
+            await context.bot.send_message(user_id, f"❌ MESKIPUN PAKET GRATIS, ANDA HARUS MEMILIKI MINIMAL SALDO BOT Rp{MIN_BALANCE_FOR_PURCHASE:,} (Saldo Anda saat ini: Rp{user_current_balance:,}).", parse_mode="Markdown")
+            await send_iflix_xl_menu(update, context)
+            return
+
+    await asyncio.create_task(execute_single_purchase(
+        update, context, user_id, kode, phone, access_token, metode,
+        deducted_balance=required_balance,
+        return_menu_callback_data="iflix_xl_menu",
+        provider="kmsp",
+        package_name_for_display=package_name_display
+    ))
+
+
+@step_router.step("handle_login_otp_input", cleanup=("temp_phone_for_login", "current_login_provider", "pending_hesda_package_details", "resume_automatic_purchase_after_otp", "resume_automatic_xutp_purchase_after_otp", "resume_automatic_xcs_purchase_after_otp", "resume_hesda_purchase_after_otp", "resume_30h_purchase_after_otp"))
+async def step_handle_login_otp_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    otp_input = update.message.text.strip()
+    if not otp_input.isdigit():
+        msg = await context.bot.send_message(user_id, "Format OTP salah. Masukkan hanya angka.")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_login_otp_input')
+        return
+
+    phone = user_data.get("registered_users", {}).get(str(user_id), {}).get('current_phone')
+    if not phone:
+        msg = await context.bot.send_message(user_id, "Nomor HP tidak ditemukan. Silakan coba Login ulang.")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        await send_main_menu(update, context)
+        return
 
-        context.user_data['phone_for_30h_batch'] = phone
-        selected_package_ids = user_data["registered_users"][str(user_id)].get("selected_30h_pkg_ids", [])
-        user_data["registered_users"][str(user_id)]["selected_30h_pkg_ids"] = []
+    current_provider = context.user_data.get('current_login_provider')
+    stored_auth_id = account_store.auth_id(user_id, phone, current_provider)
 
-        context.user_data['packages_to_process_30h_batch'] = selected_package_ids
-        context.user_data['current_batch_index_30h'] = 0
-        context.user_data['current_30h_batch_results'] = []
+    if not stored_auth_id:
+        msg = await context.bot.send_message(user_id, f"Auth ID tidak ditemukan untuk nomor ini. Silakan coba Login kembali.")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        await send_main_menu(update, context)
+        return
 
-        logging.info(f"Starting 30H batch purchase for user {user_id} with phone {phone}. Packages: {selected_package_ids}")
-        asyncio.create_task(process_30h_package_queue(update, context))
+    login_counter[user_id] = login_counter.get(user_id, 0) + 1
+    if login_counter[user_id] > 3:
+        msg = await context.bot.send_message(user_id, "Anda telah melebihi batas percobaan OTP. Silakan mulai ulang proses Login.")
+        del login_counter[user_id]
+        await send_main_menu(update, context)
         return
 
-    elif next_step == 'handle_akun_saya_nomor_input':
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
-        else:
-            phone = phone_raw
+    try:
+        if current_provider == 'kmsp':
+            response = await provider_client.kmsp_get("login", KMSP_API_KEY, phone=phone, method="OTP", auth_id=stored_auth_id, otp=otp_input)
+            response.raise_for_status()
+            result = response.json()
+            data_login = result.get('data')
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            await update.message.reply_text("Format nomor HP salah. Masukkan lagi atau kembali ke menu utama.")
-            context.user_data['next'] = 'handle_akun_saya_nomor_input'
-            return
+            logging.info(f"Response Login OTP KMSP for {phone}: {result}")
 
-                                                                      
-        keyboard = [[InlineKeyboardButton("🔙 Kembali", callback_data="back_to_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+            if not data_login or 'access_token' not in data_login:
+                api_error_message = result.get("message", "Login gagal. Respons tidak valid atau token tidak ditemukan.")
+                raise ValueError(api_error_message)
 
-        nomor_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone)
+            access_token = data_login['access_token']
+            account_store.simpan_token(user_id, phone, 'kmsp', access_token, data_login.get('expires_in'))
+            logging.info(f"User {user_id} login KMSP berhasil dengan nomor {phone}. Token: {access_token[:10]}...")
 
-        if nomor_data:
-            kmsp_status = "✅" if nomor_data.get("kmsp", {}).get("access_token") else "❌"
-            hesda_status = "✅" if nomor_data.get("hesda", {}).get("access_token") else "❌"
+            await context.bot.send_message(user_id, f"✅ *Login OTP Berhasil!* Nomor *{phone}* telah terhubung.", parse_mode="Markdown")
+            await context.bot.send_message(ADMIN_ID, f"⚠️ User `{user_id}` (`{update.effective_user.first_name or 'N/A'}`) login OTP LOGIN berhasil untuk nomor `{phone}`.", parse_mode="Markdown")
 
-            timestamp_str = "N/A"
-            ts_iso = nomor_data.get("kmsp", {}).get("login_timestamp") or nomor_data.get("hesda", {}).get("login_timestamp")
-            if ts_iso:
-                try:
-                    dt_object = datetime.fromisoformat(ts_iso)
-                    timestamp_str = dt_object.strftime('%H.%M  %d.%m.%Y')
-                except ValueError:
-                    timestamp_str = "Format waktu tidak valid"
-
-            response_text = (
-                f"Nomor kamu terdeteksi\n"
-                f"`{phone}`   `{timestamp_str}`\n\n"
-                f"*Status Nomor*\n"
-                f"LOGIN OTP {kmsp_status}\n"
-                f"OTP BYPAS {hesda_status}\n\n"
-                f"_Meskipun nomor kamu sudah pernah login, jika XL merefresh token login, besar kemungkinan kamu mesti login otp ulang._"
-            )
-                                                                 
-            await update.message.reply_text(response_text, parse_mode="Markdown", reply_markup=reply_markup)
-        else:
-            response_text = f"❌ Nomor `{phone}` tidak ditemukan di riwayat login Anda. Silakan login terlebih dahulu untuk nomor ini."
-                                                                 
-            await update.message.reply_text(response_text, parse_mode="Markdown", reply_markup=reply_markup)
-            
-                                                                 
-                                                
-        return
+        elif current_provider == 'hesda':
+            headers = get_hesda_auth_headers()
+            if not headers:
+                raise ValueError("Informasi otentikasi tidak lengkap.")
+
+            payload = {
+                "hesdastore": HESDA_API_KEY,
+                "no_hp": phone,
+                "metode": "OTP",
+                "auth_id": stored_auth_id,
+                "kode_otp": otp_input
+            }
 
-    elif next_step == 'handle_beli_single_vidio_package':
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
-        else:
-            phone = phone_raw
+            response = await provider_client.hesda_post("login_sms", headers, **payload)
+            response.raise_for_status()
+            result = response.json()
+            data_login = result.get('data')
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_beli_single_vidio_package'
-            return
+            logging.info(f"Response Login OTP Hesda for {phone}: {result}")
 
-        kode = context.user_data.pop('selected_package_code')
-        package_name_display = context.user_data.pop('selected_package_name_display')
-        metode = context.user_data.pop('selected_payment_method')
-        price_lookup_key = context.user_data.pop('selected_price_lookup_key')
-        api_provider = context.user_data.get('selected_api_provider', 'kmsp')
+            if not data_login or 'access_token' not in data_login:
+                api_error_message = result.get("message", "Login gagal. Respons tidak valid atau token tidak ditemukan.")
+                raise ValueError(api_error_message)
 
-        if not kode or not package_name_display or not metode or price_lookup_key is None:
-            await update.message.reply_text("Informasi paket tidak lengkap. Silakan pilih ulang paket.")
-            await send_main_menu(update, context)
-            return
+            access_token = data_login['access_token']
+            account_store.simpan_token(user_id, phone, 'hesda', access_token, data_login.get('expires_in'))
+            logging.info(f"User {user_id} login Hesda berhasil dengan nomor {phone}. Token: {access_token[:10]}...")
 
-                                            
-        access_token = None
-        if user_id == ADMIN_ID:
-            logging.info(f"Admin ({user_id}) memulai alur Vidio XL untuk {phone}. Mencari token KMSP di database...")
-            for uid, details in user_data["registered_users"].items():
-                token = details.get("accounts", {}).get(phone, {}).get(api_provider, {}).get("access_token")
-                if token:
-                    access_token = token
-                    logging.info(f"Token KMSP untuk {phone} ditemukan di akun user {uid}.")
-                    break
-        
-        if not access_token:
-            token_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {})
-            access_token = token_data.get(api_provider, {}).get("access_token")
-                                            
+            await context.bot.send_message(user_id, f"✅ *Login BYPAS Berhasil!* Nomor *{phone}* telah terhubung.", parse_mode="Markdown")
+            await context.bot.send_message(ADMIN_ID, f"⚠️ User `{user_id}` (`{update.effective_user.first_name or 'N/A'}`) login OTP BYPAS berhasil untuk nomor `{phone}`.", parse_mode="Markdown")
 
-        required_balance = CUSTOM_PACKAGE_PRICES.get(price_lookup_key, {}).get('price_bot', 0)
+        del login_counter[user_id]
 
-        if not access_token:
-            if user_id == ADMIN_ID:
-                 await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken LOGIN tidak ditemukan untuk `{phone}` di database.", parse_mode="Markdown")
-            else:
-                await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor ini. Silakan login terlebih dahulu.")
-                await context.bot.send_message(user_id, "Silakan login untuk LOGIN.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("LOGIN OTP", callback_data="login_kmsp")]]))
-            return
+        if context.user_data.pop('resume_hesda_purchase_after_otp', False):
+            pending_package_details = context.user_data.pop('pending_hesda_package_details', None)
+            if pending_package_details:
+                selected_package_id = pending_package_details['id']
+                package_name = pending_package_details['name']
+                required_balance = pending_package_details['price_bot']
+                payment_method = pending_package_details['payment_method']
+                return_menu_callback_data = pending_package_details['return_menu']
 
-        user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
-        if user_current_balance < required_balance:
-            await context.bot.send_message(user_id, f"❌ Saldo Anda tidak cukup untuk membeli paket: *{package_name_display}* (harga: Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_current_balance:,}.", parse_mode="Markdown")
-            await send_vidio_xl_menu(update, context)
-            return
+                user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
+                if user_current_balance < required_balance:
+                    await context.bot.send_message(user_id, f"❌ Saldo Anda tidak cukup untuk membeli paket: *{package_name}* (harga bot: Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_current_balance:,}.", parse_mode="Markdown")
+                    await send_bypass_menu(update, context)
+                    return
 
-        if required_balance > 0:
-            user_data["registered_users"][str(user_id)]["balance"] -= required_balance
-            simpan_data_ke_db()
-            await update.message.reply_text(f"Memproses pembelian... Saldo Anda terpotong: *Rp{required_balance:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
-            logging.info(f"Saldo user {user_id} dipotong sebesar {required_balance} untuk paket {package_name_display}.")
-        else:
-            if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
-                await context.bot.send_message(user_id, f"❌ MESKIPUN PAKET GRATIS, ANDA HARUS MEMILIKI MINIMAL SALDO BOT Rp{MIN_BALANCE_FOR_PURCHASE:,} (Saldo Anda saat ini: Rp{user_current_balance:,}).", parse_mode="Markdown")
-                await send_vidio_xl_menu(update, context)
-                return
+                if required_balance > 0:
+                    if not debit_saldo(user_id, required_balance, "pembelian", kunci_update(update, "pembelian")):
+                        await context.bot.send_message(user_id, pesan_debit_gagal(user_id, required_balance))
+                        await send_bypass_menu(update, context)
+                        return
+                    simpan_data_ke_db(user_id)
+                    await context.bot.send_message(user_id, f"Melanjutkan pembelian *{package_name}*...\nSaldo Anda terpotong: *Rp{required_balance:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
+                    logging.info(f"Saldo user {user_id} dipotong sebesar {required_balance} untuk paket BYPAS {package_name} (setelah OTP).")
+                else:
+                    if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
+                        await context.bot.send_message(user_id, f"❌ MESKIPUN PAKET GRATIS, ANDA HARUS MEMILIKI MINIMAL SALDO BOT Rp{MIN_BALANCE_FOR_PURCHASE:,} (Saldo Anda saat ini: Rp{user_current_balance:,}).", parse_mode="Markdown")
+                        await send_bypass_menu(update, context)
+                        return
 
-        await asyncio.create_task(execute_single_purchase(
-            update, context, user_id, kode, phone, access_token, metode,
-            deducted_balance=required_balance,
-            return_menu_callback_data="vidio_xl_menu",
-            provider=api_provider,
-            package_name_for_display=package_name_display
-        ))
-
-    elif next_step == 'handle_beli_single_iflix_package':                     
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
+                asyncio.create_task(pembelian_hesda_tunggal(update, context, user_id, selected_package_id, package_name, phone, access_token, payment_method, required_balance, return_menu_callback_data))
+            elif 'packages_to_process_hesda_batch' in context.user_data:
+                logging.info(f"Resuming Hesda batch purchase for user {user_id} after OTP.")
+                asyncio.create_task(process_hesda_package_queue(update, context))
+            else:
+                await context.bot.send_message(user_id, "Terjadi kesalahan: data pembelian BYPAS tidak ditemukan setelah OTP. Silakan coba lagi dari awal.")
+                await send_bypass_menu(update, context)
+        elif context.user_data.pop('resume_30h_purchase_after_otp', False):
+            logging.info(f"Resuming 30H batch purchase for user {user_id} after KMSP OTP.")
+            asyncio.create_task(process_30h_package_queue(update, context))
+        elif context.user_data.pop('resume_automatic_purchase_after_otp', False):
+            logging.info(f"Resuming automatic purchase flow for user {user_id} after KMSP OTP.")
+            asyncio.create_task(run_automatic_purchase_flow(update, context))
+        elif context.user_data.pop('resume_automatic_xutp_purchase_after_otp', False):
+            logging.info(f"Resuming automatic XUTP purchase flow for user {user_id} after KMSP OTP.")
+            asyncio.create_task(run_automatic_xutp_flow(update, context))
         else:
-            phone = phone_raw
+            await send_main_menu(update, context)
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_beli_single_iflix_package'                          
-            return
+    except httpx.HTTPStatusError as http_err:
+        error_detail = http_err.response.json().get("message", "unknown error") if http_err.response.content else "no response content"
+        logging.error(f"HTTP error saat login OTP {current_provider} untuk {phone}: {http_err}. Respon: {http_err.response.text}. Detail: {error_detail}")
+        msg = await context.bot.send_message(user_id, f"OTP salah atau kedaluwarsa. Terjadi kesalahan saat login: {error_detail}. Mohon coba lagi atau minta OTP baru.")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_login_otp_input')
+    except httpx.HTTPError as e:
+        logging.error(f"Network error saat login OTP {current_provider} untuk {phone}: {e}")
+        msg = await context.bot.send_message(user_id, f"Terjadi kesalahan jaringan saat login. Mohon coba lagi nanti.")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        await send_main_menu(update, context)
+    except json.JSONDecodeError:
+        logging.error(f"Gagal mengurai JSON dari respon login OTP {current_provider}. Respon: {response.text}")
+        msg = await context.bot.send_message(user_id, f"Terjadi kesalahan saat memproses data login (JSON tidak valid). Cek kembali OTP Anda.")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_login_otp_input')
+    except ValueError as e:
+        logging.error(f"Kesalahan logika login {current_provider}: {e}")
+        msg = await context.bot.send_message(user_id, f"Login gagal: {e}.")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_login_otp_input')
+    except Exception as e:
+        logging.error(f"Kesalahan tak terduga saat login {current_provider}: {e}", exc_info=True)
+        msg = await context.bot.send_message(user_id, f"Terjadi kesalahan tak terduga saat login. Silakan laporkan ini kepada admin.")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        await send_main_menu(update, context)
 
-        kode = context.user_data.pop('selected_package_code') 
-        package_name_display = context.user_data.pop('selected_package_name_display') 
-        metode = context.user_data.pop('selected_payment_method') 
-        price_lookup_key = context.user_data.pop('selected_price_lookup_key') 
-        api_provider = context.user_data.get('selected_api_provider', 'kmsp')
 
-        if not kode or not package_name_display or not metode or price_lookup_key is None:
-            await update.message.reply_text("Informasi paket tidak lengkap. Silakan pilih ulang paket.")
-            await send_main_menu(update, context)
-            return
+@step_router.step("handle_top_up_amount")
+async def step_handle_top_up_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await handle_top_up_amount(update, context)
 
-        token_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {})
-        access_token = token_data.get(api_provider, {}).get("access_token")
 
-        if not access_token:
-            await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor ini. Silakan login terlebih dahulu.")
-            required_balance_for_refund = CUSTOM_PACKAGE_PRICES.get(price_lookup_key)
-            if required_balance_for_refund is not None and required_balance_for_refund > 0:
-                user_data["registered_users"][str(user_id)]["balance"] += required_balance_for_refund
-                simpan_data_ke_db()
-                await context.bot.send_message(user_id, f"Saldo Anda sebesar *Rp{required_balance_for_refund:,}* telah dikembalikan karena token tidak ditemukan.", parse_mode="Markdown")
+@step_router.step("handle_all_addons_phone_input")
+async def step_handle_all_addons_phone_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
 
-            await context.bot.send_message(user_id, "Silakan login untuk LOGIN.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("LOGIN OTP", callback_data="login_kmsp")]]))
-            return
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_all_addons_phone_input')
+        return
 
-        user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
-        required_balance = CUSTOM_PACKAGE_PRICES.get(price_lookup_key, {}).get('price_bot', 0)
+    context.user_data['phone_for_all_addons'] = phone
+    asyncio.create_task(process_addon_batch(update, context))
 
-        if user_current_balance < required_balance:
-            await context.bot.send_message(user_id, f"❌ Saldo Anda tidak cukup untuk membeli paket: *{package_name_display}* (harga: Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_current_balance:,}.", parse_mode="Markdown")
-            await send_iflix_xl_menu(update, context)                           
-            return
 
-        if required_balance > 0: 
-            user_data["registered_users"][str(user_id)]["balance"] -= required_balance
-            simpan_data_ke_db()
-            await update.message.reply_text(f"Memproses pembelian... Saldo Anda terpotong: *Rp{required_balance:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
-            logging.info(f"Saldo user {user_id} dipotong sebesar {required_balance} untuk paket {package_name_display}.")
-        else: 
-            if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
-                await context.bot.send_message(user_id, f"❌ MESKIPUN PAKET GRATIS, ANDA HARUS MEMILIKI MINIMAL SALDO BOT Rp{MIN_BALANCE_FOR_PURCHASE:,} (Saldo Anda saat ini: Rp{user_current_balance:,}).", parse_mode="Markdown")
-                await send_iflix_xl_menu(update, context)                           
-                return
+@step_router.step("handle_beli_xcp", cleanup=("selected_package_code", "selected_package_name_display", "selected_payment_method", "selected_price_lookup_key", "selected_api_provider"))
+async def step_handle_beli_xcp(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await proses_nomor_beli_paket_tunggal(update, context, 'handle_beli_xcp')
 
-        await asyncio.create_task(execute_single_purchase(
-            update, context, user_id, kode, phone, access_token, metode,
-            deducted_balance=required_balance, 
-            return_menu_callback_data="iflix_xl_menu",                           
-            provider="kmsp",
-            package_name_for_display=package_name_display 
-        ))
-
-    elif next_step == 'handle_login_otp_input':
-        otp_input = update.message.text.strip()
-        if not otp_input.isdigit():
-            msg = await context.bot.send_message(user_id, "Format OTP salah. Masukkan hanya angka.")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_login_otp_input'
-            return
 
-        phone = user_data.get("registered_users", {}).get(str(user_id), {}).get('current_phone')
-        if not phone:
-            msg = await context.bot.send_message(user_id, "Nomor HP tidak ditemukan. Silakan coba Login ulang.")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            await send_main_menu(update, context)
-            return
+@step_router.step("handle_beli_uts_package", cleanup=("selected_package_code", "selected_package_name_display", "selected_payment_method", "selected_price_lookup_key", "selected_api_provider"))
+async def step_handle_beli_uts_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await proses_nomor_beli_paket_tunggal(update, context, 'handle_beli_uts_package')
 
-        current_provider = context.user_data.get('current_login_provider')
-        stored_auth_id = user_data["registered_users"][str(user_id)]['accounts'].get(phone, {}).get(current_provider, {}).get('auth_id')
+async def proses_nomor_beli_paket_tunggal(update: Update, context: ContextTypes.DEFAULT_TYPE, next_step: str):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
 
-        if not stored_auth_id:
-            msg = await context.bot.send_message(user_id, f"Auth ID tidak ditemukan untuk nomor ini. Silakan coba Login kembali.")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            await send_main_menu(update, context)
-            return
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, next_step)
+        return
 
-        login_counter[user_id] = login_counter.get(user_id, 0) + 1
-        if login_counter[user_id] > 3:
-            msg = await context.bot.send_message(user_id, "Anda telah melebihi batas percobaan OTP. Silakan mulai ulang proses Login.")
-            del login_counter[user_id]
-            await send_main_menu(update, context)
-            return
+    kode = context.user_data.get('selected_package_code')
+    metode = context.user_data.get('selected_payment_method', "DANA")
+    api_provider = context.user_data.get('selected_api_provider', 'kmsp')
 
-        try:
-            if current_provider == 'kmsp':
-                url = f"https://golang-openapi-login-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}&phone={phone}&method=OTP&auth_id={stored_auth_id}&otp={otp_input}"
-                response = requests.get(url, timeout=20)
-                response.raise_for_status()
-                result = response.json()
-                data_login = result.get('data')
+    return_menu = None
+    if next_step == 'handle_beli_xcp':
+        if kode == XCP_8GB_PACKAGE['code']:
+            return_menu = 'xcp_addon'
+        else:
+            return_menu = 'xcp_addon_dana'
+    elif next_step == 'handle_beli_uts_package':
+        return_menu = 'menu_uts_nested'
 
-                logging.info(f"Response Login OTP KMSP for {phone}: {result}")
+    if not kode:
+        await update.message.reply_text("Informasi paket tidak lengkap. Silakan pilih ulang paket.")
+        await send_main_menu(update, context)
+        return
 
-                if not data_login or 'access_token' not in data_login:
-                    api_error_message = result.get("message", "Login gagal. Respons tidak valid atau token tidak ditemukan.")
-                    raise ValueError(api_error_message)
+    access_token = None
+    if user_id == ADMIN_ID:
+        logging.info(f"Admin ({user_id}) memulai alur {next_step} untuk {phone}. Mencari token {api_provider}...")
+        uid, token = account_store.token_nomor(phone, api_provider)
+        if token:
+            access_token = token
+            logging.info(f"Token {api_provider} untuk {phone} ditemukan di akun user {uid}.")
 
-                access_token = data_login['access_token']
-                user_data["registered_users"][str(user_id)]['accounts'][phone]['kmsp']['access_token'] = access_token
-                                             
-                user_data["registered_users"][str(user_id)]['accounts'][phone]['kmsp']['login_timestamp'] = datetime.now().isoformat()
-                simpan_data_ke_db()
-                logging.info(f"User {user_id} login KMSP berhasil dengan nomor {phone}. Token: {access_token[:10]}...")
-
-                await context.bot.send_message(user_id, f"✅ *Login OTP Berhasil!* Nomor *{phone}* telah terhubung.", parse_mode="Markdown")
-                await context.bot.send_message(ADMIN_ID, f"⚠️ User `{user_id}` (`{update.effective_user.first_name or 'N/A'}`) login OTP LOGIN berhasil untuk nomor `{phone}`.", parse_mode="Markdown")
-
-            elif current_provider == 'hesda':
-                url = "https://api.hesda-store.com/v2/login_sms"
-                headers = get_hesda_auth_headers()
-                if not headers:
-                    raise ValueError("Informasi otentikasi tidak lengkap.")
-
-                payload = {
-                    "hesdastore": HESDA_API_KEY,
-                    "no_hp": phone,
-                    "metode": "OTP",
-                    "auth_id": stored_auth_id,
-                    "kode_otp": otp_input
-                }
+    if not access_token:
+        access_token = account_store.token(user_id, phone, api_provider)
+    access_token = await token_siap_pakai(phone, api_provider, access_token)
 
-                response = requests.post(url, headers=headers, data=payload, timeout=20)
-                response.raise_for_status()
-                result = response.json()
-                data_login = result.get('data')
+    if not access_token:
+        if user_id == ADMIN_ID:
+            await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken {api_provider.upper()} tidak ditemukan untuk nomor `{phone}`.", parse_mode="Markdown")
+        else:
+            await update.message.reply_text(f"Token {api_provider.upper()} tidak ditemukan untuk nomor ini. Silakan login terlebih dahulu.")
+            if api_provider == 'kmsp':
+                await context.bot.send_message(user_id, "Silakan login untuk LOGIN.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("LOGIN OTP", callback_data="login")]]))
+            elif api_provider == 'hesda':
+                await context.bot.send_message(user_id, "Silakan login untuk BYPAS.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Login BYPAS", callback_data="login_hesda")]]))
+        return
 
-                logging.info(f"Response Login OTP Hesda for {phone}: {result}")
+    user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
+    required_balance = CUSTOM_PACKAGE_PRICES.get(kode, {}).get('price_bot', 0)
+
+    if user_current_balance < required_balance:
+        await context.bot.send_message(user_id, f"❌ Saldo Anda tidak cukup untuk membeli paket: *{kode}* (harga: Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_current_balance:,}.", parse_mode="Markdown")
+        if return_menu == 'xcp_addon': await send_xcp_addon_menu(update, context)
+        elif return_menu == 'xcp_addon_dana': await send_xcp_addon_dana_menu(update, context)
+        elif return_menu == 'menu_uts_nested': await send_uts_menu(update, context)
+        else: await send_main_menu(update, context)
+        return
 
-                if not data_login or 'access_token' not in data_login:
-                    api_error_message = result.get("message", "Login gagal. Respons tidak valid atau token tidak ditemukan.")
-                    raise ValueError(api_error_message)
+    if required_balance > 0:
+        if not debit_saldo(user_id, required_balance, "pembelian", kunci_update(update, "pembelian")):
+            await context.bot.send_message(user_id, pesan_debit_gagal(user_id, required_balance))
+            if return_menu == 'xcp_addon': await send_xcp_addon_menu(update, context)
+            elif return_menu == 'xcp_addon_dana': await send_xcp_addon_dana_menu(update, context)
+            elif return_menu == 'menu_uts_nested': await send_uts_menu(update, context)
+            else: await send_main_menu(update, context)
+            return
+        simpan_data_ke_db(user_id)
+        await update.message.reply_text(f"Memproses pembelian... Saldo Anda terpotong: *Rp{required_balance:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
+        logging.info(f"Saldo user {user_id} dipotong sebesar {required_balance} untuk paket {kode}.")
+    else:
+        if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
+            await context.bot.send_message(user_id, f"❌ MESKIPUN PAKET GRATIS, ANDA HARUS MEMILIKI MINIMAL SALDO BOT Rp{MIN_BALANCE_FOR_PURCHASE:,} (Saldo Anda saat ini: Rp{user_current_balance:,}).", parse_mode="Markdown")
+            if return_menu == 'xcp_addon': await send_xcp_addon_menu(update, context)
+            elif return_menu == 'xcp_addon_dana': await send_xcp_addon_dana_menu(update, context)
+            elif return_menu == 'menu_uts_nested': await send_uts_menu(update, context)
+            else: await send_main_menu(update, context)
+            return
 
-                access_token = data_login['access_token']
-                user_data["registered_users"][str(user_id)]['accounts'][phone]['hesda']['access_token'] = access_token
-                                             
-                user_data["registered_users"][str(user_id)]['accounts'][phone]['hesda']['login_timestamp'] = datetime.now().isoformat()
-                simpan_data_ke_db()
-                logging.info(f"User {user_id} login Hesda berhasil dengan nomor {phone}. Token: {access_token[:10]}...")
-
-                await context.bot.send_message(user_id, f"✅ *Login BYPAS Berhasil!* Nomor *{phone}* telah terhubung.", parse_mode="Markdown")
-                await context.bot.send_message(ADMIN_ID, f"⚠️ User `{user_id}` (`{update.effective_user.first_name or 'N/A'}`) login OTP BYPAS berhasil untuk nomor `{phone}`.", parse_mode="Markdown")
-
-            del login_counter[user_id]
-
-            if context.user_data.pop('resume_hesda_purchase_after_otp', False):
-                pending_package_details = context.user_data.pop('pending_hesda_package_details', None)
-                if pending_package_details:
-                    selected_package_id = pending_package_details['id']
-                    package_name = pending_package_details['name']
-                    required_balance = pending_package_details['price_bot']
-                    payment_method = pending_package_details['payment_method']
-                    return_menu_callback_data = pending_package_details['return_menu']
-
-                    user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
-                    if user_current_balance < required_balance:
-                        await context.bot.send_message(user_id, f"❌ Saldo Anda tidak cukup untuk membeli paket: *{package_name}* (harga bot: Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_current_balance:,}.", parse_mode="Markdown")
-                        await send_bypass_menu(update, context)
-                        return
+    asyncio.create_task(execute_single_purchase(update, context, user_id, kode, phone, access_token, metode, deducted_balance=required_balance, return_menu_callback_data=return_menu, provider=api_provider))
 
-                    if required_balance > 0:
-                        user_data["registered_users"][str(user_id)]["balance"] -= required_balance
-                        simpan_data_ke_db()
-                        await context.bot.send_message(user_id, f"Melanjutkan pembelian *{package_name}*...\nSaldo Anda terpotong: *Rp{required_balance:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
-                        logging.info(f"Saldo user {user_id} dipotong sebesar {required_balance} untuk paket BYPAS {package_name} (setelah OTP).")
-                    else:
-                        if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
-                            await context.bot.send_message(user_id, f"❌ MESKIPUN PAKET GRATIS, ANDA HARUS MEMILIKI MINIMAL SALDO BOT Rp{MIN_BALANCE_FOR_PURCHASE:,} (Saldo Anda saat ini: Rp{user_current_balance:,}).", parse_mode="Markdown")
-                            await send_bypass_menu(update, context)
-                            return
-
-                    asyncio.create_task(execute_single_purchase_hesda(update, context, user_id, selected_package_id, package_name, phone, access_token, payment_method, required_balance, return_menu_callback_data))
-                elif 'packages_to_process_hesda_batch' in context.user_data:
-                    logging.info(f"Resuming Hesda batch purchase for user {user_id} after OTP.")
-                    asyncio.create_task(process_hesda_package_queue(update, context))
-                else:
-                    await context.bot.send_message(user_id, "Terjadi kesalahan: data pembelian BYPAS tidak ditemukan setelah OTP. Silakan coba lagi dari awal.")
-                    await send_bypass_menu(update, context)
-            elif context.user_data.pop('resume_30h_purchase_after_otp', False):
-                logging.info(f"Resuming 30H batch purchase for user {user_id} after KMSP OTP.")
-                asyncio.create_task(process_30h_package_queue(update, context))
-            elif context.user_data.pop('resume_automatic_purchase_after_otp', False):
-                logging.info(f"Resuming automatic purchase flow for user {user_id} after KMSP OTP.")
-                asyncio.create_task(run_automatic_purchase_flow(update, context))
-            elif context.user_data.pop('resume_automatic_xutp_purchase_after_otp', False):
-                logging.info(f"Resuming automatic XUTP purchase flow for user {user_id} after KMSP OTP.")
-                asyncio.create_task(run_automatic_xutp_flow(update, context))
-            else:
-                await send_main_menu(update, context)
 
-        except requests.exceptions.HTTPError as http_err:
-            error_detail = http_err.response.json().get("message", "unknown error") if http_err.response.content else "no response content"
-            logging.error(f"HTTP error saat login OTP {current_provider} untuk {phone}: {http_err}. Respon: {http_err.response.text}. Detail: {error_detail}")
-            msg = await context.bot.send_message(user_id, f"OTP salah atau kedaluwarsa. Terjadi kesalahan saat login: {error_detail}. Mohon coba lagi atau minta OTP baru.")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_login_otp_input'
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Network error saat login OTP {current_provider} untuk {phone}: {e}")
-            msg = await context.bot.send_message(user_id, f"Terjadi kesalahan jaringan saat login. Mohon coba lagi nanti.")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            await send_main_menu(update, context)
-        except json.JSONDecodeError:
-            logging.error(f"Gagal mengurai JSON dari respon login OTP {current_provider}. Respon: {response.text}")
-            msg = await context.bot.send_message(user_id, f"Terjadi kesalahan saat memproses data login (JSON tidak valid). Cek kembali OTP Anda.")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_login_otp_input'
-        except ValueError as e:
-            logging.error(f"Kesalahan logika login {current_provider}: {e}")
-            msg = await context.bot.send_message(user_id, f"Login gagal: {e}.")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_login_otp_input'
-        except Exception as e:
-            logging.error(f"Kesalahan tak terduga saat login {current_provider}: {e}", exc_info=True)
-            msg = await context.bot.send_message(user_id, f"Terjadi kesalahan tak terduga saat login. Silakan laporkan ini kepada admin.")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            await send_main_menu(update, context)
-            
-    elif next_step == 'handle_top_up_amount':
-        await handle_top_up_amount(update, context)
-        return
+@step_router.step("handle_buy_custom_package_phone_input", cleanup=("selected_custom_package_code", "selected_custom_package_name", "selected_custom_package_price", "selected_custom_payment_method", "selected_api_provider"))
+async def step_handle_buy_custom_package_phone_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
 
-    elif next_step == 'handle_all_addons_phone_input':
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
-        else:
-            phone = phone_raw
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_buy_custom_package_phone_input')
+        return
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_all_addons_phone_input'
-            return
+    package_code = context.user_data.pop('selected_custom_package_code', None)
+    package_name = context.user_data.pop('selected_custom_package_name', None)
+    package_price = context.user_data.pop('selected_custom_package_price', None)
+    payment_method = context.user_data.pop('selected_custom_payment_method', 'BALANCE')
+    api_provider = context.user_data.get('selected_api_provider', 'kmsp')
 
-        context.user_data['phone_for_all_addons'] = phone
-        asyncio.create_task(process_addon_batch(update, context))
+    if not all([package_code, package_name, package_price is not None]):
+        await update.message.reply_text("Terjadi kesalahan dalam detail paket. Silakan coba lagi.")
+        await send_main_menu(update, context)
         return
 
-    elif next_step == 'handle_beli_xcp' or next_step == 'handle_beli_uts_package':
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
+    access_token = None
+    if user_id == ADMIN_ID:
+        logging.info(f"Admin ({user_id}) memulai alur Paket Kustom untuk {phone}. Mencari token {api_provider}...")
+        uid, token = account_store.token_nomor(phone, api_provider)
+        if token:
+            access_token = token
+            logging.info(f"Token {api_provider} untuk {phone} ditemukan di akun user {uid}.")
+
+    if not access_token:
+        access_token = account_store.token(user_id, phone, api_provider)
+    access_token = await token_siap_pakai(phone, api_provider, access_token)
+
+    if not access_token:
+        # Saldo belum dipotong pada titik ini, jadi tidak ada yang perlu dikembalikan.
+        if user_id == ADMIN_ID:
+            await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken {api_provider.upper()} tidak ditemukan untuk nomor `{phone}`.", parse_mode="Markdown")
         else:
-            phone = phone_raw
+            await update.message.reply_text(f"Token {api_provider.upper()} tidak ditemukan untuk nomor ini. Silakan login terlebih dahulu.")
+            if api_provider == 'kmsp':
+                await context.bot.send_message(user_id, "Silakan login untuk LOGIN.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("LOGIN OTP", callback_data="login")]]))
+            elif api_provider == 'hesda':
+                await context.bot.send_message(user_id, "Silakan login untuk BYPAS.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Login BYPAS", callback_data="login_hesda")]]))
+        return
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = next_step
-            return
+    user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
+    if user_current_balance < package_price:
+        await update.message.reply_text(f"❌ Saldo Anda tidak cukup untuk membeli paket *{package_name}* (harga: Rp{package_price:,}).", parse_mode="Markdown")
+        await send_main_menu(update, context)
+        return
 
-        kode = context.user_data.get('selected_package_code')
-        metode = context.user_data.get('selected_payment_method', "DANA")
-        api_provider = context.user_data.get('selected_api_provider', 'kmsp')
+    if not debit_saldo(user_id, package_price, "pembelian", kunci_update(update, "pembelian")):
+        await update.message.reply_text(pesan_debit_gagal(user_id, package_price))
+        await send_main_menu(update, context)
+        return
+    simpan_data_ke_db(user_id)
+    await update.message.reply_text(f"Memproses pembelian paket kustom *{package_name}*...\nSaldo Anda terpotong: *Rp{package_price:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
+    logging.info(f"Saldo user {user_id} dipotong {package_price} untuk paket kustom {package_code}.")
 
-        return_menu = None
-        if next_step == 'handle_beli_xcp':
-            if kode == XCP_8GB_PACKAGE['code']:
-                return_menu = 'xcp_addon'
-            else:
-                return_menu = 'xcp_addon_dana'
-        elif next_step == 'handle_beli_uts_package':
-            return_menu = 'menu_uts_nested'
+    asyncio.create_task(execute_custom_package_purchase(
+        update, context, user_id, package_code, package_name,
+        package_price, phone, access_token, payment_method, api_provider
+    ))
 
-        if not kode:
-            await update.message.reply_text("Informasi paket tidak lengkap. Silakan pilih ulang paket.")
-            await send_main_menu(update, context)
-            return
 
-                                            
-        access_token = None
-        if user_id == ADMIN_ID:
-            logging.info(f"Admin ({user_id}) memulai alur {next_step} untuk {phone}. Mencari token {api_provider}...")
-            for uid, details in user_data["registered_users"].items():
-                token = details.get("accounts", {}).get(phone, {}).get(api_provider, {}).get("access_token")
-                if token:
-                    access_token = token
-                    logging.info(f"Token {api_provider} untuk {phone} ditemukan di akun user {uid}.")
-                    break
-        
-        if not access_token:
-            token_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {})
-            access_token = token_data.get(api_provider, {}).get("access_token")
-                                            
-
-        if not access_token:
-            if user_id == ADMIN_ID:
-                await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken {api_provider.upper()} tidak ditemukan untuk nomor `{phone}`.", parse_mode="Markdown")
-            else:
-                await update.message.reply_text(f"Token {api_provider.upper()} tidak ditemukan untuk nomor ini. Silakan login terlebih dahulu.")
-                if api_provider == 'kmsp':
-                    await context.bot.send_message(user_id, "Silakan login untuk LOGIN.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("LOGIN OTP", callback_data="login")]]))
-                elif api_provider == 'hesda':
-                    await context.bot.send_message(user_id, "Silakan login untuk BYPAS.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Login BYPAS", callback_data="login_hesda")]]))
-            return
+@step_router.step("handle_automatic_purchase_phone_input")
+async def step_handle_automatic_purchase_phone_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    phone_raw = update.message.text.strip()
+    if phone_raw.startswith('08'):
+        phone = '62' + phone_raw[1:]
+    else:
+        phone = phone_raw
 
-        user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
-        required_balance = CUSTOM_PACKAGE_PRICES.get(kode, {}).get('price_bot', 0)
+    if not re.match(r'^628\d{9,12}$', phone):
+        msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
+        bot_messages.setdefault(user_id, []).append(msg.message_id)
+        step_router.set_next(context, 'handle_automatic_purchase_phone_input')
+        return
 
-        if user_current_balance < required_balance:
-            await context.bot.send_message(user_id, f"❌ Saldo Anda tidak cukup untuk membeli paket: *{kode}* (harga: Rp{required_balance:,}). Saldo Anda saat ini: Rp{user_current_balance:,}.", parse_mode="Markdown")
-            if return_menu == 'xcp_addon': await send_xcp_addon_menu(update, context)
-            elif return_menu == 'xcp_addon_dana': await send_xcp_addon_dana_menu(update, context)
-            elif return_menu == 'menu_uts_nested': await send_uts_menu(update, context)
-            else: await send_main_menu(update, context)
-            return
+    payment_method_selected = context.user_data.get('automatic_purchase_payment_method', 'DANA')
 
-        if required_balance > 0: 
-            user_data["registered_users"][str(user_id)]["balance"] -= required_balance
-            simpan_data_ke_db()
-            await update.message.reply_text(f"Memproses pembelian... Saldo Anda terpotong: *Rp{required_balance:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
-            logging.info(f"Saldo user {user_id} dipotong sebesar {required_balance} untuk paket {kode}.")
-        else:
-            if user_current_balance < MIN_BALANCE_FOR_PURCHASE:
-                await context.bot.send_message(user_id, f"❌ MESKIPUN PAKET GRATIS, ANDA HARUS MEMILIKI MINIMAL SALDO BOT Rp{MIN_BALANCE_FOR_PURCHASE:,} (Saldo Anda saat ini: Rp{user_current_balance:,}).", parse_mode="Markdown")
-                if return_menu == 'xcp_addon': await send_xcp_addon_menu(update, context)
-                elif return_menu == 'xcp_addon_dana': await send_xcp_addon_dana_menu(update, context)
-                elif return_menu == 'menu_uts_nested': await send_uts_menu(update, context)
-                else: await send_main_menu(update, context)
-                return
+    access_token_kmsp = None
+    if user_id == ADMIN_ID:
+        logging.info(f"Admin ({user_id}) memulai alur Otomatis UTS/XC untuk {phone}. Mencari token KMSP...")
+        uid, token = account_store.token_nomor(phone, "kmsp")
+        if token:
+            access_token_kmsp = token
+            logging.info(f"Token KMSP untuk {phone} ditemukan di akun user {uid}.")
 
-        asyncio.create_task(execute_single_purchase(update, context, user_id, kode, phone, access_token, metode, deducted_balance=required_balance, return_menu_callback_data=return_menu, provider=api_provider))
+    if not access_token_kmsp:
+        access_token_kmsp = account_store.token(user_id, phone, "kmsp")
+    access_token_kmsp = await token_siap_pakai(phone, "kmsp", access_token_kmsp)
 
-    elif next_step == 'handle_buy_custom_package_phone_input':
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
+    if not access_token_kmsp:
+        if user_id == ADMIN_ID:
+            await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken LOGIN tidak ditemukan untuk nomor `{phone}` di seluruh database.", parse_mode="Markdown")
+            await send_main_menu(update, context)
         else:
-            phone = phone_raw
-
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_buy_custom_package_phone_input'
-            return
+            await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor `{phone}`. Silakan login terlebih dahulu untuk nomor ini.")
+            context.user_data['temp_phone_for_login'] = phone
+            context.user_data['current_login_provider'] = 'kmsp'
+            step_router.set_next(context, 'handle_login_otp_input')
+            context.user_data['resume_automatic_purchase_after_otp'] = True
+            await request_otp_and_prompt_kmsp(update, context, phone)
+        return
 
-        package_code = context.user_data.pop('selected_custom_package_code', None)
-        package_name = context.user_data.pop('selected_custom_package_name', None)
-        package_price = context.user_data.pop('selected_custom_package_price', None)
-        payment_method = context.user_data.pop('selected_custom_payment_method', 'BALANCE')
-        api_provider = context.user_data.get('selected_api_provider', 'kmsp')
+    context.user_data['automatic_purchase_phone'] = phone
+    context.user_data['automatic_purchase_token'] = access_token_kmsp
+    context.user_data['automatic_purchase_payment_method'] = payment_method_selected
 
-        if not all([package_code, package_name, package_price is not None]):
-            await update.message.reply_text("Terjadi kesalahan dalam detail paket. Silakan coba lagi.")
-            await send_main_menu(update, context)
-            return
+    if 'automatic_flow_state' in user_data["registered_users"].get(str(user_id), {}).get('accounts', {}).get(phone, {}):
+         del user_data["registered_users"][str(user_id)]['accounts'][phone]['automatic_flow_state']
+    simpan_data_ke_db(user_id)
 
-                                            
-        access_token = None
-        if user_id == ADMIN_ID:
-            logging.info(f"Admin ({user_id}) memulai alur Paket Kustom untuk {phone}. Mencari token {api_provider}...")
-            for uid, details in user_data["registered_users"].items():
-                token = details.get("accounts", {}).get(phone, {}).get(api_provider, {}).get("access_token")
-                if token:
-                    access_token = token
-                    logging.info(f"Token {api_provider} untuk {phone} ditemukan di akun user {uid}.")
-                    break
-        
-        if not access_token:
-            token_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {})
-            access_token = token_data.get(api_provider, {}).get("access_token")
-                                            
+    await context.bot.send_message(user_id, f"Memulai proses pembelian Otomatis untuk nomor *{phone}* dengan metode *{payment_method_selected}*.\n\nMemproses paket XUTS...", parse_mode="Markdown")
+    asyncio.create_task(run_automatic_purchase_flow(update, context))
 
-        if not access_token:
-                                                       
-            user_data["registered_users"][str(user_id)]["balance"] += package_price
-            simpan_data_ke_db()
-            
-            if user_id == ADMIN_ID:
-                await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken {api_provider.upper()} tidak ditemukan untuk nomor `{phone}`.", parse_mode="Markdown")
-            else:
-                await update.message.reply_text(f"Token {api_provider.upper()} tidak ditemukan untuk nomor ini. Silakan login terlebih dahulu.")
-                if api_provider == 'kmsp':
-                    await context.bot.send_message(user_id, "Silakan login untuk LOGIN.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("LOGIN OTP", callback_data="login")]]))
-                elif api_provider == 'hesda':
-                    await context.bot.send_message(user_id, "Silakan login untuk BYPAS.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Login BYPAS", callback_data="login_hesda")]]))
-            return
 
-        user_current_balance = user_data["registered_users"][str(user_id)]["balance"]
-        if user_current_balance < package_price:
-            await update.message.reply_text(f"❌ Saldo Anda tidak cukup untuk membeli paket *{package_name}* (harga: Rp{package_price:,}).", parse_mode="Markdown")
-            await send_main_menu(update, context)
-            return
+@step_router.step("handle_stop_paket_input")
+async def step_handle_stop_paket_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    encrypted_package_code = update.message.text.strip()
+    current_phone = user_data.get("registered_users", {}).get(str(user_id), {}).get("current_phone")
+    access_token = account_store.token(user_id, current_phone, "kmsp")
 
-        user_data["registered_users"][str(user_id)]["balance"] -= package_price
-        simpan_data_ke_db()
-        await update.message.reply_text(f"Memproses pembelian paket kustom *{package_name}*...\nSaldo Anda terpotong: *Rp{package_price:,}*. Saldo tersisa: *Rp{user_data['registered_users'][str(user_id)]['balance']:,}*.", parse_mode="Markdown")
-        logging.info(f"Saldo user {user_id} dipotong {package_price} untuk paket kustom {package_code}.")
-
-        asyncio.create_task(execute_custom_package_purchase(
-            update, context, user_id, package_code, package_name, 
-            package_price, phone, access_token, payment_method, api_provider
-        ))
-
-    elif next_step == 'handle_automatic_purchase_phone_input':
-        phone_raw = update.message.text.strip()
-        if phone_raw.startswith('08'):
-            phone = '62' + phone_raw[1:]
-        else:
-            phone = phone_raw
+    if not access_token:
+        await update.message.reply_text("Access token LOGIN tidak ditemukan. Silakan login terlebih dahulu.")
+        await send_main_menu(update, context)
+        return
 
-        if not re.match(r'^628\d{9,12}$', phone):
-            msg = await context.bot.send_message(user_id, "Format nomor HP salah. Gunakan `08xxxxxxxxxx` atau `628xxxxxxxxxx`.", parse_mode="Markdown")
-            bot_messages.setdefault(user_id, []).append(msg.message_id)
-            context.user_data['next'] = 'handle_automatic_purchase_phone_input'
-            return
+    asyncio.create_task(execute_unreg_package(update, context, user_id, current_phone, access_token, encrypted_package_code))
 
-        payment_method_selected = context.user_data.get('automatic_purchase_payment_method', 'DANA')
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
 
-                                            
-        access_token_kmsp = None
-        if user_id == ADMIN_ID:
-            logging.info(f"Admin ({user_id}) memulai alur Otomatis UTS/XC untuk {phone}. Mencari token KMSP...")
-            for uid, details in user_data["registered_users"].items():
-                token = details.get("accounts", {}).get(phone, {}).get("kmsp", {}).get("access_token")
-                if token:
-                    access_token_kmsp = token
-                    logging.info(f"Token KMSP untuk {phone} ditemukan di akun user {uid}.")
-                    break
-        
-        if not access_token_kmsp:
-            token_data = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {})
-            access_token_kmsp = token_data.get("kmsp", {}).get("access_token")
-                                            
-
-        if not access_token_kmsp:
-            if user_id == ADMIN_ID:
-                await update.message.reply_text(f"❌ *Pencarian Gagal (Admin)*\n\nToken LOGIN tidak ditemukan untuk nomor `{phone}` di seluruh database.", parse_mode="Markdown")
-                await send_main_menu(update, context)
-            else:
-                await update.message.reply_text(f"Token LOGIN tidak ditemukan untuk nomor `{phone}`. Silakan login terlebih dahulu untuk nomor ini.")
-                context.user_data['temp_phone_for_login'] = phone
-                context.user_data['current_login_provider'] = 'kmsp'
-                context.user_data['next'] = 'handle_login_otp_input'
-                context.user_data['resume_automatic_purchase_after_otp'] = True
-                await request_otp_and_prompt_kmsp(update, context, phone)
+    if user_id == ADMIN_ID and (context.user_data.get('next') or '').startswith('admin_'):
+        next_admin_step, kedaluwarsa = step_router.pop_next(context.user_data)
+        if kedaluwarsa:
+            await update.message.reply_text("⌛ Sesi input admin sudah kedaluwarsa. Silakan ulangi dari menu admin.")
+            await admin_menu(update, context)
             return
 
-        context.user_data['automatic_purchase_phone'] = phone
-        context.user_data['automatic_purchase_token'] = access_token_kmsp
-        context.user_data['automatic_purchase_payment_method'] = payment_method_selected
-        
-        if 'automatic_flow_state' in user_data["registered_users"].get(str(user_id), {}).get('accounts', {}).get(phone, {}):
-             del user_data["registered_users"][str(user_id)]['accounts'][phone]['automatic_flow_state']
-        simpan_data_ke_db()
+        if next_admin_step not in ['admin_handle_broadcast_exclusions', 'admin_handle_search_user_input', 'admin_handle_check_user_transactions_input', 'admin_handle_search_api_package_input']:
+             await delete_last_message(user_id, context)
 
-        await context.bot.send_message(user_id, f"Memulai proses pembelian Otomatis untuk nomor *{phone}* dengan metode *{payment_method_selected}*.\n\nMemproses paket XUTS...", parse_mode="Markdown")
-        asyncio.create_task(run_automatic_purchase_flow(update, context))
+        await step_router.dispatch(update, context, next_admin_step, grup="admin")
         return
 
-    elif next_step == 'handle_stop_paket_input':
-        encrypted_package_code = update.message.text.strip()
-        current_phone = user_data.get("registered_users", {}).get(str(user_id), {}).get("current_phone")
-        access_token = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(current_phone, {}).get("kmsp", {}).get("access_token")
+    if not await check_access(update, context):
+        return
 
-        if not access_token:
-            await update.message.reply_text("Access token LOGIN tidak ditemukan. Silakan login terlebih dahulu.")
-            await send_main_menu(update, context)
-            return
+    if 'next' not in context.user_data:
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        return
 
-        asyncio.create_task(execute_unreg_package(update, context, user_id, current_phone, access_token, encrypted_package_code))
+    next_step, kedaluwarsa = step_router.pop_next(context.user_data)
+    if kedaluwarsa:
+        await update.message.reply_text("⌛ Sesi input sudah kedaluwarsa. Silakan ulangi dari menu.")
+        await send_main_menu(update, context)
+        return
 
+    if not await step_router.dispatch(update, context, next_step):
+        logging.warning(f"Step input tidak dikenal untuk user {user_id}: {next_step}")
 
-async def process_addon_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    context.user_data['stop_batch_purchase'] = False
 
-    phone = context.user_data.get('phone_for_all_addons')
-    current_batch_num = context.user_data.get('addon_batch_current', 1)
+ADDON_BATCH_DELAY = 25   # detik jeda antar paket dalam satu batch add-on
 
+def _info_addon_batch(context):
+    """(nomor batch, total batch, daftar paket di batch ini) untuk batch add-on yang sedang aktif."""
+    current_batch_num = context.user_data.get('addon_batch_current', 1)
     total_batches = math.ceil(len(ADD_ON_SEQUENCE) / ADDON_BATCH_SIZE)
-    
     start_index = (current_batch_num - 1) * ADDON_BATCH_SIZE
     end_index = start_index + ADDON_BATCH_SIZE
-    packages_in_batch = ADD_ON_SEQUENCE[start_index:end_index]
+    packages_in_batch = [ADD_ON_REGISTRY[pkg["code"]] for pkg in ADD_ON_SEQUENCE[start_index:end_index]]
+    return current_batch_num, total_batches, packages_in_batch
+
+async def process_addon_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    context.user_data['stop_batch_purchase'] = False
+
+    current_batch_num, total_batches, packages_in_batch = _info_addon_batch(context)
     
     if not packages_in_batch:
         await context.bot.send_message(user_id, "Tidak ada lagi paket Add-On untuk dibeli.")
@@ -6046,51 +6577,75 @@ async def process_addon_batch(update: Update, context: ContextTypes.DEFAULT_TYPE
     status_message_text = f"⏳ Memulai *Batch {current_batch_num}/{total_batches}*...\nMohon jangan menutup chat atau menekan tombol lain."
     status_msg = await context.bot.send_message(user_id, status_message_text, parse_mode="Markdown", reply_markup=stop_button_keyboard)
 
-    batch_results = []
+    context.user_data['addon_batch_progress'] = {"index": 0, "results": [], "status_message_id": status_msg.message_id}
+    await process_addon_batch_step(update, context)
+
+async def process_addon_batch_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Beli satu paket dari batch add-on aktif, lalu jadwalkan paket berikutnya setelah jeda."""
+    user_id = update.effective_user.id
+    progress = context.user_data.get('addon_batch_progress')
+    if not progress:
+        return
+    phone = context.user_data.get('phone_for_all_addons')
+    current_batch_num, total_batches, packages_in_batch = _info_addon_batch(context)
+    stop_button_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("⏹️ Hentikan Proses", callback_data="stop_batch_purchase")]])
+    status_message_id = progress["status_message_id"]
     total_in_batch = len(packages_in_batch)
-    for i, package_info in enumerate(packages_in_batch):
-        if context.user_data.get('stop_batch_purchase'):
-            await status_msg.edit_text("🛑 Proses pembelian batch dihentikan oleh pengguna.", reply_markup=None)
-            return
+    i = progress["index"]
+
+    if context.user_data.get('stop_batch_purchase') or i >= total_in_batch:
+        await finish_addon_batch(update, context)
+        return
+
+    package_info = packages_in_batch[i]
+    remaining_in_batch = total_in_batch - i
+    await status_message.perbarui(
+        context, user_id, status_message_id,
+        text=f"⏳ *Memproses Batch {current_batch_num}/{total_batches}...*\n"
+             f"🛍️ Membeli paket *{package_info['name']}*...\n"
+             f"📦 Sisa *{remaining_in_batch}* paket lagi di batch ini.",
+        parse_mode="Markdown",
+        reply_markup=stop_button_keyboard
+    )
+    
+    purchase_result = await execute_package_purchase_for_batch(user_id, context, package_info, phone)
+    progress["results"].append(purchase_result)
+    progress["index"] += 1
+    
+    if progress["index"] >= total_in_batch or context.user_data.get('stop_batch_purchase'):
+        await finish_addon_batch(update, context)
+        return
 
-        remaining_in_batch = total_in_batch - i
-        await status_msg.edit_text(
-            f"⏳ *Memproses Batch {current_batch_num}/{total_batches}...*\n"
-            f"🛍️ Membeli paket *{package_info['name']}*...\n"
-            f"📦 Sisa *{remaining_in_batch}* paket lagi di batch ini.",
+    info_text = f"Mohon sabar, bot akan jeda {ADDON_BATCH_DELAY} detik untuk menghindari transaksi pending di XL."
+    status_after_purchase = "Berhasil" if purchase_result['success'] else f"Gagal ({purchase_result.get('error_message', 'Error')})"
+
+    async def tampilkan_jeda(ctx, sisa):
+        await status_message.perbarui(
+            ctx, user_id, status_message_id,
+            text=f"✅ *{package_info['name']}*: {status_after_purchase}.\n"
+                 f"⏸️ Jeda *{sisa} detik* sebelum membeli paket berikutnya.\n"
+                 f"_{info_text}_",
             parse_mode="Markdown",
             reply_markup=stop_button_keyboard
         )
-        
-        purchase_result = await execute_package_purchase_for_batch(user_id, context, package_info, phone)
-        batch_results.append(purchase_result)
-        
-        if i < total_in_batch - 1:
-            if context.user_data.get('stop_batch_purchase'):
-                break 
 
-            delay_duration = 25
-            info_text = "Mohon sabar, bot akan jeda 25 detik untuk menghindari transaksi pending di XL."
-            status_after_purchase = "Berhasil" if purchase_result['success'] else f"Gagal ({purchase_result.get('error_message', 'Error')})"
-            
-            for t in range(delay_duration, 0, -1):
-                if context.user_data.get('stop_batch_purchase'):
-                    break
-                try:
-                    await status_msg.edit_text(
-                        f"✅ *{package_info['name']}*: {status_after_purchase}.\n"
-                        f"⏸️ Jeda *{t} detik* sebelum membeli paket berikutnya.\n"
-                        f"_{info_text}_",
-                        parse_mode="Markdown",
-                        reply_markup=stop_button_keyboard
-                    )
-                except Exception as e:
-                    if 'message is not modified' not in str(e):
-                        logging.warning(f"Gagal edit pesan countdown batch: {e}")
-                await asyncio.sleep(1)
-    
     try:
-        await status_msg.delete()
+        await tampilkan_jeda(context, ADDON_BATCH_DELAY)
+    except Exception as e:
+        logging.warning(f"Gagal edit pesan countdown batch: {e}")
+    flow_scheduler.jadwalkan_countdown(context, ADDON_BATCH_DELAY, 1, tampilkan_jeda, process_addon_batch_step, update,
+                                       batal=lambda ctx: ctx.user_data.get('stop_batch_purchase'))
+
+async def finish_addon_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Tutup batch add-on aktif: hapus pesan status lalu kirim ringkasan (atau info dihentikan)."""
+    user_id = update.effective_user.id
+    progress = context.user_data.pop('addon_batch_progress', None) or {"results": [], "status_message_id": None}
+    current_batch_num, total_batches, _ = _info_addon_batch(context)
+    batch_results = progress["results"]
+
+    try:
+        status_message.lupakan(user_id, progress["status_message_id"])
+        await context.bot.delete_message(chat_id=user_id, message_id=progress["status_message_id"])
     except Exception:
         pass
 
@@ -6132,7 +6687,7 @@ async def execute_package_purchase_for_batch(user_id, context, package_info, pho
     payment_method = "DANA"
 
                                                                                            
-    access_token = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {}).get("kmsp", {}).get("access_token")
+    access_token = account_store.token(user_id, phone, "kmsp")
 
     if not access_token:
         return {"success": False, "package_name": package_name, "error_message": "Token LOGIN tidak ditemukan untuk nomor batch.", "refunded_amount": 0, "deeplink": None}
@@ -6145,24 +6700,24 @@ async def execute_package_purchase_for_batch(user_id, context, package_info, pho
                                                    
                                                                  
 
-    url = f"https://golang-openapi-packagepurchase-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}&package_code={package_code}&phone={phone}&access_token={access_token}&payment_method={payment_method}"
     try:
-        response = requests.get(url, timeout=20)
+        response = await retry_engine.jalankan("kmsp", lambda attempt: provider_client.kmsp_purchase(KMSP_API_KEY, package_code, phone, access_token, payment_method,
+                                                                                                     prioritas=purchase_queue.PRIORITAS_BATCH))
         response.raise_for_status()
         result = response.json()
-        if isinstance(result, list): result = result[0] if result else {}
+        result = provider_client.normalisasi_respons(result)
         
         api_status = result.get('status', False)
         if not api_status:
             raise ValueError(result.get('message', 'API mengembalikan status gagal'))
         
         deeplink = result.get("data", {}).get("deeplink_data", {}).get("deeplink_url")
-        user_data["registered_users"][str(user_id)]["transactions"].append({
+        catat_transaksi(user_id, {
             "type": "Pembelian Paket (Batch)", "package_code": package_code, "package_name": package_name, "phone": phone,
             "amount": -required_balance, "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "status": "Berhasil",
             "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
         })
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
 
         await context.bot.send_message(ADMIN_ID, f"BATCH-BUY: ✅ User {user_id} beli {package_name} utk {phone} (LOGIN).", parse_mode="Markdown")
         return {"success": True, "package_name": package_name, "error_message": None, "refunded_amount": 0, "deeplink": deeplink}
@@ -6171,13 +6726,13 @@ async def execute_package_purchase_for_batch(user_id, context, package_info, pho
         user_facing_error = "Error tidak diketahui"
         admin_facing_error = str(e)
 
-        if isinstance(e, requests.exceptions.ReadTimeout):
+        if isinstance(e, httpx.ReadTimeout):
             user_facing_error = "Server terlalu lama merespon."
             admin_facing_error = "Read timed out"
-        elif isinstance(e, requests.exceptions.ConnectTimeout):
+        elif isinstance(e, httpx.ConnectTimeout):
             user_facing_error = "Gagal terhubung ke server."
             admin_facing_error = "Connection timed out"
-        elif isinstance(e, requests.exceptions.HTTPError):
+        elif isinstance(e, httpx.HTTPStatusError):
             try:
                 error_msg_from_api = e.response.json().get("message", "Terjadi kesalahan HTTP.")
                 user_facing_error = error_msg_from_api
@@ -6194,14 +6749,13 @@ async def execute_package_purchase_for_batch(user_id, context, package_info, pho
 
                                                                                                   
                                            
-        user_data["registered_users"][str(user_id)]["balance"] += required_balance
-        
-        user_data["registered_users"][str(user_id)]["transactions"].append({
+        kredit_saldo(user_id, required_balance, "refund")
+        catat_transaksi(user_id, {
             "type": "Pembelian Gagal (Refund)", "package_code": package_code, "package_name": package_name, "phone": phone,
             "amount": required_balance, "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "status": "Gagal",
             "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
         })
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
         await context.bot.send_message(ADMIN_ID, f"BATCH-BUY: ❌ User {user_id} GAGAL beli {package_name} utk {phone} (LOGIN). Error: {admin_facing_error}", parse_mode="Markdown")
         return {"success": False, "package_name": package_name, "error_message": user_facing_error, "refunded_amount": required_balance, "deeplink": None}
 
@@ -6218,6 +6772,7 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
     if not packages_to_process or current_index >= len(packages_to_process):
         if status_message_id:
             try:
+                status_message.lupakan(user_id, status_message_id)
                 await context.bot.delete_message(chat_id=user_id, message_id=status_message_id)
             except Exception as e:
                 logging.warning(f"Gagal menghapus pesan status akhir {status_message_id}: {e}")
@@ -6253,19 +6808,23 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
         context.user_data.pop('current_batch_index_hesda', None)
         context.user_data.pop('current_hesda_batch_results', None)
         context.user_data.pop('total_hesdapkg_batch_price', None)                    
-        user_data[str(user_id)]["selected_hesdapkg_ids"] = []                                      
-        simpan_data_ke_db()
+        user_data["registered_users"][str(user_id)]["selected_hesdapkg_ids"] = []                                      
+        simpan_data_ke_db(user_id)
+        purchase_jobs.hapus(user_id, purchase_jobs.JENIS_HESDA_BATCH)
         return
 
+    dana_tertahan = sum(HESDA_REGISTRY.get(pid, {}).get('price_bot', 0) for pid in packages_to_process[current_index:])
+    checkpoint_job(context, user_id, purchase_jobs.JENIS_HESDA_BATCH, dana_tertahan)
+
     current_package_id = packages_to_process[current_index]
-    package_info = next((p for p in HESDA_PACKAGES if p["id"] == current_package_id), None)
+    package_info = HESDA_REGISTRY.get(current_package_id)
 
     if not package_info:
         logging.error(f"Paket BYPAS dengan ID {current_package_id} tidak ditemukan dalam daftar HESDA_PACKAGES.")
         message_text = f"❌ Terjadi kesalahan: Paket tidak dikenali ({current_package_id}). Melanjutkan ke paket berikutnya jika ada."
         if status_message_id:
             try:
-                await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=message_text, parse_mode="Markdown")
+                await status_message.perbarui(context, user_id, status_message_id, text=message_text, parse_mode="Markdown")
             except Exception:
                 await context.bot.send_message(user_id, message_text, parse_mode="Markdown")
         else:
@@ -6274,8 +6833,8 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
         
                                                                                           
         refund_amount_for_this_package = package_info.get('price_bot', 0) if package_info else 0
-        user_data["registered_users"][str(user_id)]["balance"] += refund_amount_for_this_package
-        simpan_data_ke_db()
+        kredit_saldo(user_id, refund_amount_for_this_package, "refund")
+        simpan_data_ke_db(user_id)
         context.user_data['current_hesda_batch_results'].append({
             "success": False, 
             "package_name": package_info.get('name', 'Paket Tidak Dikenali'), 
@@ -6294,7 +6853,7 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
     processing_text = f"Memproses pembelian: *{package_name}* ({current_index + 1} dari {len(packages_to_process)})"
     if status_message_id:
         try:
-            await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=processing_text, parse_mode="Markdown")
+            await status_message.perbarui(context, user_id, status_message_id, text=processing_text, parse_mode="Markdown")
         except Exception as e:
             logging.warning(f"Gagal mengedit pesan status {status_message_id} dengan '{processing_text}': {e}. Mengirim pesan baru.")
             msg = await context.bot.send_message(user_id, processing_text, parse_mode="Markdown")
@@ -6304,7 +6863,7 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
         context.user_data['hesda_batch_status_message_id'] = msg.message_id
         status_message_id = msg.message_id
 
-    access_token_hesda = user_data.get("registered_users", {}).get(str(user_id), {}).get("accounts", {}).get(phone, {}).get("hesda", {}).get("access_token")
+    access_token_hesda = account_store.token(user_id, phone, "hesda")
 
     if not access_token_hesda:
         logging.info(f"No BYPAS token found for {phone}. Initiating OTP flow for batch purchase.")
@@ -6312,18 +6871,20 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
         context.user_data['pending_hesda_batch_after_otp'] = packages_to_process[current_index:]
         context.user_data['phone_for_hesda_batch'] = phone
         context.user_data['current_login_provider'] = 'hesda'
-        context.user_data['next'] = 'handle_login_otp_input'
+        step_router.set_next(context, 'handle_login_otp_input')
         context.user_data['resume_hesda_purchase_after_otp'] = True
 
                                                                                                    
                                                                                          
-        user_data["registered_users"][str(user_id)]["balance"] += total_hesdapkg_batch_price - sum(r.get('refunded_amount', 0) for r in context.user_data['current_hesda_batch_results'] if not r['success'])
-        simpan_data_ke_db()
+        kredit_saldo(user_id, total_hesdapkg_batch_price - sum(r.get('refunded_amount', 0) for r in context.user_data['current_hesda_batch_results'] if not r['success']), "refund")
+        simpan_data_ke_db(user_id)
+        purchase_jobs.hapus(user_id, purchase_jobs.JENIS_HESDA_BATCH)
         
         await context.bot.send_message(user_id, f"❌ Token BYPAS tidak ditemukan untuk nomor `{phone}`. Silakan login ulang untuk melanjutkan pembelian batch. Saldo Anda akan dikembalikan jika tidak melanjutkan.")
 
         if status_message_id:
             try:
+                status_message.lupakan(user_id, status_message_id)
                 await context.bot.delete_message(chat_id=user_id, message_id=status_message_id)
             except Exception:
                 pass
@@ -6333,7 +6894,18 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
         return
 
                                                                                
-    purchase_result = await execute_single_purchase_hesda(update, context, user_id, current_package_id, package_name, phone, access_token_hesda, "PULSA", required_balance_for_this_package, "menu_bypass_nested")
+    purchase_result = await execute_single_purchase_hesda(update, context, user_id, current_package_id, package_name, phone, access_token_hesda, "PULSA", required_balance_for_this_package, "menu_bypass_nested",
+                                                          attempt=context.user_data.get('hesda_batch_attempt', 1))
+    if purchase_result.get('ulang_dalam'):
+        context.user_data['hesda_batch_attempt'] = purchase_result['attempt']
+        if status_message_id:
+            try:
+                await status_message.perbarui(context, user_id, status_message_id, text=f"⏳ Server sibuk, *{package_name}* dicoba lagi dalam {int(purchase_result['ulang_dalam'])} detik...", parse_mode="Markdown")
+            except Exception as e:
+                logging.warning(f"Gagal mengedit pesan status {status_message_id} dengan jeda percobaan ulang: {e}")
+        flow_scheduler.jadwalkan(context, purchase_result['ulang_dalam'], process_hesda_package_queue, update)
+        return
+    context.user_data.pop('hesda_batch_attempt', None)
     
                                                                                                 
                                                             
@@ -6355,7 +6927,7 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
 
     if status_message_id:
         try:
-            await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=result_text, parse_mode="Markdown")
+            await status_message.perbarui(context, user_id, status_message_id, text=result_text, parse_mode="Markdown")
         except Exception as e:
             logging.warning(f"Gagal mengedit pesan status {status_message_id} dengan hasil: {e}. Mengirim pesan baru.")
             msg = await context.bot.send_message(user_id, result_text, parse_mode="Markdown")
@@ -6372,7 +6944,7 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
         pause_text = "⏸️ Jeda 10 detik sebelum memproses paket berikutnya menghindari error..."
         if status_message_id:
             try:
-                await context.bot.edit_message_text(chat_id=user_id, message_id=status_message_id, text=pause_text, parse_mode="Markdown")
+                await status_message.perbarui(context, user_id, status_message_id, text=pause_text, parse_mode="Markdown")
             except Exception as e:
                 logging.warning(f"Gagal mengedit pesan status {status_message_id} dengan jeda: {e}. Mengirim pesan baru.")
                 msg = await context.bot.send_message(user_id, pause_text, parse_mode="Markdown")
@@ -6381,14 +6953,14 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
             msg = await context.bot.send_message(user_id, pause_text, parse_mode="Markdown")
             context.user_data['hesda_batch_status_message_id'] = msg.message_id
             
-        await asyncio.sleep(10)
-        asyncio.create_task(process_hesda_package_queue(update, context))
+        flow_scheduler.jadwalkan(context, 10, process_hesda_package_queue, update)
     else:
                                                      
                                                                                     
         await process_hesda_package_queue(update, context)                             
         if status_message_id:
             try:
+                status_message.lupakan(user_id, status_message_id)
                 await context.bot.delete_message(chat_id=user_id, message_id=status_message_id)
             except Exception as e:
                 logging.warning(f"Gagal menghapus pesan status terakhir {status_message_id} sebelum ringkasan: {e}")
@@ -6408,8 +6980,8 @@ async def process_hesda_package_queue(update: Update, context: ContextTypes.DEFA
         context.user_data.pop('packages_to_process_hesda_batch', None)
         context.user_data.pop('current_batch_index_hesda', None)
         context.user_data.pop('current_hesda_batch_results', None)
-        user_data[str(user_id)]["selected_hesdapkg_ids"] = []                                  
-        simpan_data_ke_db()
+        user_data["registered_users"][str(user_id)]["selected_hesdapkg_ids"] = []                                  
+        simpan_data_ke_db(user_id)
 
 async def process_30h_package_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -6440,6 +7012,7 @@ async def process_30h_package_queue(update: Update, context: ContextTypes.DEFAUL
     if not packages_to_process or current_index >= len(packages_to_process):
         if status_message_id:
             try:
+                status_message.lupakan(user_id, status_message_id)
                 await context.bot.delete_message(chat_id=user_id, message_id=status_message_id)
             except Exception as e:
                 logging.warning(f"Gagal menghapus pesan status akhir {status_message_id} untuk 30H: {e}")
@@ -6483,11 +7056,15 @@ async def process_30h_package_queue(update: Update, context: ContextTypes.DEFAUL
         context.user_data.pop('current_30h_batch_results', None)
         context.user_data.pop('total_30h_batch_price', None)
         user_data["registered_users"][str(user_id)]["selected_30h_pkg_ids"] = [] 
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
+        purchase_jobs.hapus(user_id, purchase_jobs.JENIS_30H_BATCH)
         return
 
+    dana_tertahan = sum(THIRTY_H_REGISTRY.get(pid, {}).get('price_bot', 0) for pid in packages_to_process[current_index:])
+    checkpoint_job(context, user_id, purchase_jobs.JENIS_30H_BATCH, dana_tertahan)
+
     current_package_id = packages_to_process[current_index]
-    package_info = next((p for p in THIRTY_H_PACKAGES if p["id"] == current_package_id), None)
+    package_info = THIRTY_H_REGISTRY.get(current_package_id)
 
     if not package_info:
         logging.error(f"Paket 30H dengan ID {current_package_id} tidak ditemukan dalam daftar THIRTY_H_PACKAGES. Melewatkan paket ini.")
@@ -6497,8 +7074,8 @@ async def process_30h_package_queue(update: Update, context: ContextTypes.DEFAUL
         
         refund_amount_for_this_package = package_info.get('price_bot', 0) if package_info else 0
         if refund_amount_for_this_package > 0:
-            user_data["registered_users"][str(user_id)]["balance"] += refund_amount_for_this_package
-            simpan_data_ke_db()
+            kredit_saldo(user_id, refund_amount_for_this_package, "refund")
+            simpan_data_ke_db(user_id)
         context.user_data.setdefault('current_30h_batch_results', []).append({
             "success": False, 
             "package_name": package_info.get('name', 'Paket Tidak Dikenali'), 
@@ -6517,19 +7094,17 @@ async def process_30h_package_queue(update: Update, context: ContextTypes.DEFAUL
     escaped_package_name_in_progress = escape_markdown(package_name, version=2)
     progress_message_content = f"⏳ Sedang memproses paket *{escaped_package_name_in_progress}* ({current_index + 1} dari {len(packages_to_process)}) untuk nomor {phone}..."
     try:
-        await context.bot.edit_message_text(
-            chat_id=user_id, 
-            message_id=status_message_id, 
-            text=progress_message_content, 
+        await status_message.perbarui(
+            context, user_id, status_message_id,
+            text=progress_message_content,
             parse_mode="Markdown",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⏹️ Hentikan Proses", callback_data="stop_batch_purchase")]])
         )
     except Exception as e:
-        if "message is not modified" not in str(e):
-            logging.warning(f"Gagal mengedit pesan status {status_message_id} dengan progres untuk 30H: {e}. Mengirim pesan baru.")
-            msg = await context.bot.send_message(user_id, progress_message_content, parse_mode="Markdown")
-            context.user_data['30h_batch_status_message_id'] = msg.message_id
-            status_message_id = msg.message_id 
+        logging.warning(f"Gagal mengedit pesan status {status_message_id} dengan progres untuk 30H: {e}. Mengirim pesan baru.")
+        msg = await context.bot.send_message(user_id, progress_message_content, parse_mode="Markdown")
+        context.user_data['30h_batch_status_message_id'] = msg.message_id
+        status_message_id = msg.message_id 
 
                                         
                                                                             
@@ -6541,7 +7116,7 @@ async def process_30h_package_queue(update: Update, context: ContextTypes.DEFAUL
         context.user_data['pending_30h_batch_after_otp'] = packages_to_process[current_index:]
         context.user_data['phone_for_30h_batch'] = phone
         context.user_data['current_login_provider'] = 'kmsp' 
-        context.user_data['next'] = 'handle_login_otp_input'
+        step_router.set_next(context, 'handle_login_otp_input')
         context.user_data['resume_30h_purchase_after_otp'] = True 
 
                                                                  
@@ -6551,13 +7126,15 @@ async def process_30h_package_queue(update: Update, context: ContextTypes.DEFAUL
         )
         sisa_saldo_refund = total_30h_batch_price - processed_packages_price
         if sisa_saldo_refund > 0:
-            user_data["registered_users"][str(user_id)]["balance"] += sisa_saldo_refund
-            simpan_data_ke_db()
+            kredit_saldo(user_id, sisa_saldo_refund, "refund")
+            simpan_data_ke_db(user_id)
+        purchase_jobs.hapus(user_id, purchase_jobs.JENIS_30H_BATCH)
         
         await context.bot.send_message(user_id, f"❌ Token LOGIN tidak ditemukan untuk nomor `{phone}`. Silakan login ulang untuk melanjutkan pembelian batch 30H. Saldo yang belum terpakai (Rp{sisa_saldo_refund:,}) telah dikembalikan sementara.", parse_mode="Markdown")
 
         if status_message_id:
             try:
+                status_message.lupakan(user_id, status_message_id)
                 await context.bot.delete_message(chat_id=user_id, message_id=status_message_id)
             except Exception:
                 pass
@@ -6568,8 +7145,18 @@ async def process_30h_package_queue(update: Update, context: ContextTypes.DEFAUL
 
     purchase_result = await execute_single_purchase_30h( 
         update, context, user_id, current_package_id, package_name, phone, access_token_kmsp, 
-        "BALANCE", required_balance_for_this_package, "menu_30h_nested" 
+        "BALANCE", required_balance_for_this_package, "menu_30h_nested",
+        attempt=context.user_data.get('30h_batch_attempt', 1)
     )
+    if purchase_result.get('ulang_dalam'):
+        context.user_data['30h_batch_attempt'] = purchase_result['attempt']
+        try:
+            await status_message.perbarui(context, user_id, status_message_id, text=f"⏳ Server sibuk, *{escaped_package_name_in_progress}* dicoba lagi dalam {int(purchase_result['ulang_dalam'])} detik...", parse_mode="Markdown")
+        except Exception as e:
+            logging.warning(f"Gagal mengedit pesan status {status_message_id} dengan jeda percobaan ulang untuk 30H: {e}")
+        flow_scheduler.jadwalkan(context, purchase_result['ulang_dalam'], process_30h_package_queue, update)
+        return
+    context.user_data.pop('30h_batch_attempt', None)
     
     context.user_data.setdefault('current_30h_batch_results', []).append(purchase_result)
 
@@ -6577,45 +7164,20 @@ async def process_30h_package_queue(update: Update, context: ContextTypes.DEFAUL
     
     if context.user_data.get('current_batch_index_30h') < len(packages_to_process):
         pause_text_duration = 10
-        await asyncio.sleep(pause_text_duration) 
-
-        asyncio.create_task(process_30h_package_queue(update, context))
+        flow_scheduler.jadwalkan(context, pause_text_duration, process_30h_package_queue, update)
     else:
         await process_30h_package_queue(update, context)
 
 async def execute_single_purchase(update, context, user_id, package_code, phone, access_token, payment_method, deducted_balance, return_menu_callback_data, provider="kmsp", attempt=1, package_name_for_display=None):
-    url = ""
     package_name_display = package_name_for_display if package_name_for_display else ""
 
-    api_price_or_fee = 0
-
-    if package_code == XC1PLUS1GB_DANA_CODE:
-        api_price_or_fee = 2500
-    elif package_code == XC1PLUS1GB_PULSA_CODE:
-        api_price_or_fee = 2500
-    elif package_code == "XLUNLITURBOVIDIO_DANA":
-        api_price_or_fee = 1500
-    elif package_code == XUTS_PACKAGE_CODE:
-        api_price_or_fee = 0
-    else:
-        all_api_packages = context.user_data.get('all_api_packages', [])
-        found_api_package_info = next((p for p in all_api_packages if p.get("package_code") == package_code), None)
-        if found_api_package_info:
-            api_harga_str = found_api_package_info.get("package_harga", "Rp. 0,00")
-            cleaned_harga_str = api_harga_str.replace("Rp. ", "").replace(".", "").replace(",", "")
-            try:
-                api_price_or_fee = int(float(cleaned_harga_str))
-            except ValueError:
-                api_price_or_fee = 0
-        else:
-            api_price_or_fee = 0
+    api_price_or_fee = get_api_price_or_fee(package_code)
 
     if provider == "kmsp":
-        url = f"https://golang-openapi-packagepurchase-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}&package_code={package_code}&phone={phone}&access_token={access_token}&payment_method={payment_method}&price_or_fee={api_price_or_fee}"
         
         if not package_name_for_display:
             if return_menu_callback_data == 'xcp_addon_dana':
-                package_info = next((p for p in ADD_ON_SEQUENCE if p["code"] == package_code), None)
+                package_info = ADD_ON_REGISTRY.get(package_code)
                 package_name_display = package_info['name'] if package_info else package_code
             elif return_menu_callback_data == 'xcp_addon':
                 package_name_display = XCP_8GB_PACKAGE['name'] if package_code == XCP_8GB_PACKAGE['code'] else package_code
@@ -6639,24 +7201,18 @@ async def execute_single_purchase(update, context, user_id, package_code, phone,
     else:
         await context.bot.send_message(user_id, "Terjadi kesalahan internal. Provider API tidak dikenali.", parse_mode="Markdown")
         if deducted_balance > 0:
-            user_data["registered_users"][str(user_id)]["balance"] += deducted_balance
-            simpan_data_ke_db()
+            kredit_saldo(user_id, deducted_balance, "refund")
+            simpan_data_ke_db(user_id)
         return
 
     status_msg = await context.bot.send_message(user_id, f"Memproses pembelian *{package_name_display}* dari LOGIN...\nProses ini dapat memakan waktu hingga 60 detik. Harap tunggu.", parse_mode="Markdown")
-    loop = asyncio.get_running_loop()
 
     transaction_time = datetime.now()
     transaction_time_str = transaction_time.strftime('%Y-%m-%d %H:%M:%S')
 
     try:
-        def blocking_api_call():
-            return requests.get(url, timeout=58)
-
-        response = await asyncio.wait_for(
-            loop.run_in_executor(None, blocking_api_call),
-            timeout=60.0
-        )
+        response = await retry_engine.jalankan("kmsp", lambda attempt: provider_client.kmsp_purchase(KMSP_API_KEY, package_code, phone, access_token, payment_method,
+                                                                                                     price_or_fee=api_price_or_fee, prioritas=purchase_queue.PRIORITAS_SINGLE))
 
         try:
             await status_msg.delete()
@@ -6666,15 +7222,14 @@ async def execute_single_purchase(update, context, user_id, package_code, phone,
         response.raise_for_status()
         result = response.json()
 
-        if isinstance(result, list): result = result[0] if result else {}
+        result = provider_client.normalisasi_respons(result)
 
         api_message = result.get('message', '')
         api_status = result.get('status', False)
         api_code = result.get('code', '')
 
         if package_code == "XLUNLITURBOSUPERXC_PULSA":
-            SUCCESS_422_MESSAGE = "Error Message: 422 -> Failed call ipaas purchase, with status code:422 : null"
-            if SUCCESS_422_MESSAGE in api_message:
+            if provider_client.is_sukses_422(api_message):
                 logging.info(f"Pembelian XUTS PULSA untuk {phone} dianggap SUKSES karena respons 422 spesifik: '{api_message}'")
                 text = (
                     f"✅ *NOMOR KAMU SUPORT XUTS* ✅\n"
@@ -6684,12 +7239,12 @@ async def execute_single_purchase(update, context, user_id, package_code, phone,
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 await context.bot.send_message(user_id, text, parse_mode="Markdown", reply_markup=reply_markup)
 
-                user_data["registered_users"][str(user_id)]["transactions"].append({
+                catat_transaksi(user_id, {
                     "type": f"Pembelian Paket (LOGIN - XUTS Sukses 422)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
                     "amount": -deducted_balance, "timestamp": transaction_time_str, "status": "Berhasil (422)",
                     "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
                 })
-                simpan_data_ke_db()
+                simpan_data_ke_db(user_id)
 
                 user_info = user_data["registered_users"][str(user_id)]
                 user_first_name = user_info.get("first_name", "N/A")
@@ -6714,13 +7269,13 @@ async def execute_single_purchase(update, context, user_id, package_code, phone,
                 logging.info(f"Pembelian XUTS PULSA untuk {phone} dianggap GAGAL meskipun status API: {api_status}, pesan: '{api_message}'. Memaksa error.")
                 
                 if deducted_balance > 0:
-                    user_data["registered_users"][str(user_id)]["balance"] += deducted_balance
-                    user_data["registered_users"][str(user_id)]["transactions"].append({
+                    kredit_saldo(user_id, deducted_balance, "refund")
+                    catat_transaksi(user_id, {
                         "type": f"Pembelian Gagal (LOGIN - XUTS Refund)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
                         "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Gagal (Refund)",
                         "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
                     })
-                    simpan_data_ke_db()
+                    simpan_data_ke_db(user_id)
                     
                     user_info = user_data["registered_users"][str(user_id)]
                     user_first_name = user_info.get("first_name", "N/A")
@@ -6824,12 +7379,12 @@ async def execute_single_purchase(update, context, user_id, package_code, phone,
             reply_markup = InlineKeyboardMarkup(keyboard)
             await context.bot.send_message(user_id, text, parse_mode="Markdown", reply_markup=reply_markup)
 
-        user_data["registered_users"][str(user_id)]["transactions"].append({
+        catat_transaksi(user_id, {
             "type": f"Pembelian Paket (LOGIN)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
             "amount": -deducted_balance, "timestamp": transaction_time_str, "status": "Berhasil",
             "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
         })
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
 
         user_info = user_data["registered_users"][str(user_id)]
         user_first_name = user_info.get("first_name", "N/A")
@@ -6876,7 +7431,7 @@ async def execute_single_purchase(update, context, user_id, package_code, phone,
                                                                                
         if isinstance(e, ValueError) and TOKEN_EXPIRED_MESSAGE in str(e):
             is_token_error = True
-        elif isinstance(e, requests.exceptions.HTTPError):
+        elif isinstance(e, httpx.HTTPStatusError):
             try:
                 error_msg_from_api = e.response.json().get("message", "")
                 if TOKEN_EXPIRED_MESSAGE in error_msg_from_api:
@@ -6892,13 +7447,13 @@ async def execute_single_purchase(update, context, user_id, package_code, phone,
             )
                                    
         
-        elif isinstance(e, asyncio.TimeoutError) or isinstance(e, requests.exceptions.ReadTimeout):
+        elif isinstance(e, asyncio.TimeoutError) or isinstance(e, httpx.ReadTimeout):
             user_facing_error = "Server tidak merespon dalam 60 detik (Timeout). Silakan coba lagi."
             admin_facing_error = "Request timed out after 60 seconds"
-        elif isinstance(e, requests.exceptions.ConnectTimeout):
+        elif isinstance(e, httpx.ConnectTimeout):
             user_facing_error = "Tidak dapat terhubung ke server (Connection Timeout)."
             admin_facing_error = "Connection timed out"
-        elif isinstance(e, requests.exceptions.HTTPError):
+        elif isinstance(e, httpx.HTTPStatusError):
             try:
                                                                 
                 error_msg_from_api = e.response.json().get("message", "Terjadi kesalahan HTTP.")
@@ -6918,13 +7473,13 @@ async def execute_single_purchase(update, context, user_id, package_code, phone,
         final_user_error_message = f"❌ Gagal melakukan pembelian *{escaped_package_name_display}* dari LOGIN.\n*Pesan Error:*\n`{escaped_user_facing_error}`"
 
         if deducted_balance > 0:
-            user_data["registered_users"][str(user_id)]["balance"] += deducted_balance
-            user_data["registered_users"][str(user_id)]["transactions"].append({
+            kredit_saldo(user_id, deducted_balance, "refund")
+            catat_transaksi(user_id, {
                 "type": f"Pembelian Gagal (LOGIN) (Refund)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
                 "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Gagal",
                 "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
             })
-            simpan_data_ke_db()
+            simpan_data_ke_db(user_id)
             final_user_error_message += f"\n💰 Saldo Anda sebesar *Rp{deducted_balance:,}* telah dikembalikan."
 
         retry_data_key = uuid.uuid4().hex[:10]
@@ -6952,8 +7507,22 @@ async def execute_single_purchase(update, context, user_id, package_code, phone,
                          f"Error: `{error_type}` - `{escaped_admin_facing_error}` (Saldo direfund)")
         await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown")
 
-async def execute_single_purchase_hesda(update, context, user_id, package_id, package_name, phone, access_token, payment_method, deducted_balance, return_menu_callback_data, attempt=1):
-    url = "https://api.hesda-store.com/v2/beli/otp"
+async def pembelian_hesda_tunggal(update, context, user_id, package_id, package_name, phone, access_token, payment_method, deducted_balance, return_menu_callback_data, attempt=1):
+    """Pembelian BYPAS satuan; percobaan ulang error transien dijadwalkan lewat flow_scheduler, bukan ditunggu di dalam task."""
+    hasil = await execute_single_purchase_hesda(update, context, user_id, package_id, package_name, phone, access_token, payment_method, deducted_balance,
+                                                return_menu_callback_data, attempt=attempt, prioritas=purchase_queue.PRIORITAS_SINGLE)
+    if hasil.get("ulang_dalam"):
+        flow_scheduler.jadwalkan_panggilan(context, hasil["ulang_dalam"], pembelian_hesda_tunggal, user_id, {
+            "user_id": user_id, "package_id": package_id, "package_name": package_name, "phone": phone, "access_token": access_token,
+            "payment_method": payment_method, "deducted_balance": deducted_balance, "return_menu_callback_data": return_menu_callback_data,
+            "attempt": hasil["attempt"],
+        })
+    return hasil
+
+async def execute_single_purchase_hesda(update, context, user_id, package_id, package_name, phone, access_token, payment_method, deducted_balance, return_menu_callback_data, attempt=1, prioritas=purchase_queue.PRIORITAS_BATCH,
+                                        kebijakan=retry_engine.RETRY_HESDA):
+    """Satu percobaan pembelian BYPAS. Jika error transien masih boleh diulang menurut kebijakan, saldo tidak direfund dan
+    hasilnya membawa "ulang_dalam" (detik) & "attempt" berikutnya; pemanggil menjadwalkan ulang lewat flow_scheduler."""
     headers = get_hesda_auth_headers()
     if not headers:
         return {"success": False, "package_name": package_name, "error_message": "Informasi otentikasi tidak lengkap. Hubungi admin.", "refunded_amount": deducted_balance, "status_message": "Gagal (Auth Error)"}
@@ -6972,22 +7541,19 @@ async def execute_single_purchase_hesda(update, context, user_id, package_id, pa
     transaction_time_str = transaction_time.strftime('%Y-%m-%d %H:%M:%S')
 
     raw_api_response = {}
+    percobaan_terakhir = attempt
 
-    try:
-        def blocking_api_call():
-            return requests.post(url, headers=headers, data=payload, timeout=58)
-
-        response = await asyncio.wait_for(
-            asyncio.get_running_loop().run_in_executor(None, blocking_api_call),
-            timeout=60.0 
-        )
+    async def coba(attempt):
+        nonlocal raw_api_response, percobaan_terakhir
+        percobaan_terakhir = attempt
+        response = await provider_client.hesda_beli(headers, payload, prioritas=prioritas)
         
         raw_api_response = response.json()
 
                                                                       
         if response.status_code == 422:
             error_message_from_api = raw_api_response.get('message', '')
-            if "Error Message: 422 -> Failed call ipaas purchase, with status code:422 : null" in error_message_from_api:
+            if provider_client.is_sukses_422(error_message_from_api):
                 logging.info(f"Pembelian BYPAS untuk {package_name} di {phone} dianggap SUKSES meskipun respons API 422 dengan pesan tertentu. (Percobaan {attempt})")
                 result = raw_api_response
             else:
@@ -6997,44 +7563,21 @@ async def execute_single_purchase_hesda(update, context, user_id, package_id, pa
             response.raise_for_status() 
             result = raw_api_response
 
-        if isinstance(result, list): result = result[0] if result else {}
+        result = provider_client.normalisasi_respons(result)
         
-        if not result.get('status', True) and not ("Error Message: 422 -> Failed call ipaas purchase, with status code:422 : null" in result.get('message', '')):
+        if not result.get('status', True) and not provider_client.is_sukses_422(result.get('message', '')):
             raise ValueError(result.get('message', 'API BYPAS mengembalikan status gagal atau respons tidak jelas.'))
+        return result
 
-                                                                      
-                                                                     
-                                                      
-
-        user_data["registered_users"][str(user_id)]["transactions"].append({
-            "type": "Pembelian Paket (BYPAS)", "package_id": package_id, "package_name": package_name, "phone": phone,
-            "amount": -deducted_balance, "timestamp": transaction_time_str, "status": "Berhasil",
-            "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
-        })
-        simpan_data_ke_db()
-        
-        user_info = user_data["registered_users"][str(user_id)]
-        user_first_name = user_info.get("first_name", "N/A")
-        user_username = user_info.get("username", "N/A")
-        remaining_balance = user_info.get("balance", 0)                                             
-
-        admin_message = (
-            f"✅ *BYPAS BERHASIL!* ✅\n"
-            f"User ID: `{user_id}`\n"
-            f" (`{user_first_name}` / `@{user_username}`)\n"
-            f"Nomor HP: `{phone}`\n"
-            f"ID Paket: `{package_id}`\n"
-            f"Nama Paket: `{package_name}`\n" 
-            f"Saldo Diproses: `Rp{deducted_balance:,}`\n"                                      
-            f"Sisa Saldo: `Rp{remaining_balance:,}`\n"
-            f"Waktu Transaksi: `{transaction_time_str}`"
-        )
-        
-        await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown")
-        
-        return {"success": True, "package_name": package_name, "error_message": None, "refunded_amount": 0, "status_message": "Berhasil"}
-
+    try:
+        await retry_engine.jalankan("hesda", coba, attempt_awal=attempt, label=f"Pembelian BYPAS {package_name} user {user_id}")
     except Exception as e:
+        attempt = percobaan_terakhir
+        jeda = retry_engine.jeda_ulang(e, kebijakan, attempt)
+        if jeda is not None:
+            logging.info(f"Pembelian BYPAS {package_name} user {user_id}: percobaan {attempt} gagal ({e}), dijadwalkan ulang dalam {jeda:.1f} detik.")
+            return {"success": False, "package_name": package_name, "error_message": str(e), "refunded_amount": 0,
+                    "status_message": "Menunggu percobaan ulang", "ulang_dalam": jeda, "attempt": attempt + 1}
         error_type = type(e).__name__
         user_facing_error = "Terjadi kesalahan yang tidak terduga."
         admin_facing_error = str(e)
@@ -7045,7 +7588,7 @@ async def execute_single_purchase_hesda(update, context, user_id, package_id, pa
 
         if isinstance(e, ValueError) and TOKEN_EXPIRED_MESSAGE in str(e):
             is_token_error = True
-        elif isinstance(e, requests.exceptions.HTTPError):
+        elif isinstance(e, httpx.HTTPStatusError):
             try:
                 error_msg_from_api = e.response.json().get("message", "")
                 if TOKEN_EXPIRED_MESSAGE in error_msg_from_api:
@@ -7055,13 +7598,13 @@ async def execute_single_purchase_hesda(update, context, user_id, package_id, pa
                 pass
                                    
 
-        if isinstance(e, asyncio.TimeoutError) or isinstance(e, requests.exceptions.ReadTimeout):
+        if isinstance(e, asyncio.TimeoutError) or isinstance(e, httpx.ReadTimeout):
             user_facing_error = "Waktu tunggu habis. Server tidak merespon dalam 60 detik (Timeout). Silakan coba lagi."
             admin_facing_error = "Request timed out after 60 seconds (Hesda API)"
-        elif isinstance(e, requests.exceptions.ConnectTimeout):
+        elif isinstance(e, httpx.ConnectTimeout):
             user_facing_error = "Gagal terhubung. Tidak dapat terhubung ke server (Connection Timeout)."
             admin_facing_error = "Connection timed out (Hesda API)"
-        elif isinstance(e, requests.exceptions.HTTPError) and not is_token_error:
+        elif isinstance(e, httpx.HTTPStatusError) and not is_token_error:
             try:
                 response_json = e.response.json()
                 user_facing_error = f"Pesan dari server: {response_json.get('message', 'Terjadi kesalahan HTTP.')}"
@@ -7074,16 +7617,11 @@ async def execute_single_purchase_hesda(update, context, user_id, package_id, pa
             admin_facing_error = str(e)
         
         logging.error(f"Pembelian Hesda gagal untuk user {user_id}, paket {package_id}. Error: {str(e)}")
+        if retry_engine.klasifikasi(e) == retry_engine.PENDING:
+            admin_facing_error += " | Status pembelian tidak pasti (request terkirim tapi tidak terjawab), tidak dicoba ulang. Cek manual ke provider."
         logging.error(traceback.format_exc())
 
-        MAX_RETRIES = 3
-        RETRY_DELAY = 10
-
                                                  
-        is_general_token_error = "access token is invalid" in admin_facing_error.lower() or \
-                                 "token invalid" in admin_facing_error.lower() or \
-                                 "token expired" in admin_facing_error.lower() or \
-                                 "gagal login" in admin_facing_error.lower()
 
                                                                     
         if is_token_error:
@@ -7093,50 +7631,77 @@ async def execute_single_purchase_hesda(update, context, user_id, package_id, pa
             )
 
                                                                                       
-        if attempt < MAX_RETRIES and not is_token_error and not is_general_token_error:
-            logging.info(f"Mencoba lagi pembelian BYPAS untuk {package_name} (percobaan {attempt + 1})... Menunda {RETRY_DELAY} detik.")
-            await asyncio.sleep(RETRY_DELAY)
-            return await execute_single_purchase_hesda(update, context, user_id, package_id, package_name, phone, access_token, payment_method, deducted_balance, return_menu_callback_data, attempt + 1)
-        else:
-                                                                                        
-            user_data["registered_users"][str(user_id)]["balance"] += deducted_balance
-            user_data["registered_users"][str(user_id)]["transactions"].append({
-                "type": "Pembelian Gagal (BYPAS) (Refund)", "package_id": package_id, "package_name": package_name, "phone": phone,
-                "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Gagal (Refund)",
-                "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
-            })
-            simpan_data_ke_db()
-            logging.info(f"Saldo user {user_id} dikembalikan {deducted_balance} karena kegagalan pembelian BYPAS (maksimal percobaan atau error token).")
-        
-            admin_message = (f"❌ *PEMBELIAN GAGAL (BYPAS)!* ❌\n"
-                             f"User ID: `{user_id}`\nNomor HP: `{phone}`\nID Paket: `{package_id}`\n"
-                             f"({package_name})\n"
-                             f"Error: `{error_type}` - `{admin_facing_error}` (Saldo direfund)\n"
-                             f"Total Percobaan: `{attempt}`")
-                                                           
-            unique_key = uuid.uuid4().hex
-            context.bot_data[f" Bethesda_API_Response_Data_{unique_key}"] = json.dumps(raw_api_response, indent=2)
-            admin_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("📄 Lihat Respon API", callback_data=f" Bethesda_api_res_{unique_key}")]])
-            await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown", reply_markup=admin_keyboard)
+                                                                                    
+        kredit_saldo(user_id, deducted_balance, "refund")
+        catat_transaksi(user_id, {
+            "type": "Pembelian Gagal (BYPAS) (Refund)", "package_id": package_id, "package_name": package_name, "phone": phone,
+            "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Gagal (Refund)",
+            "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
+        })
+        simpan_data_ke_db(user_id)
+        logging.info(f"Saldo user {user_id} dikembalikan {deducted_balance} karena kegagalan pembelian BYPAS (maksimal percobaan atau error token).")
+    
+        admin_message = (f"❌ *PEMBELIAN GAGAL (BYPAS)!* ❌\n"
+                         f"User ID: `{user_id}`\nNomor HP: `{phone}`\nID Paket: `{package_id}`\n"
+                         f"({package_name})\n"
+                         f"Error: `{error_type}` - `{admin_facing_error}` (Saldo direfund)\n"
+                         f"Total Percobaan: `{attempt}`")
+                                                       
+        unique_key = uuid.uuid4().hex
+        context.bot_data[f" Bethesda_API_Response_Data_{unique_key}"] = json.dumps(raw_api_response, indent=2)
+        admin_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("📄 Lihat Respon API", callback_data=f" Bethesda_api_res_{unique_key}")]])
+        await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown", reply_markup=admin_keyboard)
 
-            return {"success": False, "package_name": package_name, "error_message": user_facing_error, "refunded_amount": deducted_balance, "status_message": "Gagal"}
+        return {"success": False, "package_name": package_name, "error_message": user_facing_error, "refunded_amount": deducted_balance, "status_message": "Gagal"}
+
+    # Pencatatan sukses di luar coba(): error setelah pembelian berhasil tidak boleh memicu pembelian ulang.
+    catat_transaksi(user_id, {
+        "type": "Pembelian Paket (BYPAS)", "package_id": package_id, "package_name": package_name, "phone": phone,
+        "amount": -deducted_balance, "timestamp": transaction_time_str, "status": "Berhasil",
+        "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
+    })
+    simpan_data_ke_db(user_id)
+    
+    user_info = user_data["registered_users"][str(user_id)]
+    user_first_name = user_info.get("first_name", "N/A")
+    user_username = user_info.get("username", "N/A")
+    remaining_balance = user_info.get("balance", 0)                                             
+
+    admin_message = (
+        f"✅ *BYPAS BERHASIL!* ✅\n"
+        f"User ID: `{user_id}`\n"
+        f" (`{user_first_name}` / `@{user_username}`)\n"
+        f"Nomor HP: `{phone}`\n"
+        f"ID Paket: `{package_id}`\n"
+        f"Nama Paket: `{package_name}`\n" 
+        f"Saldo Diproses: `Rp{deducted_balance:,}`\n"                                      
+        f"Sisa Saldo: `Rp{remaining_balance:,}`\n"
+        f"Waktu Transaksi: `{transaction_time_str}`"
+    )
+    
+    try:
+        await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown")
+    except Exception as e:
+        logging.warning(f"Gagal mengirim notifikasi BYPAS berhasil ke admin untuk user {user_id}: {e}")
+    
+    return {"success": True, "package_name": package_name, "error_message": None, "refunded_amount": 0, "status_message": "Berhasil"}
 
-async def execute_single_purchase_30h(update, context, user_id, package_code, package_name_display, phone, access_token, payment_method, deducted_balance, return_menu_callback_data, attempt=1):
-    url = f"https://golang-openapi-packagepurchase-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}&package_code={package_code}&phone={phone}&access_token={access_token}&payment_method={payment_method}&price_or_fee=0"
+async def execute_single_purchase_30h(update, context, user_id, package_code, package_name_display, phone, access_token, payment_method, deducted_balance, return_menu_callback_data, attempt=1, prioritas=purchase_queue.PRIORITAS_BATCH,
+                                      kebijakan=retry_engine.RETRY_30H):
+    """Satu percobaan pembelian 30H; error transien yang masih boleh diulang dikembalikan sebagai "ulang_dalam"
+    tanpa refund, seperti execute_single_purchase_hesda."""
     
     transaction_time = datetime.now()
     transaction_time_str = transaction_time.strftime('%Y-%m-%d %H:%M:%S')
 
-    raw_api_response_content = None 
-    
-    try:
-        def blocking_api_call():
-            return requests.get(url, timeout=58)
+    raw_api_response_content = None
+    percobaan_terakhir = attempt
 
-        response = await asyncio.wait_for(
-            asyncio.get_running_loop().run_in_executor(None, blocking_api_call),
-            timeout=60.0 
-        )
+    async def coba(attempt):
+        nonlocal raw_api_response_content, percobaan_terakhir
+        percobaan_terakhir = attempt
+        response = await provider_client.kmsp_purchase(KMSP_API_KEY, package_code, phone, access_token, payment_method, price_or_fee=0,
+                                                       prioritas=prioritas)
         
         raw_api_response_content = response.text 
         
@@ -7145,11 +7710,7 @@ async def execute_single_purchase_30h(update, context, user_id, package_code, pa
         api_status = False 
 
         try:
-            parsed_json = response.json()
-            if isinstance(parsed_json, list):
-                result = parsed_json[0] if parsed_json else {}
-            else:
-                result = parsed_json
+            result = provider_client.normalisasi_respons(response.json())
             
             api_message = result.get('message', '').strip().replace('\r', '').replace('\n', '')
             api_status = result.get('status', False) 
@@ -7158,103 +7719,29 @@ async def execute_single_purchase_30h(update, context, user_id, package_code, pa
             api_message = f"Invalid JSON response or non-JSON content: {raw_api_response_content[:100]}...".strip().replace('\r', '').replace('\n', '')
             api_status = False 
 
-        EXPECTED_SUCCESS_MESSAGE_CONTAINING_422 = "Error Message: 422 -> Failed call ipaas purchase, with status code:422 : null,".strip().replace('\r', '').replace('\n', '')
-        EXPECTED_PENDING_MESSAGE_MYXL = "Paket berhasil dibeli. Silakan cek kuotanya via aplikasi MyXL (disarankan) dan/atau via SMS kamu".strip().replace('\r', '').replace('\n', '')
-
 
-        if response.status_code == 200 and EXPECTED_SUCCESS_MESSAGE_CONTAINING_422 in api_message:
+        if response.status_code == 200 and provider_client.is_sukses_422(api_message):
             logging.info(f"Pembelian 30H (KMSP) untuk {phone} ({package_name_display}) dianggap SUKSES karena respons HTTP 200 dengan pesan 422 spesifik. (Percobaan {attempt})")
-            
-            user_data["registered_users"][str(user_id)]["transactions"].append({
-                "type": f"Pembelian Paket (LOGIN - 30H Sukses 200_dengan_422_message)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
-                "amount": -deducted_balance, "timestamp": transaction_time_str, "status": "Berhasil (200_dengan_422_message)",
-                "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
-            })
-            simpan_data_ke_db()
-
-            user_info = user_data["registered_users"][str(user_id)]
-            user_first_name = user_info.get("first_name", "N/A")
-            user_username = user_info.get("username", "N/A")
-            remaining_balance = user_info.get("balance", 0)
-
-            admin_message = (
-                f"✅ *PEMBELIAN 30H BERHASIL (LOGIN - Khusus 200 dengan Pesan 422)!* ✅\n"
-                f"User ID: `{user_id}`\n"
-                f" (`{escape_markdown(user_first_name, version=2)}` / `@{escape_markdown(user_username, version=2)}`)\n"
-                f"Nomor HP: `{phone}`\n"
-                f"Kode Paket: `{package_code}`\n"
-                f" ({escape_markdown(package_name_display, version=2)})\n"
-                f"Metode Pembayaran: `{payment_method}`\n"
-                f"Saldo Dipotong: `Rp{deducted_balance:,}`\n"
-                f"Sisa Saldo: `Rp{remaining_balance:,}`\n"
-                f"Waktu Transaksi: `{transaction_time_str}`"
-            )
-            await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown")
-            
-            return {"success": True, "package_name": package_name_display, "error_message": None, "refunded_amount": 0, "status_message": "Berhasil (200_dengan_422_message)"}
-        
-        elif response.status_code == 200 and EXPECTED_PENDING_MESSAGE_MYXL in api_message:
+            return "sukses_422", api_message
+        if response.status_code == 200 and provider_client.is_sukses_myxl(api_message):
             logging.info(f"Pembelian 30H (KMSP) untuk {phone} ({package_name_display}) dianggap PENDING karena respon 200 dgn pesan MyXL, perlu jeda & retry. (Percobaan {attempt})")
-            
-                                                          
-            user_data["registered_users"][str(user_id)]["balance"] += deducted_balance
-            user_data["registered_users"][str(user_id)]["transactions"].append({
-                "type": f"Pembelian Paket (LOGIN - 30H Pending Retry) (Refund)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
-                "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Pending (Refund)", 
-                "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
-            })
-            simpan_data_ke_db()
-            logging.info(f"Saldo user {user_id} dikembalikan Rp{deducted_balance} karena 30H pending (MyXL message).")
-
-            user_info = user_data["registered_users"][str(user_id)]
-            admin_message = (
-                f"⚠️ *PEMBELIAN 30H PENDING (LOGIN)!* ⚠️\n"
-                f"User ID: `{user_id}` (`{escape_markdown(user_info.get('first_name', 'N/A'), version=2)}` / `@{escape_markdown(user_info.get('username', 'N/A'), version=2)}`)\n"
-                f"Nomor HP: `{phone}`\n"
-                f"Kode Paket: `{package_code}`\n"
-                f" ({escape_markdown(package_name_display, version=2)})\n"
-                f"Metode Pembayaran: `{payment_method}`\n"
-                f"Saldo Dipotong Awal: `Rp{deducted_balance:,}` (SUDAH DIREFUND)\n"
-                f"Sisa Saldo: `Rp{user_info.get('balance', 0):,}`\n"
-                f"Waktu Transaksi: `{transaction_time_str}`\n"
-                f"Pesan API: `{escape_markdown(api_message, version=2)}`"
-            )
-            await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown")
-
-            return {"success": False, "package_name": package_name_display, "error_message": "PROSES BERHASIL", "refunded_amount": deducted_balance, "status_message": "Pending (Retry)", "specific_action": "countdown_retry"}
-
-        else:
-            response.raise_for_status()
-            
-            if not api_status: 
-                raise ValueError(api_message or f'API LOGIN mengembalikan status false untuk {package_code} (tidak dikenal sebagai sukses).')
-            
-            logging.info(f"Pembelian 30H (KMSP) untuk {phone} ({package_name_display}) berhasil diproses dengan respons status TRUE.")
-            user_data["registered_users"][str(user_id)]["transactions"].append({
-                "type": f"Pembelian Paket (LOGIN - 30H)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
-                "amount": -deducted_balance, "timestamp": transaction_time_str, "status": "Berhasil",
-                "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
-            })
-            simpan_data_ke_db()
-
-            user_info = user_data["registered_users"][str(user_id)]
-            admin_message = (
-                f"✅ *PEMBELIAN 30H BERHASIL (LOGIN)!* ✅\n"
-                f"User ID: `{user_id}`\n"
-                f" (`{escape_markdown(user_info.get('first_name', 'N/A'), version=2)}` / `@{escape_markdown(user_info.get('username', 'N/A'), version=2)}`)\n"
-                f"Nomor HP: `{phone}`\n"
-                f"Kode Paket: `{package_code}`\n"
-                f" ({escape_markdown(package_name_display, version=2)})\n"
-                f"Metode Pembayaran: `{payment_method}`\n"
-                f"Saldo Dipotong: `Rp{deducted_balance:,}`\n"
-                f"Sisa Saldo: `Rp{user_info.get('balance', 0):,}`\n"
-                f"Waktu Transaksi: `{transaction_time_str}`"
-            )
-            await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown")
-
-            return {"success": True, "package_name": package_name_display, "error_message": None, "refunded_amount": 0, "status_message": "Berhasil"}
+            return "pending_myxl", api_message
+        response.raise_for_status()
+        
+        if not api_status: 
+            raise ValueError(api_message or f'API LOGIN mengembalikan status false untuk {package_code} (tidak dikenal sebagai sukses).')
+        return "sukses", api_message
 
+    try:
+        jenis_hasil, api_message = await retry_engine.jalankan("kmsp", coba, attempt_awal=attempt,
+                                                               label=f"Pembelian 30H {package_name_display} user {user_id}")
     except Exception as e:
+        attempt = percobaan_terakhir
+        jeda = retry_engine.jeda_ulang(e, kebijakan, attempt)
+        if jeda is not None:
+            logging.info(f"Pembelian 30H {package_name_display} user {user_id}: percobaan {attempt} gagal ({e}), dijadwalkan ulang dalam {jeda:.1f} detik.")
+            return {"success": False, "package_name": package_name_display, "error_message": str(e), "refunded_amount": 0,
+                    "status_message": "Menunggu percobaan ulang", "ulang_dalam": jeda, "attempt": attempt + 1}
         error_type = type(e).__name__
         user_facing_error = "Terjadi kesalahan yang tidak terduga."
         admin_facing_error = str(e)
@@ -7265,7 +7752,7 @@ async def execute_single_purchase_30h(update, context, user_id, package_code, pa
         
         if isinstance(e, ValueError) and TOKEN_EXPIRED_MESSAGE in str(e):
             is_token_error = True
-        elif isinstance(e, requests.exceptions.HTTPError):
+        elif isinstance(e, httpx.HTTPStatusError):
             try:
                 error_msg_from_api = e.response.json().get("message", "")
                 if TOKEN_EXPIRED_MESSAGE in error_msg_from_api:
@@ -7280,13 +7767,13 @@ async def execute_single_purchase_30h(update, context, user_id, package_code, pa
                 "⚠️ *TOKEN LOGIN ANDA KADALUWARSA* ⚠️\n"
                 "Kemungkinan saat maintenance XL merefresh token login. Coba login ulang."
             )
-        elif isinstance(e, asyncio.TimeoutError) or isinstance(e, requests.exceptions.ReadTimeout):
+        elif isinstance(e, asyncio.TimeoutError) or isinstance(e, httpx.ReadTimeout):
             user_facing_error = "Waktu tunggu habis. Server tidak merespon dalam 60 detik (Timeout). Silakan coba lagi."
             admin_facing_error = "Request timed out after 60 seconds (KMSP API - 30H)"
-        elif isinstance(e, requests.exceptions.ConnectTimeout):
+        elif isinstance(e, httpx.ConnectTimeout):
             user_facing_error = "Gagal terhubung. Tidak dapat terhubung ke server (Connection Timeout)."
             admin_facing_error = "Connection timed out (KMSP API - 30H)"
-        elif isinstance(e, requests.exceptions.HTTPError):
+        elif isinstance(e, httpx.HTTPStatusError):
             try:
                 if e.response and e.response.content:
                     response_json_content = {}
@@ -7308,88 +7795,151 @@ async def execute_single_purchase_30h(update, context, user_id, package_code, pa
             admin_facing_error = str(e)
         
         logging.error(f"Pembelian 30H (KMSP) gagal untuk user {user_id}, paket {package_code}. Error: {str(e)}")
+        if retry_engine.klasifikasi(e) == retry_engine.PENDING:
+            admin_facing_error += " | Status pembelian tidak pasti (request terkirim tapi tidak terjawab), tidak dicoba ulang. Cek manual ke provider."
         logging.error(traceback.format_exc())
 
-        MAX_RETRIES = 10
-        RETRY_DELAY = 11
 
-        is_general_token_error = "access token is invalid" in admin_facing_error.lower() or \
-                                 "token invalid" in admin_facing_error.lower() or \
-                                 "token expired" in admin_facing_error.lower() or \
-                                 "gagal login" in admin_facing_error.lower()
+                                                                               
+        kredit_saldo(user_id, deducted_balance, "refund")
+        catat_transaksi(user_id, {
+            "type": "Pembelian Gagal (LOGIN - 30H) (Refund)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
+            "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Gagal (Refund)",
+            "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
+        })
+        simpan_data_ke_db(user_id)
+        logging.info(f"Saldo user {user_id} dikembalikan {deducted_balance} karena kegagalan pembelian 30H (maksimal percobaan atau error token).")
+    
+        admin_message = (f"❌ *PEMBELIAN 30H GAGAL (LOGIN)!* ❌\n"
+                         f"User ID: `{user_id}`\nNomor HP: `{phone}`\nKode Paket: `{package_code}`\n"
+                         f"({escape_markdown(package_name_display, version=2)})\n"
+                         f"Error: `{error_type}` - `{admin_facing_error}` (Saldo direfund)\n"
+                         f"Total Percobaan: `{attempt}`")
+        retry_data_key = uuid.uuid4().hex[:10]
+        context.bot_data[f"retry_data_{retry_data_key}"] = json.dumps({
+            'provider': 'kmsp', 
+            'package_id_or_code': package_code,
+            'package_name': package_name_display,
+            'phone': phone,
+            'payment_method': payment_method,
+            'deducted_balance': deducted_balance,
+            'return_menu_callback_data': return_menu_callback_data,
+            'package_name_for_display': package_name_display 
+        }).encode('utf-8').decode('utf-8')
+        admin_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔁 COBA BELI LAGI (Admin)", callback_data=f"retry_single_{retry_data_key}")]])
+        await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown", reply_markup=admin_keyboard)
 
-        if attempt < MAX_RETRIES and not is_token_error and not is_general_token_error:
-            logging.info(f"Mencoba lagi pembelian 30H (KMSP) untuk {package_name_display} (percobaan {attempt + 1})... Menunda {RETRY_DELAY} detik.")
-            await asyncio.sleep(RETRY_DELAY)
-            return await execute_single_purchase_30h(update, context, user_id, package_code, package_name_display, phone, access_token, payment_method, deducted_balance, return_menu_callback_data, attempt + 1)
-        else:
-                                                                                   
-            user_data["registered_users"][str(user_id)]["balance"] += deducted_balance
-            user_data["registered_users"][str(user_id)]["transactions"].append({
-                "type": "Pembelian Gagal (LOGIN - 30H) (Refund)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
-                "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Gagal (Refund)",
-                "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
-            })
-            simpan_data_ke_db()
-            logging.info(f"Saldo user {user_id} dikembalikan {deducted_balance} karena kegagalan pembelian 30H (maksimal percobaan atau error token).")
+        return {"success": False, "package_name": package_name_display, "error_message": "Token kadaluarsa", "refunded_amount": deducted_balance, "status_message": "Gagal (Token Kadaluarsa)", "fatal_error": True}
+
+    # Pencatatan hasil di luar coba(): error setelah pembelian berhasil tidak boleh memicu pembelian ulang.
+    if jenis_hasil == "sukses_422":
+        catat_transaksi(user_id, {
+            "type": f"Pembelian Paket (LOGIN - 30H Sukses 200_dengan_422_message)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
+            "amount": -deducted_balance, "timestamp": transaction_time_str, "status": "Berhasil (200_dengan_422_message)",
+            "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
+        })
+        simpan_data_ke_db(user_id)
+
+        user_info = user_data["registered_users"][str(user_id)]
+        user_first_name = user_info.get("first_name", "N/A")
+        user_username = user_info.get("username", "N/A")
+        remaining_balance = user_info.get("balance", 0)
+
+        admin_message = (
+            f"✅ *PEMBELIAN 30H BERHASIL (LOGIN - Khusus 200 dengan Pesan 422)!* ✅\n"
+            f"User ID: `{user_id}`\n"
+            f" (`{escape_markdown(user_first_name, version=2)}` / `@{escape_markdown(user_username, version=2)}`)\n"
+            f"Nomor HP: `{phone}`\n"
+            f"Kode Paket: `{package_code}`\n"
+            f" ({escape_markdown(package_name_display, version=2)})\n"
+            f"Metode Pembayaran: `{payment_method}`\n"
+            f"Saldo Dipotong: `Rp{deducted_balance:,}`\n"
+            f"Sisa Saldo: `Rp{remaining_balance:,}`\n"
+            f"Waktu Transaksi: `{transaction_time_str}`"
+        )
+        try:
+            await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown")
+        except Exception as e:
+            logging.warning(f"Gagal mengirim notifikasi 30H ke admin untuk user {user_id}: {e}")
         
-            admin_message = (f"❌ *PEMBELIAN 30H GAGAL (LOGIN)!* ❌\n"
-                             f"User ID: `{user_id}`\nNomor HP: `{phone}`\nKode Paket: `{package_code}`\n"
-                             f"({escape_markdown(package_name_display, version=2)})\n"
-                             f"Error: `{error_type}` - `{admin_facing_error}` (Saldo direfund)\n"
-                             f"Total Percobaan: `{attempt}`")
-            retry_data_key = uuid.uuid4().hex[:10]
-            context.bot_data[f"retry_data_{retry_data_key}"] = json.dumps({
-                'provider': 'kmsp', 
-                'package_id_or_code': package_code,
-                'package_name': package_name_display,
-                'phone': phone,
-                'payment_method': payment_method,
-                'deducted_balance': deducted_balance,
-                'return_menu_callback_data': return_menu_callback_data,
-                'package_name_for_display': package_name_display 
-            }).encode('utf-8').decode('utf-8')
-            admin_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔁 COBA BELI LAGI (Admin)", callback_data=f"retry_single_{retry_data_key}")]])
-            await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown", reply_markup=admin_keyboard)
-
-            return {"success": False, "package_name": package_name_display, "error_message": "Token kadaluarsa", "refunded_amount": deducted_balance, "status_message": "Gagal (Token Kadaluarsa)", "fatal_error": True}
+        return {"success": True, "package_name": package_name_display, "error_message": None, "refunded_amount": 0, "status_message": "Berhasil (200_dengan_422_message)"}
 
-async def execute_custom_package_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, package_code: str, package_name: str, package_price: int, phone: str, access_token: str, payment_method: str, provider="kmsp"):
-    url = ""
-    api_price_or_fee = 0
+    if jenis_hasil == "pending_myxl":
+        kredit_saldo(user_id, deducted_balance, "refund")
+        catat_transaksi(user_id, {
+            "type": f"Pembelian Paket (LOGIN - 30H Pending Retry) (Refund)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
+            "amount": deducted_balance, "timestamp": transaction_time_str, "status": "Pending (Refund)", 
+            "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
+        })
+        simpan_data_ke_db(user_id)
+        logging.info(f"Saldo user {user_id} dikembalikan Rp{deducted_balance} karena 30H pending (MyXL message).")
 
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT ewallet_fee FROM custom_packages WHERE code = ?", (package_code,))
-    result = cursor.fetchone()
-    conn.close()
+        user_info = user_data["registered_users"][str(user_id)]
+        admin_message = (
+            f"⚠️ *PEMBELIAN 30H PENDING (LOGIN)!* ⚠️\n"
+            f"User ID: `{user_id}` (`{escape_markdown(user_info.get('first_name', 'N/A'), version=2)}` / `@{escape_markdown(user_info.get('username', 'N/A'), version=2)}`)\n"
+            f"Nomor HP: `{phone}`\n"
+            f"Kode Paket: `{package_code}`\n"
+            f" ({escape_markdown(package_name_display, version=2)})\n"
+            f"Metode Pembayaran: `{payment_method}`\n"
+            f"Saldo Dipotong Awal: `Rp{deducted_balance:,}` (SUDAH DIREFUND)\n"
+            f"Sisa Saldo: `Rp{user_info.get('balance', 0):,}`\n"
+            f"Waktu Transaksi: `{transaction_time_str}`\n"
+            f"Pesan API: `{escape_markdown(api_message, version=2)}`"
+        )
+        try:
+            await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown")
+        except Exception as e:
+            logging.warning(f"Gagal mengirim notifikasi 30H ke admin untuk user {user_id}: {e}")
 
-    if result:
-        api_price_or_fee = result[0]
-    
-    if provider == "kmsp":
-        url = f"https://golang-openapi-packagepurchase-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}&package_code={package_code}&phone={phone}&access_token={access_token}&payment_method={payment_method}&price_or_fee={api_price_or_fee}"
-    else:
+        return {"success": False, "package_name": package_name_display, "error_message": "PROSES BERHASIL", "refunded_amount": deducted_balance, "status_message": "Pending (Retry)", "specific_action": "countdown_retry"}
+
+    logging.info(f"Pembelian 30H (KMSP) untuk {phone} ({package_name_display}) berhasil diproses dengan respons status TRUE.")
+    catat_transaksi(user_id, {
+        "type": f"Pembelian Paket (LOGIN - 30H)", "package_code": package_code, "package_name": package_name_display, "phone": phone,
+        "amount": -deducted_balance, "timestamp": transaction_time_str, "status": "Berhasil",
+        "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
+    })
+    simpan_data_ke_db(user_id)
+
+    user_info = user_data["registered_users"][str(user_id)]
+    admin_message = (
+        f"✅ *PEMBELIAN 30H BERHASIL (LOGIN)!* ✅\n"
+        f"User ID: `{user_id}`\n"
+        f" (`{escape_markdown(user_info.get('first_name', 'N/A'), version=2)}` / `@{escape_markdown(user_info.get('username', 'N/A'), version=2)}`)\n"
+        f"Nomor HP: `{phone}`\n"
+        f"Kode Paket: `{package_code}`\n"
+        f" ({escape_markdown(package_name_display, version=2)})\n"
+        f"Metode Pembayaran: `{payment_method}`\n"
+        f"Saldo Dipotong: `Rp{deducted_balance:,}`\n"
+        f"Sisa Saldo: `Rp{user_info.get('balance', 0):,}`\n"
+        f"Waktu Transaksi: `{transaction_time_str}`"
+    )
+    try:
+        await context.bot.send_message(ADMIN_ID, admin_message, parse_mode="Markdown")
+    except Exception as e:
+        logging.warning(f"Gagal mengirim notifikasi 30H ke admin untuk user {user_id}: {e}")
+
+    return {"success": True, "package_name": package_name_display, "error_message": None, "refunded_amount": 0, "status_message": "Berhasil"}
+
+async def execute_custom_package_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, package_code: str, package_name: str, package_price: int, phone: str, access_token: str, payment_method: str, provider="kmsp"):
+    api_price_or_fee = get_api_price_or_fee(package_code)
+
+    if provider != "kmsp":
         logging.error(f"execute_custom_package_purchase dipanggil dengan provider tidak dikenal: {provider}")
         await context.bot.send_message(user_id, "Terjadi kesalahan internal. Provider API tidak dikenali.", parse_mode="Markdown")
-        user_data["registered_users"][str(user_id)]["balance"] += package_price
-        simpan_data_ke_db()
+        kredit_saldo(user_id, package_price, "refund")
+        simpan_data_ke_db(user_id)
         return
     
     status_msg = await context.bot.send_message(user_id, f"Memproses pembelian paket kustom *{package_name}* dari LOGIN...\nHarap tunggu hingga 60 detik.", parse_mode="Markdown")
-    loop = asyncio.get_running_loop()
     
     transaction_time = datetime.now()
     transaction_time_str = transaction_time.strftime('%Y-%m-%d %H:%M:%S')
 
     try:
-        def blocking_api_call():
-            return requests.get(url, timeout=58)
-
-        api_response = await asyncio.wait_for(
-            loop.run_in_executor(None, blocking_api_call),
-            timeout=60.0
-        )
+        api_response = await retry_engine.jalankan("kmsp", lambda attempt: provider_client.kmsp_purchase(KMSP_API_KEY, package_code, phone, access_token, payment_method,
+                                                                                                         price_or_fee=api_price_or_fee, prioritas=purchase_queue.PRIORITAS_SINGLE))
         
         try:
             await status_msg.delete()
@@ -7399,8 +7949,7 @@ async def execute_custom_package_purchase(update: Update, context: ContextTypes.
         api_response.raise_for_status()
         api_result = api_response.json()
         
-        if isinstance(api_result, list): 
-            api_result = api_result[0] if api_result else {}
+        api_result = provider_client.normalisasi_respons(api_result)
 
         if not api_result.get('status', False):
              raise ValueError(api_result.get("message", "Pembelian gagal menurut API LOGIN"))
@@ -7444,12 +7993,12 @@ async def execute_custom_package_purchase(update: Update, context: ContextTypes.
         else:
             await context.bot.send_message(user_id, f"✅ Pembelian *{package_name}* berhasil diproses!", parse_mode="Markdown")
 
-        user_data["registered_users"][str(user_id)]["transactions"].append({
+        catat_transaksi(user_id, {
             "type": f"Pembelian Paket Kustom ({provider.upper()})", "package_code": package_code, "package_name": package_name, "phone": phone,
             "amount": -package_price, "timestamp": transaction_time_str, "status": "Berhasil",
             "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
         })
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
         
         user_info = user_data["registered_users"][str(user_id)]
         remaining_balance = user_info.get("balance", 0)
@@ -7482,7 +8031,7 @@ async def execute_custom_package_purchase(update: Update, context: ContextTypes.
         
         if isinstance(e, ValueError) and TOKEN_EXPIRED_MESSAGE in str(e):
             is_token_error = True
-        elif isinstance(e, requests.exceptions.HTTPError):
+        elif isinstance(e, httpx.HTTPStatusError):
             try:
                 error_msg_from_api = e.response.json().get("message", "")
                 if TOKEN_EXPIRED_MESSAGE in error_msg_from_api:
@@ -7498,11 +8047,11 @@ async def execute_custom_package_purchase(update: Update, context: ContextTypes.
             )
                                    
         
-        elif isinstance(e, asyncio.TimeoutError) or isinstance(e, requests.exceptions.ReadTimeout):
+        elif isinstance(e, asyncio.TimeoutError) or isinstance(e, httpx.ReadTimeout):
             user_facing_error = "Server tidak merespon dalam 60 detik (Timeout). Silakan coba lagi."
-        elif isinstance(e, requests.exceptions.ConnectTimeout):
+        elif isinstance(e, httpx.ConnectTimeout):
             user_facing_error = "Tidak dapat terhubung ke server (Connection Timeout)."
-        elif isinstance(e, requests.exceptions.HTTPError):
+        elif isinstance(e, httpx.HTTPStatusError):
             try:
                 error_msg_from_api = e.response.json().get("message", "Terjadi kesalahan HTTP.")
                 user_facing_error = f"Pesan dari API: {error_msg_from_api}"
@@ -7517,13 +8066,13 @@ async def execute_custom_package_purchase(update: Update, context: ContextTypes.
         logging.error(f"Custom package purchase failed for user {user_id}, package {package_code}. Provider: {provider}. Full error: {str(e)}")
         logging.error(traceback.format_exc())
 
-        user_data["registered_users"][str(user_id)]["balance"] += package_price
-        user_data["registered_users"][str(user_id)]["transactions"].append({
+        kredit_saldo(user_id, package_price, "refund")
+        catat_transaksi(user_id, {
             "type": f"Pembelian Kustom Gagal ({provider.upper()}) (Refund)", "package_code": package_code, "package_name": package_name, "phone": phone,
             "amount": package_price, "timestamp": transaction_time_str, "status": "Gagal (Refund)",
             "balance_after_tx": user_data["registered_users"][str(user_id)]["balance"]
         })
-        simpan_data_ke_db()
+        simpan_data_ke_db(user_id)
 
         error_text = f"❌ Gagal membeli paket kustom *{package_name}*: `{user_facing_error}`\n💰 Saldo Anda sebesar *Rp{package_price:,}* telah dikembalikan."
         
@@ -7539,11 +8088,10 @@ async def execute_custom_package_purchase(update: Update, context: ContextTypes.
     await send_main_menu(update, context)
 
 async def execute_unreg_package(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, current_phone: str, access_token: str, encrypted_package_code: str):
-    url = f"https://golang-openapi-unregpackage-xltembakservice.kmsp-store.com/v1?api_key={KMSP_API_KEY}&access_token={access_token}&encrypted_package_code={encrypted_package_code}"
     logging.info(f"User {user_id} mencoba menghentikan paket (KMSP): {encrypted_package_code}")
     
     try:
-        response = requests.get(url, timeout=20)
+        response = await provider_client.kmsp_get("unregpackage", KMSP_API_KEY, access_token=access_token, encrypted_package_code=encrypted_package_code)
         response.raise_for_status()
         result = response.json()
 
@@ -7556,7 +8104,7 @@ async def execute_unreg_package(update: Update, context: ContextTypes.DEFAULT_TY
 
     except Exception as e:
         error_detail = str(e)
-        if isinstance(e, requests.exceptions.HTTPError):
+        if isinstance(e, httpx.HTTPStatusError):
             try:
                 error_detail = e.response.json().get("message", "unknown error")
             except (json.JSONDecodeError, AttributeError):
@@ -7580,20 +8128,21 @@ async def admin_confirm_user_top_up(update: Update, context: ContextTypes.DEFAUL
         return
 
                                        
+    if not kredit_saldo(user_to_affect_id, amount_to_add, "topup", f"topup:{user_to_affect_id}:{query.message.message_id}"):
+        await query.answer("Top up ini sudah dikonfirmasi sebelumnya.", show_alert=True)
+        return
+
     pending_info = user_details.pop("pending_top_up", {})
     user_msg_ids = pending_info.get("user_message_ids", [])
-
-                                 
-    user_details["balance"] += amount_to_add
     
                                                           
     new_balance = user_details["balance"]
 
-    user_details["transactions"].append({
+    catat_transaksi(user_to_affect_id, {
         "type": "Top Up", "amount": amount_to_add, "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         "status": "Berhasil", "admin_id": admin_id
     })
-    simpan_data_ke_db()
+    simpan_data_ke_db(user_to_affect_id)
     
                                        
     for msg_id in user_msg_ids:
@@ -7628,7 +8177,7 @@ async def admin_reject_user_top_up(update: Update, context: ContextTypes.DEFAULT
 
     pending_info = user_details.pop("pending_top_up", {})
     user_msg_ids = pending_info.get("user_message_ids", [])
-    simpan_data_ke_db()
+    simpan_data_ke_db(user_to_affect_id)
     
     for msg_id in user_msg_ids:
         try:
@@ -7637,43 +8186,42 @@ async def admin_reject_user_top_up(update: Update, context: ContextTypes.DEFAULT
             
     await context.bot.send_message(user_to_affect_id, "❌ Maaf, permintaan top up Anda ditolak. Silakan hubungi admin untuk info lebih lanjut.")
     await query.edit_message_text(f"❌ Permintaan top up dari user `{user_to_affect_id}` telah ditolak.")
-async def admin_list_users(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
+async def admin_list_users(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0, arah=None, kursor=()):
     query = update.callback_query
     await query.answer()
 
-    all_users = list(user_data.get("registered_users", {}).items())
+    total_users = len(user_data.get("registered_users", {}))
     
-    if not all_users:
+    if not total_users:
         await query.edit_message_text("Belum ada pengguna terdaftar.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali ke Menu Admin", callback_data="admin_back_to_menu")]]))
         return
 
     # Atur Paginasi
     USERS_PER_PAGE = 10 # Anda bisa ubah angka ini
-    total_pages = math.ceil(len(all_users) / USERS_PER_PAGE)
+    total_pages = math.ceil(total_users / USERS_PER_PAGE)
     start_index = page * USERS_PER_PAGE
-    end_index = start_index + USERS_PER_PAGE
-    paginated_users = all_users[start_index:end_index]
+    rows, ada_lagi = ambil_halaman_user("id", USERS_PER_PAGE, arah, kursor)
+    if not rows:
+        await query.edit_message_text("Tidak ada pengguna di halaman ini.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Kembali ke Menu Admin", callback_data="admin_back_to_menu")]]))
+        return
 
     # Format Pesan
     text = f"👥 *Daftar Pengguna Terdaftar (Halaman {page + 1}/{total_pages})*\n\n"
-    for i, (user_id, details) in enumerate(paginated_users, start=start_index + 1):
-        first_name = details.get('first_name', 'N/A')
-        username = details.get('username', 'N/A')
-        balance = details.get('balance', 0)
+    for i, (user_id, first_name, username, balance) in enumerate(rows, start=start_index + 1):
         text += (
             f"*{i}.* `{user_id}`\n"
-            f"   - Nama: {escape_markdown(first_name)}\n"
-            f"   - Username: @{username}\n"
-            f"   - Saldo: `Rp{balance:,}`\n\n"
+            f"   - Nama: {escape_markdown(first_name or 'N/A')}\n"
+            f"   - Username: @{username or 'N/A'}\n"
+            f"   - Saldo: `Rp{balance or 0:,}`\n\n"
         )
 
-    # Buat Tombol Navigasi
+    # Buat Tombol Navigasi (kursor = ID user pertama/terakhir di halaman ini)
     keyboard = []
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⏪ Sebelumnya", callback_data=f"admin_list_users_page_{page - 1}"))
-    if end_index < len(all_users):
-        nav_buttons.append(InlineKeyboardButton("Berikutnya ⏩", callback_data=f"admin_list_users_page_{page + 1}"))
+        nav_buttons.append(InlineKeyboardButton("⏪ Sebelumnya", callback_data=f"admin_list_users_page_{page - 1}_p_{rows[0][0]}"))
+    if ada_lagi or arah == "p":
+        nav_buttons.append(InlineKeyboardButton("Berikutnya ⏩", callback_data=f"admin_list_users_page_{page + 1}_n_{rows[-1][0]}"))
     
     if nav_buttons:
         keyboard.append(nav_buttons)
@@ -7703,8 +8251,7 @@ async def akun_saya_command_handler(update: Update, context: ContextTypes.DEFAUL
         await context.bot.send_message(user_id, text, parse_mode="Markdown", reply_markup=reply_markup)
         
                                       
-    context.user_data['next'] = 'handle_akun_saya_nomor_input'
-    
+    step_router.set_next(context, 'handle_akun_saya_nomor_input')
 async def hapus_akun_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
@@ -7751,6 +8298,7 @@ async def eksekusi_hapus_akun(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     del user_data["registered_users"][str(user_id)]["accounts"][phone_to_delete]
+    account_store.hapus(user_id, phone_to_delete)
     
     if user_data["registered_users"][str(user_id)].get("current_phone") == phone_to_delete:
         if user_data["registered_users"][str(user_id)]["accounts"]:
@@ -7760,15 +8308,16 @@ async def eksekusi_hapus_akun(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     user_details = user_data["registered_users"][str(user_id)]
                                                     
-    if not user_details["accounts"] and not user_details["transactions"] and user_details["balance"] == 0:
+    if not user_details["accounts"] and user_details["balance"] == 0 and hitung_transaksi_user(user_id) == 0:
         del user_data["registered_users"][str(user_id)]
-        simpan_data_ke_db()
+        user_index.hapus(user_id)
+        simpan_data_ke_db(user_id)
         logging.info(f"User {user_id} dan semua datanya dihapus karena tidak ada akun, transaksi, dan saldo 0.")
         msg = await context.bot.send_message(user_id, f"✅ Akun `{phone_to_delete}` dan semua data Anda telah dihapus karena tidak ada data tersisa.")
         bot_messages.setdefault(user_id, []).append(msg.message_id)
         return
     
-    simpan_data_ke_db()
+    simpan_data_ke_db(user_id)
     logging.info(f"User {user_id} menghapus akun {phone_to_delete}")
     msg = await context.bot.send_message(user_id, f"✅ Akun `{phone_to_delete}` telah berhasil dihapus.")
     bot_messages.setdefault(user_id, []).append(msg.message_id)
@@ -7843,6 +8392,25 @@ async def show_custom_packages_for_user(update: Update, context: ContextTypes.DE
     else:
         await context.bot.send_message(user_id, text, parse_mode="Markdown", reply_markup=reply_markup)
 
+async def bersihkan_step_kedaluwarsa_job(context: ContextTypes.DEFAULT_TYPE):
+    step_router.sapu_kedaluwarsa(context.application.user_data.values())
+
+# Step input admin yang handler-nya fungsi biasa (step dengan logika inline didaftarkan lewat @step_router.step).
+step_router.register("admin_handle_add_balance_input", admin_handle_add_balance_input, grup="admin")
+step_router.register("admin_handle_deduct_balance_input", admin_handle_deduct_balance_input, grup="admin")
+step_router.register("admin_handle_block_user_input", admin_handle_block_user_input, grup="admin")
+step_router.register("admin_handle_unblock_user_input", admin_handle_unblock_user_input, grup="admin")
+step_router.register("admin_handle_broadcast_message_content", admin_handle_broadcast_message_content, grup="admin")
+step_router.register("admin_handle_broadcast_exclusions", admin_handle_broadcast_exclusions, grup="admin")
+step_router.register("admin_handle_search_user_input", admin_handle_search_user_input, grup="admin")
+step_router.register("admin_handle_check_user_transactions_input", admin_handle_check_user_transactions_input, grup="admin")
+step_router.register("admin_handle_search_api_package_input", admin_handle_search_api_package_input, grup="admin")
+step_router.register("admin_handle_smart_package_code_input", admin_handle_smart_package_code_input, grup="admin", cleanup=("temp_custom_pkg",))
+step_router.register("admin_handle_smart_package_display_name_input", admin_handle_smart_package_display_name_input, grup="admin", cleanup=("temp_custom_pkg",))
+step_router.register("admin_handle_smart_package_price_input", admin_handle_smart_package_price_input, grup="admin", cleanup=("temp_custom_pkg",))
+step_router.register("admin_handle_smart_package_ewallet_fee_input", admin_handle_smart_package_ewallet_fee_input, grup="admin", cleanup=("temp_custom_pkg",))
+step_router.register("admin_handle_smart_package_desc_and_save", admin_handle_smart_package_desc_and_save, grup="admin", cleanup=("temp_custom_pkg",))
+
 
 def main():
                           
@@ -7854,7 +8422,24 @@ def main():
         logging.critical("BOT_TOKEN tidak ditemukan. Harap atur environment variable.")
         sys.exit(1)
         
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    async def post_init(application) -> None:
+        purchase_queue.mulai()
+        await pulihkan_job_pembelian(application)
+        await broadcast_engine.lanjutkan_tertunda(application)
+
+    async def post_shutdown(application) -> None:
+        # SIGINT/SIGTERM ditangani run_polling, jadi hook ini selalu jalan saat bot dimatikan.
+        await purchase_queue.berhenti()
+        await broadcast_engine.berhenti()
+        await http_client.tutup()
+        simpan_data_ke_db()
+        logging.info("✅ Data berhasil disimpan. Bot dimatikan.")
+
+    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
+    app.job_queue.run_repeating(refresh_katalog_paket_job, interval=package_catalog.CATALOG_REFRESH_INTERVAL, first=1)
+    app.job_queue.run_repeating(bersihkan_step_kedaluwarsa_job, interval=300, first=300)
+    app.job_queue.run_repeating(poll_saldo_kmsp_job, interval=panel_balance.BALANCE_POLL_INTERVAL, first=1)
+    app.job_queue.run_repeating(probe_endpoint_job, interval=endpoint_health.PROBE_INTERVAL, first=endpoint_health.PROBE_INTERVAL)
 # --- PERBAIKAN: Menambahkan error handler ---
     async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -7870,22 +8455,13 @@ def main():
     app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_text))
 
 
-    signal.signal(signal.SIGINT, shutdown_handler)
-    signal.signal(signal.SIGTERM, shutdown_handler)
-
     logging.info("Bot XL Tembak sedang berjalan...")
     try:
         app.run_polling()
     except Exception as e:
         logging.critical(f"Terjadi kesalahan fatal saat menjalankan bot: {e}", exc_info=True)
-        shutdown_handler(None, None)
+        simpan_data_ke_db()
         sys.exit(1)
 
-def shutdown_handler(sig, frame):
-    logging.info("🔌 Menerima sinyal shutdown...")
-    simpan_data_ke_db()
-    logging.info("✅ Data berhasil disimpan. Bot dimatikan.")
-    sys.exit(0)
-
 if __name__ == '__main__':
     main()
@@ -0,0 +1,247 @@
+# broadcast_engine.py
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from datetime import datetime
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+import status_message
+
+# Batas Telegram: ~30 pesan/detik untuk seluruh bot dan ~1 pesan/detik per chat. Setiap user hanya
+# menerima satu pesan per broadcast, jadi batas per chat cukup dijaga lewat RetryAfter.
+GLOBAL_RATE = 25          # pesan per detik (di bawah batas global agar ada ruang untuk pesan lain)
+KONKURENSI = 8            # copy_message yang berjalan bersamaan
+MAX_PERCOBAAN = 3         # percobaan per user untuk error sementara (RetryAfter tidak dihitung)
+CHECKPOINT_SETIAP = 100   # simpan progres & perbarui pesan admin setiap sekian user selesai
+
+STATUS_BERJALAN = "berjalan"
+STATUS_SELESAI = "selesai"
+
+_db_file = None
+# broadcast_id -> asyncio.Task
+_berjalan = {}
+
+
+class TokenBucket:
+    """Token bucket async: `rate` token per detik dengan burst maksimal `kapasitas`."""
+
+    def __init__(self, rate, kapasitas=None):
+        self.rate = rate
+        self.kapasitas = kapasitas or rate
+        self.token = float(self.kapasitas)
+        self.diisi_pada = time.monotonic()
+        self.jeda_sampai = 0.0
+        self._lock = asyncio.Lock()
+
+    def jeda(self, detik):
+        """Tahan semua pengiriman selama `detik` (Telegram mengirim RetryAfter untuk seluruh bot)."""
+        self.jeda_sampai = max(self.jeda_sampai, time.monotonic() + detik)
+        self.diisi_pada = self.jeda_sampai
+        self.token = 0.0
+
+    async def ambil(self):
+        async with self._lock:
+            while True:
+                sekarang = time.monotonic()
+                if sekarang < self.jeda_sampai:
+                    await asyncio.sleep(self.jeda_sampai - sekarang)
+                    continue
+                self.token = min(self.kapasitas, self.token + (sekarang - self.diisi_pada) * self.rate)
+                self.diisi_pada = sekarang
+                if self.token >= 1:
+                    self.token -= 1
+                    return
+                await asyncio.sleep((1 - self.token) / self.rate)
+
+
+def inisialisasi(db_file):
+    """Siapkan tabel broadcast_jobs untuk menyimpan progres broadcast."""
+    global _db_file
+    _db_file = db_file
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER NOT NULL, from_chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL,
+            reply_markup TEXT, target TEXT NOT NULL,
+            posisi INTEGER DEFAULT 0, berhasil INTEGER DEFAULT 0, gagal INTEGER DEFAULT 0,
+            status TEXT NOT NULL, dibuat_pada TEXT NOT NULL
+        )''')
+        conn.commit()
+    finally:
+        conn.close()
+
+def _baris_ke_job(row):
+    return {"id": row[0], "admin_chat_id": row[1], "from_chat_id": row[2], "message_id": row[3],
+            "reply_markup": json.loads(row[4]) if row[4] else None, "target": json.loads(row[5]),
+            "posisi": row[6], "berhasil": row[7], "gagal": row[8], "status": row[9]}
+
+def _ambil(broadcast_id):
+    conn = sqlite3.connect(_db_file)
+    try:
+        row = conn.execute(
+            "SELECT id, admin_chat_id, from_chat_id, message_id, reply_markup, target, posisi, berhasil, gagal, status "
+            "FROM broadcast_jobs WHERE id = ?", (broadcast_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return _baris_ke_job(row) if row else None
+
+def _simpan_progres(broadcast_id, progres, status=STATUS_BERJALAN):
+    conn = sqlite3.connect(_db_file)
+    try:
+        conn.execute(
+            "UPDATE broadcast_jobs SET posisi = ?, berhasil = ?, gagal = ?, status = ? WHERE id = ?",
+            (progres["posisi"], progres["berhasil"], progres["gagal"], status, broadcast_id)
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Gagal menyimpan progres broadcast #{broadcast_id}: {e}")
+    finally:
+        conn.close()
+
+def _detik(retry_after):
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+async def _jalankan(application, broadcast_id):
+    job = _ambil(broadcast_id)
+    bot = application.bot
+    admin_chat_id = job["admin_chat_id"]
+    target = job["target"]
+    markup = InlineKeyboardMarkup.de_json(job["reply_markup"], bot) if job["reply_markup"] else None
+    bucket = TokenBucket(GLOBAL_RATE)
+    antrian = asyncio.Queue()
+    for indeks in range(job["posisi"], len(target)):
+        antrian.put_nowait((indeks, 1))
+
+    # posisi = jumlah target terdepan yang sudah pasti selesai; saat resume dilanjutkan dari sini,
+    # sehingga paling banyak pesan yang sedang dikirim (KONKURENSI) yang bisa terkirim dua kali.
+    progres = {"posisi": job["posisi"], "berhasil": job["berhasil"], "gagal": job["gagal"]}
+    selesai_di_depan = set()
+    mulai = time.monotonic()
+
+    pesan_progres = await bot.send_message(admin_chat_id, f"📢 Broadcast #{broadcast_id}: {progres['posisi']}/{len(target)} user diproses...")
+
+    async def tandai_selesai(indeks, sukses):
+        progres["berhasil" if sukses else "gagal"] += 1
+        selesai_di_depan.add(indeks)
+        while progres["posisi"] in selesai_di_depan:
+            selesai_di_depan.discard(progres["posisi"])
+            progres["posisi"] += 1
+        if (progres["berhasil"] + progres["gagal"]) % CHECKPOINT_SETIAP == 0:
+            _simpan_progres(broadcast_id, progres)
+            try:
+                await status_message.perbarui(
+                    application, admin_chat_id, pesan_progres.message_id,
+                    text=f"📢 Broadcast #{broadcast_id}: {progres['posisi']}/{len(target)} user diproses "
+                         f"(berhasil {progres['berhasil']}, gagal {progres['gagal']})..."
+                )
+            except Exception as e:
+                logging.warning(f"Gagal memperbarui progres broadcast #{broadcast_id}: {e}")
+
+    async def worker():
+        while True:
+            indeks, percobaan = await antrian.get()
+            try:
+                await bucket.ambil()
+                await bot.copy_message(chat_id=target[indeks], from_chat_id=job["from_chat_id"],
+                                       message_id=job["message_id"], reply_markup=markup)
+            except RetryAfter as e:
+                logging.warning(f"Broadcast #{broadcast_id}: flood control, jeda {_detik(e.retry_after)} detik.")
+                bucket.jeda(_detik(e.retry_after))
+                antrian.put_nowait((indeks, percobaan))
+            except (Forbidden, BadRequest) as e:
+                # Bot diblokir / chat tidak ada: tidak ada gunanya dicoba ulang.
+                logging.info(f"Broadcast #{broadcast_id} tidak terkirim ke {target[indeks]}: {e}")
+                await tandai_selesai(indeks, False)
+            except TelegramError as e:
+                if percobaan < MAX_PERCOBAAN:
+                    antrian.put_nowait((indeks, percobaan + 1))
+                else:
+                    logging.warning(f"Broadcast #{broadcast_id} gagal ke {target[indeks]} setelah {percobaan} percobaan: {e}")
+                    await tandai_selesai(indeks, False)
+            except Exception as e:
+                logging.warning(f"Broadcast #{broadcast_id} gagal ke {target[indeks]}: {e}")
+                await tandai_selesai(indeks, False)
+            else:
+                await tandai_selesai(indeks, True)
+            finally:
+                antrian.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(KONKURENSI)]
+    try:
+        await antrian.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        _simpan_progres(broadcast_id, progres, STATUS_SELESAI if progres["posisi"] >= len(target) else STATUS_BERJALAN)
+
+    durasi = time.monotonic() - mulai
+    logging.info(f"Broadcast #{broadcast_id} selesai dalam {durasi:.0f} detik: {progres['berhasil']} berhasil, {progres['gagal']} gagal.")
+    status_message.lupakan(admin_chat_id, pesan_progres.message_id)
+    try:
+        await bot.delete_message(chat_id=admin_chat_id, message_id=pesan_progres.message_id)
+    except Exception:
+        pass
+    await bot.send_message(
+        admin_chat_id,
+        f"✅ Selesai mengirim broadcast.\nBerhasil: *{progres['berhasil']}* user\nGagal: *{progres['gagal']}* user\n"
+        f"Durasi: *{int(durasi // 60)} menit {int(durasi % 60)} detik*",
+        parse_mode="Markdown"
+    )
+
+def _mulai_task(application, broadcast_id):
+    task = asyncio.create_task(_jalankan(application, broadcast_id))
+    _berjalan[broadcast_id] = task
+    task.add_done_callback(lambda _: _berjalan.pop(broadcast_id, None))
+
+def mulai(application, admin_chat_id, from_chat_id, message_id, target_ids, reply_markup=None):
+    """Simpan broadcast baru lalu jalankan di background; mengembalikan id broadcast."""
+    conn = sqlite3.connect(_db_file)
+    try:
+        cursor = conn.execute(
+            "INSERT INTO broadcast_jobs (admin_chat_id, from_chat_id, message_id, reply_markup, target, status, dibuat_pada) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (admin_chat_id, from_chat_id, message_id, json.dumps(reply_markup.to_dict()) if reply_markup else None,
+             json.dumps(list(target_ids)), STATUS_BERJALAN, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        conn.commit()
+        broadcast_id = cursor.lastrowid
+    finally:
+        conn.close()
+    logging.info(f"Broadcast #{broadcast_id} dimulai ke {len(target_ids)} user.")
+    _mulai_task(application, broadcast_id)
+    return broadcast_id
+
+async def lanjutkan_tertunda(application):
+    """Lanjutkan broadcast yang terputus (bot restart) dari posisi checkpoint terakhir."""
+    conn = sqlite3.connect(_db_file)
+    try:
+        rows = conn.execute(
+            "SELECT id, admin_chat_id, from_chat_id, message_id, reply_markup, target, posisi, berhasil, gagal, status "
+            "FROM broadcast_jobs WHERE status = ?", (STATUS_BERJALAN,)
+        ).fetchall()
+    finally:
+        conn.close()
+    for job in map(_baris_ke_job, rows):
+        logging.info(f"Melanjutkan broadcast #{job['id']} dari posisi {job['posisi']}/{len(job['target'])}.")
+        try:
+            await application.bot.send_message(
+                job["admin_chat_id"], f"♻️ Bot restart: broadcast #{job['id']} dilanjutkan dari user ke-{job['posisi'] + 1} dari {len(job['target'])}."
+            )
+        except Exception as e:
+            logging.warning(f"Gagal memberi tahu admin soal broadcast #{job['id']}: {e}")
+        _mulai_task(application, job["id"])
+
+async def berhenti():
+    """Hentikan broadcast yang sedang berjalan; progres tersimpan dan dilanjutkan saat start berikutnya."""
+    tasks = list(_berjalan.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
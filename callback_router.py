@@ -0,0 +1,73 @@
+# callback_router.py
+import logging
+import time
+
+_HANDLER = "__handler__"
+# grup -> {"exact": {callback_data: handler}, "trie": trie karakter prefix}; grup memisahkan route user & admin
+_routes = {}
+# route -> [jumlah panggilan, total detik, detik terlama]
+_statistik = {}
+
+def _tabel(grup):
+    return _routes.setdefault(grup, {"exact": {}, "trie": {}})
+
+def route(*callback_data, prefix=None, grup="user"):
+    """Decorator pendaftaran handler callback: route("menu_a", "menu_b") atau route(prefix="unreg_")."""
+    def decorator(handler):
+        for data in callback_data:
+            register_exact(data, handler, grup)
+        if prefix is not None:
+            register_prefix(prefix, handler, grup)
+        return handler
+    return decorator
+
+def register_exact(data, handler, grup="user"):
+    exact = _tabel(grup)["exact"]
+    if data in exact:
+        logging.warning(f"Route callback '{data}' ({grup}) didaftarkan ulang; handler lama ditimpa.")
+    exact[data] = handler
+
+def register_prefix(prefix, handler, grup="user"):
+    node = _tabel(grup)["trie"]
+    for char in prefix:
+        node = node.setdefault(char, {})
+    node[_HANDLER] = (prefix + "*", handler)
+
+def resolve(data, grup="user"):
+    """Cari (nama_route, handler) untuk callback_data: exact dulu, lalu prefix terpanjang yang cocok."""
+    tabel = _tabel(grup)
+    handler = tabel["exact"].get(data)
+    if handler is not None:
+        return data, handler
+    found = (None, None)
+    node = tabel["trie"]
+    for char in data:
+        node = node.get(char)
+        if node is None:
+            break
+        if _HANDLER in node:
+            found = node[_HANDLER]
+    return found
+
+async def dispatch(update, context, data, grup="user"):
+    """Jalankan handler yang cocok; False jika tidak ada route untuk data ini."""
+    nama_route, handler = resolve(data, grup)
+    if handler is None:
+        return False
+    mulai = time.perf_counter()
+    try:
+        await handler(update, context)
+    finally:
+        durasi = time.perf_counter() - mulai
+        stat = _statistik.setdefault(f"{grup}:{nama_route}", [0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += durasi
+        stat[2] = max(stat[2], durasi)
+    return True
+
+def statistik():
+    """Ringkasan latensi per route: {"grup:route": {"count", "avg", "max"}}."""
+    return {
+        nama: {"count": count, "avg": total / count, "max": terlama}
+        for nama, (count, total, terlama) in _statistik.items()
+    }
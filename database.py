@@ -2,12 +2,18 @@
 import logging
 import datetime
 import mysql.connector
-from mysql.connector import Error, pooling
+from mysql.connector import Error, IntegrityError, pooling
 from typing import Optional, Dict, List
 import config
 
 logger = logging.getLogger(__name__)
 
+# Results of debit_balance / credit_balance
+LEDGER_APPLIED = "applied"
+LEDGER_DUPLICATE = "duplicate"        # idempotency key already used, nothing changed
+LEDGER_INSUFFICIENT = "insufficient"  # balance too low (or user not found), nothing changed
+LEDGER_ERROR = "error"
+
 # Connection pool configuration
 DB_POOL = pooling.MySQLConnectionPool(
     pool_name="bot_pool",
@@ -35,8 +41,18 @@ def init_db():
                 balance DECIMAL(10,2) DEFAULT 0,
                 date DATE,
                 last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                INDEX (telegram_user_id)
+                INDEX (telegram_user_id),
+                INDEX idx_users_username (username))
+        """)
+        
+        # Tables created before the username index existed: add it once
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = 'users' AND column_name = 'username'
         """)
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("CREATE INDEX idx_users_username ON users (username)")
+            logger.info("Added index idx_users_username on users.username")
         
         # Create transactions table
         cursor.execute("""
@@ -57,7 +73,20 @@ def init_db():
                 date_up TIMESTAMP,
                 provider VARCHAR(50),
                 INDEX (user),
-                INDEX (status)
+                INDEX (status))
+        """)
+        
+        # Create append-only balance ledger (one row per balance change)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS balance_ledger (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                idempotency_key VARCHAR(100) NOT NULL UNIQUE,
+                telegram_user_id BIGINT NOT NULL,
+                delta DECIMAL(10,2) NOT NULL,
+                balance_after DECIMAL(10,2),
+                note VARCHAR(255),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                INDEX (telegram_user_id))
         """)
         
         # Create packages table
@@ -253,6 +282,61 @@ def update_user_balance(user_identifier: str, new_balance: float, by_username: b
             cursor.close()
             conn.close()
 
+def _apply_ledger(telegram_user_id: int, delta: float, idempotency_key: str, note: str = None) -> str:
+    """Apply a balance change and its ledger row in one transaction, returns a LEDGER_* result"""
+    conn = get_db_connection()
+    if not conn:
+        return LEDGER_ERROR
+        
+    try:
+        cursor = conn.cursor()
+        conn.start_transaction()
+        # Ledger row first: a reused idempotency key fails here before the balance is touched
+        cursor.execute(
+            "INSERT INTO balance_ledger (idempotency_key, telegram_user_id, delta, note) VALUES (%s, %s, %s, %s)",
+            (idempotency_key, telegram_user_id, delta, note)
+        )
+        ledger_id = cursor.lastrowid
+        if delta < 0:
+            cursor.execute(
+                "UPDATE users SET balance = balance + %s WHERE telegram_user_id = %s AND balance >= %s",
+                (delta, telegram_user_id, -delta)
+            )
+        else:
+            cursor.execute(
+                "UPDATE users SET balance = balance + %s WHERE telegram_user_id = %s",
+                (delta, telegram_user_id)
+            )
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return LEDGER_INSUFFICIENT
+        cursor.execute(
+            "UPDATE balance_ledger SET balance_after = (SELECT balance FROM users WHERE telegram_user_id = %s) WHERE id = %s",
+            (telegram_user_id, ledger_id)
+        )
+        conn.commit()
+        return LEDGER_APPLIED
+    except IntegrityError:
+        conn.rollback()
+        logger.info(f"Balance change {idempotency_key} already applied, skipped")
+        return LEDGER_DUPLICATE
+    except Error as e:
+        conn.rollback()
+        logger.error(f"Error applying balance change {idempotency_key}: {e}")
+        return LEDGER_ERROR
+    finally:
+        if conn and conn.is_connected():
+            cursor.close()
+            conn.close()
+
+def debit_balance(telegram_user_id: int, amount: float, idempotency_key: str, note: str = None) -> str:
+    """Atomically deduct amount if the balance covers it, returns a LEDGER_* result"""
+    return _apply_ledger(telegram_user_id, -amount, idempotency_key, note)
+
+def credit_balance(telegram_user_id: int, amount: float, idempotency_key: str, note: str = None) -> str:
+    """Atomically add amount to the balance, returns a LEDGER_* result"""
+    return _apply_ledger(telegram_user_id, amount, idempotency_key, note)
+
 def update_last_active(telegram_user_id: int) -> bool:
     """Update user's last active timestamp"""
     conn = get_db_connection()
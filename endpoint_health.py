@@ -0,0 +1,122 @@
+# endpoint_health.py
+import logging
+import time
+from collections import deque
+
+WINDOW = 300             # detik jendela statistik bergulir
+MAX_SAMPEL = 200         # sampel terbanyak yang disimpan per endpoint
+MIN_SAMPEL = 5           # sirkuit baru boleh terbuka setelah ada sampel sebanyak ini di jendela
+ERROR_RATE_BUKA = 0.5    # rasio gagal di jendela yang membuka sirkuit
+P95_BUKA = 0.8           # p95 latensi di jendela >= rasio ini dari timeout endpoint juga membuka sirkuit
+COOLDOWN = 60            # detik sirkuit terbuka sebelum boleh di-probe (half-open)
+PROBE_INTERVAL = 30      # interval job probe berkala untuk sirkuit yang terbuka
+PROBE_TIMEOUT = 90       # probe half-open yang tidak melapor setelah ini dianggap hilang
+
+TERTUTUP = "closed"
+TERBUKA = "open"
+SETENGAH_TERBUKA = "half_open"
+
+# nama endpoint ("kmsp:purchase") -> {"sampel": deque[(waktu, durasi, sukses)], "status", "dibuka_pada"}
+_endpoints = {}
+
+
+class SirkuitTerbuka(ValueError):
+    """Endpoint sedang ditandai down; turunan ValueError agar handler lama menampilkan pesannya ke user."""
+
+    def __init__(self, nama, sisa_detik):
+        super().__init__(f"Server provider sedang gangguan, permintaan tidak dikirim. Silakan coba lagi dalam {max(1, int(sisa_detik))} detik.")
+        self.nama = nama
+
+
+def _endpoint(nama):
+    return _endpoints.setdefault(nama, {"sampel": deque(maxlen=MAX_SAMPEL), "status": TERTUTUP, "dibuka_pada": 0.0, "probe_mulai": 0.0})
+
+def _sampel_di_jendela(data):
+    batas = time.monotonic() - WINDOW
+    while data["sampel"] and data["sampel"][0][0] < batas:
+        data["sampel"].popleft()
+    return data["sampel"]
+
+def _buka(nama, data, alasan):
+    data["status"] = TERBUKA
+    data["dibuka_pada"] = time.monotonic()
+    logging.warning(f"Sirkuit endpoint {nama} TERBUKA ({alasan}); request akan gagal cepat selama {COOLDOWN} detik.")
+
+def _tutup(nama, data):
+    if data["status"] != TERTUTUP:
+        logging.info(f"Sirkuit endpoint {nama} tertutup kembali.")
+    data["status"] = TERTUTUP
+    data["sampel"].clear()
+
+def cek(nama):
+    """Lempar SirkuitTerbuka jika endpoint sedang down; setelah cooldown satu request dilewatkan sebagai probe."""
+    data = _endpoint(nama)
+    if data["status"] == TERTUTUP:
+        return
+    sekarang = time.monotonic()
+    sisa = data["dibuka_pada"] + COOLDOWN - sekarang
+    if (data["status"] == TERBUKA and sisa <= 0) or \
+            (data["status"] == SETENGAH_TERBUKA and sekarang - data["probe_mulai"] > PROBE_TIMEOUT):
+        data["status"] = SETENGAH_TERBUKA
+        data["probe_mulai"] = sekarang
+        return
+    raise SirkuitTerbuka(nama, max(sisa, PROBE_INTERVAL))
+
+def catat(nama, durasi, sukses, timeout=None):
+    """Catat hasil satu request; sukses berarti upstream menjawab (HTTP < 500).
+
+    Jika timeout endpoint diberikan, sirkuit juga dibuka saat p95 latensi mendekati timeout itu,
+    karena upstream yang menjawab di detik-detik terakhir tetap menahan user selama hampir satu menit.
+    """
+    data = _endpoint(nama)
+    if data["status"] == SETENGAH_TERBUKA:
+        if sukses:
+            _tutup(nama, data)
+        else:
+            _buka(nama, data, "probe half-open gagal")
+        return
+    sampel = _sampel_di_jendela(data)
+    sampel.append((time.monotonic(), durasi, sukses))
+    if data["status"] == TERTUTUP and len(sampel) >= MIN_SAMPEL:
+        error_rate = sum(1 for _, _, ok in sampel if not ok) / len(sampel)
+        p95 = _persentil([durasi for _, durasi, _ in sampel], 0.95)
+        if error_rate >= ERROR_RATE_BUKA:
+            _buka(nama, data, f"error rate {error_rate:.0%} dari {len(sampel)} request")
+        elif timeout and p95 >= P95_BUKA * timeout:
+            _buka(nama, data, f"p95 latensi {p95:.1f} detik dari timeout {timeout} detik")
+
+def perlu_probe():
+    """Nama endpoint yang terbuka dan sudah melewati cooldown."""
+    sekarang = time.monotonic()
+    return [nama for nama, data in _endpoints.items()
+            if data["status"] == TERBUKA and sekarang - data["dibuka_pada"] >= COOLDOWN]
+
+def hasil_probe(nama, sukses):
+    """Terapkan hasil probe terjadwal.
+
+    Probe gagal memperpanjang masa terbuka. Probe sukses tidak menutup sirkuit: endpoint probe bukan endpoint
+    yang sama, jadi sirkuit dibiarkan siap half-open dan request asli berikutnya yang memutuskan (lihat cek/catat).
+    """
+    data = _endpoint(nama)
+    if not sukses and data["status"] == TERBUKA:
+        data["dibuka_pada"] = time.monotonic()
+
+def _persentil(nilai, p):
+    if not nilai:
+        return 0.0
+    urut = sorted(nilai)
+    return urut[min(len(urut) - 1, int(round(p * (len(urut) - 1))))]
+
+def ringkasan():
+    """Kesehatan tiap endpoint: {"nama": {"status", "request", "error_rate", "p95"}} dalam jendela WINDOW."""
+    hasil = {}
+    for nama, data in _endpoints.items():
+        sampel = _sampel_di_jendela(data)
+        jumlah = len(sampel)
+        hasil[nama] = {
+            "status": data["status"],
+            "request": jumlah,
+            "error_rate": sum(1 for _, _, ok in sampel if not ok) / jumlah if jumlah else 0.0,
+            "p95": _persentil([durasi for _, durasi, _ in sampel], 0.95),
+        }
+    return hasil
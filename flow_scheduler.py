@@ -0,0 +1,91 @@
+# flow_scheduler.py
+import logging
+
+from telegram import Chat, User
+
+import status_message
+
+# Jeda antar langkah flow otomatis dijadwalkan lewat JobQueue (heap timer milik APScheduler),
+# bukan asyncio.sleep di dalam task, jadi tidak ada coroutine yang tertahan selama menunggu.
+# Job hanya menyimpan user_id/chat_id; objek Update asli tidak ikut tertahan di memori.
+
+
+class UpdateTerjadwal:
+    """Pengganti Update untuk langkah yang dipicu timer, dibangun ulang dari user_id/chat_id di data job.
+
+    Tidak membawa pesan maupun callback query lama, jadi langkah yang menampilkan menu mengirim pesan baru.
+    """
+    callback_query = None
+    message = None
+    effective_message = None
+
+    def __init__(self, user_id, chat_id):
+        self.effective_user = User(id=user_id, first_name="", is_bot=False)
+        self.effective_chat = Chat(id=chat_id, type=Chat.PRIVATE)
+
+
+def _ids(update):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id if update.effective_chat else user_id
+    return user_id, chat_id
+
+async def _hapus_pesan(context, user_id, message_id):
+    if message_id is None:
+        return
+    status_message.lupakan(user_id, message_id)
+    try:
+        await context.bot.delete_message(chat_id=user_id, message_id=message_id)
+    except Exception as e:
+        logging.warning(f"Gagal menghapus pesan jeda {message_id} untuk user {user_id}: {e}")
+
+async def _jalankan_langkah(context):
+    data = context.job.data
+    await _hapus_pesan(context, data["user_id"], data["hapus_pesan_id"])
+    await data["langkah"](UpdateTerjadwal(data["user_id"], data["chat_id"]), context)
+
+def jadwalkan(context, detik, langkah, update, hapus_pesan_id=None):
+    """Jalankan langkah(update, context) setelah `detik` detik; pesan hapus_pesan_id dihapus lebih dulu."""
+    user_id, chat_id = _ids(update)
+    return context.job_queue.run_once(
+        _jalankan_langkah, detik, user_id=user_id, chat_id=chat_id,
+        data={"langkah": langkah, "user_id": user_id, "chat_id": chat_id, "hapus_pesan_id": hapus_pesan_id},
+        name=f"flow_{langkah.__name__}_{user_id}"
+    )
+
+async def _jalankan_panggilan(context):
+    data = context.job.data
+    await data["fungsi"](UpdateTerjadwal(data["user_id"], data["chat_id"]), context, **data["kwargs"])
+
+def jadwalkan_panggilan(context, detik, fungsi, user_id, kwargs):
+    """Panggil fungsi(update, context, **kwargs) setelah `detik` detik; kwargs berisi data biasa (id, kode paket), bukan Update."""
+    return context.job_queue.run_once(
+        _jalankan_panggilan, detik, user_id=user_id, chat_id=user_id,
+        data={"fungsi": fungsi, "user_id": user_id, "chat_id": user_id, "kwargs": kwargs},
+        name=f"panggil_{fungsi.__name__}_{user_id}"
+    )
+
+async def _tick_countdown(context):
+    data = context.job.data
+    data["sisa"] -= data["interval"]
+    dibatalkan = data["batal"] is not None and data["batal"](context)
+    if data["sisa"] > 0 and not dibatalkan:
+        try:
+            await data["tampilkan"](context, data["sisa"])
+        except Exception as e:
+            if "message is not modified" not in str(e):
+                logging.warning(f"Gagal memperbarui countdown untuk user {data['user_id']}: {e}")
+        return
+    context.job.schedule_removal()
+    await _hapus_pesan(context, data["user_id"], data["hapus_pesan_id"])
+    await data["langkah"](UpdateTerjadwal(data["user_id"], data["chat_id"]), context)
+
+def jadwalkan_countdown(context, detik, interval, tampilkan, langkah, update, hapus_pesan_id=None, batal=None):
+    """Countdown tanpa task yang tidur: await tampilkan(context, sisa_detik) tiap `interval` detik,
+    lalu langkah(update, context) saat waktu habis atau batal(context) bernilai True."""
+    user_id, chat_id = _ids(update)
+    return context.job_queue.run_repeating(
+        _tick_countdown, interval, first=interval, user_id=user_id, chat_id=chat_id,
+        data={"sisa": detik, "interval": interval, "tampilkan": tampilkan, "langkah": langkah,
+              "user_id": user_id, "chat_id": chat_id, "hapus_pesan_id": hapus_pesan_id, "batal": batal},
+        name=f"countdown_{langkah.__name__}_{user_id}"
+    )
@@ -85,7 +85,9 @@ async def ask_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await query.edit_message_text("Gagal mengambil data user/paket.")
         return ConversationHandler.END
     harga_paket = int(pkg_details['harga_final'])
-    context.user_data.update({'harga_paket': harga_paket, 'harga_kmsp': int(pkg_details.get('harga_kmsp') or 0)})
+    # purchase_key: kunci idempotensi konfirmasi ini, agar tombol konfirmasi yang ditekan dua kali hanya memotong saldo sekali
+    context.user_data.update({'harga_paket': harga_paket, 'harga_kmsp': int(pkg_details.get('harga_kmsp') or 0),
+                              'purchase_key': 'P' + uuid.uuid4().hex})
     if user_data['balance'] < harga_paket:
         await query.edit_message_text(f"Saldo Anda (Rp{user_data['balance']:,}) tidak cukup.")
         return ConversationHandler.END
@@ -102,14 +104,29 @@ async def process_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await query.answer()
     await query.edit_message_text("✅ Konfirmasi diterima. Memproses transaksi ke server...")
     ud = context.user_data
-    result = kmsp_api.purchase_package(ud['package_code'], ud['phone_number'], 'DANA', ud['harga_kmsp'])
+    purchase_key = ud.get('purchase_key')
+    if not purchase_key:
+        await query.edit_message_text("ℹ️ Pesanan ini sudah diproses sebelumnya.", reply_markup=keyboards.main_menu_keyboard())
+        return ConversationHandler.END
+    # Saldo dipotong lebih dulu dengan UPDATE bersyarat di database, dikembalikan jika pembelian gagal.
+    debit = database.debit_balance(update.effective_user.id, ud['harga_paket'], purchase_key, note=ud['package_code'])
+    if debit != database.LEDGER_APPLIED:
+        if debit == database.LEDGER_INSUFFICIENT:
+            await query.edit_message_text("❌ **GAGAL!**\n\nSaldo Anda tidak cukup.", parse_mode='Markdown', reply_markup=keyboards.main_menu_keyboard())
+        elif debit == database.LEDGER_ERROR:
+            await query.edit_message_text("❌ Gagal memproses saldo. Silakan coba lagi.", reply_markup=keyboards.main_menu_keyboard())
+        else:
+            await query.edit_message_text("ℹ️ Pesanan ini sudah diproses sebelumnya.", reply_markup=keyboards.main_menu_keyboard())
+        return ConversationHandler.END
+    result = await kmsp_api.purchase_package(ud['package_code'], ud['phone_number'], 'DANA', ud['harga_kmsp'])
+    ud.pop('purchase_key', None)
     user_info = database.get_user_balance(update.effective_user.id)
     pkg_details = database.get_package_details(ud['package_code'])
     if result and result.get('status'):
-        database.update_user_balance(user_info['username'], user_info['balance'] - ud['harga_paket'])
         msg, trx_id, status_log = result.get('message', 'Sukses!'), result.get('data', {}).get('trx_id', 'N/A'), 'success'
         await query.edit_message_text(f"✅ **BERHASIL!**\n\n{msg}\n**ID Transaksi:** `{trx_id}`", parse_mode='Markdown', reply_markup=keyboards.main_menu_keyboard())
     else:
+        database.credit_balance(update.effective_user.id, ud['harga_paket'], f"{purchase_key}:refund", note=ud['package_code'])
         msg, status_log = result.get('message', 'Gagal dari server.'), 'error'
         await query.edit_message_text(f"❌ **GAGAL!**\n\n{msg}", reply_markup=keyboards.main_menu_keyboard())
     log_data = {'wid': 'W'+str(uuid.uuid4().int)[:9],'tid': result.get('data',{}).get('trx_id','T'+str(uuid.uuid4().int)[:9]),'user': user_info.get('username'),'code': ud['package_code'],'name': pkg_details['package_name'],'data': ud['phone_number'],'note': msg,'price': ud['harga_paket'],'status': status_log,'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
@@ -131,7 +148,7 @@ async def receive_phone_for_otp(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Format nomor salah. Harap gunakan awalan 628. Coba lagi:")
         return OTP_ASK_PHONE
     await update.message.reply_text(f"⏳ Mengirim kode OTP ke {phone}, mohon tunggu...")
-    result = kmsp_api.request_otp(phone)
+    result = await kmsp_api.request_otp(phone)
     if result and result.get('status'):
         context.user_data['auth_id'] = result['data']['auth_id']
         context.user_data['phone'] = phone
@@ -145,7 +162,7 @@ async def receive_otp_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     otp_code = update.message.text.strip()
     auth_id, phone = context.user_data.get('auth_id'), context.user_data.get('phone')
     await update.message.reply_text(f"🔑 Memverifikasi kode OTP...")
-    result = kmsp_api.login_with_otp(phone, auth_id, otp_code)
+    result = await kmsp_api.login_with_otp(phone, auth_id, otp_code)
     if result and result.get('status'):
         context.user_data['access_token'] = result['data']['access_token']
         await update.message.reply_text(
@@ -165,7 +182,7 @@ async def check_pulsa_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not access_token:
         await query.edit_message_text("Sesi berakhir. Silakan login kembali.", reply_markup=keyboards.main_menu_keyboard())
         return
-    result = kmsp_api.get_subscriber_info(access_token)
+    result = await kmsp_api.get_subscriber_info(access_token)
     if result and result.get('status'):
         data = result['data']
         text = (f"💰 **Informasi Pulsa & Nomor**\n\n"
@@ -184,7 +201,7 @@ async def check_lokasi_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     if not access_token:
         await query.edit_message_text("Sesi berakhir. Silakan login kembali.", reply_markup=keyboards.main_menu_keyboard())
         return
-    result = kmsp_api.get_subscriber_location(access_token)
+    result = await kmsp_api.get_subscriber_location(access_token)
     if result and result.get('status'):
         text = f"📍 **Lokasi Terdeteksi:**\n`{result['data']['location']}`"
         await query.edit_message_text(text, parse_mode='Markdown', reply_markup=keyboards.panel_xl_keyboard())
@@ -198,7 +215,7 @@ async def check_paket_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not access_token:
         await query.edit_message_text("Sesi berakhir. Silakan login kembali.", reply_markup=keyboards.main_menu_keyboard())
         return
-    result = kmsp_api.get_quota_details(access_token)
+    result = await kmsp_api.get_quota_details(access_token)
     if result and result.get('status') and result['data']['quotas']:
         text = "📦 **Daftar Paket Aktif Anda:**\n\n"
         buttons = []
@@ -218,7 +235,7 @@ async def unreg_paket_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not access_token:
         await query.edit_message_text("Sesi berakhir. Silakan login kembali.", reply_markup=keyboards.main_menu_keyboard())
         return
-    result = kmsp_api.unreg_package(access_token, encrypted_code)
+    result = await kmsp_api.unreg_package(access_token, encrypted_code)
     if result and result.get('status'):
         await query.edit_message_text("✅ Paket berhasil dihentikan. Silakan cek ulang.", reply_markup=keyboards.panel_xl_keyboard())
     else:
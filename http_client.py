@@ -0,0 +1,31 @@
+import logging
+
+import httpx
+
+DEFAULT_TIMEOUT = 20
+POOL_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+
+_client = None
+
+def get_client():
+    """Kembalikan AsyncClient bersama; koneksi keep-alive di-pool per host (KMSP, Hesda, QRIS, dst)."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(limits=POOL_LIMITS, timeout=DEFAULT_TIMEOUT, follow_redirects=True)
+    return _client
+
+async def get(url, params=None, headers=None, timeout=DEFAULT_TIMEOUT):
+    """GET async lewat client bersama."""
+    return await get_client().get(url, params=params, headers=headers, timeout=timeout)
+
+async def post(url, data=None, json=None, headers=None, timeout=DEFAULT_TIMEOUT):
+    """POST async lewat client bersama."""
+    return await get_client().post(url, data=data, json=json, headers=headers, timeout=timeout)
+
+async def tutup():
+    """Tutup client bersama beserta semua koneksi di pool-nya."""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+        logging.info("HTTP client bersama ditutup.")
+    _client = None
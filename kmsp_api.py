@@ -1,67 +1,77 @@
 # kmsp_api.py
-import requests
+import asyncio
 import config
 import logging
 
+import httpx
+
+import provider_client
+
 logger = logging.getLogger(__name__)
 
-BASE_URLS = {
-    # URL Lama
-    "accesstokenlist": "https://golang-openapi-accesstokenlist-xltembakservice.kmsp-store.com/v1",
-    "purchase": "https://golang-openapi-packagepurchase-xltembakservice.kmsp-store.com/v1",
-    # URL Baru dari Panel Modern
-    "reqotp": "https://golang-openapi-reqotp-xltembakservice.kmsp-store.com/v1",
-    "login": "https://golang-openapi-login-xltembakservice.kmsp-store.com/v1",
-    "subscriberinfo": "https://golang-openapi-subscriberinfo-xltembakservice.kmsp-store.com/v1",
-    "subscriberlocation": "https://golang-openapi-subscriberlocation-xltembakservice.kmsp-store.com/v1",
-    "quotadetails": "https://golang-openapi-quotadetails-xltembakservice.kmsp-store.com/v1",
-    "unregpackage": "https://golang-openapi-unregpackage-xltembakservice.kmsp-store.com/v1"
-}
+# Endpoint, timeout & retry KMSP sekarang dikelola di provider_client.KMSP_ENDPOINTS.
+HEADERS = {'User-Agent': 'PPOB-Bot-Python'}
 
-def _api_get(url, params={}):
+async def _api_get(nama_endpoint, params=None):
     """Fungsi helper untuk melakukan request GET ke API."""
+    return await provider_client.kmsp_get_json(nama_endpoint, config.KMSP_API_KEY, headers=HEADERS, **(params or {}))
+
+# --- Fungsi untuk Pembelian ---
+async def purchase_package(package_code, phone_number, payment_method, price_or_fee, access_token=None):
+    """Beli paket lewat antrian pembelian provider_client; respons 422 'palsu' dari provider dianggap sukses."""
     try:
-        params['api_key'] = config.KMSP_API_KEY
-        headers = {'User-Agent': 'PPOB-Bot-Python'}
-        response = requests.get(url, params=params, headers=headers, timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"API request error: {e}")
+        response = await provider_client.kmsp_purchase(config.KMSP_API_KEY, package_code, phone_number, access_token,
+                                                       payment_method, price_or_fee=price_or_fee)
+    except ValueError as e:
+        # SirkuitTerbuka / SaldoPanelHabis: request tidak dikirim ke provider
+        return {'status': False, 'message': str(e)}
+    except (httpx.HTTPError, asyncio.TimeoutError) as e:
+        logger.error(f"KMSP purchase request error: {e}")
         return {'status': False, 'message': f"Gagal menghubungi server API: {e}"}
 
-# --- Fungsi untuk Pembelian (sudah ada) ---
-def purchase_package(package_code, phone_number, payment_method, price_or_fee):
-    # ... (kode fungsi ini tidak berubah, bisa dibiarkan)
-    pass # Placeholder
+    try:
+        result = provider_client.normalisasi_respons(response.json())
+    except ValueError:
+        result = {}
+    # Body dicek sebelum status HTTP: 422 'palsu' berarti pembelian sudah diproses provider.
+    if provider_client.is_sukses_422(response.text):
+        logger.info(f"Pembelian {package_code} untuk {phone_number} dianggap sukses (respons 422 khusus).")
+        result['status'] = True
+        return result
+    if response.status_code >= 400:
+        logger.error(f"KMSP purchase HTTP {response.status_code}: {response.text[:200]}")
+        return {'status': False, 'message': result.get('message') or f"Gagal menghubungi server API: HTTP {response.status_code}"}
+    if not result:
+        return {'status': False, 'message': "Respons API tidak valid (bukan JSON)."}
+    return result
 
 # --- Fungsi-Fungsi Baru untuk Panel XL ---
-def request_otp(phone):
+async def request_otp(phone):
     """Meminta OTP ke nomor telepon."""
     params = {'phone': phone, 'method': 'OTP'}
-    return _api_get(BASE_URLS['reqotp'], params)
+    return await _api_get('reqotp', params)
 
-def login_with_otp(phone, auth_id, otp):
+async def login_with_otp(phone, auth_id, otp):
     """Login menggunakan OTP untuk mendapatkan access_token."""
     params = {'phone': phone, 'method': 'OTP', 'auth_id': auth_id, 'otp': otp}
-    return _api_get(BASE_URLS['login'], params)
+    return await _api_get('login', params)
 
-def get_subscriber_info(access_token):
+async def get_subscriber_info(access_token):
     """Cek Pulsa & Masa Aktif."""
     params = {'access_token': access_token}
-    return _api_get(BASE_URLS['subscriberinfo'], params)
+    return await _api_get('subscriberinfo', params)
 
-def get_subscriber_location(access_token):
+async def get_subscriber_location(access_token):
     """Cek Lokasi Kartu."""
     params = {'access_token': access_token}
-    return _api_get(BASE_URLS['subscriberlocation'], params)
+    return await _api_get('subscriberlocation', params)
 
-def get_quota_details(access_token):
+async def get_quota_details(access_token):
     """Cek Paket Aktif."""
     params = {'access_token': access_token}
-    return _api_get(BASE_URLS['quotadetails'], params)
+    return await _api_get('quotadetails', params)
 
-def unreg_package(access_token, encrypted_code):
+async def unreg_package(access_token, encrypted_code):
     """Stop/Unreg paket aktif."""
     params = {'access_token': access_token, 'encrypted_package_code': encrypted_code}
-    return _api_get(BASE_URLS['unregpackage'], params)
+    return await _api_get('unregpackage', params)
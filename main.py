@@ -7,6 +7,8 @@ from telegram.ext import (
 import config
 import handlers
 import database
+import http_client
+import purchase_queue
 
 # Konfigurasi logging
 logging.basicConfig(
@@ -19,10 +21,19 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     """Menangani semua error yang tidak tertangkap."""
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
 
+async def post_init(application: Application) -> None:
+    """Jalankan worker antrian pembelian setelah event loop aktif."""
+    purchase_queue.mulai()
+
+async def post_shutdown(application: Application) -> None:
+    """Hentikan antrian pembelian dan tutup koneksi HTTP bersama saat bot berhenti."""
+    await purchase_queue.berhenti()
+    await http_client.tutup()
+
 def main() -> None:
     """Memulai dan menjalankan bot."""
     database.init_db()
-    application = Application.builder().token(config.BOT_TOKEN).build()
+    application = Application.builder().token(config.BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     application.add_error_handler(error_handler)
 
     # --- Daftarkan semua handler ---
@@ -0,0 +1,102 @@
+# package_catalog.py
+import asyncio
+import logging
+import time
+
+import httpx
+
+import endpoint_health
+import provider_client
+
+CATALOG_TTL = 600               # detik sebelum katalog dianggap basi
+CATALOG_REFRESH_INTERVAL = 300  # interval refresh berkala dari job queue
+
+_paket_list = []
+_paket_index = {}
+_harga_index = {}
+_listeners = []
+_dimuat_pada = None
+_refresh_lock = asyncio.Lock()
+_refresh_task = None
+
+def parse_harga(nilai):
+    """Ubah harga API ("Rp. 5.000,00", "5000", 5000) menjadi int rupiah; 0 jika tidak terbaca."""
+    if isinstance(nilai, (int, float)):
+        return int(nilai)
+    teks = str(nilai or "").replace("Rp", "").replace(" ", "").lstrip(".")
+    bagian_bulat = teks.split(",", 1)[0].replace(".", "")
+    try:
+        return int(bagian_bulat)
+    except ValueError:
+        return 0
+
+def tambah_listener(fungsi):
+    """Daftarkan fungsi (tanpa argumen) yang dipanggil setiap katalog berhasil diperbarui."""
+    _listeners.append(fungsi)
+
+def harga_api():
+    """Mapping package_code -> harga API (int) dari katalog terakhir."""
+    return _harga_index
+
+def sudah_dimuat():
+    """True jika katalog pernah berhasil dimuat dari API."""
+    return _dimuat_pada is not None
+
+def is_basi():
+    """True jika katalog belum dimuat atau umurnya melewati CATALOG_TTL."""
+    return _dimuat_pada is None or time.monotonic() - _dimuat_pada > CATALOG_TTL
+
+async def refresh(api_key):
+    """Ambil ulang packagelist dari KMSP dan ganti katalog; katalog lama dipertahankan jika gagal."""
+    global _paket_list, _paket_index, _harga_index, _dimuat_pada
+    if _refresh_lock.locked():
+        # Refresh lain sedang berjalan, cukup tunggu hasilnya.
+        async with _refresh_lock:
+            return sudah_dimuat()
+    async with _refresh_lock:
+        try:
+            response = await provider_client.kmsp_get("packagelist", api_key)
+            response.raise_for_status()
+            paket_data = response.json().get("data", [])
+        except httpx.HTTPError as e:
+            logging.error(f"Gagal refresh katalog paket API: {e}")
+            return False
+        except endpoint_health.SirkuitTerbuka as e:
+            logging.warning(f"Refresh katalog paket API dilewati: {e}")
+            return False
+        except (ValueError, AttributeError):
+            logging.error("Gagal memecah JSON dari API list paket.")
+            return False
+        _paket_list = paket_data
+        _paket_index = {p.get("package_code"): p for p in paket_data if p.get("package_code")}
+        _harga_index = {code: parse_harga(p.get("package_harga")) for code, p in _paket_index.items()}
+        _dimuat_pada = time.monotonic()
+        logging.info(f"Katalog paket API diperbarui: {len(_paket_index)} paket.")
+        for fungsi in _listeners:
+            try:
+                fungsi()
+            except Exception as e:
+                logging.error(f"Listener katalog paket gagal: {e}", exc_info=True)
+        return True
+
+def _refresh_di_background(api_key):
+    """Jadwalkan satu refresh di background (stale-while-revalidate)."""
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.create_task(refresh(api_key))
+
+async def _pastikan_dimuat(api_key):
+    if not sudah_dimuat():
+        await refresh(api_key)
+    elif is_basi():
+        _refresh_di_background(api_key)
+
+async def get_packages(api_key):
+    """Semua paket dari katalog (urutan sesuai API); None jika katalog belum pernah bisa dimuat."""
+    await _pastikan_dimuat(api_key)
+    return _paket_list if sudah_dimuat() else None
+
+async def get_package(api_key, package_code):
+    """Detail satu paket berdasarkan package_code, atau None."""
+    await _pastikan_dimuat(api_key)
+    return _paket_index.get(package_code)
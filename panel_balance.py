@@ -0,0 +1,70 @@
+# panel_balance.py
+import logging
+import time
+
+# Saldo akun panel KMSP di-poll berkala oleh job queue; admin panel dan cek pembelian cukup membaca cache.
+BALANCE_POLL_INTERVAL = 120   # detik antar poll saldo panel
+BATAS_PERINGATAN = 50000      # saldo di bawah ini memicu peringatan ke admin
+BATAS_BLOKIR = 5000           # saldo di bawah ini: pembelian KMSP ditolak sebelum dikirim ke upstream
+PERINGATAN_ULANG = 3600       # jarak minimal antar peringatan saldo rendah
+MAKS_UMUR = 3 * BALANCE_POLL_INTERVAL  # saldo yang lebih tua dari ini tidak dipakai untuk memblokir pembelian
+
+_saldo = None
+_pesan = "Belum dimuat"
+_diperbarui_pada = None
+_peringatan_terakhir = None
+
+
+class SaldoPanelHabis(ValueError):
+    """Saldo panel provider di bawah BATAS_BLOKIR; turunan ValueError agar pesannya tampil ke user."""
+
+    def __init__(self):
+        super().__init__("Stok server sedang habis, pembelian belum bisa diproses. Silakan coba lagi nanti atau hubungi admin.")
+
+
+def perbarui(saldo, pesan=None):
+    """Simpan hasil poll: saldo (int) jika berhasil, atau None beserta pesan error (saldo lama tetap disimpan)."""
+    global _saldo, _pesan, _diperbarui_pada, _peringatan_terakhir
+    _pesan = pesan
+    if saldo is None:
+        return
+    _saldo = saldo
+    _diperbarui_pada = time.monotonic()
+    if saldo >= BATAS_PERINGATAN:
+        _peringatan_terakhir = None
+
+def saldo():
+    """Saldo panel terakhir yang diketahui (int) atau None."""
+    return _saldo
+
+def umur():
+    """Detik sejak saldo terakhir berhasil diperbarui, atau None."""
+    return None if _diperbarui_pada is None else time.monotonic() - _diperbarui_pada
+
+def teks():
+    """Saldo untuk ditampilkan di admin panel, lengkap dengan umur cache."""
+    if _saldo is None:
+        return _pesan or "Belum dimuat"
+    detik = int(umur())
+    usia = f"{detik} detik lalu" if detik < 60 else f"{detik // 60} menit lalu"
+    hasil = f"Rp{_saldo:,} ({usia})"
+    if _pesan:
+        hasil += f" ⚠️ {_pesan}"
+    return hasil
+
+def cek_pembelian():
+    """Lempar SaldoPanelHabis jika saldo panel (yang masih segar) sudah di bawah BATAS_BLOKIR."""
+    if _saldo is not None and _saldo < BATAS_BLOKIR and umur() <= MAKS_UMUR:
+        logging.warning(f"Pembelian KMSP ditolak: saldo panel Rp{_saldo:,} di bawah batas Rp{BATAS_BLOKIR:,}.")
+        raise SaldoPanelHabis()
+
+def perlu_peringatan():
+    """True (sekali per PERINGATAN_ULANG) jika saldo panel di bawah BATAS_PERINGATAN."""
+    global _peringatan_terakhir
+    if _saldo is None or _saldo >= BATAS_PERINGATAN:
+        return False
+    sekarang = time.monotonic()
+    if _peringatan_terakhir is not None and sekarang - _peringatan_terakhir < PERINGATAN_ULANG:
+        return False
+    _peringatan_terakhir = sekarang
+    return True
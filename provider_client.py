@@ -0,0 +1,168 @@
+# provider_client.py
+import asyncio
+import logging
+import sqlite3
+import time
+
+import httpx
+
+import account_store
+import endpoint_health
+import panel_balance
+import http_client
+import purchase_queue
+import retry_engine
+
+# Registry endpoint provider. Timeout & jumlah retry diatur per endpoint di sini;
+# retry hanya untuk error transport (koneksi/timeout), tidak pernah untuk pembelian.
+# "cek_latensi": False mematikan pembukaan sirkuit karena p95 latensi; pembelian memang wajar lambat.
+KMSP_ENDPOINTS = {
+    "accesstokenlist": {"url": "https://golang-openapi-accesstokenlist-xltembakservice.kmsp-store.com/v1", "timeout": 20, "retries": 1},
+    "purchase": {"url": "https://golang-openapi-packagepurchase-xltembakservice.kmsp-store.com/v1", "timeout": 58, "retries": 0, "cek_latensi": False},
+    "reqotp": {"url": "https://golang-openapi-reqotp-xltembakservice.kmsp-store.com/v1", "timeout": 20, "retries": 0},
+    "login": {"url": "https://golang-openapi-login-xltembakservice.kmsp-store.com/v1", "timeout": 20, "retries": 0},
+    "subscriberinfo": {"url": "https://golang-openapi-subscriberinfo-xltembakservice.kmsp-store.com/v1", "timeout": 30, "retries": 2},
+    "subscriberlocation": {"url": "https://golang-openapi-subscriberlocation-xltembakservice.kmsp-store.com/v1", "timeout": 30, "retries": 2},
+    "quotadetails": {"url": "https://golang-openapi-quotadetails-xltembakservice.kmsp-store.com/v1", "timeout": 30, "retries": 2},
+    "unregpackage": {"url": "https://golang-openapi-unregpackage-xltembakservice.kmsp-store.com/v1", "timeout": 20, "retries": 0},
+    "packagelist": {"url": "https://golang-openapi-packagelist-xltembakservice.kmsp-store.com/v1", "timeout": 30, "retries": 2},
+    "panelaccountbalance": {"url": "https://golang-openapi-panelaccountbalance-xltembakservice.kmsp-store.com/v1", "timeout": 10, "retries": 1},
+}
+
+HESDA_ENDPOINTS = {
+    "get_otp": {"url": "https://api.hesda-store.com/v2/get_otp", "timeout": 20, "retries": 0},
+    "login_sms": {"url": "https://api.hesda-store.com/v2/login_sms", "timeout": 20, "retries": 0},
+    "beli_otp": {"url": "https://api.hesda-store.com/v2/beli/otp", "timeout": 58, "retries": 0, "cek_latensi": False},
+}
+
+RETRY_DELAY = 1.5
+PURCHASE_TIMEOUT = 60.0   # batas total satu request pembelian, di luar waktu tunggu antrian
+
+# Respons 422 ini dari KMSP/Hesda sebenarnya berarti pembelian berhasil diproses.
+SUKSES_422_MESSAGE = "Error Message: 422 -> Failed call ipaas purchase, with status code:422 : null"
+SUKSES_MYXL_MESSAGE = "Paket berhasil dibeli. Silakan cek kuotanya via aplikasi MyXL (disarankan) dan/atau via SMS kamu"
+
+
+def normalisasi_respons(result):
+    """Samakan bentuk respons provider: list diambil elemen pertamanya, selain dict jadi {}."""
+    if isinstance(result, list):
+        result = result[0] if result else {}
+    return result if isinstance(result, dict) else {}
+
+def is_sukses_422(message):
+    """True jika pesan API adalah 422 'palsu' yang menandakan pembelian sukses."""
+    return SUKSES_422_MESSAGE in (message or "")
+
+def is_sukses_myxl(message):
+    """True jika pesan API adalah konfirmasi sukses gaya MyXL."""
+    return SUKSES_MYXL_MESSAGE in (message or "")
+
+async def _kirim(method, nama, endpoint, params=None, data=None, headers=None):
+    """Kirim request sesuai konfigurasi endpoint, ulangi hanya untuk error transport.
+
+    Setiap percobaan dicatat ke endpoint_health, termasuk yang dibatalkan timeout pemanggil (wait_for);
+    jika sirkuit endpoint terbuka request tidak dikirim dan SirkuitTerbuka dilempar.
+    """
+    retries = endpoint.get("retries", 0)
+    batas_latensi = endpoint["timeout"] if endpoint.get("cek_latensi", True) else None
+    percobaan = 0
+    while True:
+        endpoint_health.cek(nama)
+        mulai = time.monotonic()
+        try:
+            if method == "GET":
+                response = await http_client.get(endpoint["url"], params=params, headers=headers, timeout=endpoint["timeout"])
+            else:
+                response = await http_client.post(endpoint["url"], data=data, headers=headers, timeout=endpoint["timeout"])
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            endpoint_health.catat(nama, time.monotonic() - mulai, False, batas_latensi)
+            raise
+        except httpx.TransportError as e:
+            endpoint_health.catat(nama, time.monotonic() - mulai, False, batas_latensi)
+            if percobaan >= retries:
+                raise
+            percobaan += 1
+            logging.warning(f"Request ke {endpoint['url']} gagal ({type(e).__name__}), mencoba lagi ({percobaan}/{retries})...")
+            await asyncio.sleep(RETRY_DELAY * percobaan)
+        else:
+            endpoint_health.catat(nama, time.monotonic() - mulai, response.status_code < 500, batas_latensi)
+            return response
+
+async def kmsp_get(nama_endpoint, api_key, headers=None, **params):
+    """GET ke endpoint KMSP dari registry; parameter di-encode oleh httpx, nilai None dibuang."""
+    endpoint = KMSP_ENDPOINTS[nama_endpoint]
+    query = {"api_key": api_key}
+    query.update({k: v for k, v in params.items() if v is not None})
+    return await _kirim("GET", f"kmsp:{nama_endpoint}", endpoint, params=query, headers=headers)
+
+async def kmsp_get_json(nama_endpoint, api_key, headers=None, **params):
+    """Seperti kmsp_get, tapi mengembalikan dict ter-normalisasi; kegagalan jadi {'status': False, 'message': ...}."""
+    try:
+        response = await kmsp_get(nama_endpoint, api_key, headers=headers, **params)
+        response.raise_for_status()
+        return normalisasi_respons(response.json())
+    except endpoint_health.SirkuitTerbuka as e:
+        return {'status': False, 'message': str(e)}
+    except httpx.HTTPError as e:
+        logging.error(f"KMSP {nama_endpoint} request error: {e}")
+        return {'status': False, 'message': f"Gagal menghubungi server API: {e}"}
+    except ValueError:
+        logging.error(f"KMSP {nama_endpoint} mengembalikan respons non-JSON.")
+        return {'status': False, 'message': "Respons API tidak valid (bukan JSON)."}
+
+def _catat_token(phone, provider, access_token, response):
+    """Catat ke account_store apakah token diterima atau ditolak upstream pada respons pembelian."""
+    if not access_token or response.status_code >= 500:
+        return
+    try:
+        if retry_engine.is_pesan_token(response.text):
+            account_store.tandai_ditolak(phone, provider, access_token)
+        elif response.status_code < 400:
+            account_store.tandai_sukses(phone, provider, access_token)
+    except sqlite3.Error as e:
+        logging.warning(f"Gagal mencatat status token {provider} untuk {phone}: {e}")
+
+async def kmsp_purchase(api_key, package_code, phone, access_token, payment_method, price_or_fee=None,
+                        prioritas=purchase_queue.PRIORITAS_SINGLE):
+    """Request pembelian paket KMSP lewat antrian pembelian (tanpa retry, agar tidak terjadi pembelian ganda).
+
+    Ditolak lebih dulu dengan SaldoPanelHabis jika saldo panel (cache) sudah di bawah batas blokir.
+    """
+    panel_balance.cek_pembelian()
+    response = await purchase_queue.submit("kmsp", lambda: asyncio.wait_for(
+        kmsp_get("purchase", api_key, package_code=package_code, phone=phone, access_token=access_token,
+                 payment_method=payment_method, price_or_fee=price_or_fee),
+        timeout=PURCHASE_TIMEOUT), prioritas)
+    _catat_token(phone, "kmsp", access_token, response)
+    return response
+
+async def hesda_post(nama_endpoint, headers, **data):
+    """POST form ke endpoint Hesda dari registry."""
+    endpoint = HESDA_ENDPOINTS[nama_endpoint]
+    return await _kirim("POST", f"hesda:{nama_endpoint}", endpoint, data=data, headers=headers)
+
+async def hesda_beli(headers, payload, prioritas=purchase_queue.PRIORITAS_SINGLE):
+    """Request pembelian paket Hesda (beli_otp) lewat antrian pembelian."""
+    response = await purchase_queue.submit("hesda", lambda: asyncio.wait_for(
+        hesda_post("beli_otp", headers, **payload), timeout=PURCHASE_TIMEOUT), prioritas)
+    _catat_token(payload.get("no_hp"), "hesda", payload.get("access_token"), response)
+    return response
+
+async def probe_endpoint_terbuka(kmsp_api_key):
+    """Probe endpoint KMSP yang sirkuitnya terbuka dengan request ber-api_key yang ringan (packagelist).
+
+    Probe gagal menahan sirkuit tetap terbuka; probe sukses hanya membiarkan request asli berikutnya lewat
+    sebagai probe half-open. Hesda tidak punya endpoint ringan, jadi sirkuitnya langsung diputuskan oleh
+    request asli setelah cooldown.
+    """
+    for nama in endpoint_health.perlu_probe():
+        if not nama.startswith("kmsp:"):
+            continue
+        endpoint = KMSP_ENDPOINTS["packagelist"]
+        try:
+            response = await http_client.get(endpoint["url"], params={"api_key": kmsp_api_key}, timeout=endpoint["timeout"])
+            sukses = response.status_code < 400 and normalisasi_respons(response.json()).get("status", True) is not False
+        except (httpx.HTTPError, ValueError):
+            sukses = False
+        logging.info(f"Probe endpoint {nama} lewat packagelist: {'upstream menjawab' if sukses else 'masih gagal'}.")
+        endpoint_health.hasil_probe(nama, sukses)
@@ -0,0 +1,87 @@
+# purchase_jobs.py
+import json
+import logging
+import sqlite3
+from datetime import datetime
+
+JENIS_XCS = "xcs_addon"
+JENIS_XUTP = "xutp"
+JENIS_HESDA_BATCH = "hesda_batch"
+JENIS_30H_BATCH = "30h_batch"
+
+_db_file = None
+
+def inisialisasi(db_file):
+    """Siapkan tabel purchase_jobs; satu baris per (user, jenis flow) yang sedang berjalan."""
+    global _db_file
+    _db_file = db_file
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS purchase_jobs (
+            user_id INTEGER NOT NULL, jenis TEXT NOT NULL, state TEXT NOT NULL,
+            dana_tertahan INTEGER DEFAULT 0, dibuat_pada TEXT NOT NULL, diperbarui_pada TEXT NOT NULL,
+            PRIMARY KEY (user_id, jenis)
+        )''')
+        conn.commit()
+    finally:
+        conn.close()
+
+def _serialisasi(state):
+    # Objek yang tidak bisa disimpan (mis. asyncio.Task di state flow) disimpan sebagai null.
+    return json.dumps(state, default=lambda _: None)
+
+def simpan(user_id, jenis, state, dana_tertahan=0):
+    """Checkpoint state flow beserta saldo user yang sudah dipotong tetapi belum terpakai."""
+    sekarang = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = sqlite3.connect(_db_file)
+    try:
+        conn.execute('''
+        INSERT INTO purchase_jobs (user_id, jenis, state, dana_tertahan, dibuat_pada, diperbarui_pada)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, jenis) DO UPDATE SET
+            state = excluded.state, dana_tertahan = excluded.dana_tertahan, diperbarui_pada = excluded.diperbarui_pada
+        ''', (int(user_id), jenis, _serialisasi(state), int(dana_tertahan or 0), sekarang, sekarang))
+        conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Gagal menyimpan job pembelian {jenis} user {user_id}: {e}")
+    finally:
+        conn.close()
+
+def hapus(user_id, jenis):
+    """Hapus job yang sudah selesai, dibatalkan, atau direfund."""
+    conn = sqlite3.connect(_db_file)
+    try:
+        conn.execute("DELETE FROM purchase_jobs WHERE user_id = ? AND jenis = ?", (int(user_id), jenis))
+        conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Gagal menghapus job pembelian {jenis} user {user_id}: {e}")
+    finally:
+        conn.close()
+
+def ambil(user_id, jenis):
+    """Satu job tertunda sebagai dict, atau None."""
+    conn = sqlite3.connect(_db_file)
+    try:
+        row = conn.execute(
+            "SELECT state, dana_tertahan, dibuat_pada, diperbarui_pada FROM purchase_jobs WHERE user_id = ? AND jenis = ?",
+            (int(user_id), jenis)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return {"user_id": int(user_id), "jenis": jenis, "state": json.loads(row[0]), "dana_tertahan": row[1],
+            "dibuat_pada": row[2], "diperbarui_pada": row[3]}
+
+def semua():
+    """Semua job tertunda (dipakai saat startup untuk resume/refund)."""
+    conn = sqlite3.connect(_db_file)
+    try:
+        rows = conn.execute(
+            "SELECT user_id, jenis, state, dana_tertahan, dibuat_pada, diperbarui_pada FROM purchase_jobs ORDER BY diperbarui_pada"
+        ).fetchall()
+    finally:
+        conn.close()
+    return [{"user_id": row[0], "jenis": row[1], "state": json.loads(row[2]), "dana_tertahan": row[3],
+             "dibuat_pada": row[4], "diperbarui_pada": row[5]} for row in rows]
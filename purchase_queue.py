@@ -0,0 +1,106 @@
+# purchase_queue.py
+import asyncio
+import itertools
+import logging
+import time
+
+# Prioritas job: angka kecil diproses lebih dulu.
+PRIORITAS_SINGLE = 0     # pembelian satuan yang ditunggu user
+PRIORITAS_OTOMATIS = 1   # langkah flow otomatis (XUTS/XC/XUTP)
+PRIORITAS_BATCH = 2      # batch add-on / antrian Hesda / 30H
+
+# Batas per provider: jumlah request pembelian paralel & jumlah request baru per detik.
+PROVIDER_LIMITS = {
+    "kmsp": {"concurrency": 4, "rate": 2.0},
+    "hesda": {"concurrency": 2, "rate": 1.0},
+}
+
+_queues = {}
+_workers = []
+_urutan = itertools.count()
+_mulai_terakhir = {}
+_rate_locks = {}
+# provider -> [job selesai, job gagal, total detik tunggu antrian]
+_statistik = {}
+
+async def _tunggu_rate(provider):
+    """Jaga jarak minimal antar job baru agar tidak melewati rate provider."""
+    jeda = 1.0 / PROVIDER_LIMITS[provider]["rate"]
+    async with _rate_locks[provider]:
+        sisa = _mulai_terakhir.get(provider, 0.0) + jeda - time.monotonic()
+        if sisa > 0:
+            await asyncio.sleep(sisa)
+        _mulai_terakhir[provider] = time.monotonic()
+
+async def _worker(provider):
+    queue = _queues[provider]
+    while True:
+        _, _, buat_coro, future, masuk_pada = await queue.get()
+        try:
+            if future.cancelled():
+                continue
+            await _tunggu_rate(provider)
+            stat = _statistik.setdefault(provider, [0, 0, 0.0])
+            stat[2] += time.monotonic() - masuk_pada
+            try:
+                hasil = await buat_coro()
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                stat[1] += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                stat[0] += 1
+                if not future.done():
+                    future.set_result(hasil)
+        finally:
+            queue.task_done()
+
+def mulai():
+    """Jalankan worker pool; panggil sekali setelah event loop aktif (post_init)."""
+    if _workers:
+        return
+    for provider, limit in PROVIDER_LIMITS.items():
+        _queues[provider] = asyncio.PriorityQueue()
+        _rate_locks[provider] = asyncio.Lock()
+        for _ in range(limit["concurrency"]):
+            _workers.append(asyncio.create_task(_worker(provider)))
+    logging.info(f"Worker antrian pembelian aktif: {len(_workers)} worker.")
+
+async def berhenti():
+    """Hentikan semua worker; job yang masih menunggu dibatalkan."""
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    for queue in _queues.values():
+        while not queue.empty():
+            _, _, _, future, _ = queue.get_nowait()
+            if not future.done():
+                future.cancel()
+    _queues.clear()
+
+async def submit(provider, buat_coro, prioritas=PRIORITAS_SINGLE):
+    """Masukkan request pembelian ke antrian provider dan tunggu hasilnya.
+
+    buat_coro adalah fungsi tanpa argumen yang membuat coroutine request; baru dipanggil
+    saat giliran job tiba. Jika worker belum berjalan, request langsung dieksekusi.
+    """
+    if provider not in _queues:
+        return await buat_coro()
+    future = asyncio.get_running_loop().create_future()
+    await _queues[provider].put((prioritas, next(_urutan), buat_coro, future, time.monotonic()))
+    return await future
+
+def statistik():
+    """Ringkasan antrian per provider: {"provider": {"antri", "selesai", "gagal", "avg_tunggu"}}."""
+    hasil = {}
+    for provider, queue in _queues.items():
+        selesai, gagal, total_tunggu = _statistik.get(provider, [0, 0, 0.0])
+        jumlah = selesai + gagal
+        hasil[provider] = {"antri": queue.qsize(), "selesai": selesai, "gagal": gagal,
+                           "avg_tunggu": total_tunggu / jumlah if jumlah else 0.0}
+    return hasil
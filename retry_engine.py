@@ -0,0 +1,95 @@
+# retry_engine.py
+import asyncio
+import logging
+import random
+
+import httpx
+
+import endpoint_health
+import panel_balance
+
+# Kelas error hasil klasifikasi; hanya TRANSIEN yang dicoba ulang.
+TOKEN_KADALUARSA = "token_kadaluarsa"
+TRANSIEN = "transien"          # gagal konek (request belum terkirim), HTTP 5xx/429
+PENDING = "pending"            # timeout/putus setelah request terkirim: pembelian mungkin sudah diproses, jangan diulang
+GAGAL_API = "gagal_api"        # API menjawab tapi menolak (status false, 4xx)
+SIRKUIT_TERBUKA = "sirkuit_terbuka"
+SALDO_PANEL_HABIS = "saldo_panel_habis"
+
+TOKEN_EXPIRED_MESSAGE = "Terjadi kesalahan saat menampilkan data subscriber info!"
+PENANDA_TOKEN = ("access token is invalid", "token invalid", "token expired", "gagal login")
+
+# Kebijakan retry: jumlah percobaan maksimal dan backoff eksponensial (detik) dengan jitter.
+RETRY_HESDA = {"max_attempts": 3, "base_delay": 10, "max_delay": 40}
+RETRY_30H = {"max_attempts": 10, "base_delay": 6, "max_delay": 30}
+SEKALI = {"max_attempts": 1, "base_delay": 0, "max_delay": 0}   # pembelian tanpa retry
+
+# Circuit breaker dikelola per endpoint oleh endpoint_health (dicek di provider_client._kirim).
+SirkuitTerbuka = endpoint_health.SirkuitTerbuka
+
+# Error transport yang terjadi sebelum request sampai ke upstream.
+BELUM_TERKIRIM = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def _pesan_api(e):
+    if isinstance(e, httpx.HTTPStatusError):
+        try:
+            return str(e.response.json().get("message", ""))
+        except (ValueError, AttributeError):
+            return ""
+    return ""
+
+def is_pesan_token(teks):
+    """True jika teks respons/error menandakan access token ditolak (kadaluarsa/tidak valid)."""
+    teks = teks or ""
+    return TOKEN_EXPIRED_MESSAGE in teks or any(penanda in teks.lower() for penanda in PENANDA_TOKEN)
+
+def klasifikasi(e):
+    """Tentukan kelas error untuk keputusan retry & circuit breaker."""
+    if isinstance(e, SirkuitTerbuka):
+        return SIRKUIT_TERBUKA
+    if isinstance(e, panel_balance.SaldoPanelHabis):
+        return SALDO_PANEL_HABIS
+    if is_pesan_token(f"{e} {_pesan_api(e)}"):
+        return TOKEN_KADALUARSA
+    if isinstance(e, BELUM_TERKIRIM):
+        return TRANSIEN
+    if isinstance(e, (asyncio.TimeoutError, httpx.TransportError)):
+        return PENDING
+    if isinstance(e, httpx.HTTPStatusError) and (e.response.status_code >= 500 or e.response.status_code == 429):
+        return TRANSIEN
+    return GAGAL_API
+
+def hitung_jeda(kebijakan, attempt):
+    """Backoff eksponensial dengan jitter: antara setengah dan penuh dari base * 2^(attempt-1), dibatasi max_delay."""
+    jeda = min(kebijakan["max_delay"], kebijakan["base_delay"] * (2 ** (attempt - 1)))
+    return random.uniform(jeda / 2, jeda)
+
+def jeda_ulang(e, kebijakan, attempt):
+    """Detik jeda sebelum percobaan berikutnya jika e boleh diulang (hanya TRANSIEN, attempt belum habis), selain itu None.
+
+    Alur yang berjalan di JobQueue memakai ini untuk menjadwalkan percobaan berikutnya lewat flow_scheduler
+    alih-alih menunggu di dalam task.
+    """
+    if klasifikasi(e) != TRANSIEN or attempt >= kebijakan["max_attempts"]:
+        return None
+    return hitung_jeda(kebijakan, attempt)
+
+async def jalankan(provider, coba, kebijakan=SEKALI, attempt_awal=1, label=""):
+    """Jalankan coba(attempt) secara iteratif sampai berhasil atau kebijakan habis.
+
+    Error terakhir dilempar ulang apa adanya (SirkuitTerbuka jika endpoint provider sedang down),
+    sehingga penanganan error pemanggil tetap sama. Hanya error TRANSIEN yang dicoba ulang; PENDING tidak,
+    agar pembelian yang mungkin sudah diproses upstream tidak terbeli dua kali.
+    """
+    attempt = attempt_awal
+    while True:
+        try:
+            return await coba(attempt)
+        except Exception as e:
+            jeda = jeda_ulang(e, kebijakan, attempt)
+            if jeda is None:
+                raise
+            logging.info(f"{label or provider}: percobaan {attempt} gagal ({e}). Mencoba lagi dalam {jeda:.1f} detik.")
+            await asyncio.sleep(jeda)
+            attempt += 1
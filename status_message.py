@@ -0,0 +1,95 @@
+# status_message.py
+import logging
+import time
+from collections import OrderedDict
+
+# Edit pesan status dibatasi per chat: update yang datang lebih rapat dari EDIT_INTERVAL digabung
+# dan hanya teks terakhir yang dikirim; teks yang sama dengan yang sudah tampil tidak dikirim ulang.
+EDIT_INTERVAL = 3.0
+MAX_PESAN_PER_CHAT = 5   # jumlah pesan status per chat yang teks terakhirnya diingat
+MAX_CHAT = 1000          # chat yang state-nya disimpan; yang paling lama tidak dipakai dibuang lebih dulu
+
+# chat_id -> {"terakhir_edit", "terkirim": {message_id: (text, reply_markup)}, "tertunda": {message_id: isi}, "job"}
+# Urutan = LRU: chat yang baru dipakai dipindah ke belakang.
+_chats = OrderedDict()
+
+
+def _idle(data):
+    return not data["tertunda"] and data["job"] is None and \
+        time.monotonic() - data["terakhir_edit"] >= EDIT_INTERVAL
+
+def _chat(chat_id):
+    data = _chats.get(chat_id)
+    if data is not None:
+        _chats.move_to_end(chat_id)
+        return data
+    if len(_chats) >= MAX_CHAT:
+        # Buang chat paling lama yang idle; chat yang masih menunggu flush dilewati.
+        kelebihan = len(_chats) + 1 - MAX_CHAT
+        for lama in list(_chats):
+            if kelebihan <= 0:
+                break
+            if _idle(_chats[lama]):
+                del _chats[lama]
+                kelebihan -= 1
+    data = _chats[chat_id] = {"terakhir_edit": 0.0, "terkirim": {}, "tertunda": {}, "job": None}
+    return data
+
+def _ingat(data, message_id, isi):
+    terkirim = data["terkirim"]
+    terkirim.pop(message_id, None)
+    terkirim[message_id] = (isi["text"], isi["reply_markup"])
+    while len(terkirim) > MAX_PESAN_PER_CHAT:
+        terkirim.pop(next(iter(terkirim)))
+
+async def _edit(bot, chat_id, message_id, isi):
+    data = _chat(chat_id)
+    data["terakhir_edit"] = time.monotonic()
+    try:
+        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, **isi)
+    except Exception as e:
+        if "message is not modified" not in str(e):
+            raise
+    _ingat(data, message_id, isi)
+
+async def _flush(context):
+    chat_id = context.job.data
+    data = _chat(chat_id)
+    data["job"] = None
+    tertunda, data["tertunda"] = data["tertunda"], {}
+    for message_id, isi in tertunda.items():
+        try:
+            await _edit(context.bot, chat_id, message_id, isi)
+        except Exception as e:
+            logging.warning(f"Gagal mengedit pesan status {message_id} untuk chat {chat_id}: {e}")
+
+async def perbarui(context, chat_id, message_id, text, parse_mode=None, reply_markup=None):
+    """Edit pesan status: langsung jika jatah edit chat tersedia, jika tidak digabung ke slot berikutnya.
+
+    Error edit langsung (selain "message is not modified") dilempar ke pemanggil seperti edit_message_text biasa.
+    """
+    data = _chat(chat_id)
+    isi = {"text": text, "parse_mode": parse_mode, "reply_markup": reply_markup}
+    if data["terkirim"].get(message_id) == (text, reply_markup):
+        data["tertunda"].pop(message_id, None)
+        return
+    sisa = data["terakhir_edit"] + EDIT_INTERVAL - time.monotonic()
+    if sisa <= 0 and not data["tertunda"]:
+        await _edit(context.bot, chat_id, message_id, isi)
+        return
+    data["tertunda"][message_id] = isi
+    if data["job"] is None:
+        data["job"] = context.job_queue.run_once(_flush, max(sisa, 0), data=chat_id, name=f"status_message_{chat_id}")
+
+def lupakan(chat_id, message_id):
+    """Buang state pesan status yang akan/sudah dihapus agar edit tertunda tidak dikirim; chat yang kosong dan idle ikut dibuang."""
+    data = _chats.get(chat_id)
+    if data is None:
+        return
+    data["terkirim"].pop(message_id, None)
+    data["tertunda"].pop(message_id, None)
+    if not data["tertunda"] and data["job"] is not None:
+        data["job"].schedule_removal()
+        data["job"] = None
+    if not data["terkirim"] and _idle(data):
+        del _chats[chat_id]
@@ -0,0 +1,78 @@
+# step_router.py
+import logging
+import time
+
+DEFAULT_STEP_TIMEOUT = 900   # detik; input yang datang setelah ini dianggap sesi basi
+
+# grup -> {nama_step: {"handler", "timeout", "cleanup"}}; grup memisahkan step user & admin
+_steps = {}
+# nama_step -> konfigurasi, untuk timeout/cleanup tanpa perlu tahu grupnya
+_semua_step = {}
+
+def register(nama_step, handler, grup="user", timeout=DEFAULT_STEP_TIMEOUT, cleanup=()):
+    """Daftarkan handler input teks untuk satu nama step (nilai context.user_data['next'])."""
+    config = {"handler": handler, "timeout": timeout, "cleanup": tuple(cleanup)}
+    _steps.setdefault(grup, {})[nama_step] = config
+    _semua_step[nama_step] = config
+
+def step(*nama_step, grup="user", timeout=DEFAULT_STEP_TIMEOUT, cleanup=()):
+    """Decorator versi register: @step("handle_x", "handle_x_alias", cleanup=("temp_key",))."""
+    def decorator(handler):
+        for nama in nama_step:
+            register(nama, handler, grup, timeout, cleanup)
+        return handler
+    return decorator
+
+def set_next(context, nama_step):
+    """Tandai step input berikutnya untuk user ini beserta waktu mulainya."""
+    context.user_data['next'] = nama_step
+    context.user_data['next_at'] = time.monotonic()
+
+def is_kedaluwarsa(user_data):
+    """True jika step aktif di user_data sudah melewati timeout-nya."""
+    nama_step = user_data.get('next')
+    if nama_step is None:
+        return False
+    config = _semua_step.get(nama_step)
+    timeout = config["timeout"] if config else DEFAULT_STEP_TIMEOUT
+    return time.monotonic() - user_data.get('next_at', time.monotonic()) > timeout
+
+def bersihkan(user_data, nama_step=None):
+    """Hapus step aktif beserta key sementara yang didaftarkan sebagai cleanup step tersebut."""
+    nama_step = nama_step or user_data.get('next')
+    user_data.pop('next', None)
+    user_data.pop('next_at', None)
+    config = _semua_step.get(nama_step)
+    if config:
+        for key in config["cleanup"]:
+            user_data.pop(key, None)
+
+def pop_next(user_data):
+    """Ambil step aktif dan lepaskan dari user_data; kembalikan (nama_step, kedaluwarsa)."""
+    nama_step = user_data.get('next')
+    kedaluwarsa = is_kedaluwarsa(user_data)
+    if kedaluwarsa:
+        bersihkan(user_data, nama_step)
+    else:
+        user_data.pop('next', None)
+        user_data.pop('next_at', None)
+    return nama_step, kedaluwarsa
+
+async def dispatch(update, context, nama_step, grup="user"):
+    """Jalankan handler step; False jika step tidak terdaftar di grup ini."""
+    config = _steps.get(grup, {}).get(nama_step)
+    if config is None:
+        return False
+    await config["handler"](update, context)
+    return True
+
+def sapu_kedaluwarsa(semua_user_data):
+    """Bersihkan step basi dari kumpulan user_data (mis. application.user_data.values()); kembalikan jumlahnya."""
+    jumlah = 0
+    for user_data in semua_user_data:
+        if 'next' in user_data and is_kedaluwarsa(user_data):
+            bersihkan(user_data)
+            jumlah += 1
+    if jumlah:
+        logging.info(f"{jumlah} step input kedaluwarsa dibersihkan.")
+    return jumlah
@@ -0,0 +1,61 @@
+# token_validity.py
+import logging
+import time
+from datetime import datetime
+
+import account_store
+import provider_client
+import retry_engine
+
+# Validasi access token sebelum saldo dipotong dan request pembelian dikirim, agar token kadaluarsa
+# ketahuan di awal (user diminta login ulang) dan bukan di tengah batch.
+PROBE_TTL = 300        # detik hasil probe subscriberinfo disimpan di cache
+SUKSES_TTL = 600       # token yang diterima upstream dalam rentang ini tidak perlu di-probe
+PROVIDER_PROBE = ("kmsp",)   # Hesda tidak punya endpoint ringan untuk cek token
+MAKS_CACHE = 2000
+
+# (phone, provider, access_token) -> (valid, waktu monotonic)
+_cache = {}
+
+
+def _simpan(kunci, valid):
+    if len(_cache) >= MAKS_CACHE:
+        batas = time.monotonic() - PROBE_TTL
+        for lama in [k for k, (_, waktu) in _cache.items() if waktu < batas]:
+            del _cache[lama]
+    _cache[kunci] = (valid, time.monotonic())
+
+def _baru_dipakai(phone, provider, access_token):
+    """True jika token baru saja diterima upstream dan belum melewati perkiraan umurnya."""
+    info = account_store.info_token(phone, provider, access_token)
+    if not info or info[1] is None:
+        return False
+    login, terakhir_sukses = info
+    sekarang = datetime.now()
+    if (sekarang - terakhir_sukses).total_seconds() > SUKSES_TTL:
+        return False
+    perkiraan = account_store.perkiraan_umur(provider)
+    return perkiraan is None or login is None or (sekarang - login).total_seconds() < perkiraan
+
+async def periksa(api_key, phone, provider, access_token):
+    """False jika upstream menolak token (token ditandai kedaluwarsa); True jika valid atau belum bisa dipastikan."""
+    kunci = (phone, provider, access_token)
+    tersimpan = _cache.get(kunci)
+    if tersimpan and time.monotonic() - tersimpan[1] < PROBE_TTL:
+        return tersimpan[0]
+    if provider not in PROVIDER_PROBE or _baru_dipakai(phone, provider, access_token):
+        return True
+
+    hasil = await provider_client.kmsp_get_json("subscriberinfo", api_key, access_token=access_token)
+    if hasil.get("status"):
+        account_store.tandai_sukses(phone, provider, access_token)
+        valid = True
+    elif retry_engine.is_pesan_token(hasil.get("message")):
+        account_store.tandai_ditolak(phone, provider, access_token)
+        valid = False
+    else:
+        # Upstream bermasalah: jangan blokir pembelian hanya karena probe gagal.
+        logging.info(f"Probe token {provider} untuk {phone} tidak meyakinkan: {hasil.get('message')}")
+        return True
+    _simpan(kunci, valid)
+    return valid
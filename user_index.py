@@ -0,0 +1,123 @@
+# user_index.py
+from bisect import bisect_left, insort
+
+# Indeks pencarian user untuk admin, disinkronkan dengan user_data["registered_users"]:
+# - username (huruf kecil, tanpa "@") -> user_id untuk lookup persis O(1)
+# - daftar terurut (teks, user_id) dari username & nama depan untuk pencarian awalan (bisect)
+# - trigram -> {user_id} untuk pencarian potongan teks (substring)
+KOSONG = ("", "n/a")
+BATAS_HASIL = 20
+
+_uid_per_username = {}
+_terurut = []
+_trigram = {}
+# user_id -> (username, first_name) yang sedang terindeks
+_terindeks = {}
+# Indeks dibangun saat pertama kali dipakai dari fungsi sumber (lihat atur_sumber), bukan saat startup.
+_sumber = None
+_terbangun = False
+
+
+def _normal(teks):
+    teks = (teks or "").strip().lower()
+    return "" if teks in KOSONG else teks
+
+def _normal_username(username):
+    return _normal(username).lstrip("@")
+
+def _trigram_dari(teks):
+    return {teks[i:i + 3] for i in range(len(teks) - 2)}
+
+def _teks_user(username, first_name):
+    return [teks for teks in (username, first_name) if teks]
+
+def atur_sumber(fungsi):
+    """fungsi() -> iterable (user_id, username, first_name) dari data tersimpan; dipanggil saat indeks pertama dipakai."""
+    global _sumber, _terbangun
+    _sumber = fungsi
+    _terbangun = False
+
+def _pastikan_terbangun():
+    if not _terbangun and _sumber is not None:
+        bangun(_sumber())
+
+def hapus(user_id):
+    """Keluarkan user dari indeks (user dihapus/diblokir)."""
+    if not _terbangun:
+        return
+    user_id = str(user_id)
+    lama = _terindeks.pop(user_id, None)
+    if lama is None:
+        return
+    username, first_name = lama
+    if username and _uid_per_username.get(username) == user_id:
+        del _uid_per_username[username]
+    for teks in _teks_user(username, first_name):
+        posisi = bisect_left(_terurut, (teks, user_id))
+        if posisi < len(_terurut) and _terurut[posisi] == (teks, user_id):
+            del _terurut[posisi]
+        for tri in _trigram_dari(teks):
+            anggota = _trigram.get(tri)
+            if anggota is not None:
+                anggota.discard(user_id)
+                if not anggota:
+                    del _trigram[tri]
+
+def perbarui(user_id, username, first_name):
+    """Indeks ulang satu user setelah /start atau perubahan profil; tanpa efek jika tidak ada yang berubah."""
+    if not _terbangun:
+        return
+    user_id = str(user_id)
+    baru = (_normal_username(username), _normal(first_name))
+    if _terindeks.get(user_id) == baru:
+        return
+    hapus(user_id)
+    _terindeks[user_id] = baru
+    if baru[0]:
+        _uid_per_username[baru[0]] = user_id
+    for teks in _teks_user(*baru):
+        insort(_terurut, (teks, user_id))
+        for tri in _trigram_dari(teks):
+            _trigram.setdefault(tri, set()).add(user_id)
+
+def bangun(baris):
+    """Bangun ulang seluruh indeks dari baris (user_id, username, first_name)."""
+    global _terbangun
+    _uid_per_username.clear()
+    _terurut.clear()
+    _trigram.clear()
+    _terindeks.clear()
+    _terbangun = True
+    for user_id, username, first_name in baris:
+        perbarui(user_id, username, first_name)
+
+def cari_username(username):
+    """user_id (str) pemilik username (tanpa beda huruf besar/kecil, boleh diawali "@"), atau None."""
+    _pastikan_terbangun()
+    return _uid_per_username.get(_normal_username(username))
+
+def cari(query, batas=BATAS_HASIL):
+    """user_id (str) yang username atau nama depannya memuat query, maksimal `batas` hasil."""
+    _pastikan_terbangun()
+    query = _normal_username(query)
+    if not query:
+        return []
+    if len(query) < 3:
+        # Terlalu pendek untuk trigram: cukup cocokkan awalan lewat daftar terurut.
+        hasil = []
+        posisi = bisect_left(_terurut, (query, ""))
+        while posisi < len(_terurut) and _terurut[posisi][0].startswith(query) and len(hasil) < batas:
+            if _terurut[posisi][1] not in hasil:
+                hasil.append(_terurut[posisi][1])
+            posisi += 1
+        return hasil
+    kandidat = None
+    for tri in sorted(_trigram_dari(query), key=lambda t: len(_trigram.get(t, ()))):
+        anggota = _trigram.get(tri)
+        if not anggota:
+            return []
+        kandidat = set(anggota) if kandidat is None else kandidat & anggota
+        if not kandidat:
+            return []
+    cocok = [uid for uid in kandidat if any(query in teks for teks in _teks_user(*_terindeks[uid]))]
+    return sorted(cocok, key=lambda uid: (not _terindeks[uid][0].startswith(query), _terindeks[uid]))[:batas]
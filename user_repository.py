@@ -0,0 +1,182 @@
+# user_repository.py
+import json
+import logging
+import sqlite3
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+CACHE_KAPASITAS = 5000   # jumlah user maksimal yang disimpan di memori
+
+KOLOM_JSON = {"accounts": "{}", "selected_hesdapkg_ids": "[]", "selected_30h_pkg_ids": "[]"}
+KOLOM_USER = ("first_name", "username", "balance") + tuple(KOLOM_JSON)
+
+
+class DataUser(dict):
+    """Dict data satu user; subclass agar bisa direferensikan lewat weakref setelah keluar dari cache."""
+
+
+def siapkan_tabel(cursor):
+    """Tambahkan kolom `extra` (key data user di luar kolom baku, mis. current_phone) jika belum ada."""
+    cursor.execute("PRAGMA table_info(users)")
+    if 'extra' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE users ADD COLUMN extra TEXT DEFAULT '{}'")
+
+
+class UserRepository(MutableMapping):
+    """Pengganti dict registered_users: user dimuat dari SQLite saat dibutuhkan ke cache LRU terbatas.
+
+    Perubahan tetap dicatat lewat set `kotor` (tandai_user_berubah) dan ditulis oleh simpan_data_ke_db;
+    user kotor yang keluar dari cache ditulis lebih dulu (write-back). User yang masih direferensikan
+    handler setelah keluar dari cache tetap dikembalikan sebagai objek yang sama.
+    """
+
+    def __init__(self, db_file, kotor, kapasitas=CACHE_KAPASITAS):
+        self.db_file = db_file
+        self.kotor = kotor
+        self.kapasitas = kapasitas
+        self._cache = OrderedDict()
+        self._terlepas = weakref.WeakValueDictionary()
+        self._dihapus = set()
+        self._jumlah = None
+
+    def _muat(self, user_id):
+        data = self._terlepas.pop(user_id, None)
+        if data is None:
+            conn = sqlite3.connect(self.db_file)
+            try:
+                row = conn.execute(
+                    f"SELECT {', '.join(KOLOM_USER)}, extra FROM users WHERE id = ?", (int(user_id),)
+                ).fetchone()
+            finally:
+                conn.close()
+            if row is None:
+                return None
+            data = DataUser(json.loads(row[-1] or '{}'))
+            for kolom, nilai in zip(KOLOM_USER, row):
+                data[kolom] = json.loads(nilai or KOLOM_JSON[kolom]) if kolom in KOLOM_JSON else nilai
+        self._simpan_ke_cache(user_id, data)
+        return data
+
+    def _simpan_ke_cache(self, user_id, data):
+        self._cache[user_id] = data
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.kapasitas:
+            lama_id, lama = self._cache.popitem(last=False)
+            if lama_id in self.kotor:
+                self._tulis_satu(lama_id, lama)
+            self._terlepas[lama_id] = lama
+
+    def _tulis_satu(self, user_id, data):
+        conn = sqlite3.connect(self.db_file)
+        try:
+            self.tulis(conn.cursor(), [user_id], {user_id: data})
+            conn.commit()
+            self.kotor.discard(user_id)
+        except sqlite3.Error as e:
+            logging.error(f"Gagal write-back user {user_id} yang keluar dari cache: {e}")
+        finally:
+            conn.close()
+
+    def _baris(self, user_id, data):
+        extra = {k: v for k, v in data.items() if k not in KOLOM_USER}
+        return (
+            int(user_id),
+            data.get('first_name', 'N/A'),
+            data.get('username', 'N/A'),
+            data.get('balance', 0),
+            json.dumps(data.get('accounts', {})),
+            json.dumps(data.get('selected_hesdapkg_ids', [])),
+            json.dumps(data.get('selected_30h_pkg_ids', [])),
+            json.dumps(extra, default=lambda _: None)
+        )
+
+    def tulis(self, cursor, user_ids, sumber=None):
+        """Tulis (atau hapus) baris user_ids memakai cursor milik pemanggil; commit dilakukan pemanggil."""
+        for user_id in user_ids:
+            data = (sumber or {}).get(user_id)
+            if data is None:
+                data = self._cache.get(user_id)
+            if data is None:
+                data = self._terlepas.get(user_id)
+            if user_id in self._dihapus or data is None:
+                cursor.execute("DELETE FROM users WHERE id = ?", (int(user_id),))
+                continue
+            # balance hanya diisi saat baris dibuat; setelah itu kolom ini milik balance_ledger.
+            cursor.execute(f'''
+            INSERT INTO users (id, {', '.join(KOLOM_USER)}, extra)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET {', '.join(f'{k} = excluded.{k}' for k in KOLOM_USER + ('extra',) if k != 'balance')}
+            ''', self._baris(user_id, data))
+
+    def selesai_tulis(self, user_ids):
+        """Dipanggil setelah commit berhasil: user yang dihapus sudah hilang dari DB."""
+        self._dihapus.difference_update(user_ids)
+
+    def __getitem__(self, user_id):
+        user_id = str(user_id)
+        if user_id in self._dihapus:
+            raise KeyError(user_id)
+        data = self._cache.get(user_id)
+        if data is not None:
+            self._cache.move_to_end(user_id)
+            return data
+        data = self._muat(user_id)
+        if data is None:
+            raise KeyError(user_id)
+        return data
+
+    def __contains__(self, user_id):
+        try:
+            self[user_id]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, user_id, data):
+        user_id = str(user_id)
+        baru = user_id not in self
+        if not isinstance(data, DataUser):
+            data = DataUser(data)
+        self._dihapus.discard(user_id)
+        self._terlepas.pop(user_id, None)
+        self._simpan_ke_cache(user_id, data)
+        self.kotor.add(user_id)
+        if baru and self._jumlah is not None:
+            self._jumlah += 1
+
+    def setdefault(self, user_id, default=None):
+        # Versi MutableMapping mengembalikan `default` apa adanya, bukan DataUser yang tersimpan di cache.
+        try:
+            return self[user_id]
+        except KeyError:
+            self[user_id] = default if default is not None else {}
+            return self[user_id]
+
+    def __delitem__(self, user_id):
+        user_id = str(user_id)
+        if user_id not in self:
+            raise KeyError(user_id)
+        self._cache.pop(user_id, None)
+        self._terlepas.pop(user_id, None)
+        self._dihapus.add(user_id)
+        self.kotor.add(user_id)
+        if self._jumlah is not None:
+            self._jumlah -= 1
+
+    def _id_di_db(self):
+        conn = sqlite3.connect(self.db_file)
+        try:
+            return {str(row[0]) for row in conn.execute("SELECT id FROM users")}
+        finally:
+            conn.close()
+
+    def __iter__(self):
+        # Scan penuh (dipakai admin/broadcast): gabungkan ID di DB dengan user baru yang belum ditulis.
+        semua = (self._id_di_db() | set(self._cache)) - self._dihapus
+        return iter(sorted(semua, key=int))
+
+    def __len__(self):
+        if self._jumlah is None:
+            self._jumlah = len((self._id_di_db() | set(self._cache)) - self._dihapus)
+        return self._jumlah